@@ -11,6 +11,14 @@ import httpx
 from httpx import HTTPError, TimeoutException
 from woocommerce import API
 from oid_utils import make_oid, site_id_for_source  # cross-site-safe surrogate order id
+import order_index  # 派生 year_month/day 列，upsert 时同步维护
+import order_search  # orders_fts 全文搜索文档，upsert 时重建
+import order_tracking  # 提取后的运单号表，upsert 时重建
+import identity_graph  # 客户身份图（邮箱/电话/地址聚类），upsert 时增量更新
+import customer_stats  # 客户统计（按身份聚合），upsert 时登记待刷新客户
+import wc_outbox  # 待推送到 WC 的写回队列：同步时保留其本地状态
+import shipping_view  # 发货队列展示字段（地址/商品/风险键），upsert 时重建
+import customer_risk  # 风险客户匹配键（已退回/问题退货订单的邮箱/电话/地址），upsert 时刷新
 
 # 添加代理配置（如果需要使用代理）
 PROXY_CONFIG = {
@@ -186,12 +194,28 @@ def create_orders_table():
             refunds TEXT,
             set_paid INTEGER,
             source TEXT,
+            year_month TEXT,
+            day TEXT,
             created_at TEXT DEFAULT CURRENT_TIMESTAMP,
             updated_at TEXT DEFAULT CURRENT_TIMESTAMP
         )
         """
         cursor.execute(create_table_query)
         connection.commit()
+        # 旧库补齐 year_month/day 列及索引（月份页按它们做可走索引的过滤）
+        order_index.ensure_schema(connection)
+        # 订单搜索全文索引（首次运行会给已有订单补建文档）
+        order_search.ensure_schema(connection)
+        # 运单号提取表（首次运行会给已有订单补提取）
+        order_tracking.ensure_schema(connection)
+        shipping_view.ensure_schema(connection)
+        customer_risk.ensure_schema(connection)
+        # 客户身份图（首次运行会从全部订单建图）
+        identity_graph.ensure_schema(connection)
+        # 客户统计表（首次运行登记全部客户，由网页端折算）
+        customer_stats.ensure_schema(connection)
+        # WC 写回队列（网页端/定时任务的状态修改在推送成功前保存在这里）
+        wc_outbox.ensure_schema(connection)
         print("订单表创建成功或已存在")
     except Exception as e:
         print(f"创建订单表时出错: {e}")
@@ -445,6 +469,11 @@ def archive_orphaned_orders(site_url, remote_ids):
             [now_iso, 'orphaned_remote_deleted', site_url] + orphan_params,
         )
         archived = cursor.rowcount
+        order_index.bump_order_months(connection, orphan_params)  # 删除前先记下所在月份
+        order_search.remove_orders(connection, orphan_params)
+        order_tracking.remove_orders(connection, orphan_params)
+        shipping_view.remove_orders(connection, orphan_params)
+        customer_stats.mark_orders(connection, orphan_params, identity_graph.remove_orders(connection, orphan_params))
         cursor.execute(
             f"DELETE FROM orders WHERE source = ? AND id IN ({placeholders})",
             [site_url] + orphan_params,
@@ -498,7 +527,8 @@ def save_orders_to_db(orders_data):
         # woo_id keeps the raw per-site WC post id; id is the cross-site-safe
         # surrogate "<sites.id>-<woo_id>" (see oid_utils.py) so same-numbered
         # orders from different stores no longer collide under ON CONFLICT(id).
-        all_columns = wc_fields + ['woo_id', 'updated_at']
+        # year_month / day：月份/日期分桶的索引列（见 order_index.py），随 date_created 一起写入
+        all_columns = wc_fields + ['woo_id', 'year_month', 'day', 'updated_at']
         placeholders = ', '.join(['?'] * len(all_columns))
         update_set = ', '.join(f'{c} = excluded.{c}' for c in all_columns if c != 'id')
         insert_query = f"""
@@ -542,14 +572,29 @@ def save_orders_to_db(orders_data):
                 else:
                     processed_order.append(value)
 
-            # 添加 woo_id 与 updated_at 字段
+            # 添加 woo_id、year_month/day 与 updated_at 字段
             processed_order.append(woo_id)
+            processed_order.extend(order_index.date_keys(order.get('date_created')))
             processed_order.append(datetime.now().isoformat())
 
             processed_orders.append(tuple(processed_order))
         
+        # 只有新增/确有修改(date_modified 变化)的订单所在月份才递增数据版本（见 order_index.py）
+        dm_idx, ym_idx = all_columns.index('date_modified'), all_columns.index('year_month')
+        changed_months = order_index.changed_upsert_months(
+            connection, [(row[0], row[dm_idx], row[ym_idx]) for row in processed_orders])
+
         # 批量插入数据
         cursor.executemany(insert_query, processed_orders)
+        # 写回队列里还没推送到 WC 的状态修改：保留本地状态，不被刚拉回的旧状态覆盖
+        wc_outbox.reapply_pending(connection, [row[0] for row in processed_orders])
+        order_index.bump_versions(connection, [order_index.orders_scope(m) for m in changed_months])
+        order_search.index_orders(connection, [row[0] for row in processed_orders])
+        order_tracking.refresh_orders(connection, [row[0] for row in processed_orders])
+        shipping_view.refresh_orders(connection, [row[0] for row in processed_orders])
+        customer_risk.refresh_orders(connection, [row[0] for row in processed_orders])
+        reclustered = identity_graph.refresh_orders(connection, [row[0] for row in processed_orders])
+        customer_stats.mark_orders(connection, [row[0] for row in processed_orders], reclustered)
         connection.commit()
         print(f"已保存 {len(processed_orders)} 个订单到SQLite数据库")
         
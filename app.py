@@ -5,6 +5,9 @@ Flask application with user authentication and data visualization
 import sqlite3
 import json
 import html
+import threading
+import hashlib
+import bisect
 from datetime import datetime
 from functools import wraps
 
@@ -12,6 +15,30 @@ from flask import Flask, render_template, render_template_string, request, redir
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from oid_utils import woo_post_id  # cross-site-safe WC post id for REST calls
 import blocklist  # customer blocklist: auto-cancel COD orders from blacklisted phones
+import order_index  # indexed year_month/day buckets maintained at upsert
+import order_search  # FTS5 order search documents maintained at upsert / ship / mark
+import order_tracking  # extracted tracking numbers maintained at upsert / ship
+import latest_note  # orders.latest_note_id pointers maintained by every note writer
+import identity_graph  # persisted email/phone/address identity clusters maintained at upsert
+import customer_stats  # per-identity customer aggregates behind /customers
+import view_cache  # version-keyed page / summary cache (memory LRU + shared SQLite file)
+import site_traffic  # stored per-day 51.la traffic behind /report
+import wc_catalog  # local WC product / variation mirror behind /product-manager
+import link_check  # remembered liveness of remote media URLs (clone / image repair)
+import wc_outbox  # durable queue of WooCommerce write-backs (status / notes / shipments)
+import customer_risk  # customer_risk_keys of flagged orders, also refreshed at sync upsert
+from identity_graph import (  # key normalizers shared with the sync writers
+    normalize_email as _normalize_email,
+    normalize_phone as _normalize_phone,
+    normalize_address as _normalize_address,
+    addr_for_order as _addr_for_order,
+)
+import shipping_view  # precomputed shipping-queue display fields maintained at upsert
+import site_profile  # cached per-site tracking format / carriers behind the ship modal
+from shipping_view import (  # address / custom-field helpers shared with the sync writers
+    compose_address as _compose_address,
+    extract_custom_billing_fields,
+)
 from werkzeug.security import generate_password_hash, check_password_hash
 import pandas as pd
 
@@ -300,124 +327,40 @@ def parse_json_field(value):
 # false-positive different households sharing one apartment block. See
 # _build_risk_index / _assess_customer_risk below.
 
-def _normalize_email(e):
-    s = (e or '').strip().lower()
-    return s or None
-
-
-def _is_placeholder_phone(digits):
-    """True for obviously-fake numbers people type to bypass a required field:
-    all-same-digit (000000000), or a straight ascending/descending run
-    (123456789 / 987654321). These must never link unrelated customers."""
-    if not digits:
-        return True
-    if len(set(digits)) <= 1:
-        return True
-    if len(digits) >= 6:
-        diffs = {int(digits[i + 1]) - int(digits[i]) for i in range(len(digits) - 1)}
-        if diffs == {1} or diffs == {-1}:
-            return True
-    return False
-
-
-def _normalize_phone(p):
-    """Keep digits only; collapse to the last 9 digits to fold away the
-    PL +48 / AU +61 / AE +971 country codes that customers add inconsistently.
-    Returns None if there's no plausible phone number left, or if it's an
-    obvious placeholder (so it can't merge / flag unrelated people)."""
-    digits = ''.join(c for c in (p or '') if c.isdigit())
-    if len(digits) < 7:  # too short to be a real number
-        return None
-    canonical = digits[-9:] if len(digits) >= 9 else digits
-    if _is_placeholder_phone(canonical) or _is_placeholder_phone(digits):
-        return None
-    return canonical
-
-
-def _normalize_address(addr_dict):
-    """Build a tight match key from address_1 + postcode + city. All
-    lowercase, whitespace collapsed. Returns None when too sparse to be
-    a useful match (a country code alone isn't a customer)."""
-    if not isinstance(addr_dict, dict):
-        return None
-    import re as _re
-    a1 = _re.sub(r'\s+', ' ', (addr_dict.get('address_1') or '').strip().lower())
-    pc = (addr_dict.get('postcode') or '').strip().replace(' ', '').lower()
-    city = _re.sub(r'\s+', ' ', (addr_dict.get('city') or '').strip().lower())
-    parts = [p for p in (a1, pc, city) if p]
-    if len(parts) < 2 or not a1:
-        return None
-    return ' | '.join(parts)
-
-
-def _addr_for_order(billing, shipping):
-    """Pick the more complete of (shipping, billing) for matching."""
-    if isinstance(shipping, dict) and shipping.get('address_1'):
-        return shipping
-    return billing if isinstance(billing, dict) else {}
-
-
-def _compose_address(addr, sep=', '):
-    """Compose a human-readable shipping address from a billing/shipping dict.
-
-    The locality line is "City State Postcode" (e.g. "Brassall QLD 4305") so the
-    destination state is always shown. It used to be dropped from every shipping
-    view, which made AU/US parcels ambiguous — the same suburb name recurs across
-    states, and packers/carriers need the state to route correctly. Polish (DPD/
-    InPost) addresses simply have no state, so it falls away cleanly there."""
-    if not isinstance(addr, dict):
-        return ''
-    locality = ' '.join(p for p in (
-        (addr.get('city') or '').strip(),
-        (addr.get('state') or '').strip(),
-        (addr.get('postcode') or '').strip(),
-    ) if p)
-    parts = [
-        (addr.get('address_1') or '').strip(),
-        (addr.get('address_2') or '').strip(),
-        locality,
-        (addr.get('country') or '').strip(),
-    ]
-    return sep.join(p for p in parts if p)
-
-
-# AU postcode -> expected state (Australia Post ranges). Checkout's state
-# dropdown is customer-chosen and never validated by WC, so e.g. Perth+6000
-# can arrive with state=ACT. Gray-zone ranges list every state they can
-# legitimately belong to, so only impossible combinations get flagged.
-_AU_POSTCODE_STATES = (
-    ((200, 299), {'ACT'}), ((800, 999), {'NT'}),
-    ((1000, 2599), {'NSW'}), ((2600, 2620), {'ACT', 'NSW'}),
-    ((2621, 2899), {'NSW'}), ((2900, 2920), {'ACT', 'NSW'}),
-    ((2921, 2999), {'NSW'}), ((3000, 3999), {'VIC'}),
-    ((4000, 4999), {'QLD'}), ((5000, 5999), {'SA'}),
-    ((6000, 6999), {'WA'}), ((7000, 7999), {'TAS'}),
-    ((8000, 8999), {'VIC'}), ((9000, 9999), {'QLD'}),
-)
-
-
-def _au_state_mismatch(addr):
-    """Return the expected AU state code(s) ('WA' / 'ACT/NSW') when the chosen
-    state cannot contain the postcode; None when consistent or not checkable."""
-    if not isinstance(addr, dict) or (addr.get('country') or '').upper() != 'AU':
-        return None
-    state = (addr.get('state') or '').strip().upper()
-    pc_raw = (addr.get('postcode') or '').strip()
-    if not state or not pc_raw.isdigit():
-        return None
-    pc = int(pc_raw)
-    if pc == 872:  # tri-state remote zone (NT/SA/WA), never flag
-        return None
-    for (lo, hi), states in _AU_POSTCODE_STATES:
-        if lo <= pc <= hi:
-            return None if state in states else '/'.join(sorted(states))
-    return None
+# _normalize_email / _normalize_phone / _normalize_address / _addr_for_order
+# come from identity_graph.py (imported at the top) so the sync writers
+# derive the same keys for the persisted identity graph. _compose_address and
+# extract_custom_billing_fields come from shipping_view.py for the same reason
+# (shipping_view rows are derived at sync time).
+
+
+# Normalized email / phone / address keys of every flagged order live in
+# customer_risk_keys (customer_risk.py; kept by the mark / unmark endpoints
+# through _refresh_risk_keys and by the sync upsert when a flagged order's
+# address changes), so the shipping lists no longer re-parse and re-normalize
+# all flagged orders on every poll. The assembled index is cached per process
+# and stamped with the 'customer_risk' data version; another worker's
+# mark/unmark or sync bumps it and the next request reloads.
+RISK_KEYS_SCOPE = customer_risk.SCOPE
+_risk_index_cache = None  # (version, index)
+
+
+def _refresh_risk_keys(conn, order_ids):
+    """Re-derive customer_risk_keys for the given orders after their
+    undelivered / problem-return flags changed, and bump the risk version
+    (the flag change alters the index even when the keys stay the same).
+    Orders no longer flagged just lose their keys. Does not commit."""
+    order_ids = [str(i) for i in order_ids if i is not None]
+    if not order_ids:
+        return
+    customer_risk.refresh_orders(conn, order_ids)
+    order_index.bump_versions(conn, [RISK_KEYS_SCOPE])
 
 
 def _build_risk_index(conn):
-    """Scan every order that's been flagged as a problem-return or undelivered
-    and group them by normalized email / phone / address. Each bucket lists
-    the matching orders so the consumer can dedupe and aggregate.
+    """Group every order that's been flagged as a problem-return or undelivered
+    by normalized email / phone / address. Each bucket lists the matching
+    orders so the consumer can dedupe and aggregate.
 
     Returned shape:
         {
@@ -425,55 +368,68 @@ def _build_risk_index(conn):
           'undeliv': {'email': {...}, 'phone': {...}, 'addr': {...}},
         }
     rec = {order_id, number, source, at, loss, type}
+
+    Served from the per-process cache while the 'customer_risk' version is
+    unchanged; otherwise rebuilt from customer_risk_keys joined to the
+    flagged orders (no JSON parsing). Callers only read the result.
     """
+    global _risk_index_cache
+    try:
+        version = order_index.get_versions(conn, [RISK_KEYS_SCOPE])[RISK_KEYS_SCOPE]
+    except Exception:
+        version = None
+    cached = _risk_index_cache
+    if cached is not None and version is not None and cached[0] == version:
+        return cached[1]
+
     out = {
         'problem': {'email': {}, 'phone': {}, 'addr': {}},
         'undeliv': {'email': {}, 'phone': {}, 'addr': {}},
     }
     try:
         rows = conn.execute("""
-            SELECT id, number, billing, shipping, source,
-                   is_problem_return, problem_return_type, product_loss_amount, problem_return_at,
-                   is_undelivered, shipping_loss_amount, undelivered_at
-            FROM orders
-            WHERE COALESCE(is_problem_return,0) = 1 OR COALESCE(is_undelivered,0) = 1
+            SELECT k.key_type, k.key,
+                   o.id, o.number, o.source,
+                   o.is_problem_return, o.problem_return_type, o.product_loss_amount, o.problem_return_at,
+                   o.is_undelivered, o.shipping_loss_amount, o.undelivered_at
+            FROM customer_risk_keys k
+            JOIN orders o ON o.id = k.order_id
+            WHERE COALESCE(o.is_problem_return,0) = 1 OR COALESCE(o.is_undelivered,0) = 1
+            ORDER BY o.rowid
         """).fetchall()
     except Exception:
         return out
 
+    problem_recs = {}
+    undeliv_recs = {}
     for r in rows:
-        billing = parse_json_field(r['billing']) or {}
-        shipping = parse_json_field(r['shipping']) or {}
-        addr_d = _addr_for_order(billing, shipping)
-        email = _normalize_email(billing.get('email') or shipping.get('email'))
-        phone = _normalize_phone(addr_d.get('phone') or billing.get('phone'))
-        addr_key = _normalize_address(addr_d)
-
         if r['is_problem_return']:
-            rec = {
-                'order_id': r['id'],
-                'number': r['number'],
-                'source': r['source'],
-                'at': r['problem_return_at'],
-                'loss': float(r['product_loss_amount'] or 0),
-                'type': r['problem_return_type'] or '',
-            }
-            if email: out['problem']['email'].setdefault(email, []).append(rec)
-            if phone: out['problem']['phone'].setdefault(phone, []).append(rec)
-            if addr_key: out['problem']['addr'].setdefault(addr_key, []).append(rec)
+            rec = problem_recs.get(r['id'])
+            if rec is None:
+                rec = problem_recs[r['id']] = {
+                    'order_id': r['id'],
+                    'number': r['number'],
+                    'source': r['source'],
+                    'at': r['problem_return_at'],
+                    'loss': float(r['product_loss_amount'] or 0),
+                    'type': r['problem_return_type'] or '',
+                }
+            out['problem'][r['key_type']].setdefault(r['key'], []).append(rec)
         if r['is_undelivered']:
-            rec = {
-                'order_id': r['id'],
-                'number': r['number'],
-                'source': r['source'],
-                'at': r['undelivered_at'],
-                'loss': float(r['shipping_loss_amount'] or 0),
-                'type': '',
-            }
-            if email: out['undeliv']['email'].setdefault(email, []).append(rec)
-            if phone: out['undeliv']['phone'].setdefault(phone, []).append(rec)
-            if addr_key: out['undeliv']['addr'].setdefault(addr_key, []).append(rec)
+            rec = undeliv_recs.get(r['id'])
+            if rec is None:
+                rec = undeliv_recs[r['id']] = {
+                    'order_id': r['id'],
+                    'number': r['number'],
+                    'source': r['source'],
+                    'at': r['undelivered_at'],
+                    'loss': float(r['shipping_loss_amount'] or 0),
+                    'type': '',
+                }
+            out['undeliv'][r['key_type']].setdefault(r['key'], []).append(rec)
 
+    if version is not None:
+        _risk_index_cache = (version, out)
     return out
 
 
@@ -481,12 +437,14 @@ def _build_risk_index(conn):
 _RISK_UNDELIVERED_THRESHOLD = 2
 
 
-def _assess_customer_risk(billing, shipping, idx, current_order_id=None):
+def _assess_customer_risk(billing, shipping, idx, current_order_id=None, keys=None):
     """Look up this customer in the risk index across email/phone/addr and
     return a risk dict, or None if no prior risky history is found.
 
     The current order itself is excluded by id so a freshly-marked order
-    doesn't flag its own self.
+    doesn't flag its own self. keys: precomputed (email, phone, addr) keys
+    (shipping_view email_key / phone_key / addr_key); billing / shipping are
+    not looked at then.
 
     Returns:
         {
@@ -504,14 +462,14 @@ def _assess_customer_risk(billing, shipping, idx, current_order_id=None):
     if not idx:
         return None
 
-    billing = billing or {}
-    shipping = shipping or {}
-    addr_d = _addr_for_order(billing, shipping)
-    email = _normalize_email(billing.get('email') or shipping.get('email'))
-    phone = _normalize_phone(addr_d.get('phone') or billing.get('phone'))
-    addr_key = _normalize_address(addr_d)
-
-    keys = [('email', email), ('phone', phone), ('address', addr_key)]
+    if keys is None:
+        billing = billing or {}
+        shipping = shipping or {}
+        addr_d = _addr_for_order(billing, shipping)
+        keys = (_normalize_email(billing.get('email') or shipping.get('email')),
+                _normalize_phone(addr_d.get('phone') or billing.get('phone')),
+                _normalize_address(addr_d))
+    keys = list(zip(('email', 'phone', 'address'), keys))
 
     p_matched, p_via = _collect_in_indices(idx['problem'], keys, current_order_id)
     u_matched, u_via = _collect_in_indices(idx['undeliv'], keys, current_order_id)
@@ -567,15 +525,9 @@ def _collect_in_indices(category_idx, keys, current_order_id):
     return matched, via
 
 
-# A phone / address shared by MORE distinct emails than this is treated as
-# non-identifying (placeholder number like 123456789, a shared web form, an
-# apartment block) and will NOT merge identities. Email is always trusted.
-_IDENTITY_SHARED_KEY_LIMIT = 4
-
-
 def _resolve_identity_clusters(conn, where_clause, params):
-    """Entity resolution over the customer base: union emails that belong to
-    the same person, linked by a shared phone number or delivery address.
+    """Entity resolution over the customer base: emails that belong to the
+    same person, linked by a shared phone number or delivery address.
 
     Returns a tuple (email_to_cluster, cluster_meta):
       email_to_cluster: {normalized_email: cluster_key}
@@ -584,86 +536,38 @@ def _resolve_identity_clusters(conn, where_clause, params):
     The cluster_key is the lexicographically-smallest email in the cluster
     (stable across requests). Emails that share nothing form singleton clusters.
 
-    Over-merge guard: phone/address keys linked to more than
-    _IDENTITY_SHARED_KEY_LIMIT distinct emails are dropped before unioning.
+    Clusters come from the persisted identity graph (identity_graph.py), which
+    the writers keep current — no JSON decode or union-find per request. They
+    are global: two in-scope emails linked through an order outside the scope
+    still count as one person. emails / phones / addrs only list what the
+    in-scope orders (where_clause over orders) carry.
     """
-    rows = conn.execute(
-        f"SELECT billing, shipping FROM orders {where_clause}", params
-    ).fetchall()
+    rows = conn.execute(f"""
+        SELECT DISTINCT k.email, k.phone, k.addr
+        FROM orders JOIN identity_keys k ON k.order_id = orders.id
+        {where_clause}
+    """, params).fetchall()
 
     email_keys = {}     # email -> {'phones': set, 'addrs': set}
-    phone_emails = {}   # phone -> set(emails)
-    addr_emails = {}    # addr  -> set(emails)
     for r in rows:
-        b = parse_json_field(r['billing']) or {}
-        s = parse_json_field(r['shipping']) or {}
-        ad = _addr_for_order(b, s)
-        e = _normalize_email(b.get('email') or s.get('email'))
-        if not e:
-            continue
-        p = _normalize_phone(ad.get('phone') or b.get('phone'))
-        ak = _normalize_address(ad)
-        ek = email_keys.setdefault(e, {'phones': set(), 'addrs': set()})
-        if p:
-            ek['phones'].add(p)
-            phone_emails.setdefault(p, set()).add(e)
-        if ak:
-            ek['addrs'].add(ak)
-            addr_emails.setdefault(ak, set()).add(e)
-
-    good_phone = {p for p, es in phone_emails.items() if len(es) <= _IDENTITY_SHARED_KEY_LIMIT}
-    good_addr = {a for a, es in addr_emails.items() if len(es) <= _IDENTITY_SHARED_KEY_LIMIT}
-
-    # Union-Find over emails.
-    parent = {}
-
-    def find(x):
-        parent.setdefault(x, x)
-        root = x
-        while parent[root] != root:
-            root = parent[root]
-        while parent[x] != root:  # path compression
-            parent[x], x = root, parent[x]
-        return root
-
-    def union(a, b):
-        ra, rb = find(a), find(b)
-        if ra == rb:
-            return
-        if rb < ra:
-            ra, rb = rb, ra
-        parent[rb] = ra
-
-    for e in email_keys:
-        find(e)
-
-    matched_via = {}  # email -> set of reasons it got merged ('phone'/'address')
-    for p, es in phone_emails.items():
-        if p not in good_phone or len(es) < 2:
-            continue
-        es = list(es)
-        for other in es[1:]:
-            union(es[0], other)
-        for e in es:
-            matched_via.setdefault(e, set()).add('phone')
-    for a, es in addr_emails.items():
-        if a not in good_addr or len(es) < 2:
-            continue
-        es = list(es)
-        for other in es[1:]:
-            union(es[0], other)
-        for e in es:
-            matched_via.setdefault(e, set()).add('address')
-
-    email_to_cluster = {e: find(e) for e in email_keys}
+        ek = email_keys.setdefault(r['email'], {'phones': set(), 'addrs': set()})
+        if r['phone']:
+            ek['phones'].add(r['phone'])
+        if r['addr']:
+            ek['addrs'].add(r['addr'])
+
+    clusters = identity_graph.clusters_for(conn, email_keys)
+    email_to_cluster = {}
     cluster_meta = {}
-    for e, ck in email_to_cluster.items():
+    for e, keys in email_keys.items():
+        ck, matched_by = clusters.get(e, (e, set()))
+        email_to_cluster[e] = ck
         m = cluster_meta.setdefault(ck, {'emails': set(), 'phones': set(),
                                          'addrs': set(), 'matched_by': set()})
         m['emails'].add(e)
-        m['phones'] |= email_keys[e]['phones']
-        m['addrs'] |= email_keys[e]['addrs']
-        m['matched_by'] |= matched_via.get(e, set())
+        m['phones'] |= keys['phones']
+        m['addrs'] |= keys['addrs']
+        m['matched_by'] |= matched_by
     return email_to_cluster, cluster_meta
 
 
@@ -1014,6 +918,88 @@ def get_all_exchange_rates():
     return [dict(r) for r in rates]
 
 
+# Conditional GET for the polled JSON APIs (dashboard charts, reconciliation,
+# shipping list, product stats, sales-board lookups). Every writer bumps a
+# data_versions scope and order_index.bump_versions moves the global 'all'
+# counter with it, so (endpoint, args, user, day, 'all' version) identifies a
+# response. An unchanged re-poll is answered 304 after one primary-key lookup,
+# before the view touches orders. The day is part of the tag because several
+# views are relative to today (aging, "last N days", current month).
+# The version is read BEFORE the view runs: a write landing mid-request makes
+# the next poll miss, never serves stale data.
+ETAG_FORMAT = 1
+
+
+def _response_etag(conn):
+    version = order_index.get_versions(conn, [order_index.GLOBAL_SCOPE])[order_index.GLOBAL_SCOPE]
+    key = [ETAG_FORMAT, request.endpoint, request.view_args,
+           sorted(request.args.items(multi=True)),
+           current_user.id if current_user.is_authenticated else None,
+           getattr(current_user, 'role', None),
+           datetime.now().strftime('%Y-%m-%d'), version]
+    return hashlib.sha1(json.dumps(key, default=str, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def conditional_json(f):
+    """Decorator: ETag / If-None-Match on a read-only JSON GET.
+
+    Put it below the login / permission decorators so a denied request never
+    gets a tag. Non-200 responses (errors) are passed through untagged.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if request.method != 'GET':
+            return f(*args, **kwargs)
+        conn = get_db_connection()
+        try:
+            etag = _response_etag(conn)
+        except sqlite3.OperationalError:
+            etag = None  # data_versions not created yet
+        finally:
+            conn.close()
+        if etag and etag in request.if_none_match:
+            resp = make_response('', 304)
+        else:
+            resp = make_response(f(*args, **kwargs))
+            if resp.status_code != 200 or not etag:
+                return resp
+        resp.set_etag(etag)
+        resp.headers['Cache-Control'] = 'private, no-cache'
+        return resp
+    return decorated_function
+
+
+# Version-keyed cache of the heavy page contexts and summary payloads (see
+# view_cache.py). Keyed like the ETag above, but on the user's allowed
+# sources instead of the user, so managers who see the same sites share
+# entries. VIEW_CACHE_DB is the file the gunicorn workers share (None keeps
+# the cache per process).
+VIEW_CACHE_DB = 'view_cache.db'
+
+
+def _cached_view(name, build, *scope):
+    """build() served from view_cache, keyed by (name, request args, the
+    user's allowed sources, extra scope values, today, global version).
+
+    Only for views whose output depends on nothing else per user; anything
+    read live (or per user) stays outside build().
+    """
+    conn = get_db_connection()
+    try:
+        version = order_index.get_versions(conn, [order_index.GLOBAL_SCOPE])[order_index.GLOBAL_SCOPE]
+    except sqlite3.OperationalError:
+        version = None  # data_versions not created yet
+    finally:
+        conn.close()
+    if version is None:
+        return build()
+    allowed = get_user_allowed_sources(current_user.id, current_user.is_admin(), current_user.is_viewer())
+    key = view_cache.make_key(name, version, sorted(request.args.items(multi=True)),
+                              sorted(allowed) if allowed is not None else None, list(scope),
+                              datetime.now().strftime('%Y-%m-%d'))
+    return view_cache.get_or_build(name, version, key, build)
+
+
 def admin_required(f):
     """Decorator to require admin role"""
     from functools import wraps
@@ -1476,6 +1462,16 @@ def logout():
 @login_required
 def dashboard():
     """Main dashboard with statistics"""
+    context = _cached_view('dashboard', _dashboard_context)
+    # Read live: api_status is written by the API checks, which bump no version.
+    conn = get_db_connection()
+    api_error_sites = conn.execute("SELECT url FROM sites WHERE api_status = 'error'").fetchall()
+    conn.close()
+    return render_template('dashboard.html', api_error_sites=api_error_sites, **context)
+
+
+def _dashboard_context():
+    """Template context of the dashboard (cached by dashboard())."""
     from datetime import date, timedelta
     conn = get_db_connection()
     
@@ -1792,9 +1788,9 @@ def dashboard():
     # and convert each bucket to CNY using the period's per-currency rate,
     # then sum to a single CNY number — same approach /monthly uses.
     success_cond = _revenue_status_cond()
-    period_fmt = '%Y-%m-%d' if trend_type == 'daily' else '%Y-%m'
+    period_col = 'day' if trend_type == 'daily' else 'year_month'
     trend_data_raw = conn.execute(f'''
-        SELECT strftime('{period_fmt}', date_created) as period,
+        SELECT {period_col} as period,
                COALESCE(currency, '') as currency,
                COUNT(*) as orders,
                COALESCE(SUM(total), 0) as revenue,
@@ -1971,12 +1967,7 @@ def dashboard():
     if stats.get('net_revenue'):
         cny_rate = round(stats.get('net_revenue_cny', 0) / stats['net_revenue'], 4)
     
-    # Get sites with API errors
-    conn = get_db_connection()
-    api_error_sites = conn.execute("SELECT url FROM sites WHERE api_status = 'error'").fetchall()
-    conn.close()
-        
-    return render_template('dashboard.html',
+    return dict(
                          stats=stats,
                          status_data=status_data,
                          source_data=source_data,
@@ -1990,14 +1981,18 @@ def dashboard():
                          all_managers=all_managers,
                          site_managers=site_managers,
                          customer_attributes=customer_attributes,
-                         cny_rate=cny_rate,
-                         api_error_sites=api_error_sites)
+                         cny_rate=cny_rate)
 
 
 @app.route('/orders')
 @login_required
 def orders():
     """Order list with filtering and summary statistics"""
+    return render_template('orders.html', **_cached_view('orders', _orders_context))
+
+
+def _orders_context():
+    """Template context of the order list (cached by orders())."""
     from datetime import date, timedelta
     conn = get_db_connection()
     
@@ -2110,11 +2105,16 @@ def orders():
     if search:
         like_term = f'%{search}%'
         # When the input is long enough to plausibly be a tracking number, email,
-        # or customer detail, also search inside JSON columns (billing/shipping →
-        # customer email/name/phone; AST plugin → meta_data; VillaTheme →
-        # line_items; generic shipping_lines) and our shipping_logs. Short inputs
-        # stay on the fast number/id path to avoid false positives.
-        if len(search) >= 6:
+        # or customer detail, also search the customer / product / tracking /
+        # note text. Short inputs stay on number/id to avoid false positives.
+        # Both go through the orders_fts trigram index (order_search.py); the
+        # LIKE scans below only run for < 3 chars or an SQLite without FTS5.
+        fts = order_search.match_clause(
+            search, None if len(search) >= 6 else ('order_id', 'number'))
+        if fts:
+            conditions.append(fts[0])
+            params.extend(fts[1])
+        elif len(search) >= 6:
             conditions.append('''(
                 number LIKE ?
                 OR id LIKE ?
@@ -2212,7 +2212,7 @@ def orders():
     
     # Get all available months for pagination
     months_query = f'''
-        SELECT DISTINCT strftime('%Y-%m', date_created) as month 
+        SELECT DISTINCT year_month as month 
         FROM orders {where_clause} 
         ORDER BY month DESC
     '''
@@ -2240,7 +2240,7 @@ def orders():
     elif current_month:
         month_conditions = conditions.copy() if conditions else []
         month_params = params.copy()
-        month_conditions.append("strftime('%Y-%m', date_created) = ?")
+        month_conditions.append("year_month = ?")
         month_params.append(current_month)
         month_where = ' WHERE ' + ' AND '.join(month_conditions)
         
@@ -2600,7 +2600,7 @@ def orders():
 
     conn.close()
     
-    return render_template('orders.html',
+    return dict(
                          orders=processed_orders,
                          sources=sources,
                          statuses=statuses,
@@ -2631,6 +2631,11 @@ def orders():
 @login_required
 def monthly():
     """Monthly statistics page"""
+    return render_template('monthly.html', **_cached_view('monthly', _monthly_context))
+
+
+def _monthly_context():
+    """Template context of the monthly statistics page (cached by monthly())."""
     conn = get_db_connection()
     
     # Get user's allowed sources for permission filtering
@@ -2742,11 +2747,11 @@ def monthly():
         params.append(source_filter)
 
     if start_month:
-        conditions.append("strftime('%Y-%m', date_created) >= ?")
+        conditions.append("year_month >= ?")
         params.append(start_month)
 
     if end_month:
-        conditions.append("strftime('%Y-%m', date_created) <= ?")
+        conditions.append("year_month <= ?")
         params.append(end_month)
 
     # Exclude checkout drafts and trash — same as orders page
@@ -2775,7 +2780,7 @@ def monthly():
     conn.close()
 
     if len(df) == 0:
-        return render_template('monthly.html', monthly_stats=[], sources=all_sources, source_filter=source_filter, country_filter=country_filter, all_countries=all_countries, start_month=start_month, end_month=end_month)
+        return dict(monthly_stats=[], sources=all_sources, source_filter=source_filter, country_filter=country_filter, all_countries=all_countries, start_month=start_month, end_month=end_month)
 
     # Calculate product quantities
     def get_product_qty(line_items):
@@ -2901,35 +2906,286 @@ def monthly():
         monthly_aggregates[m]['currency_amounts'][currency]['shipping_loss'] += row.get('shipping_loss', 0)
         monthly_aggregates[m]['currency_amounts'][currency]['product_loss'] += row.get('product_loss', 0)
         
-    return render_template('monthly.html', monthly_stats=rows, monthly_aggregates=monthly_aggregates, sources=all_sources, source_filter=source_filter, manager_filter=manager_filter, country_filter=country_filter, all_managers=all_managers, all_countries=all_countries, sort_by=sort_by, site_managers=site_managers, start_month=start_month, end_month=end_month)
+    return dict(monthly_stats=rows, monthly_aggregates=monthly_aggregates, sources=all_sources, source_filter=source_filter, manager_filter=manager_filter, country_filter=country_filter, all_managers=all_managers, all_countries=all_countries, sort_by=sort_by, site_managers=site_managers, start_month=start_month, end_month=end_month)
+
+
+# ----------------- Background export jobs -----------------
+# Excel/CSV exports used to be built inside the request; a wide monthly range
+# or the full order list blocked a worker long enough to hit the proxy
+# timeout. Export endpoints now only validate + capture the caller's
+# permissions, queue a build function on a small thread pool and return the
+# job id. The file lands in exports/<kind>/ and base.html polls
+# /api/export-jobs/<id> to notify + download when it's ready.
+EXPORT_JOB_WORKERS = 2
+EXPORT_JOB_RETENTION_DAYS = 7
+# Queued / running jobs carry a heartbeat_at that their process refreshes
+# every EXPORT_JOB_HEARTBEAT_SECONDS. Under gunicorn a starting worker must not
+# fail the jobs another live worker is building, so only a job whose
+# heartbeat stopped for EXPORT_JOB_STALE_SECONDS counts as interrupted.
+EXPORT_JOB_HEARTBEAT_SECONDS = 60
+EXPORT_JOB_STALE_SECONDS = 300
+_export_executor = None
+_export_executor_lock = threading.Lock()
+_export_jobs_owned = set()  # queued / running job ids of this process
+_export_heartbeat = {'pid': None, 'thread': None}
+
+
+def _get_exports_dir(kind):
+    import os
+    base = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exports', kind)
+    os.makedirs(base, exist_ok=True)
+    return base
+
+
+def _get_export_executor():
+    global _export_executor
+    with _export_executor_lock:
+        if _export_executor is None:
+            import concurrent.futures
+            _export_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=EXPORT_JOB_WORKERS, thread_name_prefix='export')
+        return _export_executor
+
+
+def _export_heartbeat_loop():
+    import time as _time
+    while True:
+        _time.sleep(EXPORT_JOB_HEARTBEAT_SECONDS)
+        with _export_executor_lock:
+            ids = list(_export_jobs_owned)
+        if not ids:
+            continue
+        try:
+            conn = get_db_connection()
+            try:
+                conn.execute(f"UPDATE export_jobs SET heartbeat_at = datetime('now') "
+                             f"WHERE id IN ({','.join('?' * len(ids))})", ids)
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            app.logger.warning(f'export job heartbeat failed: {e}')
+
+
+def _own_export_job(job_id):
+    """Count job_id among this process's live jobs and make sure the
+    heartbeat thread runs (again in a forked worker, where the parent's
+    thread does not exist)."""
+    import os
+    with _export_executor_lock:
+        _export_jobs_owned.add(job_id)
+        thread = _export_heartbeat['thread']
+        if thread is None or not thread.is_alive() or _export_heartbeat['pid'] != os.getpid():
+            thread = threading.Thread(target=_export_heartbeat_loop, daemon=True)
+            _export_heartbeat.update(pid=os.getpid(), thread=thread)
+            thread.start()
+
+
+def _expire_stale_export_jobs(conn):
+    """Fail queued / running jobs whose process stopped (heartbeat older
+    than EXPORT_JOB_STALE_SECONDS). Only writes when there is such a job, so
+    the polls can call it. Does not commit."""
+    stale = "status IN ('queued', 'running') AND COALESCE(heartbeat_at, created_at) < datetime('now', ?)"
+    cutoff = (f'-{EXPORT_JOB_STALE_SECONDS} seconds',)
+    if conn.execute(f'SELECT 1 FROM export_jobs WHERE {stale} LIMIT 1', cutoff).fetchone():
+        conn.execute(f"""UPDATE export_jobs SET status = 'error', error = '处理进程已停止，导出任务已中断，请重新导出',
+                                finished_at = datetime('now')
+                         WHERE {stale}""", cutoff)
+
+
+def _prune_export_jobs(conn):
+    """Drop job rows (and their files) older than EXPORT_JOB_RETENTION_DAYS.
+    Sales board files are kept — they belong to sales_board_exports history."""
+    import os
+    old = conn.execute(
+        "SELECT id, kind, file_path FROM export_jobs WHERE created_at < datetime('now', ?)",
+        (f'-{EXPORT_JOB_RETENTION_DAYS} days',)
+    ).fetchall()
+    for row in old:
+        if row['kind'] != 'sales_board' and row['file_path']:
+            try:
+                os.remove(row['file_path'])
+            except OSError:
+                pass
+    if old:
+        conn.executemany('DELETE FROM export_jobs WHERE id = ?', [(row['id'],) for row in old])
+
+
+def _submit_export_job(kind, label, params, build):
+    """Queue an export and return its job id.
+
+    build(job_id, params) runs on the export pool inside an app context and
+    must return (filename, file_path) of the finished file; raising marks the
+    job failed with the exception text. params must already carry anything
+    derived from current_user (allowed sources etc.) — there is no request
+    context in the worker.
+    """
+    conn = get_db_connection()
+    try:
+        _prune_export_jobs(conn)
+        cur = conn.execute(
+            "INSERT INTO export_jobs (kind, label, created_by, heartbeat_at) VALUES (?, ?, ?, datetime('now'))",
+            (kind, label, int(current_user.id))
+        )
+        conn.commit()
+        job_id = cur.lastrowid
+    finally:
+        conn.close()
+    _own_export_job(job_id)
+    _get_export_executor().submit(_run_export_job, job_id, params, build)
+    return job_id
+
+
+def _run_export_job(job_id, params, build):
+    import os
+    with app.app_context():
+        conn = get_db_connection()
+        try:
+            conn.execute("UPDATE export_jobs SET status = 'running', started_at = datetime('now'), "
+                         "heartbeat_at = datetime('now') WHERE id = ?", (job_id,))
+            conn.commit()
+            try:
+                filename, file_path = build(job_id, params)
+            except Exception as e:
+                app.logger.exception(f"export job {job_id} failed")
+                conn.execute("""UPDATE export_jobs SET status = 'error', error = ?, finished_at = datetime('now')
+                                WHERE id = ?""", (str(e)[:500] or type(e).__name__, job_id))
+            else:
+                conn.execute("""UPDATE export_jobs SET status = 'done', filename = ?, file_path = ?,
+                                       file_size = ?, finished_at = datetime('now')
+                                WHERE id = ?""",
+                             (filename, file_path, os.path.getsize(file_path), job_id))
+            conn.commit()
+        finally:
+            conn.close()
+            with _export_executor_lock:
+                _export_jobs_owned.discard(job_id)
+
+
+def _export_job_path(kind, job_id, filename):
+    """On-disk path for a job's file (job id prefix keeps same-named exports apart)."""
+    import os
+    return os.path.join(_get_exports_dir(kind), f'{job_id}_{filename}')
+
+
+def _get_own_export_job(conn, job_id):
+    return conn.execute('SELECT * FROM export_jobs WHERE id = ? AND created_by = ?',
+                        (job_id, int(current_user.id))).fetchone()
+
+
+def _export_job_json(row):
+    d = dict(row)
+    d.pop('file_path', None)
+    d['download_url'] = url_for('download_export_job', job_id=row['id']) if row['status'] == 'done' else None
+    return d
+
+
+@app.route('/api/export-jobs')
+@login_required
+def list_export_jobs():
+    """The current user's recent export jobs (newest first)."""
+    conn = get_db_connection()
+    try:
+        _expire_stale_export_jobs(conn)
+        conn.commit()
+        rows = conn.execute('SELECT * FROM export_jobs WHERE created_by = ? ORDER BY id DESC LIMIT 30',
+                            (int(current_user.id),)).fetchall()
+        return jsonify([_export_job_json(r) for r in rows])
+    finally:
+        conn.close()
+
+
+@app.route('/api/export-jobs/<int:job_id>')
+@login_required
+def get_export_job(job_id):
+    conn = get_db_connection()
+    try:
+        _expire_stale_export_jobs(conn)
+        conn.commit()
+        row = _get_own_export_job(conn, job_id)
+        if not row:
+            return jsonify({'error': '导出任务不存在'}), 404
+        return jsonify(_export_job_json(row))
+    finally:
+        conn.close()
+
+
+@app.route('/api/export-jobs/<int:job_id>/download')
+@login_required
+def download_export_job(job_id):
+    import os
+    import mimetypes
+    conn = get_db_connection()
+    try:
+        row = _get_own_export_job(conn, job_id)
+    finally:
+        conn.close()
+    if not row or row['status'] != 'done':
+        return jsonify({'error': '导出任务不存在或尚未完成'}), 404
+    if not row['file_path'] or not os.path.exists(row['file_path']):
+        return jsonify({'error': '文件不存在或已被清理，请重新导出'}), 404
+    return send_file(
+        row['file_path'],
+        as_attachment=True,
+        download_name=row['filename'],
+        mimetype=mimetypes.guess_type(row['filename'])[0] or 'application/octet-stream'
+    )
 
 
 @app.route('/api/monthly/export')
 @login_required
 def monthly_export():
-    """Export monthly statistics to Excel - Admin only"""
+    """Queue the monthly statistics Excel export - Admin only.
+
+    The workbook is built by _build_monthly_export on the export pool; the
+    response only carries the job id (see _submit_export_job).
+    """
     # Check admin permission
     if not current_user.is_admin():
         return jsonify({'error': '只有管理员才能导出数据'}), 403
-    
-    from io import BytesIO
+
+    params = {
+        # Get user's allowed sources for permission filtering
+        'allowed_sources': get_user_allowed_sources(current_user.id, current_user.is_admin(), current_user.is_viewer()),
+        'source': request.args.get('source', ''),
+        'manager': request.args.get('manager', ''),
+        'country': request.args.get('country', ''),
+        'start_month': request.args.get('start_month', ''),
+        'end_month': request.args.get('end_month', ''),
+    }
+    country_name = params['country'] or '全部'
+    job_id = _submit_export_job('monthly', f'月度统计汇总（{country_name}）', params, _build_monthly_export)
+    return jsonify({'success': True, 'job_id': job_id})
+
+
+def _build_monthly_export(job_id, options):
+    """Build the monthly statistics workbook for monthly_export.
+
+    Write-only workbook: rows are streamed to disk as they are appended and
+    styling goes through named styles (one shared xf per style instead of a
+    per-cell Font/Fill/Alignment copy). Column widths are measured from the
+    row values before anything is written, since a write-only sheet can't be
+    revisited.
+    """
     from openpyxl import Workbook
-    from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+    from openpyxl.cell import WriteOnlyCell
+    from copy import copy
+    from openpyxl.styles import Font, PatternFill, Alignment, NamedStyle
+    from openpyxl.styles.fonts import DEFAULT_FONT
     from openpyxl.chart import BarChart, LineChart, Reference
     from openpyxl.chart.label import DataLabelList
-    
+    from openpyxl.utils import get_column_letter
+
     conn = get_db_connection()
-    
-    # Get user's allowed sources for permission filtering
-    allowed_sources = get_user_allowed_sources(current_user.id, current_user.is_admin(), current_user.is_viewer())
-    
+
+    allowed_sources = options['allowed_sources']
+
     # Get filters
-    source_filter = request.args.get('source', '')
-    manager_filter = request.args.get('manager', '')
-    manager_filter = request.args.get('manager', '')
-    country_filter = request.args.get('country', '')
-    start_month = request.args.get('start_month', '')
-    end_month = request.args.get('end_month', '')
+    source_filter = options['source']
+    manager_filter = options['manager']
+    country_filter = options['country']
+    start_month = options['start_month']
+    end_month = options['end_month']
     
     # Build query conditions
     conditions = []
@@ -2968,11 +3224,11 @@ def monthly_export():
         params.append(source_filter)
         
     if start_month:
-        conditions.append("strftime('%Y-%m', date_created) >= ?")
+        conditions.append("year_month >= ?")
         params.append(start_month)
 
     if end_month:
-        conditions.append("strftime('%Y-%m', date_created) <= ?")
+        conditions.append("year_month <= ?")
         params.append(end_month)
 
     # Exclude checkout drafts and trash — same as orders page
@@ -2998,7 +3254,7 @@ def monthly_export():
     conn.close()
 
     if len(df) == 0:
-        return jsonify({'error': '没有数据可导出'}), 400
+        raise ValueError('没有数据可导出')
 
     # Calculate product quantities
     def get_product_qty(line_items):
@@ -3133,11 +3389,6 @@ def monthly_export():
         monthly_totals[m]['product_loss_cny'] += row.get('_product_loss_cny', 0)
         monthly_totals[m]['net_amount_cny'] += row['_net_amount_cny']
     
-    # Create Excel workbook
-    wb = Workbook()
-    ws = wb.active
-    ws.title = '月度统计'
-    
     # Determine header currency based on country filter
     country_currency_map = {
         'PL': 'PLN',
@@ -3150,6 +3401,8 @@ def monthly_export():
         'CN': 'CNY'
     }
     header_currency = country_currency_map.get(country_filter, '混合货币') if country_filter else '混合货币'
+    # Summary rows use the same currency label
+    summary_currency = header_currency
     
     # Write headers (exclude hidden fields starting with _)
     headers = [k for k in rows[0].keys() if not k.startswith('_')] if rows else []
@@ -3160,174 +3413,96 @@ def monthly_export():
         '成功金额': f'成功金额({header_currency})',
         '成功净金额': f'成功净金额({header_currency})'
     }
-    
-    header_font = Font(bold=True, color='FFFFFF')
-    header_fill = PatternFill(start_color='366092', end_color='366092', fill_type='solid')
-    
-    for col, header in enumerate(headers, 1):
-        display_header = header_display_map.get(header, header)
-        cell = ws.cell(row=1, column=col, value=display_header)
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.alignment = Alignment(horizontal='center', vertical='center')
-    
-    # Write data (exclude hidden fields) with center alignment
-    center_align = Alignment(horizontal='center', vertical='center')
-    for row_idx, row_data in enumerate(rows, 2):
-        for col_idx, header in enumerate(headers, 1):
-            cell = ws.cell(row=row_idx, column=col_idx, value=row_data[header])
-            cell.alignment = center_align
-    
-    # Add empty row
-    summary_start_row = len(rows) + 3
-    
-    # Determine summary currency based on country filter
-    country_currency_map = {
-        'PL': 'PLN',
-        'AU': 'AUD',
-        'AE': 'AED',
-        'DE': 'EUR',
-        'FR': 'EUR',
-        'UK': 'GBP',
-        'US': 'USD',
-        'CN': 'CNY'
-    }
-    summary_currency = country_currency_map.get(country_filter, '混合货币') if country_filter else '混合货币'
-    
-    # Add monthly summary with all columns
-    summary_font = Font(bold=True, color='006400')
-    for idx, (month, totals) in enumerate(sorted(monthly_totals.items(), reverse=True)):
-        row_num = summary_start_row + idx
-        # Column A: 月份收入总计
-        cell = ws.cell(row=row_num, column=1, value=f'{month}月收入总计')
-        cell.font = summary_font
-        cell.alignment = center_align
-        # Column B: 站点数量
-        cell = ws.cell(row=row_num, column=2, value=f'{totals["site_count"]}个站点')
-        cell.font = summary_font
-        cell.alignment = center_align
-        # Column C: 负责人 - 留空
-        ws.cell(row=row_num, column=3, value='').alignment = center_align
-        # Column D: 货币 - 显示汇总货币
-        cell = ws.cell(row=row_num, column=4, value=summary_currency)
-        cell.font = summary_font
-        cell.alignment = center_align
-        # Column E: 总订单数
-        cell = ws.cell(row=row_num, column=5, value=totals['total_orders'])
-        cell.font = summary_font
-        cell.alignment = center_align
-        # Column F: 总产品数
-        cell = ws.cell(row=row_num, column=6, value=totals['total_products'])
-        cell.font = summary_font
-        cell.alignment = center_align
-        # Column G: 总金额
-        cell = ws.cell(row=row_num, column=7, value=round(totals['total_amount'], 2))
-        cell.font = summary_font
-        cell.alignment = center_align
-        # Column H: 成功订单数
-        cell = ws.cell(row=row_num, column=8, value=totals['success_orders'])
-        cell.font = summary_font
-        cell.alignment = center_align
-        # Column I: 成功产品数
-        cell = ws.cell(row=row_num, column=9, value=totals['success_products'])
-        cell.font = summary_font
-        cell.alignment = center_align
-        # Column J: 成功金额
-        cell = ws.cell(row=row_num, column=10, value=round(totals['success_amount'], 2))
-        cell.font = summary_font
-        cell.alignment = center_align
-        # Column K: 成功净金额
-        cell = ws.cell(row=row_num, column=11, value=round(totals['success_net_amount'], 2))
-        cell.font = summary_font
-        cell.alignment = center_align
-        # Column L: 失败订单
-        cell = ws.cell(row=row_num, column=12, value=totals['failed_orders'])
-        cell.font = summary_font
-        cell.alignment = center_align
-        # Column M: 取消订单
-        cell = ws.cell(row=row_num, column=13, value=totals['cancelled_orders'])
-        cell.font = summary_font
-        cell.alignment = center_align
-        # Column N: 未送达订单
-        cell = ws.cell(row=row_num, column=14, value=totals['undelivered_orders'])
-        cell.font = summary_font
-        cell.alignment = center_align
-        # Column O: 运费损失
-        cell = ws.cell(row=row_num, column=15, value=round(totals['shipping_loss'], 2))
-        cell.font = summary_font
-        cell.alignment = center_align
-        # Column P: 运费损失(CNY)
-        cell = ws.cell(row=row_num, column=16, value=round(totals['shipping_loss_cny'], 2))
-        cell.font = summary_font
-        cell.alignment = center_align
-        # Column Q: 问题退货订单
-        cell = ws.cell(row=row_num, column=17, value=totals['problem_return_orders'])
-        cell.font = summary_font
-        cell.alignment = center_align
-        # Column R: 货值损失
-        cell = ws.cell(row=row_num, column=18, value=round(totals['product_loss'], 2))
-        cell.font = summary_font
-        cell.alignment = center_align
-        # Column S: 货值损失(CNY)
-        cell = ws.cell(row=row_num, column=19, value=round(totals['product_loss_cny'], 2))
-        cell.font = summary_font
-        cell.alignment = center_align
-        # Column T: 汇率 - 留空
-        ws.cell(row=row_num, column=20, value='').alignment = center_align
-        # Column U: 净金额(CNY)
-        cell = ws.cell(row=row_num, column=21, value=f'¥{round(totals["net_amount_cny"], 2)}')
-        cell.font = summary_font
-        cell.alignment = center_align
-    
-    # Auto-adjust column widths
-    for column in ws.columns:
-        max_length = 0
-        col_letter = column[0].column_letter
-        for cell in column:
-            try:
-                if cell.value:
-                    cell_len = len(str(cell.value))
-                    # Chinese characters count as 2
-                    for ch in str(cell.value):
-                        if ord(ch) > 127:
-                            cell_len += 1
-                    if cell_len > max_length:
-                        max_length = cell_len
-            except:
-                pass
-        ws.column_dimensions[col_letter].width = min(max_length + 2, 50)
-    
+
+    # ---- Lay out every row up front (values + named style per cell) ----
+    # Sheet layout: header, data rows, blank, per-month summary, 3 blanks,
+    # chart data table (the charts below reference it).
+    HDR, CENTER, SUMMARY = 'monthly_header', 'monthly_center', 'monthly_summary'
+    sheet_rows = []
+    sheet_rows.append([(header_display_map.get(h, h), HDR) for h in headers])
+    for row_data in rows:
+        sheet_rows.append([(row_data[h], CENTER) for h in headers])
+    sheet_rows.append([])
+    summary_start_row = len(sheet_rows) + 1
+    for month, totals in sorted(monthly_totals.items(), reverse=True):
+        sheet_rows.append([
+            (f'{month}月收入总计', SUMMARY),
+            (f'{totals["site_count"]}个站点', SUMMARY),
+            ('', CENTER),                       # 负责人 - 留空
+            (summary_currency, SUMMARY),
+            (totals['total_orders'], SUMMARY),
+            (totals['total_products'], SUMMARY),
+            (round(totals['total_amount'], 2), SUMMARY),
+            (totals['success_orders'], SUMMARY),
+            (totals['success_products'], SUMMARY),
+            (round(totals['success_amount'], 2), SUMMARY),
+            (round(totals['success_net_amount'], 2), SUMMARY),
+            (totals['failed_orders'], SUMMARY),
+            (totals['cancelled_orders'], SUMMARY),
+            (totals['undelivered_orders'], SUMMARY),
+            (round(totals['shipping_loss'], 2), SUMMARY),
+            (round(totals['shipping_loss_cny'], 2), SUMMARY),
+            (totals['problem_return_orders'], SUMMARY),
+            (round(totals['product_loss'], 2), SUMMARY),
+            (round(totals['product_loss_cny'], 2), SUMMARY),
+            ('', CENTER),                       # 汇率 - 留空
+            (f'¥{round(totals["net_amount_cny"], 2)}', SUMMARY),
+        ])
+
+    # Auto-adjust column widths (Chinese characters count as 2). Measured
+    # over the table + summary only — the chart data block below is narrow.
+    col_widths = {}
+    for sheet_row in sheet_rows:
+        for col_idx, (value, _style) in enumerate(sheet_row, 1):
+            if value:
+                text = str(value)
+                cell_len = len(text) + sum(1 for ch in text if ord(ch) > 127)
+                col_widths[col_idx] = max(col_widths.get(col_idx, 0), cell_len)
+    max_col = max((len(r) for r in sheet_rows), default=0)
+
+    # Chart data (chronological order)
+    sorted_months = sorted(monthly_totals.keys())
+    chart_data_start_row = summary_start_row + len(monthly_totals) + 3
+    chart_data_end_row = chart_data_start_row + len(sorted_months)
+    if monthly_totals:
+        while len(sheet_rows) < chart_data_start_row - 1:
+            sheet_rows.append([])
+        sheet_rows.append([('月份', HDR), ('净金额(CNY)', HDR), ('订单数', HDR)])
+        for month in sorted_months:
+            sheet_rows.append([
+                (month, CENTER),
+                (round(monthly_totals[month]['net_amount_cny'], 2), CENTER),
+                (monthly_totals[month]['success_orders'], CENTER),
+            ])
+
+    # ---- Write (streamed) ----
+    wb = Workbook(write_only=True)
+    wb.add_named_style(NamedStyle(
+        name=HDR, font=Font(bold=True, color='FFFFFF'),
+        fill=PatternFill(start_color='366092', end_color='366092', fill_type='solid'),
+        alignment=Alignment(horizontal='center', vertical='center')))
+    wb.add_named_style(NamedStyle(name=CENTER, font=copy(DEFAULT_FONT),
+                                  alignment=Alignment(horizontal='center', vertical='center')))
+    wb.add_named_style(NamedStyle(
+        name=SUMMARY, font=Font(bold=True, color='006400'),
+        alignment=Alignment(horizontal='center', vertical='center')))
+
+    ws = wb.create_sheet('月度统计')
+    for col_idx in range(1, max_col + 1):
+        ws.column_dimensions[get_column_letter(col_idx)].width = min(col_widths.get(col_idx, 0) + 2, 50)
     # Freeze first row
     ws.freeze_panes = 'A2'
-    
+
+    for sheet_row in sheet_rows:
+        out = []
+        for value, style in sheet_row:
+            cell = WriteOnlyCell(ws, value=value)
+            cell.style = style
+            out.append(cell)
+        ws.append(out)
+
     # Create charts based on monthly summary data
     if monthly_totals:
-        # Sort months chronologically for charts
-        sorted_months = sorted(monthly_totals.keys())
-        
-        # Create a new sheet for chart data
-        chart_data_start_row = summary_start_row + len(monthly_totals) + 3
-        
-        # Write chart data headers
-        ws.cell(row=chart_data_start_row, column=1, value='月份').font = header_font
-        ws.cell(row=chart_data_start_row, column=1).fill = header_fill
-        ws.cell(row=chart_data_start_row, column=1).alignment = center_align
-        ws.cell(row=chart_data_start_row, column=2, value='净金额(CNY)').font = header_font
-        ws.cell(row=chart_data_start_row, column=2).fill = header_fill
-        ws.cell(row=chart_data_start_row, column=2).alignment = center_align
-        ws.cell(row=chart_data_start_row, column=3, value='订单数').font = header_font
-        ws.cell(row=chart_data_start_row, column=3).fill = header_fill
-        ws.cell(row=chart_data_start_row, column=3).alignment = center_align
-        
-        # Write chart data (chronological order)
-        for idx, month in enumerate(sorted_months):
-            row_num = chart_data_start_row + 1 + idx
-            ws.cell(row=row_num, column=1, value=month).alignment = center_align
-            ws.cell(row=row_num, column=2, value=round(monthly_totals[month]['net_amount_cny'], 2)).alignment = center_align
-            ws.cell(row=row_num, column=3, value=monthly_totals[month]['success_orders']).alignment = center_align
-        
-        chart_data_end_row = chart_data_start_row + len(sorted_months)
-        
         # Create Bar Chart for Net Amount
         bar_chart = BarChart()
         bar_chart.type = "col"
@@ -3373,27 +3548,24 @@ def monthly_export():
         # Place line chart next to bar chart
         ws.add_chart(line_chart, f"K{chart_row}")
     
-    # Save to BytesIO
-    output = BytesIO()
-    wb.save(output)
-    output.seek(0)
-    
     # Generate filename
     timestamp = datetime.now().strftime('%Y%m%d%H%M')
     country_name = country_filter if country_filter else '全部'
     filename = f'月度统计汇总（{country_name}）{timestamp}.xlsx'
-    
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name=filename
-    )
+    file_path = _export_job_path('monthly', job_id, filename)
+    wb.save(file_path)
+    return filename, file_path
 
 @app.route('/cancelled-analysis')
 @login_required
 def cancelled_analysis():
     """Cancelled/Failed Order Analysis Page"""
+    return render_template('cancelled.html', **_cached_view('cancelled_analysis', _cancelled_analysis_context))
+
+
+def _cancelled_analysis_context():
+    """Template context of the cancelled/failed analysis page (cached by
+    cancelled_analysis(); source_display_mode comes from inject_settings)."""
     conn = get_db_connection()
     
     # Get user's allowed sources for permission filtering
@@ -3557,7 +3729,7 @@ def cancelled_analysis():
 
     # Get available months (also covers undelivered / 问题退货)
     months_query = '''
-        SELECT DISTINCT strftime('%Y-%m', date_created) as month
+        SELECT DISTINCT year_month as month
         FROM orders
         WHERE status IN ('cancelled', 'failed') OR is_undelivered = 1 OR is_problem_return = 1
         ORDER BY month DESC
@@ -3811,19 +3983,9 @@ def cancelled_analysis():
         })
     source_stats_list.sort(key=lambda x: x['count'], reverse=True)
     
-    # Get source display mode for user
-    source_display_mode = 'full'
-    if current_user.is_authenticated:
-        user_pref = conn.execute('''
-            SELECT preference_value FROM user_preferences 
-            WHERE user_id = ? AND preference_key = 'source_display_mode'
-        ''', (current_user.id,)).fetchone()
-        if user_pref:
-            source_display_mode = user_pref['preference_value']
-    
     conn.close()
     
-    return render_template('cancelled.html',
+    return dict(
         orders=orders_list,
         total_cancelled=total_cancelled,
         total_amount=total_amount,
@@ -3843,7 +4005,6 @@ def cancelled_analysis():
         quick_date=quick_date,
         available_months=available_months,
         current_month=month_filter,
-        source_display_mode=source_display_mode,
         currency_stats=currency_stats,
         total_cny=total_cny
     )
@@ -3991,7 +4152,7 @@ def cancelled_analysis():
     
     # Get available months
     months_query = '''
-        SELECT DISTINCT strftime('%Y-%m', date_created) as month 
+        SELECT DISTINCT year_month as month 
         FROM orders 
         WHERE status IN ('cancelled', 'failed')
         ORDER BY month DESC
@@ -4254,7 +4415,7 @@ def cancelled_analysis():
     
     conn.close()
     
-    return render_template('cancelled.html',
+    return dict(
         orders=orders_list,
         total_cancelled=total_cancelled,
         total_amount=total_amount,
@@ -4280,19 +4441,28 @@ def cancelled_analysis():
     )
 
 
-@app.route('/customers')
-@login_required
-def customers():
-    from datetime import date, timedelta
-    conn = get_db_connection()
+def _refresh_customer_stats(conn):
+    """Fold the orders the writers queued since the last read into
+    customer_stats (see customer_stats.py). Cheap when nothing is queued."""
+    customer_stats.refresh(conn, _success_status_cond('o'))
 
-    # Get user's allowed sources for permission filtering
+
+def _customers_scope(conn):
+    """Filters shared by /customers and /api/customers, from request.args.
+
+    sources: the sites the view may count (permissions ∩ manager ∩ country ∩
+    source filter), None = every site. date_from / date_to: the period口径,
+    derived from quick_date unless given explicitly.
+    """
+    from datetime import date, timedelta
     allowed_sources = get_user_allowed_sources(current_user.id, current_user.is_admin(), current_user.is_viewer())
 
-    # Get source filter
     source_filter = request.args.get('source', '')
     manager_filter = request.args.get('manager', '')
     country_filter = request.args.get('country', '')
+    # Validate source_filter against allowed sources
+    if source_filter and allowed_sources is not None and source_filter not in allowed_sources:
+        source_filter = ''
 
     # Period filter (period口径: every number reflects only orders in range).
     # Default is 'all' so the page keeps showing the lifetime customer base
@@ -4322,410 +4492,361 @@ def customers():
             date_to = today.isoformat()
         # 'all' (or anything else) → no date bounds
 
-    # Build the shared date-range SQL fragment (applied to BOTH the customer
-    # aggregation query and the identity-resolution scan so they stay in sync).
-    date_conditions = []
-    date_params = []
-    if date_from:
-        date_conditions.append('date_created >= ?')
-        date_params.append(date_from)
-    if date_to:
-        date_conditions.append('date_created <= ?')
-        date_params.append(date_to + 'T23:59:59')
-
-    # All countries for the filter dropdown
-    all_countries = [c['country'] for c in conn.execute(
-        "SELECT DISTINCT country FROM sites WHERE country IS NOT NULL AND country != '' ORDER BY country"
-    ).fetchall()]
-
-    # Get all managers
-    all_managers = get_all_managers()
-    
-    # Validate source_filter against allowed sources
-    if source_filter and allowed_sources is not None and source_filter not in allowed_sources:
-        source_filter = ''
-    
-    # Get available sources (filtered by permissions and manager)
-    conn = get_db_connection()
-    
-    # Base source query
-    source_query = 'SELECT DISTINCT source FROM orders'
-    source_params = []
-    source_conditions = []
-    
-    if allowed_sources is not None:
-        if allowed_sources:
-            placeholders = ', '.join(['?' for _ in allowed_sources])
-            source_conditions.append(f'source IN ({placeholders})')
-            source_params.extend(allowed_sources)
-        else:
-            source_conditions.append('1=0')
-            
-    if manager_filter:
-        # Get sites managed by this manager
-        manager_sites = conn.execute('SELECT url FROM sites WHERE manager = ?', (manager_filter,)).fetchall()
-        manager_urls = [s['url'] for s in manager_sites]
-        if manager_urls:
-            placeholders = ', '.join(['?' for _ in manager_urls])
-            source_conditions.append(f'source IN ({placeholders})')
-            source_params.extend(manager_urls)
-        else:
-            source_conditions.append('1=0')
-            
-    if source_conditions:
-        source_query += ' WHERE ' + ' AND '.join(source_conditions)
-        
-    source_query += ' ORDER BY source'
-    all_sources = conn.execute(source_query, source_params).fetchall()
-    
-    # Build query with permission filter and optional source filter
-    base_condition = "json_extract(billing, '$.email') IS NOT NULL AND json_extract(billing, '$.email') != ''"
-    conditions = [base_condition]
-    params = []
-    
+    # Every restriction is a site list; together they are their intersection.
+    restrictions = []
     if allowed_sources is not None:
-        if allowed_sources:
-            placeholders = ', '.join(['?' for _ in allowed_sources])
-            conditions.append(f'source IN ({placeholders})')
-            params.extend(allowed_sources)
-        else:
-            conditions.append('1=0')
-            
-    # Add manager filter
+        restrictions.append(set(allowed_sources))
     if manager_filter:
-        # Re-use manager_urls from above or fetch if not done
-        if 'manager_urls' not in locals():
-            manager_sites = conn.execute('SELECT url FROM sites WHERE manager = ?', (manager_filter,)).fetchall()
-            manager_urls = [s['url'] for s in manager_sites]
-        
-        if manager_urls:
-            placeholders = ', '.join(['?' for _ in manager_urls])
-            conditions.append(f'source IN ({placeholders})')
-            params.extend(manager_urls)
-        else:
-            conditions.append('1=0')
-    
-    # Add country filter (resolve to that country's site URLs)
+        restrictions.append({s['url'] for s in conn.execute(
+            'SELECT url FROM sites WHERE manager = ?', (manager_filter,)).fetchall()})
     if country_filter:
-        country_sites = conn.execute('SELECT url FROM sites WHERE country = ?', (country_filter,)).fetchall()
-        country_urls = [s['url'] for s in country_sites]
-        if country_urls:
-            placeholders = ', '.join(['?' for _ in country_urls])
-            conditions.append(f'source IN ({placeholders})')
-            params.extend(country_urls)
-        else:
-            conditions.append('1=0')
-
+        restrictions.append({s['url'] for s in conn.execute(
+            'SELECT url FROM sites WHERE country = ?', (country_filter,)).fetchall()})
     if source_filter:
-        conditions.append('source = ?')
-        params.append(source_filter)
+        restrictions.append({source_filter})
 
-    # Period口径: scope every aggregate to the selected date range.
-    conditions.extend(date_conditions)
-    params.extend(date_params)
+    return {
+        'allowed_sources': allowed_sources,
+        'sources': set.intersection(*restrictions) if restrictions else None,
+        'source': source_filter,
+        'manager': manager_filter,
+        'country': country_filter,
+        'quick_date': quick_date,
+        'date_from': date_from,
+        'date_to': date_to,
+    }
 
-    where_clause = 'WHERE ' + ' AND '.join(conditions)
 
-    query = f'''
-        SELECT
-            json_extract(billing, '$.email') as email,
-            json_extract(billing, '$.first_name') || ' ' || json_extract(billing, '$.last_name') as name,
-            json_extract(billing, '$.phone') as phone,
-            COUNT(*) as total_orders,
-            SUM({_success_status_case()}) as successful_orders,
-            {_success_amount_case('total')} as total_spent,
-            SUM(CASE WHEN COALESCE(is_undelivered, 0) = 1 THEN 1 ELSE 0 END) as undelivered_orders,
-            SUM(CASE WHEN COALESCE(is_undelivered,0) = 1 OR COALESCE(is_problem_return,0) = 1
-                     THEN COALESCE(shipping_loss_amount, 0) ELSE 0 END) as shipping_loss_total,
-            SUM(CASE WHEN COALESCE(is_problem_return, 0) = 1 THEN 1 ELSE 0 END) as problem_return_orders,
-            SUM(CASE WHEN COALESCE(is_problem_return, 0) = 1 THEN COALESCE(product_loss_amount, 0) ELSE 0 END) as product_loss_total,
-            MAX(date_created) as last_order_date,
-            MIN(date_created) as first_order_date,
-            GROUP_CONCAT(DISTINCT source) as sources,
-            GROUP_CONCAT(DISTINCT currency) as currencies
-        FROM orders
-        {where_clause}
-        GROUP BY email
-        ORDER BY total_spent DESC
-    '''
-    
-    customers_data = conn.execute(query, params).fetchall()
+def _customer_accounts_sql(scope, cluster_keys=None):
+    """(SELECT, params) of the customer_accounts-shaped rows a scope counts, or
+    (None, []) for the lifetime all-sites view, which customer_stats answers.
 
-    # Site→manager map used to label each customer's sites in the 多站下单 column.
-    site_managers_global = {s['url']: (s['manager'] or '')
-                            for s in conn.execute('SELECT url, manager FROM sites').fetchall()}
+    Site-scoped views read customer_accounts; the period口径 folds the orders
+    in range on the fly (same SELECT the materialization uses).
+    cluster_keys restricts the rows to those identities.
+    """
+    sources = scope['sources']
+    conditions, params = [], []
+    if scope['date_from'] or scope['date_to']:
+        if sources is not None:
+            conditions.append(f"source IN ({','.join('?' * len(sources))})" if sources else '1=0')
+            params.extend(sorted(sources))
+        if scope['date_from']:
+            conditions.append('date_created >= ?')
+            params.append(scope['date_from'])
+        if scope['date_to']:
+            conditions.append('date_created <= ?')
+            params.append(scope['date_to'] + 'T23:59:59')
+        if cluster_keys is not None:
+            conditions.append(f"ic.cluster_key IN ({','.join('?' * len(cluster_keys))})")
+            params.extend(cluster_keys)
+        return customer_stats.account_select(_success_status_cond('o'), conditions), params
+    if sources is None:
+        return None, []
+    conditions.append(f"source IN ({','.join('?' * len(sources))})" if sources else '1=0')
+    params.extend(sorted(sources))
+    if cluster_keys is not None:
+        conditions.append(f"cluster_key IN ({','.join('?' * len(cluster_keys))})")
+        params.extend(cluster_keys)
+    return f"SELECT * FROM customer_accounts WHERE {' AND '.join(conditions)}", params
+
+
+def _customer_identities_sql(scope, filters=None):
+    """(WITH clause defining `ids`, params): one row per identity cluster in
+    scope with the customer_stats numeric columns + tier, narrowed by the list
+    toggles / search box in filters."""
+    acc_sql, params = _customer_accounts_sql(scope)
+    if acc_sql is None:
+        ids = 'SELECT * FROM customer_stats'
+        with_sql = 'WITH '
+    else:
+        ids = customer_stats.identity_select('acc')
+        with_sql = f'WITH acc AS ({acc_sql}), '
 
-    # Identity resolution: union emails that share a phone/address into one
-    # person so someone spreading orders across multiple emails collapses into a
-    # single row. Uses the SAME filter as the customer query above so the scope
-    # matches (permissions / manager / source filters).
-    email_to_cluster, cluster_meta = _resolve_identity_clusters(conn, where_clause, params)
+    filters = filters or {}
+    conditions = []
+    if filters.get('loss_only'):
+        conditions.append('total_loss > 0')
+    if filters.get('multi_site'):
+        conditions.append('site_count >= 2')
+    if filters.get('merged'):
+        conditions.append('identity_email_count >= 2')
+    q = (filters.get('q') or '').strip().lower()
+    if q:
+        conditions.append('instr(search, ?) > 0' if acc_sql is None else customer_stats.search_condition('acc'))
+        params = params + [q]
+    if conditions:
+        ids = f"SELECT * FROM ({ids}) WHERE {' AND '.join(conditions)}"
+    return f'{with_sql}ids AS ({ids})', params
 
-    conn.close()
 
-    total_revenue = 0
-    repeat_customers = 0
-    new_customers_month = 0
-    new_customers_last_month = 0
-    # Repeat-rate numerators/denominators for the three switchable口径:
-    #   headcount = repeat_customers / total_customers
-    #   by_orders = repeat_success_orders / total_success_orders
-    #   by_revenue = repeat_spending / total_revenue
-    total_success_orders = 0
-    repeat_success_orders = 0
-    repeat_spending = 0.0
+def _customer_thresholds():
+    from datetime import timedelta
+    now = datetime.now()
+    return {
+        'thirty_days_ago': (now - timedelta(days=30)).strftime('%Y-%m-%d'),
+        'sixty_days_ago': (now - timedelta(days=60)).strftime('%Y-%m-%d'),
+        'ninety_days_ago': (now - timedelta(days=90)).strftime('%Y-%m-%d'),
+    }
 
-    import datetime
-    now = datetime.datetime.now()
-    thirty_days_ago = (now - datetime.timedelta(days=30)).strftime('%Y-%m-%d')
-    sixty_days_ago = (now - datetime.timedelta(days=60)).strftime('%Y-%m-%d')
-    ninety_days_ago = (now - datetime.timedelta(days=90)).strftime('%Y-%m-%d')
 
-    tier_counts = {'VIP': 0, '优质': 0, '普通': 0, '新客': 0}
+def _customer_display_row(c, site_managers, thresholds):
+    """Per-row fields the list renders on top of customer_stats.fold()."""
+    c['refusal_rate'] = round(c['undelivered_orders'] / c['total_orders'] * 100, 1) if c['total_orders'] else 0
+    # Smart Actions
+    actions = []
+    if c['tier'] == 'VIP':
+        actions.append({'type': 'success', 'icon': 'gift', 'text': '专属礼遇'})
+        actions.append({'type': 'primary', 'icon': 'people', 'text': '邀请入群'})
+    elif c['last_order_date'] and c['last_order_date'] < thresholds['ninety_days_ago']:
+        actions.append({'type': 'warning', 'icon': 'ticket-perforated', 'text': '召回优惠券'})
+    elif c['successful_orders'] == 1 and c['first_order_date'] and c['first_order_date'] >= thresholds['thirty_days_ago']:
+        actions.append({'type': 'info', 'icon': 'book', 'text': '欢迎指南'})
+        actions.append({'type': 'info', 'icon': 'bag-plus', 'text': '关联推荐'})
+    elif c['successful_orders'] > 3:
+        actions.append({'type': 'primary', 'icon': 'arrow-repeat', 'text': '订阅服务'})
+    c['actions'] = actions
+    # Sources across the WHOLE identity (drives the 多站下单 column).
+    c['site_list'] = [{
+        'url': s,
+        'short': s.replace('https://www.', '').replace('https://', ''),
+        'manager': site_managers.get(s, ''),
+    } for s in c['all_sources']]
+    c.pop('search', None)
+    return c
+
+
+def _customer_page(conn, scope, sort='total_spent', direction='desc', limit=25, after=None, filters=None):
+    """One keyset page of identities: (rows, next_cursor).
+
+    after: [sort value, cluster_key] of the previous page's last row (the
+    next_cursor it returned). Ties on the sort column are broken by
+    cluster_key, so paging never skips or repeats an identity.
+    """
+    with_sql, params = _customer_identities_sql(scope, filters)
+    where = ''
+    order = 'DESC' if direction == 'desc' else 'ASC'
+    if after is not None:
+        where = f"WHERE ({sort}, cluster_key) {'<' if direction == 'desc' else '>'} (?, ?)"
+        params = params + list(after)
+    page = conn.execute(
+        f'{with_sql} SELECT * FROM ids {where} ORDER BY {sort} {order}, cluster_key {order} LIMIT ?',
+        params + [limit + 1]).fetchall()
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = [page[-1][sort], page[-1]['cluster_key']]
+
+    keys = [r['cluster_key'] for r in page]
+    acc_sql, acc_params = _customer_accounts_sql(scope, keys)
+    if acc_sql is None:
+        rows = [customer_stats.from_stats_row(r) for r in page]
+    else:
+        # Display fields (primary email, merged emails, sites ...) for just this
+        # page's identities, from their in-scope accounts.
+        by_cluster = {}
+        for a in (conn.execute(acc_sql, acc_params).fetchall() if keys else []):
+            by_cluster.setdefault(a['cluster_key'], []).append(dict(a))
+        matched = identity_graph.clusters_for(conn, {a['norm'] for accs in by_cluster.values() for a in accs})
+        matched = {e: m for e, (_ck, m) in matched.items()}
+        rows = []
+        for r in page:
+            c = customer_stats.fold(by_cluster.get(r['cluster_key'], []), matched)
+            c.update(dict(r))  # scope totals + tier from the aggregate row
+            rows.append(c)
+
+    site_managers = {s['url']: (s['manager'] or '')
+                     for s in conn.execute('SELECT url, manager FROM sites').fetchall()}
+    thresholds = _customer_thresholds()
+    return [_customer_display_row(c, site_managers, thresholds) for c in rows], next_cursor
+
+
+def _customer_summary(conn, scope):
+    """KPI cards / tier chart / loss strip over every identity in scope — one
+    aggregate over the identity relation, no per-customer Python."""
+    with_sql, params = _customer_identities_sql(scope)
+    t = _customer_thresholds()
+    s = conn.execute(f"""
+        {with_sql}
+        SELECT COUNT(*) AS total_customers,
+               COALESCE(SUM(total_spent), 0) AS total_revenue,
+               COALESCE(SUM(successful_orders), 0) AS total_success_orders,
+               COALESCE(SUM(successful_orders > 1), 0) AS repeat_customers,
+               COALESCE(SUM(CASE WHEN successful_orders > 1 THEN successful_orders ELSE 0 END), 0) AS repeat_success_orders,
+               COALESCE(SUM(CASE WHEN successful_orders > 1 THEN total_spent ELSE 0 END), 0) AS repeat_spending,
+               COALESCE(SUM(first_order_date >= ?), 0) AS new_customers_month,
+               COALESCE(SUM(first_order_date < ? AND first_order_date >= ?), 0) AS new_customers_last_month,
+               COALESCE(SUM(tier = 'VIP'), 0) AS tier_vip,
+               COALESCE(SUM(tier = '优质'), 0) AS tier_good,
+               COALESCE(SUM(tier = '普通'), 0) AS tier_normal,
+               COALESCE(SUM(tier = '新客'), 0) AS tier_new,
+               COALESCE(SUM(total_loss > 0), 0) AS customers_with_loss,
+               COALESCE(SUM(undelivered_orders > 0), 0) AS undelivered_customers,
+               COALESCE(SUM(problem_return_orders > 0), 0) AS problem_return_customers,
+               COALESCE(SUM(shipping_loss_total), 0) AS shipping_loss_total,
+               COALESCE(SUM(product_loss_total), 0) AS product_loss_total
+        FROM ids
+    """, params + [t['thirty_days_ago'], t['thirty_days_ago'], t['sixty_days_ago']]).fetchone()
+    by_currency = conn.execute(f"""
+        {with_sql}
+        SELECT COALESCE(currency, 'N/A') AS currency,
+               SUM(shipping_loss_total) AS shipping, SUM(product_loss_total) AS product
+        FROM ids
+        WHERE shipping_loss_total != 0 OR product_loss_total != 0
+        GROUP BY COALESCE(currency, 'N/A')
+    """, params).fetchall()
 
-    # Aggregate loss bookkeeping so the page can headline "who's costing us money".
+    total_customers = s['total_customers']
+    total_revenue = s['total_revenue']
+    new_month, new_last_month = s['new_customers_month'], s['new_customers_last_month']
+    if new_last_month > 0:
+        growth_rate = ((new_month - new_last_month) / new_last_month) * 100
+    else:
+        growth_rate = 100 if new_month > 0 else 0
+
+    # Per-currency breakdown so the overview strip can label amounts with
+    # their real currency instead of an ambiguous bare number. Single-country
+    # users get one bucket; admins viewing all countries get several.
+    currency_rows = sorted(({'currency': r['currency'], 'shipping': round(r['shipping'], 2),
+                             'product': round(r['product'], 2)} for r in by_currency),
+                           key=lambda r: -(r['shipping'] + r['product']))
     loss_stats = {
-        'customers_with_loss': 0,        # distinct identities with any shipping/product loss
-        'undelivered_customers': 0,      # identities with ≥1 undelivered order
-        'problem_return_customers': 0,   # identities with ≥1 problem-return order
-        'shipping_loss_total': 0.0,      # summed across identities (native currency, see note)
-        'product_loss_total': 0.0,
-        # Per-currency breakdown so the overview strip can label amounts with
-        # their real currency instead of an ambiguous bare number. Single-country
-        # users get one bucket; admins viewing all countries get several.
-        'by_currency': {},               # {currency: {'shipping': x, 'product': y}}
+        'customers_with_loss': s['customers_with_loss'],
+        'undelivered_customers': s['undelivered_customers'],
+        'problem_return_customers': s['problem_return_customers'],
+        'shipping_loss_total': round(s['shipping_loss_total'], 2),
+        'product_loss_total': round(s['product_loss_total'], 2),
+        'combined_loss_total': round(round(s['shipping_loss_total'], 2) + round(s['product_loss_total'], 2), 2),
+        'by_currency': {r['currency']: {'shipping': r['shipping'], 'product': r['product']} for r in currency_rows},
+        'currency_rows': currency_rows,
+        'uniform_currency': currency_rows[0]['currency'] if len(currency_rows) == 1 else None,
     }
-
-    # ── Phase A: fold the per-email SQL rows into identity clusters ──
-    # Each SQL row is one raw email (GROUP BY email). We sum its numbers into the
-    # cluster that _resolve_identity_clusters assigned its normalized email to.
-    # Guest orders with no email never merge — each gets a unique singleton key.
-    identities = {}
-    _singleton_seq = 0
-    for row in customers_data:
-        c = dict(row)
-        raw_email = c.get('email')
-        norm = _normalize_email(raw_email)
-        ck = email_to_cluster.get(norm) if norm else None
-        if not ck:
-            _singleton_seq += 1
-            ck = f"__noemail_{_singleton_seq}"
-
-        idn = identities.get(ck)
-        if idn is None:
-            idn = identities[ck] = {
-                'cluster_key': ck,
-                'emails_by_spend': [], 'names_by_spend': [], 'phones': set(),
-                'total_orders': 0, 'successful_orders': 0, 'total_spent': 0.0,
-                'undelivered_orders': 0, 'shipping_loss_total': 0.0,
-                'problem_return_orders': 0, 'product_loss_total': 0.0,
-                'sources': set(), 'currencies': set(),
-                'first_order_date': None, 'last_order_date': None,
-            }
-        spend = float(c.get('total_spent') or 0)
-        if raw_email:
-            idn['emails_by_spend'].append((spend, raw_email))
-        nm = (c.get('name') or '').strip()
-        if nm:
-            idn['names_by_spend'].append((spend, nm))
-        if c.get('phone'):
-            idn['phones'].add(str(c['phone']).strip())
-        idn['total_orders'] += int(c.get('total_orders') or 0)
-        idn['successful_orders'] += int(c.get('successful_orders') or 0)
-        idn['total_spent'] += spend
-        idn['undelivered_orders'] += int(c.get('undelivered_orders') or 0)
-        idn['shipping_loss_total'] += float(c.get('shipping_loss_total') or 0)
-        idn['problem_return_orders'] += int(c.get('problem_return_orders') or 0)
-        idn['product_loss_total'] += float(c.get('product_loss_total') or 0)
-        for s in (c.get('sources') or '').split(','):
-            s = s.strip()
-            if s:
-                idn['sources'].add(s)
-        for cur in (c.get('currencies') or '').split(','):
-            cur = cur.strip()
-            if cur:
-                idn['currencies'].add(cur)
-        fod, lod = c.get('first_order_date'), c.get('last_order_date')
-        if fod:
-            idn['first_order_date'] = fod if idn['first_order_date'] is None else min(idn['first_order_date'], fod)
-        if lod:
-            idn['last_order_date'] = lod if idn['last_order_date'] is None else max(idn['last_order_date'], lod)
-
-    # ── Phase C: derive per-identity display fields + accumulate page stats ──
-    customers_list = []
-    for ck, idn in identities.items():
-        c = {}
-        idn['emails_by_spend'].sort(reverse=True)
-        idn['names_by_spend'].sort(reverse=True)
-        # Representative name + primary email = the highest-spending within the
-        # merged identity (so the "main" account leads the display).
-        primary_email = idn['emails_by_spend'][0][1] if idn['emails_by_spend'] else ''
-        c['email'] = primary_email
-        c['name'] = idn['names_by_spend'][0][1] if idn['names_by_spend'] else (primary_email or 'Unknown')
-        c['phone'] = next(iter(idn['phones'])) if idn['phones'] else ''
-
-        # Merged-identity surfacing: how many distinct emails/phones rolled up.
-        distinct_emails = sorted({e for _, e in idn['emails_by_spend']}, key=str.lower)
-        c['identity_emails'] = distinct_emails
-        c['identity_email_count'] = len(distinct_emails)
-        c['identity_phone_count'] = len(idn['phones'])
-        c['identity_matched_by'] = sorted(cluster_meta.get(ck, {}).get('matched_by', set()))
-
-        c['total_orders'] = idn['total_orders']
-        c['successful_orders'] = idn['successful_orders']
-        c['total_spent'] = round(idn['total_spent'], 2)
-        c['undelivered_orders'] = idn['undelivered_orders']
-        c['shipping_loss_total'] = round(idn['shipping_loss_total'], 2)
-        c['problem_return_orders'] = idn['problem_return_orders']
-        c['product_loss_total'] = round(idn['product_loss_total'], 2)
-        c['total_loss'] = round(c['shipping_loss_total'] + c['product_loss_total'], 2)
-        c['refusal_rate'] = round(c['undelivered_orders'] / c['total_orders'] * 100, 1) if c['total_orders'] else 0
-        c['first_order_date'] = idn['first_order_date']
-        c['last_order_date'] = idn['last_order_date']
-        cur_str = sorted(idn['currencies'])[0] if idn['currencies'] else 'N/A'
-        c['currency'] = cur_str
-        c['currencies'] = ','.join(sorted(idn['currencies']))
-
-        total_revenue += c['total_spent']
-
-        if c['total_loss'] > 0:
-            loss_stats['customers_with_loss'] += 1
-        if c['undelivered_orders'] > 0:
-            loss_stats['undelivered_customers'] += 1
-        if c['problem_return_orders'] > 0:
-            loss_stats['problem_return_customers'] += 1
-        loss_stats['shipping_loss_total'] += c['shipping_loss_total']
-        loss_stats['product_loss_total'] += c['product_loss_total']
-        if c['shipping_loss_total'] or c['product_loss_total']:
-            bucket = loss_stats['by_currency'].setdefault(cur_str, {'shipping': 0.0, 'product': 0.0})
-            bucket['shipping'] += c['shipping_loss_total']
-            bucket['product'] += c['product_loss_total']
-
-        total_success_orders += c['successful_orders']
-        if c['successful_orders'] > 1:
-            repeat_customers += 1
-            repeat_success_orders += c['successful_orders']
-            repeat_spending += c['total_spent']
-        if c['first_order_date'] and c['first_order_date'] >= thirty_days_ago:
-            new_customers_month += 1
-        elif c['first_order_date'] and c['first_order_date'] >= sixty_days_ago:
-            new_customers_last_month += 1
-
-        # Calculate Tier (same logic as API), now over the merged identity.
-        avg_days = 0
-        if c['successful_orders'] > 1 and c['first_order_date'] and c['last_order_date']:
-            first = datetime.datetime.fromisoformat(c['first_order_date'])
-            last = datetime.datetime.fromisoformat(c['last_order_date'])
-            days = (last - first).days or 1
-            avg_days = days / c['successful_orders']
-
-        score = min(c['successful_orders'] * 10, 30) + min(c['total_spent'] / 100, 40)
-        score += 30 if avg_days > 0 and avg_days < 60 else (15 if avg_days < 120 else 0)
-        score = min(score, 100)
-
-        if score >= 80: tier = 'VIP'
-        elif score >= 60: tier = '优质'
-        elif score >= 40: tier = '普通'
-        else: tier = '新客'
-
-        c['tier'] = tier
-        tier_counts[tier] += 1
-
-        # Smart Actions
-        actions = []
-        if tier == 'VIP':
-            actions.append({'type': 'success', 'icon': 'gift', 'text': '专属礼遇'})
-            actions.append({'type': 'primary', 'icon': 'people', 'text': '邀请入群'})
-        elif c['last_order_date'] and c['last_order_date'] < ninety_days_ago:
-            actions.append({'type': 'warning', 'icon': 'ticket-perforated', 'text': '召回优惠券'})
-        elif c['successful_orders'] == 1 and c['first_order_date'] and c['first_order_date'] >= thirty_days_ago:
-            actions.append({'type': 'info', 'icon': 'book', 'text': '欢迎指南'})
-            actions.append({'type': 'info', 'icon': 'bag-plus', 'text': '关联推荐'})
-        elif c['successful_orders'] > 3:
-            actions.append({'type': 'primary', 'icon': 'arrow-repeat', 'text': '订阅服务'})
-        c['actions'] = actions
-
-        # Sources across the WHOLE identity (drives the 多站下单 column).
-        sources = sorted(idn['sources'])
-        c['source'] = sources[0] if sources else 'Unknown'
-        c['all_sources'] = sources
-        c['site_count'] = len(sources)
-        c['site_list'] = [{
-            'url': s,
-            'short': s.replace('https://www.', '').replace('https://', ''),
-            'manager': site_managers_global.get(s, ''),
-        } for s in sources]
-
-        customers_list.append(c)
-
-    # Identity count drives all the per-customer rate stats below.
-    total_customers = len(customers_list)
-    # Initial server-side order: highest spenders first (DataTables re-sorts client-side).
-    customers_list.sort(key=lambda x: x['total_spent'], reverse=True)
-
-    # Calculate growth rate
-    if new_customers_last_month > 0:
-        growth_rate = ((new_customers_month - new_customers_last_month) / new_customers_last_month) * 100
-    else:
-        growth_rate = 100 if new_customers_month > 0 else 0
-
-    loss_stats['shipping_loss_total'] = round(loss_stats['shipping_loss_total'], 2)
-    loss_stats['product_loss_total'] = round(loss_stats['product_loss_total'], 2)
-    loss_stats['combined_loss_total'] = round(
-        loss_stats['shipping_loss_total'] + loss_stats['product_loss_total'], 2)
-    # Round per-currency buckets and expose a sorted list for the template,
-    # plus a single uniform_currency when there's exactly one in view.
-    for cur, b in loss_stats['by_currency'].items():
-        b['shipping'] = round(b['shipping'], 2)
-        b['product'] = round(b['product'], 2)
-    loss_stats['currency_rows'] = [
-        {'currency': cur, 'shipping': b['shipping'], 'product': b['product']}
-        for cur, b in sorted(loss_stats['by_currency'].items(),
-                             key=lambda kv: -(kv[1]['shipping'] + kv[1]['product']))
-    ]
-    loss_stats['uniform_currency'] = (
-        loss_stats['currency_rows'][0]['currency']
-        if len(loss_stats['currency_rows']) == 1 else None
-    )
-
-    stats = {
+    # Repeat-rate numerators/denominators for the three switchable口径:
+    #   headcount = repeat_customers / total_customers
+    #   by_orders = repeat_success_orders / total_success_orders
+    #   by_revenue = repeat_spending / total_revenue
+    return {
         'total_customers': total_customers,
         'avg_ltv': total_revenue / total_customers if total_customers > 0 else 0,
-        'repeat_rate': (repeat_customers / total_customers * 100) if total_customers > 0 else 0,
+        'repeat_rate': (s['repeat_customers'] / total_customers * 100) if total_customers > 0 else 0,
         # Weighted repeat-rate variants (switchable on the KPI card).
-        'repeat_rate_orders': (repeat_success_orders / total_success_orders * 100) if total_success_orders > 0 else 0,
-        'repeat_rate_revenue': (repeat_spending / total_revenue * 100) if total_revenue > 0 else 0,
-        'repeat_customers': repeat_customers,
-        'repeat_success_orders': repeat_success_orders,
-        'total_success_orders': total_success_orders,
-        'repeat_spending': round(repeat_spending, 2),
-        'new_customer_rate': (new_customers_month / total_customers * 100) if total_customers > 0 else 0,
-        'new_customers_month': new_customers_month,
-        'new_customers_last_month': new_customers_last_month,
+        'repeat_rate_orders': (s['repeat_success_orders'] / s['total_success_orders'] * 100) if s['total_success_orders'] > 0 else 0,
+        'repeat_rate_revenue': (s['repeat_spending'] / total_revenue * 100) if total_revenue > 0 else 0,
+        'repeat_customers': s['repeat_customers'],
+        'repeat_success_orders': s['repeat_success_orders'],
+        'total_success_orders': s['total_success_orders'],
+        'repeat_spending': round(s['repeat_spending'], 2),
+        'new_customer_rate': (new_month / total_customers * 100) if total_customers > 0 else 0,
+        'new_customers_month': new_month,
+        'new_customers_last_month': new_last_month,
         'growth_rate': growth_rate,
-        'tier_counts': tier_counts,
+        'tier_counts': {'VIP': s['tier_vip'], '优质': s['tier_good'], '普通': s['tier_normal'], '新客': s['tier_new']},
         'loss': loss_stats,
     }
-    
+
+
+@app.route('/customers')
+@login_required
+def customers():
+    """Customer analysis page. The list itself is fetched page by page from
+    /api/customers; this view renders the filters, KPI cards and charts."""
+    return render_template('customers.html', **_cached_view('customers', _customers_context))
+
+
+def _customers_context():
+    """Template context of the customers page (cached by customers())."""
+    conn = get_db_connection()
+    _refresh_customer_stats(conn)
+    scope = _customers_scope(conn)
+
+    # All countries for the filter dropdown
+    all_countries = [c['country'] for c in conn.execute(
+        "SELECT DISTINCT country FROM sites WHERE country IS NOT NULL AND country != '' ORDER BY country"
+    ).fetchall()]
+
+    # Get all managers
+    all_managers = get_all_managers()
+
+    # Source dropdown: sites with customers the user may see, narrowed by the
+    # manager filter (idx_customer_accounts_source answers the DISTINCT).
+    source_conditions, source_params = [], []
+    if scope['allowed_sources'] is not None:
+        if scope['allowed_sources']:
+            source_conditions.append(f"source IN ({','.join('?' * len(scope['allowed_sources']))})")
+            source_params.extend(scope['allowed_sources'])
+        else:
+            source_conditions.append('1=0')
+    if scope['manager']:
+        source_conditions.append('source IN (SELECT url FROM sites WHERE manager = ?)')
+        source_params.append(scope['manager'])
+    all_sources = conn.execute(
+        f"SELECT DISTINCT source FROM customer_accounts "
+        f"{'WHERE ' + ' AND '.join(source_conditions) if source_conditions else ''} ORDER BY source",
+        source_params).fetchall()
+
+    stats = _customer_summary(conn, scope)
+    top_customers, _ = _customer_page(conn, scope, limit=10)
+
     # Get site managers mapping
-    conn2 = get_db_connection()
-    sites = conn2.execute('SELECT url, manager FROM sites').fetchall()
-    site_managers = {s['url']: s['manager'] or '' for s in sites}
-    conn2.close()
-    
-    current_filters = {
-        'source': source_filter,
-        'manager': manager_filter,
-        'country': country_filter,
-        'quick_date': quick_date,
-        'date_from': date_from,
-        'date_to': date_to,
+    site_managers = {s['url']: s['manager'] or ''
+                     for s in conn.execute('SELECT url, manager FROM sites').fetchall()}
+    conn.close()
+
+    current_filters = {k: scope[k] for k in ('source', 'manager', 'country', 'quick_date', 'date_from', 'date_to')}
+    period_active = bool(scope['date_from'] or scope['date_to'])
+    return dict(top_customers=top_customers, stats=stats, sources=all_sources,
+                source_filter=scope['source'], manager_filter=scope['manager'], all_managers=all_managers,
+                site_managers=site_managers, all_countries=all_countries,
+                current_filters=current_filters, period_active=period_active)
+
+
+@app.route('/api/customers')
+@login_required
+def api_customers():
+    """Customer list, one keyset page at a time.
+
+    Query: the /customers filters (source, manager, country, quick_date,
+    date_from, date_to) plus sort (one of customer_stats.SORT_COLUMNS), dir
+    (asc|desc), q (name / email / phone), loss_only, multi_site, merged
+    (1 = on), limit (≤ 200) and cursor (the next_cursor of the previous
+    page). The first page (no cursor) also carries the filtered total.
+    """
+    sort = request.args.get('sort', 'total_spent')
+    if sort not in customer_stats.SORT_COLUMNS:
+        return jsonify({'success': False, 'error': f'不支持的排序字段: {sort}'}), 400
+    direction = 'asc' if request.args.get('dir') == 'asc' else 'desc'
+    try:
+        limit = max(1, min(int(request.args.get('limit', 25)), 200))
+    except ValueError:
+        limit = 25
+    after = None
+    if request.args.get('cursor'):
+        try:
+            after = json.loads(request.args['cursor'])
+            if not (isinstance(after, list) and len(after) == 2):
+                raise ValueError
+        except ValueError:
+            return jsonify({'success': False, 'error': '无效的分页游标'}), 400
+    filters = {
+        'q': request.args.get('q', ''),
+        'loss_only': request.args.get('loss_only') == '1',
+        'multi_site': request.args.get('multi_site') == '1',
+        'merged': request.args.get('merged') == '1',
     }
-    period_active = bool(date_from or date_to)
-    return render_template('customers.html', customers=customers_list, stats=stats, sources=all_sources,
-                           source_filter=source_filter, manager_filter=manager_filter, all_managers=all_managers,
-                           site_managers=site_managers, all_countries=all_countries,
-                           current_filters=current_filters, period_active=period_active)
+
+    conn = get_db_connection()
+    try:
+        _refresh_customer_stats(conn)
+        scope = _customers_scope(conn)
+        rows, next_cursor = _customer_page(conn, scope, sort, direction, limit, after, filters)
+        result = {'success': True, 'customers': rows,
+                  'next_cursor': json.dumps(next_cursor, ensure_ascii=False) if next_cursor else None}
+        if after is None:
+            with_sql, params = _customer_identities_sql(scope, filters)
+            result['total'] = conn.execute(f'{with_sql} SELECT COUNT(*) FROM ids', params).fetchone()[0]
+        return jsonify(result)
+    finally:
+        conn.close()
 
 
 @app.route('/api/customers/loss-list')
@@ -4798,6 +4919,7 @@ def loss_customers_list():
 
 @app.route('/api/chart-data')
 @login_required
+@conditional_json
 def chart_data():
     """API endpoint for chart data"""
     conn = get_db_connection()
@@ -4806,12 +4928,12 @@ def chart_data():
     
     if chart_type == 'monthly':
         data = conn.execute('''
-            SELECT strftime('%Y-%m', date_created) as month,
+            SELECT year_month as month,
                    source,
                    COUNT(*) as orders,
                    SUM(total) as revenue
             FROM orders
-            WHERE date_created >= date('now', '-12 months')
+            WHERE day >= date('now', '-12 months')
             GROUP BY month, source
             ORDER BY month
         ''').fetchall()
@@ -4977,19 +5099,29 @@ def get_customer_details(email):
             scope_params.extend(allowed_sources)
         else:
             scope_conditions.append('1=0')
-    scope_where = 'WHERE ' + ' AND '.join(scope_conditions)
 
+    # Only this one cluster is read from the persisted graph (identity_graph.py),
+    # then narrowed to the emails that have an order in scope.
     norm_email = _normalize_email(email)
-    email_to_cluster, cluster_meta = _resolve_identity_clusters(conn, scope_where, scope_params)
-    cluster_key = email_to_cluster.get(norm_email) if norm_email else None
-    if cluster_key and cluster_key in cluster_meta:
-        identity_emails = sorted(cluster_meta[cluster_key]['emails'])
-        identity_matched_by = sorted(cluster_meta[cluster_key]['matched_by'])
-    else:
-        identity_emails = [norm_email] if norm_email else []
-        identity_matched_by = []
-
-    # Get all orders across EVERY email in the identity (case-insensitive).
+    identity_emails = []
+    identity_matched_by = []
+    cluster = identity_graph.clusters_for(conn, [norm_email]).get(norm_email) if norm_email else None
+    if cluster:
+        members = identity_graph.cluster_members(conn, cluster[0])
+        ph = ','.join(['?'] * len(members))
+        in_scope = {r['email'] for r in conn.execute(f'''
+            SELECT DISTINCT k.email FROM identity_keys k JOIN orders ON orders.id = k.order_id
+            WHERE k.email IN ({ph}) AND {' AND '.join(scope_conditions)}
+        ''', members + scope_params)}
+        identity_emails = [e for e in members if e in in_scope]
+        if identity_emails:
+            matched = identity_graph.clusters_for(conn, identity_emails)
+            identity_matched_by = sorted(set().union(*(matched[e][1] for e in identity_emails if e in matched)))
+    if not identity_emails and norm_email:
+        identity_emails = [norm_email]
+
+    # Get all orders across EVERY email in the identity (identity_keys holds
+    # each order's normalized email, so this is an index lookup).
     if identity_emails:
         ident_ph = ','.join(['?'] * len(identity_emails))
         order_sql = f'''
@@ -4997,20 +5129,20 @@ def get_customer_details(email):
                    payment_method, is_undelivered, shipping_loss_amount,
                    is_problem_return, delivery_confirmed, undelivered_note, carrier_status
             FROM orders
-            WHERE lower(trim(json_extract(billing, '$.email'))) IN ({ident_ph})
+            WHERE id IN (SELECT order_id FROM identity_keys WHERE email IN ({ident_ph}))
               AND {' AND '.join(scope_conditions)}
             ORDER BY date_created DESC
         '''
         orders = conn.execute(order_sql, identity_emails + scope_params).fetchall()
     else:
-        orders = conn.execute('''
+        orders = conn.execute(f'''
             SELECT id, number, status, total, currency, shipping_total, date_created, source, line_items, billing,
                    payment_method, is_undelivered, shipping_loss_amount,
                    is_problem_return, delivery_confirmed, undelivered_note, carrier_status
             FROM orders
-            WHERE json_extract(billing, '$.email') = ? AND status NOT IN ('checkout-draft', 'trash')
+            WHERE json_extract(billing, '$.email') = ? AND {' AND '.join(scope_conditions)}
             ORDER BY date_created DESC
-        ''', (email,)).fetchall()
+        ''', [email] + scope_params).fetchall()
 
     # On-hold is "shipped" only for sites flagged so (PL by default).
     on_hold_shipped_sources = {
@@ -5299,6 +5431,7 @@ def update_customer_quality():
                 quality_tier = excluded.quality_tier,
                 updated_at = excluded.updated_at
         ''', (email, quality))
+        order_index.bump_versions(conn, ['customer_settings'])
         conn.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -5340,6 +5473,7 @@ def block_customer():
                 reason = excluded.reason,
                 auto_cancel = excluded.auto_cancel
         ''', (norm, phone_raw, name, email, reason, auto_cancel, current_user.name))
+        order_index.bump_versions(conn, ['blocked_customers'])
         conn.commit()
         return jsonify({'success': True, 'phone': norm})
     except Exception as e:
@@ -5362,6 +5496,7 @@ def unblock_customer():
     conn = get_db_connection()
     try:
         conn.execute("DELETE FROM blocked_customers WHERE phone = ?", (norm,))
+        order_index.bump_versions(conn, ['blocked_customers'])
         conn.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -5380,6 +5515,8 @@ def blocklist_enforce_now():
     conn = get_db_connection()
     try:
         summary = blocklist.enforce(conn, dry_run=dry, actor=f'manual:{current_user.name}')
+        if summary['cancelled'] and not dry:
+            _kick_wc_outbox()
         return jsonify({'success': True, 'summary': summary})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -5704,14 +5841,18 @@ def init_sites_table():
     # Once an admin toggles a row to 0 or 1, this WHERE clause skips it on the
     # next boot. New sites added later also get classified here on first boot
     # after their country is set.
-    conn.execute("""
+    changed = conn.execute("""
         UPDATE sites SET cod_on_hold_is_shipped = 1
         WHERE cod_on_hold_is_shipped IS NULL AND country = 'PL'
-    """)
-    conn.execute("""
+    """).rowcount
+    changed += conn.execute("""
         UPDATE sites SET cod_on_hold_is_shipped = 0
         WHERE cod_on_hold_is_shipped IS NULL AND country IS NOT NULL AND country != 'PL'
-    """)
+    """).rowcount
+    if changed:
+        # Revenue status depends on this flag (see _on_hold_is_shipped_clause).
+        order_index.ensure_version_table(conn)
+        order_index.bump_versions(conn, ['sites'])
     conn.commit()
     conn.close()
 
@@ -5744,6 +5885,78 @@ def init_product_masters_table():
     conn.close()
 
 
+def init_clone_media_table():
+    """Initialize clone_media — images already sideloaded into a target site by
+    product cloning, keyed by the source image URL (scheme stripped). Later
+    clones to the same target attach the existing media id instead of making
+    WC download the same file again."""
+    conn = get_db_connection()
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS clone_media (
+            target TEXT NOT NULL,
+            source_key TEXT NOT NULL,
+            media_id INTEGER NOT NULL,
+            media_src TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (target, source_key)
+        )
+    ''')
+    conn.commit()
+    conn.close()
+
+
+def init_link_check_table():
+    """Create url_liveness, the remembered dead-link answers shared by product
+    cloning and repair_inline_images.py. See link_check.py."""
+    conn = get_db_connection()
+    link_check.ensure_schema(conn)
+    conn.close()
+
+
+def init_wc_outbox_table():
+    """Create wc_outbox, the queue of WooCommerce write-backs drained by
+    _wc_outbox_loop (and the hourly cron). See wc_outbox.py."""
+    conn = get_db_connection()
+    wc_outbox.ensure_schema(conn)
+    conn.close()
+
+
+# 写回队列 worker：每个进程一个后台线程，入队后 _kick_wc_outbox() 立即唤醒，
+# 否则每 WC_OUTBOX_POLL_SECONDS 秒检查一次到期的重试。多进程（gunicorn）下
+# 各 worker 抢占同一张表，wc_outbox 的认领是原子的，不会重复推送。
+WC_OUTBOX_POLL_SECONDS = 30
+_wc_outbox_wake = threading.Event()
+_wc_outbox_worker = {'pid': None, 'thread': None}
+_WC_OUTBOX_GUARD = threading.Lock()
+
+
+def _wc_outbox_loop(app_context):
+    with app_context:
+        while True:
+            _wc_outbox_wake.wait(WC_OUTBOX_POLL_SECONDS)
+            _wc_outbox_wake.clear()
+            try:
+                summary = wc_outbox.drain(get_db_connection)
+                if summary['retry'] or summary['dead']:
+                    app.logger.warning(f"wc outbox: {summary}")
+            except Exception:
+                app.logger.exception('wc outbox drain failed')
+
+
+def _kick_wc_outbox():
+    """Wake this process's outbox worker, starting it on first use (and again
+    in a forked worker process, where the parent's thread does not exist)."""
+    import os
+
+    with _WC_OUTBOX_GUARD:
+        thread = _wc_outbox_worker['thread']
+        if thread is None or not thread.is_alive() or _wc_outbox_worker['pid'] != os.getpid():
+            thread = threading.Thread(target=_wc_outbox_loop, args=(app.app_context(),), daemon=True)
+            _wc_outbox_worker.update(pid=os.getpid(), thread=thread)
+            thread.start()
+    _wc_outbox_wake.set()
+
+
 def init_sync_logs_table():
     """Initialize sync_logs table for storing synchronization history"""
     conn = get_db_connection()
@@ -5941,16 +6154,119 @@ def init_problem_return_columns():
     conn.close()
 
 
-def init_shipping_tables():
-    """Initialize shipping-related tables"""
+def init_order_date_columns():
+    """Add the stored, indexed year_month / day buckets to orders.
+    Month pages filter on these instead of strftime()/date() over
+    date_created, which forced a full scan per query. The sync upserts keep
+    them in step with date_created; see order_index.py.
+    Also creates data_versions, the change counters snapshots are keyed on,
+    and the (date_created, id) index export_orders pages through."""
     conn = get_db_connection()
+    order_index.ensure_schema(conn)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_created_id ON orders(date_created, id)')
+    conn.commit()
+    conn.close()
 
-    # Add can_ship column to users table if not exists
-    try:
-        conn.execute('ALTER TABLE users ADD COLUMN can_ship INTEGER DEFAULT 0')
-        conn.commit()
-    except:
-        pass  # Column already exists
+
+def init_customer_risk_keys():
+    """Create customer_risk_keys (normalized email / phone / address of every
+    undelivered / problem-return order) and fill it on the first start. The
+    mark / unmark endpoints and the sync upsert keep it current; see
+    customer_risk.py and _build_risk_index."""
+    conn = get_db_connection()
+    customer_risk.ensure_schema(conn)
+    conn.close()
+
+
+def init_order_search_index():
+    """Create orders_fts (trigram full-text index) and index orders that have
+    no search document yet — the whole archive on the first start. Runs
+    after the shipping / undelivered / problem-return migrations because the
+    documents include shipping_logs tracking numbers and the local notes.
+    See order_search.py."""
+    conn = get_db_connection()
+    order_search.ensure_schema(conn)
+    conn.close()
+
+
+def init_identity_graph():
+    """Create the persisted customer identity graph (identity_keys /
+    identity_clusters) and build it from every order on the first start.
+    The sync upserts keep it current; see identity_graph.py."""
+    conn = get_db_connection()
+    identity_graph.ensure_schema(conn)
+    conn.close()
+
+
+def init_customer_stats():
+    """Create customer_stats / customer_accounts and build them (every
+    identity is queued on the first start). Writers queue changed customers;
+    readers fold the queue in first — see customer_stats.py."""
+    conn = get_db_connection()
+    customer_stats.ensure_schema(conn)
+    _refresh_customer_stats(conn)
+    conn.close()
+
+
+def init_site_traffic_table():
+    """Create site_traffic_daily, the per-day 51.la traffic /report
+    aggregates from. Filled on demand; see site_traffic.py."""
+    conn = get_db_connection()
+    site_traffic.ensure_schema(conn)
+    conn.close()
+
+
+def init_wc_catalog_tables():
+    """Create the wc_products / wc_variations mirror the product manager
+    browses. Filled on first use per catalog; see wc_catalog.py."""
+    conn = get_db_connection()
+    wc_catalog.ensure_schema(conn)
+    conn.close()
+
+
+def init_order_tracking_table():
+    """Create order_tracking and extract every order's tracking numbers into
+    it on the first start (needs shipping_logs, so it runs with the search
+    index). See order_tracking.py."""
+    conn = get_db_connection()
+    order_tracking.ensure_schema(conn)
+    conn.close()
+
+
+def init_latest_note_pointers():
+    """Add orders.latest_note_id / latest_user_note_id (+ the order_notes
+    index behind them) and point existing orders. See latest_note.py."""
+    conn = get_db_connection()
+    latest_note.ensure_schema(conn)
+    conn.close()
+
+
+def init_shipping_view_table():
+    """Create shipping_view and derive every order's shipping-queue display
+    fields into it on the first start. See shipping_view.py."""
+    conn = get_db_connection()
+    shipping_view.ensure_schema(conn)
+    conn.close()
+
+
+def init_site_profiles():
+    """Add sites.tracking_profile / tracking_profile_at and scan every site
+    once on the first start (needs shipping_carriers). See site_profile.py."""
+    conn = get_db_connection()
+    site_profile.ensure_schema(conn)
+    conn.close()
+
+
+def init_shipping_tables():
+    """Initialize shipping-related tables"""
+    conn = get_db_connection()
+
+    # Add can_ship column to users table if not exists
+    try:
+        conn.execute('ALTER TABLE users ADD COLUMN can_ship INTEGER DEFAULT 0')
+        conn.commit()
+    except:
+        pass  # Column already exists
 
     # Add can_view_shipping — view-only access to 发货管理 (see lists/status but
     # cannot operate). Anyone with can_ship implicitly has view.
@@ -6031,6 +6347,67 @@ def init_shipping_tables():
     conn.close()
 
 
+# A running job's heartbeat_at moves with every stored result. Under gunicorn
+# (several workers, no preload) a worker restart must not fail jobs another
+# live worker is still shipping, so a job only counts as interrupted once its
+# heartbeat is older than the longest silent stretch of a run: the first
+# orders/batch round (120 s per call) plus a single-PUT fallback and the
+# email trigger of one order.
+SHIP_BATCH_STALE_SECONDS = 900
+
+
+def _expire_stale_ship_batches(conn):
+    """Fail running jobs whose worker stopped (heartbeat older than
+    SHIP_BATCH_STALE_SECONDS). Does not commit."""
+    conn.execute("""
+        UPDATE ship_batch_jobs SET status = 'error', error = '处理进程已停止，批量发货已中断，请核对未完成的订单',
+               finished_at = datetime('now')
+        WHERE status = 'running' AND COALESCE(heartbeat_at, created_at) < datetime('now', ?)
+    """, (f'-{SHIP_BATCH_STALE_SECONDS} seconds',))
+
+
+def init_ship_batch_tables():
+    """ship_batch_jobs / ship_batch_results behind /api/shipping/ship-batch.
+    Jobs whose worker stopped can never finish — those are marked failed
+    (_expire_stale_ship_batches) so the page stops polling."""
+    conn = get_db_connection()
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ship_batch_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            status TEXT NOT NULL DEFAULT 'running',
+            total INTEGER NOT NULL DEFAULT 0,
+            done INTEGER NOT NULL DEFAULT 0,
+            send_email INTEGER DEFAULT 1,
+            error TEXT,
+            created_by INTEGER,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            finished_at TEXT,
+            heartbeat_at TEXT
+        )
+    ''')
+    try:
+        conn.execute('ALTER TABLE ship_batch_jobs ADD COLUMN heartbeat_at TEXT')
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ship_batch_results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id INTEGER NOT NULL,
+            order_id TEXT,
+            success INTEGER NOT NULL,
+            warning INTEGER DEFAULT 0,
+            message TEXT,
+            format TEXT,
+            parcel_count INTEGER,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ship_batch_results_job ON ship_batch_results(job_id, id)')
+    _expire_stale_ship_batches(conn)
+    conn.commit()
+    conn.close()
+
+
 def init_product_tables():
     """Initialize product analysis tables (brands, series, product_mappings)"""
     conn = get_db_connection()
@@ -6096,7 +6473,10 @@ def init_product_tables():
             ('Lost Mary', '["LOST MARY", "LostMary"]'),
             ('Geek Bar', '["GEEK BAR", "GeekBar"]'),
         ]
+        before = conn.total_changes
         conn.executemany('INSERT OR IGNORE INTO brands (name, aliases) VALUES (?, ?)', default_brands)
+        if conn.total_changes > before:
+            order_index.bump_versions(conn, ['brands'])
         conn.commit()
     
     conn.close()
@@ -6335,6 +6715,19 @@ def init_sales_board_tables():
         )
     ''')
 
+    # Frozen board payloads for closed months (see _get_sales_board_data).
+    # restrict_manager '' = full team view.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sales_board_snapshots (
+            year_month TEXT NOT NULL,
+            restrict_manager TEXT NOT NULL DEFAULT '',
+            settings_version TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (year_month, restrict_manager)
+        )
+    ''')
+
     # No-commission brands table
     conn.execute('''
         CREATE TABLE IF NOT EXISTS no_commission_brands (
@@ -6346,11 +6739,14 @@ def init_sales_board_tables():
 
     # Insert default no-commission brands
     default_brands = ['L8', 'Esin', 'UR1']
+    before = conn.total_changes
     for brand in default_brands:
         try:
             conn.execute('INSERT OR IGNORE INTO no_commission_brands (brand_name) VALUES (?)', (brand,))
         except:
             pass
+    if conn.total_changes > before:
+        order_index.bump_versions(conn, ['no_commission_brands'])
 
     conn.commit()
     conn.close()
@@ -6621,6 +7017,21 @@ def init_partner_reconciliation_tables():
         except sqlite3.OperationalError:
             pass  # column already exists
 
+    # Computed _calc_partner_recon_detail payloads per (partner, month, site /
+    # manager slice) — see _calc_partner_recon_detail. '' = no filter.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS recon_detail_snapshots (
+            partner_id INTEGER NOT NULL,
+            year_month TEXT NOT NULL,
+            site_filter TEXT NOT NULL DEFAULT '',
+            manager_filter TEXT NOT NULL DEFAULT '',
+            settings_version TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (partner_id, year_month, site_filter, manager_filter)
+        )
+    ''')
+
     # Seed default partner: 金谷金毅（波兰）
     existing = conn.execute("SELECT id FROM partners WHERE code = 'poland_jin'").fetchone()
     if not existing:
@@ -6723,11 +7134,14 @@ def init_warehouses():
     except:
         pass
     # Backfill product_costs.warehouse_id from country
-    conn.execute('''
+    cur = conn.execute('''
         UPDATE product_costs SET warehouse_id = (
             SELECT w.id FROM warehouses w WHERE w.code = product_costs.country
         ) WHERE warehouse_id IS NULL
+          AND EXISTS (SELECT 1 FROM warehouses w WHERE w.code = product_costs.country)
     ''')
+    if cur.rowcount > 0:
+        order_index.bump_versions(conn, ['product_costs'])
 
     # Rebuild index to include effective_date — same product can have multiple
     # cost prices over time (e.g. Feb 28元, Mar 30元). Must keep ALL versions
@@ -6753,13 +7167,20 @@ def init_warehouses():
     # Earlier code joined on `w.code` (which holds the Chinese warehouse name) instead
     # of `w.country`, so the backfill never matched and ~38% of orders ended up with
     # NULL warehouse_id — which downstream cost lookups treat as "unmapped".
-    conn.execute('''
+    # Only rows that actually get a warehouse are touched, so the months
+    # bumped below are exactly the ones whose (actual-cost) board changed.
+    _wh_match = '''EXISTS (SELECT 1 FROM warehouses w JOIN sites s ON s.country = w.country
+                           WHERE s.url = orders.source)'''
+    backfill_months = [r[0] for r in conn.execute(
+        f'SELECT DISTINCT year_month FROM orders WHERE warehouse_id IS NULL AND {_wh_match}')]
+    conn.execute(f'''
         UPDATE orders SET warehouse_id = (
             SELECT MIN(w.id) FROM warehouses w
             JOIN sites s ON s.country = w.country
             WHERE s.url = orders.source
-        ) WHERE warehouse_id IS NULL
+        ) WHERE warehouse_id IS NULL AND {_wh_match}
     ''')
+    order_index.bump_versions(conn, [order_index.orders_scope(m) for m in backfill_months if m])
     try:
         conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_warehouse_id ON orders(warehouse_id)')
     except:
@@ -6820,17 +7241,189 @@ def init_blocklist_tables():
     conn.close()
 
 
+def init_view_cache():
+    """Enable view_cache's shared tier (VIEW_CACHE_DB, shared by the gunicorn
+    workers). A file that can't be opened just leaves the cache per process."""
+    try:
+        view_cache.configure(shared_path=VIEW_CACHE_DB)
+    except sqlite3.Error as e:
+        app.logger.warning(f"view cache: shared tier disabled ({e})")
+        view_cache.configure(shared_path=None)
+
+
+@app.route('/api/view-cache/stats')
+@login_required
+@admin_required
+def view_cache_stats():
+    """Hit / miss / eviction counters of this worker's view cache."""
+    return jsonify({'success': True, **view_cache.stats()})
+
+
+def _wc_outbox_op_label(op):
+    """Short description of an outbox op for the settings dead-letter list."""
+    payload = op.get('payload') or {}
+    if op['kind'] == 'order_update':
+        data = payload.get('data') or {}
+        if 'meta_data' in data or 'line_items' in data:
+            tn = next((m.get('value') for m in data.get('meta_data') or []
+                       if isinstance(m, dict) and m.get('key') == '_tracking_number'), '')
+            return f"写入运单 {tn}" + (f" + 状态 {data['status']}" if data.get('status') else '')
+        return f"状态 → {data.get('status', '?')}"
+    if op['kind'] == 'order_note':
+        return ('客户备注: ' if payload.get('customer_note') else '备注: ') + str(payload.get('note', ''))[:80]
+    if op['kind'] == 'shipment_email':
+        return f"发货通知 {payload.get('tracking_number', '')}"
+    return op['kind']
+
+
+@app.route('/api/wc-outbox')
+@login_required
+@admin_required
+def wc_outbox_list():
+    """Outbox counts plus the newest ops in one status (default 'dead' — the
+    dead-letter list on the settings page)."""
+    status = request.args.get('status', 'dead')
+    if status not in ('pending', 'running', 'done', 'dead', 'discarded'):
+        return jsonify({'success': False, 'error': f'无效状态: {status}'}), 400
+    conn = get_db_connection()
+    try:
+        ops = wc_outbox.list_ops(conn, status, limit=200)
+        ids = list({op['order_id'] for op in ops if op['order_id']})
+        numbers = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            for r in conn.execute(f"SELECT id, number FROM orders WHERE id IN ({','.join('?' * len(chunk))})", chunk):
+                numbers[r['id']] = r['number']
+        counts = wc_outbox.counts(conn)
+    finally:
+        conn.close()
+    return jsonify({
+        'success': True,
+        'counts': counts,
+        'ops': [{
+            'id': op['id'],
+            'source': op['source'],
+            'order_id': op['order_id'],
+            'number': numbers.get(op['order_id']),
+            'kind': op['kind'],
+            'label': _wc_outbox_op_label(op),
+            'attempts': op['attempts'],
+            'last_error': op['last_error'],
+            'actor': op['actor'],
+            'created_at': op['created_at'],
+            'updated_at': op['updated_at'],
+        } for op in ops],
+    })
+
+
+@app.route('/api/wc-outbox/orders')
+@login_required
+def wc_outbox_order_state():
+    """Queued / dead-lettered site writes per order (?ids=a,b,...) — drives the
+    "同步中" / "同步失败" badges of the order and shipping lists. Not cached:
+    outbox progress does not bump the data versions the list views key on."""
+    ids = [i for i in request.args.get('ids', '').split(',') if i][:1000]
+    allowed = get_user_allowed_sources(current_user.id, current_user.is_admin(), current_user.is_viewer())
+    conn = get_db_connection()
+    try:
+        state = wc_outbox.pending_orders(conn, ids, sources=allowed)
+    finally:
+        conn.close()
+    return jsonify({'success': True, 'orders': state})
+
+
+@app.route('/api/wc-outbox/<action>', methods=['POST'])
+@login_required
+@admin_required
+def wc_outbox_resolve(action):
+    """Dead-letter actions. Body {ids: [...]}.
+    retry    back to the queue (with the ops that died because of them)
+    discard  give up; the next sync brings the local order in line with WC"""
+    if action not in ('retry', 'discard'):
+        return jsonify({'success': False, 'error': '未知操作'}), 404
+    data = request.get_json(silent=True) or {}
+    try:
+        ids = [int(i) for i in data.get('ids') or []]
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'ids 格式不正确'}), 400
+    if not ids:
+        return jsonify({'success': False, 'error': '请选择要处理的记录'}), 400
+    conn = get_db_connection()
+    try:
+        if action == 'retry':
+            n = wc_outbox.retry(conn, ids)
+        else:
+            n = wc_outbox.discard(conn, ids)
+        conn.commit()
+    except sqlite3.IntegrityError:
+        # the same write was queued again between retry's check and its update
+        conn.rollback()
+        return jsonify({'success': False, 'error': '该操作已重新进入队列，请刷新后重试'}), 409
+    finally:
+        conn.close()
+    if action == 'retry':
+        _kick_wc_outbox()
+    return jsonify({'success': True, 'count': n})
+
+
+def init_export_jobs_table():
+    """Background export jobs (see _submit_export_job). Jobs whose process
+    stopped can never finish — those are marked failed
+    (_expire_stale_export_jobs) so the UI stops waiting on them."""
+    conn = get_db_connection()
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS export_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            label TEXT DEFAULT '',
+            status TEXT NOT NULL DEFAULT 'queued',
+            filename TEXT,
+            file_path TEXT,
+            file_size INTEGER DEFAULT 0,
+            error TEXT,
+            created_by INTEGER,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            started_at TEXT,
+            finished_at TEXT,
+            heartbeat_at TEXT
+        )
+    ''')
+    try:
+        conn.execute('ALTER TABLE export_jobs ADD COLUMN heartbeat_at TEXT')
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_export_jobs_user ON export_jobs(created_by, id)')
+    _expire_stale_export_jobs(conn)
+    conn.commit()
+    conn.close()
+
+
 # Initialize tables on startup
 with app.app_context():
     init_sites_table()
     init_product_masters_table()
+    init_clone_media_table()
+    init_link_check_table()
+    init_wc_outbox_table()
     init_sync_logs_table()
     init_settings_table()
     init_users_table()
     init_shipping_tables()
+    init_ship_batch_tables()
     init_undelivered_columns()
     init_problem_return_columns()
+    init_order_date_columns()
+    init_customer_risk_keys()
+    init_order_search_index()
+    init_order_tracking_table()
+    init_shipping_view_table()
+    init_latest_note_pointers()
+    init_site_profiles()
+    init_identity_graph()
+    init_customer_stats()
+    init_site_traffic_table()
     init_product_tables()
+    init_wc_catalog_tables()
     init_user_preferences_table()
     init_sales_board_tables()
     init_sales_groups_tables()
@@ -6838,6 +7431,9 @@ with app.app_context():
     init_product_costs_tables()
     init_warehouses()
     init_blocklist_tables()
+    init_export_jobs_table()
+    init_view_cache()
+    _kick_wc_outbox()  # pushes still queued from before the restart
 
 @app.route('/settings')
 @login_required
@@ -6929,6 +7525,7 @@ def exchange_rates_api():
                 INSERT OR REPLACE INTO exchange_rates (year_month, currency, rate_to_cny, updated_at)
                 VALUES (?, ?, ?, datetime('now'))
             ''', (year_month, currency, rate_to_cny))
+            order_index.bump_versions(conn, ['exchange_rates'])
             conn.commit()
             conn.close()
             return jsonify({'success': True, 'message': '汇率保存成功'})
@@ -6944,6 +7541,7 @@ def delete_exchange_rate(rate_id):
     """Delete an exchange rate"""
     conn = get_db_connection()
     conn.execute('DELETE FROM exchange_rates WHERE id = ?', (rate_id,))
+    order_index.bump_versions(conn, ['exchange_rates'])
     conn.commit()
     conn.close()
     return jsonify({'success': True, 'message': '汇率已删除'})
@@ -7001,6 +7599,7 @@ def import_sites_from_script():
                         (url, ck, cs))
             imported += 1
         
+        order_index.bump_versions(conn, ['sites'])
         conn.commit()
         conn.close()
         
@@ -7086,6 +7685,7 @@ def create_product_master():
             INSERT INTO product_masters (label, url, consumer_key, consumer_secret)
             VALUES (?, ?, ?, ?)
         ''', (label, url, ck, cs))
+        order_index.bump_versions(conn, ['product_masters'])
         conn.commit()
         new_id = cur.lastrowid
     except Exception as e:
@@ -7131,6 +7731,7 @@ def update_product_master(master_id):
                     updated_at = datetime('now')
                 WHERE id = ?
             ''', (label, url, ck, master_id))
+        order_index.bump_versions(conn, ['product_masters'])
         conn.commit()
     except Exception as e:
         conn.close()
@@ -7161,6 +7762,7 @@ def delete_product_master(master_id):
         }), 409
     try:
         conn.execute('DELETE FROM product_masters WHERE id = ?', (master_id,))
+        order_index.bump_versions(conn, ['product_masters'])
         conn.commit()
     except Exception as e:
         conn.close()
@@ -7196,6 +7798,7 @@ def test_product_master(master_id):
             SET api_status = 'error', last_api_error = ?, last_tested_at = datetime('now')
             WHERE id = ?
         ''', (f'网络错误: {e}', master_id))
+        order_index.bump_versions(conn, ['product_masters'])
         conn.commit()
         conn.close()
         return jsonify({'status': 'error', 'message': f'连接失败: {e}'}), 200
@@ -7213,6 +7816,7 @@ def test_product_master(master_id):
             SET api_status = 'error', last_api_error = ?, last_tested_at = datetime('now')
             WHERE id = ?
         ''', (msg, master_id))
+        order_index.bump_versions(conn, ['product_masters'])
         conn.commit()
         conn.close()
         return jsonify({'status': 'error', 'message': msg}), 200
@@ -7224,6 +7828,7 @@ def test_product_master(master_id):
         SET api_status = 'ok', last_api_error = NULL, last_tested_at = datetime('now')
         WHERE id = ?
     ''', (master_id,))
+    order_index.bump_versions(conn, ['product_masters'])
     conn.commit()
     conn.close()
     return jsonify({'status': 'ok', 'message': '连接成功（已验证读权限；写权限将在首次编辑时验证）'}), 200
@@ -7308,22 +7913,205 @@ def _parse_wc_response(resp):
         return None, hint
 
 
+def _fetch_wc_variations(api_url, ck, cs, parent_id):
+    """All variations of a variable product from WC. Returns (list, error_message).
+    Most variable products have <100 variations, so this is usually one call."""
+    import requests as req
+
+    all_variations = []
+    page = 1
+    while True:
+        try:
+            resp = req.get(
+                f'{api_url}/wp-json/wc/v3/products/{parent_id}/variations',
+                auth=(ck, cs),
+                params={'page': page, 'per_page': 100},
+                timeout=60,
+                headers={'User-Agent': 'WooCommerce API Client-Python/3.0.0',
+                         'Accept': 'application/json'},
+            )
+        except req.RequestException as e:
+            return None, f'连接 WC API 失败: {e}'
+
+        batch, err = _parse_wc_response(resp)
+        if err:
+            app.logger.warning(f'GET variations of {parent_id} from {api_url} failed: {err}')
+            return None, err
+        batch = batch or []
+        if not batch:
+            break
+        all_variations.extend(batch)
+        if len(batch) < 100:
+            break
+        page += 1
+        if page > 10:  # safety bound — 1000 variations is already absurd
+            break
+    return all_variations, None
+
+
+def _claim_wc_catalog_sync(catalog):
+    """Claim a catalog's sync run for this process (wc_catalog.claim_sync);
+    False when another worker is already running it."""
+    conn = get_db_connection()
+    try:
+        claimed = wc_catalog.claim_sync(conn, catalog)
+        conn.commit()
+        return claimed
+    except sqlite3.Error as e:
+        app.logger.warning(f'Claiming catalog sync of {catalog} failed: {e}')
+        return False
+    finally:
+        conn.close()
+
+
+def _sync_wc_catalog(api_url, ck, cs, full=False, claimed=False):
+    """Pull a catalog's products into the wc_products mirror.
+
+    Incremental runs ask WC only for products modified after the last run's
+    newest date_modified_gmt; full runs list every product and drop the ones
+    WC no longer returns. Variations already mirrored are refetched for every
+    product that changed. Every page (and every parent's variations) is
+    committed before the next WC call, so the run never holds the database
+    write lock across a request. Returns (summary, error_message); summary is
+    None when another worker is already syncing the catalog. claimed: the
+    caller already holds the run's claim (_start_wc_catalog_sync)."""
+    import requests as req
+    from datetime import timedelta
+
+    catalog = wc_catalog.catalog_key(api_url)
+    if not claimed and not _claim_wc_catalog_sync(catalog):
+        return None, None
+
+    conn = get_db_connection()
+    try:
+        state = wc_catalog.sync_state(conn, catalog)
+        since = None if full or state is None else state['last_modified_gmt']
+        full = not since
+        params = {'per_page': 100, 'status': 'any', 'orderby': 'id', 'order': 'asc'}
+        if since:
+            # modified_after is exclusive; one second back so a product saved in
+            # the same second as the watermark is not skipped (re-upsert is harmless)
+            since_dt = datetime.strptime(since[:19], '%Y-%m-%dT%H:%M:%S') - timedelta(seconds=1)
+            params.update(modified_after=since_dt.strftime('%Y-%m-%dT%H:%M:%S'), dates_are_gmt='true')
+
+        seen, changed, newest = set(), set(), since
+        page = 1
+        while True:
+            try:
+                resp = req.get(
+                    f'{api_url}/wp-json/wc/v3/products',
+                    auth=(ck, cs),
+                    params=dict(params, page=page),
+                    timeout=60,  # WC list endpoints can be slow on big catalogs
+                    headers={'User-Agent': 'WooCommerce API Client-Python/3.0.0',
+                             'Accept': 'application/json'},
+                )
+                batch, err = _parse_wc_response(resp)
+            except req.RequestException as e:
+                batch, err = None, f'连接 WC API 失败: {e}'
+            if err:
+                app.logger.warning(f'Sync products from {api_url} failed: {err}')
+                wc_catalog.mark_synced(conn, catalog, full, error=err)
+                conn.commit()
+                return None, err
+            batch = batch or []
+            changed |= wc_catalog.upsert_products(conn, catalog, batch)
+            wc_catalog.touch_sync(conn, catalog)
+            conn.commit()
+            for p in batch:
+                seen.add(p.get('id'))
+                modified = (p.get('date_modified_gmt') or '')[:19]
+                if modified and (not newest or modified > newest):
+                    newest = modified
+            if len(batch) < 100 or page >= int(resp.headers.get('X-WP-TotalPages', page)):
+                break
+            page += 1
+
+        removed = wc_catalog.remove_missing(conn, catalog, seen) if full else 0
+        conn.commit()
+
+        refreshed = 0
+        for parent_id in wc_catalog.variation_parents(conn, catalog, changed):
+            variations, err = _fetch_wc_variations(api_url, ck, cs, parent_id)
+            if err:
+                continue  # keeps the old rows; retried when the parent changes again
+            wc_catalog.upsert_variations(conn, catalog, parent_id, variations, complete=True)
+            wc_catalog.touch_sync(conn, catalog)
+            conn.commit()
+            refreshed += 1
+        wc_catalog.mark_synced(conn, catalog, full, last_modified=newest)
+        conn.commit()
+        return {'full': full, 'fetched': len(seen), 'changed': len(changed),
+                'removed': removed, 'variations_refreshed': refreshed}, None
+    except sqlite3.Error as e:
+        err = f'数据库错误: {e}'
+        app.logger.warning(f'Sync products from {api_url} failed: {err}')
+        try:
+            conn.rollback()
+            wc_catalog.mark_synced(conn, catalog, full, error=err)
+            conn.commit()
+        except sqlite3.Error:
+            pass  # the claim lapses after wc_catalog.SYNC_LEASE_SECONDS
+        return None, err
+    finally:
+        conn.close()
+
+
+def _start_wc_catalog_sync(api_url, ck, cs, full=False):
+    """Claim a catalog's sync run and run _sync_wc_catalog in a background
+    thread (the page is served from the mirror meanwhile). Returns False when
+    another worker already holds the run."""
+    if not _claim_wc_catalog_sync(wc_catalog.catalog_key(api_url)):
+        return False
+
+    def run(app_context):
+        with app_context:
+            try:
+                _sync_wc_catalog(api_url, ck, cs, full=full, claimed=True)
+            except Exception as e:
+                app.logger.error(f'Background catalog sync of {api_url} failed: {e}')
+
+    threading.Thread(target=run, args=(app.app_context(),), daemon=True).start()
+    return True
+
+
+def _wc_catalog_write_through(api_url, products=(), variations=()):
+    """Apply WC's PUT responses to the mirror. variations: (parent_id, object)
+    pairs. A failure here only leaves the row for the next sync to fix."""
+    catalog = wc_catalog.catalog_key(api_url)
+    conn = get_db_connection()
+    try:
+        wc_catalog.upsert_products(conn, catalog, [p for p in products if p])
+        for parent_id, v in variations:
+            if v:
+                wc_catalog.upsert_variations(conn, catalog, parent_id, [v])
+        conn.commit()
+    except sqlite3.Error as e:
+        app.logger.warning(f'Catalog write-through for {api_url} failed: {e}')
+    finally:
+        conn.close()
+
+
 @app.route('/api/product-manager/products')
 @login_required
 @product_manager_required
 def product_manager_list():
-    """List products from a single site via WC REST API (live, no caching).
-    For multistore-managed sites, fetches from the configured master.
+    """List products of a single site from the local catalog mirror
+    (wc_catalog.py). For multistore-managed sites, the master's catalog.
+
+    Always answers from the mirror and starts a background sync when it is
+    older than wc_catalog.REFRESH_SECONDS. Until a catalog's first full sync
+    has finished the answer is an empty list with syncing=true, which the
+    page re-polls; a failed first sync is reported as the error and retried
+    after REFRESH_SECONDS.
 
     Query params:
       site_id    (required) — id of a site row in `sites` table
-      search     (optional) — full-text search (WC's `?search=`)
+      search     (optional) — name / SKU substring
       status     (optional) — publish/draft/private/any (default: any)
       page       (optional) — pagination, default 1
       per_page   (optional) — default 50, max 100
     """
-    import requests as req
-
     try:
         site_id = int(request.args.get('site_id', '0'))
     except (TypeError, ValueError):
@@ -7359,67 +8147,75 @@ def product_manager_list():
             (site['product_master_id'],)
         ).fetchone()
         routing_info['master_label'] = m['label'] if m else None
-    conn.close()
-
-    params = {'page': page, 'per_page': per_page, 'status': status}
-    if search:
-        params['search'] = search
 
-    try:
-        resp = req.get(
-            f'{api_url}/wp-json/wc/v3/products',
-            auth=(ck, cs),
-            params=params,
-            timeout=60,  # WC list endpoints can be slow on big catalogs
-            headers={'User-Agent': 'WooCommerce API Client-Python/3.0.0',
-                     'Accept': 'application/json'},
-        )
-    except req.RequestException as e:
-        return jsonify({'error': f'连接 WC API 失败: {e}', 'routing': routing_info}), 502
+    catalog = wc_catalog.catalog_key(api_url)
+    state = wc_catalog.sync_state(conn, catalog)
+    due = wc_catalog.sync_due(state)
+    syncing = wc_catalog.sync_running(state)
+    if due and not syncing:
+        _start_wc_catalog_sync(api_url, ck, cs, full=due == 'full')
+        syncing = True  # by this request, or by the worker that won the claim
 
-    products, err = _parse_wc_response(resp)
-    if err:
-        app.logger.warning(f'GET products from {api_url} failed: {err}')
-        return jsonify({'error': err, 'routing': routing_info}), 502
-    products = products or []
-    # Strip down to the fields we actually need (smaller payload, less surface area)
-    slim = []
-    for p in products:
-        slim.append({
-            'id': p.get('id'),
-            'name': p.get('name'),
-            'sku': p.get('sku', ''),
-            'type': p.get('type', 'simple'),
-            'status': p.get('status'),
-            'manage_stock': bool(p.get('manage_stock', False)),
-            'stock_quantity': p.get('stock_quantity'),
-            'stock_status': p.get('stock_status', 'instock'),
-            'regular_price': p.get('regular_price', ''),
-            'sale_price': p.get('sale_price', ''),
-            'price': p.get('price', ''),  # display-only effective price
-            'permalink': p.get('permalink', ''),
-            'image': (p.get('images') or [{}])[0].get('src', '') if p.get('images') else '',
-            'variations_count': len(p.get('variations') or []),
+    if state is None or not state['full_synced_at']:
+        # never mirrored yet: the UI polls while the first full sync runs
+        conn.close()
+        if not syncing and state and state['last_error']:
+            return jsonify({'error': state['last_error'], 'routing': routing_info}), 502
+        return jsonify({
+            'products': [], 'page': page, 'per_page': per_page, 'total': 0, 'total_pages': 0,
+            'routing': routing_info, 'syncing': True, 'synced_at': None,
+            'sync_error': state['last_error'] if state else None,
         })
 
-    total = int(resp.headers.get('X-WP-Total', len(slim)))
-    total_pages = int(resp.headers.get('X-WP-TotalPages', 1))
+    products, total = wc_catalog.search_products(conn, catalog, search, status, page, per_page)
+    conn.close()
     return jsonify({
-        'products': slim,
+        'products': products,
         'page': page,
         'per_page': per_page,
         'total': total,
-        'total_pages': total_pages,
+        'total_pages': (total + per_page - 1) // per_page,
         'routing': routing_info,
+        'syncing': syncing,
+        'synced_at': state['synced_at'],
+        'sync_error': state['last_error'],
     })
 
 
-def _build_product_update_payload(data):
-    """Build a WC API PUT body from raw user input. Returns (payload, error_msg).
-    Filters out non-whitelisted fields and normalizes types.
-
-    Empty string values are treated as 'clear this field' (matches WC API behavior)
-    EXCEPT for stock_quantity, where empty means 'leave unchanged' (skip the field)
+@app.route('/api/product-manager/sync', methods=['POST'])
+@login_required
+@product_manager_required
+def product_manager_sync():
+    """Pull the site's catalog from WC into the mirror now (the list's refresh
+    button). Body: {"site_id": 123, "full": false}."""
+    data = request.get_json(silent=True) or {}
+    try:
+        site_id = int(data.get('site_id', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'site_id 必须是整数'}), 400
+    if not site_id:
+        return jsonify({'error': '请指定 site_id'}), 400
+
+    conn = get_db_connection()
+    try:
+        site, api_url, ck, cs = _resolve_site_for_product_edit(conn, site_id)
+    except ValueError as e:
+        conn.close()
+        return jsonify({'error': str(e)}), 400
+    conn.close()
+
+    summary, err = _sync_wc_catalog(api_url, ck, cs, full=bool(data.get('full')))
+    if err:
+        return jsonify({'error': err}), 502
+    return jsonify({'success': True, 'running': summary is None, 'summary': summary})
+
+
+def _build_product_update_payload(data):
+    """Build a WC API PUT body from raw user input. Returns (payload, error_msg).
+    Filters out non-whitelisted fields and normalizes types.
+
+    Empty string values are treated as 'clear this field' (matches WC API behavior)
+    EXCEPT for stock_quantity, where empty means 'leave unchanged' (skip the field)
     so toggling manage_stock without retyping the qty doesn't reset stock to 0."""
     payload = {}
 
@@ -7475,70 +8271,28 @@ def _build_product_update_payload(data):
 @login_required
 @product_manager_required
 def product_manager_list_variations(site_id, parent_id):
-    """List all variations of a variable product (paginated under the hood;
-    most variable products have <100 variations so we just fetch all)."""
-    import requests as req
-
+    """List all variations of a variable product from the catalog mirror.
+    A product's variations are fetched from WC the first time it is expanded
+    and kept current by the catalog sync afterwards."""
     conn = get_db_connection()
     try:
         site, api_url, ck, cs = _resolve_site_for_product_edit(conn, site_id)
     except ValueError as e:
         conn.close()
         return jsonify({'error': str(e)}), 400
-    conn.close()
-
-    # WC variations max 100 per page; fetch all pages until empty
-    all_variations = []
-    page = 1
-    while True:
-        try:
-            resp = req.get(
-                f'{api_url}/wp-json/wc/v3/products/{parent_id}/variations',
-                auth=(ck, cs),
-                params={'page': page, 'per_page': 100},
-                timeout=60,
-                headers={'User-Agent': 'WooCommerce API Client-Python/3.0.0',
-                         'Accept': 'application/json'},
-            )
-        except req.RequestException as e:
-            return jsonify({'error': f'连接 WC API 失败: {e}'}), 502
 
-        batch, err = _parse_wc_response(resp)
+    catalog = wc_catalog.catalog_key(api_url)
+    variations = wc_catalog.load_variations(conn, catalog, parent_id)
+    if variations is None:
+        fetched, err = _fetch_wc_variations(api_url, ck, cs, parent_id)
         if err:
-            app.logger.warning(f'GET variations of {parent_id} from {api_url} failed: {err}')
+            conn.close()
             return jsonify({'error': err}), 502
-        batch = batch or []
-        if not batch:
-            break
-        all_variations.extend(batch)
-        if len(batch) < 100:
-            break
-        page += 1
-        if page > 10:  # safety bound — 1000 variations is already absurd
-            break
-
-    slim = []
-    for v in all_variations:
-        # WC returns attributes as list of {id, name, option}
-        attr_summary = ' / '.join(
-            f"{a.get('name', '')}: {a.get('option', '')}"
-            for a in (v.get('attributes') or [])
-            if a.get('option')
-        )
-        slim.append({
-            'id': v.get('id'),
-            'parent_id': parent_id,
-            'sku': v.get('sku', ''),
-            'attributes_summary': attr_summary,
-            'manage_stock': bool(v.get('manage_stock', False)),
-            'stock_quantity': v.get('stock_quantity'),
-            'stock_status': v.get('stock_status', 'instock'),
-            'regular_price': v.get('regular_price', ''),
-            'sale_price': v.get('sale_price', ''),
-            'price': v.get('price', ''),
-            'image': (v.get('image') or {}).get('src', ''),
-        })
-    return jsonify({'variations': slim, 'parent_id': parent_id})
+        wc_catalog.upsert_variations(conn, catalog, parent_id, fetched, complete=True)
+        conn.commit()
+        variations = [wc_catalog.variation_row(v, parent_id) for v in fetched]
+    conn.close()
+    return jsonify({'variations': variations, 'parent_id': parent_id})
 
 
 @app.route('/api/product-manager/products/<int:site_id>/<int:parent_id>/variations/<int:variation_id>', methods=['PUT'])
@@ -7580,6 +8334,7 @@ def product_manager_update_variation(site_id, parent_id, variation_id):
         return jsonify({'success': False, 'error': err}), 502
 
     v = v or {}
+    _wc_catalog_write_through(api_url, variations=[(parent_id, v)])
     return jsonify({
         'success': True,
         'variation': {
@@ -7641,6 +8396,7 @@ def product_manager_update(site_id, product_id):
         return jsonify({'success': False, 'error': err}), 502
 
     p = p or {}
+    _wc_catalog_write_through(api_url, products=[p])
     return jsonify({
         'success': True,
         'product': {
@@ -7656,6 +8412,66 @@ def product_manager_update(site_id, product_id):
     })
 
 
+# WC v3 accepts at most 100 operations per products/batch (or
+# products/<id>/variations/batch) call; a few chunks go out in parallel.
+WC_BATCH_SIZE = 100
+WC_BATCH_WORKERS = 3
+# Error prefix for items whose batch call got no answer at all — unlike a
+# rejected item, those operations may or may not have been applied.
+WC_BATCH_UNREACHED = '连接失败'
+
+
+def _wc_batch(api_url, ck, cs, path, action, items, timeout=300):
+    """Send `items` to WC's `<path>/batch` under `action` ('create' / 'update'),
+    WC_BATCH_SIZE per call, up to WC_BATCH_WORKERS calls at a time.
+
+    Returns a list aligned with `items`: (object, None) for an operation WC
+    applied, (None, error_message) otherwise. WC reports per-item failures
+    inside a 200 response as {"id": ..., "error": {"code", "message"}}; a
+    failed call fails every item of its chunk."""
+    import requests as req
+    import concurrent.futures
+
+    def send(chunk):
+        try:
+            resp = req.post(
+                f'{api_url}/wp-json/wc/v3/{path}/batch',
+                auth=(ck, cs),
+                json={action: chunk},
+                timeout=timeout,  # WooMultistore syncs every item to the child stores
+                headers={'User-Agent': 'WooCommerce API Client-Python/3.0.0',
+                         'Content-Type': 'application/json',
+                         'Accept': 'application/json'},
+            )
+        except req.RequestException as e:
+            return [(None, f'{WC_BATCH_UNREACHED}: {e}')] * len(chunk)
+        data, err = _parse_wc_response(resp)
+        if err:
+            app.logger.warning(f'POST {path}/batch on {api_url} failed: {err}')
+            return [(None, err)] * len(chunk)
+        out = (data.get(action) if isinstance(data, dict) else None) or []
+        results = []
+        for i in range(len(chunk)):
+            obj = out[i] if i < len(out) else None
+            if not isinstance(obj, dict):
+                results.append((None, 'WC 批量接口未返回该项结果'))
+            elif obj.get('error'):
+                e = obj['error'] if isinstance(obj['error'], dict) else {'message': str(obj['error'])}
+                results.append((None, f"WC API 错误 ({e.get('code') or '-'}): {e.get('message') or '(无说明)'}"))
+            else:
+                results.append((obj, None))
+        return results
+
+    chunks = [items[i:i + WC_BATCH_SIZE] for i in range(0, len(items), WC_BATCH_SIZE)]
+    if len(chunks) <= 1:
+        return send(chunks[0]) if chunks else []
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(WC_BATCH_WORKERS, len(chunks))) as ex:
+        for chunk_results in ex.map(send, chunks):
+            results.extend(chunk_results)
+    return results
+
+
 @app.route('/api/product-manager/bulk', methods=['POST'])
 @login_required
 @product_manager_required
@@ -7672,9 +8488,13 @@ def product_manager_bulk():
         ]
       }
 
+    Products go out through products/batch, variations through
+    products/<parent_id>/variations/batch (see _wc_batch), so 200 items are
+    a handful of round trips instead of 200 PUTs.
+
     Returns per-item success/failure so partial failures don't lose state.
     """
-    import requests as req
+    import concurrent.futures
 
     data = request.get_json(silent=True) or {}
     try:
@@ -7695,48 +8515,47 @@ def product_manager_bulk():
         return jsonify({'error': str(e)}), 400
     conn.close()
 
-    headers = {
-        'User-Agent': 'WooCommerce API Client-Python/3.0.0',
-        'Content-Type': 'application/json',
-        'Accept': 'application/json',
-    }
-
-    results = {'success': [], 'failed': []}
-    for item in items:
+    # outcome per item index: (wc_object, None) or (None, error_message)
+    outcomes = {}
+    groups = {}  # parent_id (None for products) → [(index, batch operation)]
+    for idx, item in enumerate(items):
         pid = item.get('product_id')
         parent_id = item.get('parent_id')  # if present → this is a variation
         if not pid:
-            results['failed'].append({'product_id': None, 'error': '缺少 product_id'})
             continue
-
         payload, err = _build_product_update_payload(item)
         if err:
-            results['failed'].append({'product_id': pid, 'parent_id': parent_id, 'error': err})
+            outcomes[idx] = (None, err)
             continue
+        groups.setdefault(parent_id or None, []).append((idx, dict(payload, id=pid)))
 
-        # Route to variation endpoint if parent_id is given, otherwise to product endpoint
-        if parent_id:
-            url = f'{api_url}/wp-json/wc/v3/products/{parent_id}/variations/{pid}'
-        else:
-            url = f'{api_url}/wp-json/wc/v3/products/{pid}'
+    def run_group(parent_id):
+        ops = groups[parent_id]
+        path = f'products/{parent_id}/variations' if parent_id else 'products'
+        return list(zip([i for i, _ in ops], _wc_batch(api_url, ck, cs, path, 'update', [op for _, op in ops])))
 
-        try:
-            resp = req.put(url, auth=(ck, cs), json=payload, timeout=90, headers=headers)
-        except req.RequestException as e:
-            results['failed'].append({
-                'product_id': pid, 'parent_id': parent_id,
-                'error': f'连接失败: {e}'
-            })
-            continue
+    # variations are batched per parent, so spread the parents over a few workers too
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(WC_BATCH_WORKERS, len(groups)))) as ex:
+        for group_outcomes in ex.map(run_group, list(groups)):
+            for idx, outcome in group_outcomes:
+                outcomes[idx] = outcome
 
-        p, err = _parse_wc_response(resp)
+    results = {'success': [], 'failed': []}
+    written_products, written_variations = [], []
+    for idx, item in enumerate(items):
+        pid = item.get('product_id')
+        parent_id = item.get('parent_id')
+        if not pid:
+            results['failed'].append({'product_id': None, 'error': '缺少 product_id'})
+            continue
+        p, err = outcomes[idx]
         if err:
-            results['failed'].append({
-                'product_id': pid, 'parent_id': parent_id,
-                'error': err,
-            })
+            results['failed'].append({'product_id': pid, 'parent_id': parent_id, 'error': err})
             continue
-        p = p or {}
+        if parent_id:
+            written_variations.append((parent_id, p))
+        else:
+            written_products.append(p)
         results['success'].append({
             'product_id': pid,
             'parent_id': parent_id,
@@ -7747,6 +8566,7 @@ def product_manager_bulk():
             'sale_price': p.get('sale_price', ''),
         })
 
+    _wc_catalog_write_through(api_url, products=written_products, variations=written_variations)
     return jsonify({
         'success_count': len(results['success']),
         'failed_count': len(results['failed']),
@@ -7764,14 +8584,100 @@ _WC_HEADERS = {
     'Accept': 'application/json',
 }
 
+# Products of one clone request are cloned in parallel, at most this many at
+# a time per target host (shared by concurrent clone requests).
+CLONE_WORKERS_PER_HOST = 4
+_clone_host_lock = threading.Lock()
+_clone_host_slots = {}  # target host → BoundedSemaphore
+
+
+def _clone_host_slot(url):
+    from urllib.parse import urlparse
+
+    host = (urlparse(url).netloc or url).lower()
+    with _clone_host_lock:
+        if host not in _clone_host_slots:
+            _clone_host_slots[host] = threading.BoundedSemaphore(CLONE_WORKERS_PER_HOST)
+        return _clone_host_slots[host]
+
+
+def _clone_image_key(url):
+    """clone_media key of a source image URL (scheme-less, &amp; unescaped)."""
+    import re
+    return re.sub(r'^https?:', '', (url or '').strip().replace('&amp;', '&'))
+
+
+def _live_source_urls(urls):
+    """The subset of `urls` that answers 200 (link_check, cached per URL).
+    WC rejects a whole create / update when one image URL cannot be fetched."""
+    if not urls:
+        return set()
+    conn = get_db_connection()
+    try:
+        alive = link_check.check_urls(conn, urls)
+        conn.commit()
+    finally:
+        conn.close()
+    return {u for u, ok in alive.items() if ok}
+
+
+def _clone_media_lookup(tgt_url, urls):
+    """{clone_media key: (media_id, media_src)} of `urls` already on the target."""
+    keys = list(dict.fromkeys(_clone_image_key(u) for u in urls if u))
+    if not keys:
+        return {}
+    target = wc_catalog.catalog_key(tgt_url)
+    conn = get_db_connection()
+    try:
+        placeholders = ','.join('?' * len(keys))
+        return {r['source_key']: (r['media_id'], r['media_src']) for r in conn.execute(
+            f'SELECT source_key, media_id, media_src FROM clone_media WHERE target = ? AND source_key IN ({placeholders})',
+            [target] + keys)}
+    finally:
+        conn.close()
+
+
+def _clone_media_remember(tgt_url, entries):
+    """Record (source_url, media_id, media_src) triples sideloaded into the target."""
+    entries = [(_clone_image_key(u), mid, msrc) for u, mid, msrc in entries if u and mid]
+    if not entries:
+        return
+    target = wc_catalog.catalog_key(tgt_url)
+    conn = get_db_connection()
+    try:
+        conn.executemany(
+            'INSERT OR REPLACE INTO clone_media (target, source_key, media_id, media_src) VALUES (?, ?, ?, ?)',
+            [(target, k, mid, msrc) for k, mid, msrc in entries])
+        conn.commit()
+    except sqlite3.Error as e:
+        app.logger.warning(f'clone_media write for {tgt_url} failed: {e}')
+    finally:
+        conn.close()
+
 
-def _resolve_taxonomy_on_target(api_url, ck, cs, taxonomy, source_terms):
+def _clone_media_forget(tgt_url, media_ids):
+    """Drop cached media the target rejected (deleted from its media library)."""
+    target = wc_catalog.catalog_key(tgt_url)
+    conn = get_db_connection()
+    try:
+        conn.executemany('DELETE FROM clone_media WHERE target = ? AND media_id = ?',
+                         [(target, mid) for mid in media_ids])
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _resolve_taxonomy_on_target(api_url, ck, cs, taxonomy, source_terms, term_cache=None):
     """For each source category/tag, look up the corresponding term on the
     target site by slug. Returns (target_terms_list, warnings_list).
 
     `taxonomy` = 'categories' | 'tags'. Source terms are WC's typical
     [{id, name, slug}] shape. We don't auto-create missing terms — we just
-    warn so the user knows to set them manually on the target."""
+    warn so the user knows to set them manually on the target.
+
+    `term_cache` (a dict shared by one clone request) memoizes each
+    (target, taxonomy, slug) lookup — id, or None for "not on target" — so a
+    category shared by 50 products is looked up once."""
     import requests as req
 
     target_terms = []
@@ -7783,6 +8689,13 @@ def _resolve_taxonomy_on_target(api_url, ck, cs, taxonomy, source_terms):
         if not slug:
             warnings.append(f'源 {label} "{name}" 缺少 slug，已跳过')
             continue
+        cache_key = (api_url, taxonomy, slug)
+        if term_cache is not None and cache_key in term_cache:
+            if term_cache[cache_key] is None:
+                warnings.append(f'目标站不存在 {label} "{name}" (slug={slug})，已跳过')
+            else:
+                target_terms.append({'id': term_cache[cache_key]})
+            continue
         try:
             resp = req.get(
                 f'{api_url}/wp-json/wc/v3/products/{taxonomy}',
@@ -7793,8 +8706,12 @@ def _resolve_taxonomy_on_target(api_url, ck, cs, taxonomy, source_terms):
             )
             terms, err = _parse_wc_response(resp)
             if err or not terms:
+                if term_cache is not None and not err:
+                    term_cache[cache_key] = None
                 warnings.append(f'目标站不存在 {label} "{name}" (slug={slug})，已跳过')
                 continue
+            if term_cache is not None:
+                term_cache[cache_key] = terms[0].get('id')
             target_terms.append({'id': terms[0].get('id')})
         except Exception as e:
             warnings.append(f'查询 {label} "{name}" 失败: {e}')
@@ -7830,8 +8747,7 @@ def _clone_variations(src_url, src_ck, src_cs, tgt_url, tgt_ck, tgt_cs,
         except Exception:
             break
 
-    success = []
-    failed = []
+    payloads = []
     for v in all_variations:
         payload = {
             'regular_price': v.get('regular_price', ''),
@@ -7855,37 +8771,36 @@ def _clone_variations(src_url, src_ck, src_cs, tgt_url, tgt_ck, tgt_cs,
             payload['sku'] = sku
         if options.get('include_images') and v.get('image') and v['image'].get('src'):
             payload['image'] = {'src': v['image'].get('src')}
+        payloads.append(payload)
 
-        try:
-            resp = req.post(
-                f'{tgt_url}/wp-json/wc/v3/products/{tgt_parent_id}/variations',
-                auth=(tgt_ck, tgt_cs), json=payload, timeout=60, headers=_WC_HEADERS,
-            )
-            new_v, err = _parse_wc_response(resp)
+    # One variations/batch create per 100 variations instead of a POST each
+    path = f'products/{tgt_parent_id}/variations'
+    outcomes = _wc_batch(tgt_url, tgt_ck, tgt_cs, path, 'create', payloads)
+
+    # SKU collision? Retry those without sku as a soft fallback (one more batch)
+    retry = [i for i, (new_v, err) in enumerate(outcomes)
+             if err and payloads[i].get('sku') and 'sku' in err.lower()]
+    retried = {}
+    if retry:
+        retry_payloads = [{k: val for k, val in payloads[i].items() if k != 'sku'} for i in retry]
+        retried = dict(zip(retry, _wc_batch(tgt_url, tgt_ck, tgt_cs, path, 'create', retry_payloads)))
+
+    success = []
+    failed = []
+    for i, v in enumerate(all_variations):
+        sku = payloads[i].get('sku', '')
+        new_v, err = outcomes[i]
+        if i in retried:
+            new_v, err = retried[i]
             if err:
-                # SKU collision? Retry without sku as a soft fallback
-                if sku and 'sku' in err.lower():
-                    retry_payload = dict(payload)
-                    retry_payload.pop('sku', None)
-                    try:
-                        resp2 = req.post(
-                            f'{tgt_url}/wp-json/wc/v3/products/{tgt_parent_id}/variations',
-                            auth=(tgt_ck, tgt_cs), json=retry_payload, timeout=60, headers=_WC_HEADERS,
-                        )
-                        new_v, err2 = _parse_wc_response(resp2)
-                        if err2:
-                            failed.append({'src_id': v.get('id'), 'sku': sku, 'error': err2})
-                            continue
-                        success.append({'src_id': v.get('id'), 'tgt_id': new_v.get('id'), 'note': 'SKU 冲突，已跳过 SKU'})
-                        continue
-                    except Exception as e:
-                        failed.append({'src_id': v.get('id'), 'sku': sku, 'error': str(e)})
-                        continue
                 failed.append({'src_id': v.get('id'), 'sku': sku, 'error': err})
                 continue
-            success.append({'src_id': v.get('id'), 'tgt_id': new_v.get('id')})
-        except Exception as e:
-            failed.append({'src_id': v.get('id'), 'sku': sku, 'error': str(e)})
+            success.append({'src_id': v.get('id'), 'tgt_id': new_v.get('id'), 'note': 'SKU 冲突，已跳过 SKU'})
+            continue
+        if err:
+            failed.append({'src_id': v.get('id'), 'sku': sku, 'error': err})
+            continue
+        success.append({'src_id': v.get('id'), 'tgt_id': new_v.get('id')})
 
     return {'success': success, 'failed': failed, 'total_source': len(all_variations)}
 
@@ -7944,6 +8859,10 @@ def _migrate_inline_images_after_clone(src, new_data, src_url, tgt_url,
     new URLs, then PUT #2 to save the rewritten HTML and reset the gallery to
     the original images only (so inline images don't pollute the gallery).
 
+    Images this target already received in an earlier clone (clone_media) are
+    rewritten to their existing URL and not sideloaded again; PUT #1 is skipped
+    when all of them are known.
+
     Best-effort: any failure leaves the product intact (description still
     points at the source) and records a warning. Never raises."""
     import re
@@ -7963,49 +8882,69 @@ def _migrate_inline_images_after_clone(src, new_data, src_url, tgt_url,
     if truncated:
         order = order[:MAX_IMG]
 
-    content_urls = [groups[k]['submit'] for k in order]
+    # Already on the target from an earlier clone → reuse, don't sideload again
+    known = _clone_media_lookup(tgt_url, [groups[k]['submit'] for k in order])
+    url_map = {}
+    for k in order:
+        hit = known.get(_clone_image_key(groups[k]['submit']))
+        if hit and hit[1]:
+            url_map[k] = hit[1]
+    reused = len(url_map)
+    upload = [k for k in order if k not in url_map]
+    if upload:
+        # dead source images would make WC reject the whole PUT #1
+        live = _live_source_urls([groups[k]['submit'] for k in upload])
+        dead = [k for k in upload if groups[k]['submit'] not in live]
+        if dead:
+            warnings.append(f'文案内图片迁移：{len(dead)} 张在源站已失效，保留原链接')
+            upload = [k for k in upload if k not in dead]
+    content_urls = [groups[k]['submit'] for k in upload]
 
     # Gallery created by the initial POST — keep these by id across both PUTs.
     gallery_ids = [im.get('id') for im in (new_data.get('images') or []) if im.get('id')]
     gcount = len(gallery_ids)
     put_url = f'{tgt_url}/wp-json/wc/v3/products/{new_id}'
 
-    # PUT #1 — append content images so WC sideloads them into the media library.
-    put1_images = [{'id': gid} for gid in gallery_ids] + [{'src': u} for u in content_urls]
-    try:
-        resp = req.put(put_url, auth=(tgt_ck, tgt_cs), json={'images': put1_images},
-                       timeout=120, headers=_WC_HEADERS)
-    except Exception as e:
-        warnings.append(f'文案内图片迁移失败（描述仍指向源站）：{e}')
-        return
-    data1, err = _parse_wc_response(resp)
-    if err:
-        warnings.append(f'文案内图片迁移失败（描述仍指向源站）：{err}')
-        return
-
-    resp_imgs = data1.get('images') or []
-    new_for_content = resp_imgs[gcount:]
+    if upload:
+        # PUT #1 — append content images so WC sideloads them into the media library.
+        put1_images = [{'id': gid} for gid in gallery_ids] + [{'src': u} for u in content_urls]
+        try:
+            resp = req.put(put_url, auth=(tgt_ck, tgt_cs), json={'images': put1_images},
+                           timeout=120, headers=_WC_HEADERS)
+        except Exception as e:
+            warnings.append(f'文案内图片迁移失败（描述仍指向源站）：{e}')
+            return
+        data1, err = _parse_wc_response(resp)
+        if err:
+            warnings.append(f'文案内图片迁移失败（描述仍指向源站）：{err}')
+            return
 
-    # Map each source URL -> new target URL. Index alignment is reliable (WC
-    # preserves submission order); fall back to filename matching if counts drift.
-    url_map = {}
-    if len(new_for_content) == len(content_urls):
-        for k, im in zip(order, new_for_content):
-            if im.get('src'):
-                url_map[k] = im['src']
-    else:
-        def _basekey(u):
-            name = urlparse(u).path.rsplit('/', 1)[-1]
-            name = re.sub(r'\.(?:jpe?g|png|gif|webp|avif|svg|bmp)$', '', name, flags=re.I)
-            return re.sub(r'-\d+x\d+$', '', name).lower()
-        new_by_base = {}
-        for im in resp_imgs:
-            if im.get('src'):
-                new_by_base.setdefault(_basekey(im['src']), im['src'])
-        for k in order:
-            ns = new_by_base.get(_basekey(groups[k]['submit']))
-            if ns:
-                url_map[k] = ns
+        resp_imgs = data1.get('images') or []
+        new_for_content = resp_imgs[gcount:]
+
+        # Map each source URL -> new target URL. Index alignment is reliable (WC
+        # preserves submission order); fall back to filename matching if counts drift.
+        uploaded = []
+        if len(new_for_content) == len(content_urls):
+            for k, im in zip(upload, new_for_content):
+                if im.get('src'):
+                    url_map[k] = im['src']
+                    uploaded.append((groups[k]['submit'], im.get('id'), im['src']))
+        else:
+            def _basekey(u):
+                name = urlparse(u).path.rsplit('/', 1)[-1]
+                name = re.sub(r'\.(?:jpe?g|png|gif|webp|avif|svg|bmp)$', '', name, flags=re.I)
+                return re.sub(r'-\d+x\d+$', '', name).lower()
+            new_by_base = {}
+            for im in resp_imgs:
+                if im.get('src'):
+                    new_by_base.setdefault(_basekey(im['src']), im)
+            for k in upload:
+                im = new_by_base.get(_basekey(groups[k]['submit']))
+                if im:
+                    url_map[k] = im['src']
+                    uploaded.append((groups[k]['submit'], im.get('id'), im['src']))
+        _clone_media_remember(tgt_url, uploaded)
 
     if not url_map:
         warnings.append('文案内图片迁移：未匹配到新图片地址，描述仍指向源站')
@@ -8037,14 +8976,20 @@ def _migrate_inline_images_after_clone(src, new_data, src_url, tgt_url,
         return
 
     msg = f'文案内图片迁移：{len(url_map)}/{len(order)} 张已重新托管到目标站'
+    if reused:
+        msg += f'（{reused} 张复用此前克隆已上传的图片）'
     if truncated:
         msg += f'（图片超过 {MAX_IMG} 张，仅处理前 {MAX_IMG} 张）'
     warnings.append(msg)
 
 
 def _clone_one_product(src_url, src_ck, src_cs, tgt_url, tgt_ck, tgt_cs,
-                       source_product_id, options):
-    """Clone a single product. Returns dict with new_id + warnings, or error key."""
+                       source_product_id, options, term_cache=None):
+    """Clone a single product. Returns dict with new_id + warnings, or error key.
+
+    `term_cache` is the clone request's shared taxonomy memo (see
+    _resolve_taxonomy_on_target). Gallery images the target already has from
+    an earlier clone are attached by media id instead of by URL."""
     import requests as req
 
     # 1. Fetch full source product
@@ -8091,23 +9036,36 @@ def _clone_one_product(src_url, src_ck, src_cs, tgt_url, tgt_ck, tgt_cs,
     if src_sku:
         payload['sku'] = src_sku
 
-    # Images — WC fetches these from URL on POST
+    # Images — WC fetches these from URL on POST, unless the target has them already
+    fresh_images, reused_ids = [], []
     if options.get('include_images'):
-        imgs = src.get('images') or []
-        payload['images'] = [
-            {'src': i.get('src'), 'name': i.get('name', ''), 'alt': i.get('alt', '')}
-            for i in imgs if i.get('src')
-        ]
+        imgs = [i for i in (src.get('images') or []) if i.get('src')]
+        fresh_images = [{'src': i.get('src'), 'name': i.get('name', ''), 'alt': i.get('alt', '')} for i in imgs]
+        known = _clone_media_lookup(tgt_url, [i['src'] for i in imgs])
+        # WC fails the whole create when one gallery URL is dead — drop those
+        live = _live_source_urls([i['src'] for i in imgs if _clone_image_key(i['src']) not in known])
+        dead = [i for i in fresh_images if _clone_image_key(i['src']) not in known and i['src'] not in live]
+        if dead:
+            warnings.append(f'相册中 {len(dead)} 张图片在源站已失效，已跳过')
+            fresh_images = [i for i in fresh_images if i not in dead]
+        payload['images'] = []
+        for img in fresh_images:
+            hit = known.get(_clone_image_key(img['src']))
+            if hit:
+                reused_ids.append(hit[0])
+                payload['images'].append({'id': hit[0], 'alt': img['alt']})
+            else:
+                payload['images'].append(img)
 
     # Categories / tags — resolved by slug on target
     target_cats, cat_warnings = _resolve_taxonomy_on_target(
-        tgt_url, tgt_ck, tgt_cs, 'categories', src.get('categories') or [])
+        tgt_url, tgt_ck, tgt_cs, 'categories', src.get('categories') or [], term_cache)
     if target_cats:
         payload['categories'] = target_cats
     warnings.extend(cat_warnings)
 
     target_tags, tag_warnings = _resolve_taxonomy_on_target(
-        tgt_url, tgt_ck, tgt_cs, 'tags', src.get('tags') or [])
+        tgt_url, tgt_ck, tgt_cs, 'tags', src.get('tags') or [], term_cache)
     if target_tags:
         payload['tags'] = target_tags
     warnings.extend(tag_warnings)
@@ -8140,6 +9098,17 @@ def _clone_one_product(src_url, src_ck, src_cs, tgt_url, tgt_ck, tgt_cs,
     except Exception as e:
         return {'error': f'创建目标产品失败: {e}'}
 
+    if err and reused_ids and 'image' in err.lower():
+        # A remembered media id was deleted on the target — forget it, send URLs again
+        _clone_media_forget(tgt_url, reused_ids)
+        reused_ids = []
+        payload['images'] = fresh_images
+        try:
+            resp = _post_create(payload)
+            new_data, err = _parse_wc_response(resp)
+        except Exception as e:
+            return {'error': f'创建目标产品失败: {e}'}
+
     if err and src_sku and ('sku' in err.lower() or 'unique' in err.lower()):
         # Retry with a -COPY suffix
         retry_payload = dict(payload)
@@ -8159,6 +9128,13 @@ def _clone_one_product(src_url, src_ck, src_cs, tgt_url, tgt_ck, tgt_cs,
         return {'error': '创建目标产品成功但未返回新 ID'}
 
     new_id = new_data['id']
+    new_images = new_data.get('images') or []
+    if fresh_images and len(new_images) == len(payload['images']):
+        # WC keeps submission order — remember what it just sideloaded
+        _clone_media_remember(tgt_url, [
+            (sent['src'], im.get('id'), im.get('src'))
+            for sent, im in zip(payload['images'], new_images) if sent.get('src')
+        ])
 
     # 4. Variations (if variable + option enabled)
     if options.get('include_variations') and src.get('type') == 'variable':
@@ -8206,6 +9182,8 @@ def product_manager_clone():
         "status_on_target": "draft"
       }
     """
+    import concurrent.futures
+
     data = request.get_json(silent=True) or {}
     try:
         source_site_id = int(data.get('source_site_id', 0))
@@ -8238,13 +9216,25 @@ def product_manager_clone():
         return jsonify({'error': str(e)}), 400
     conn.close()
 
+    # Products are cloned in parallel (bounded per target host); taxonomy
+    # lookups are shared across the whole request.
+    term_cache = {}
+    slot = _clone_host_slot(tgt_url)
+
+    def clone(pid):
+        with slot:
+            try:
+                return _clone_one_product(src_url, src_ck, src_cs, tgt_url, tgt_ck, tgt_cs,
+                                          pid, options, term_cache)
+            except Exception as e:
+                return {'error': f'未知错误: {e}'}
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(CLONE_WORKERS_PER_HOST, len(product_ids))) as ex:
+        outcomes = list(ex.map(clone, product_ids))
+
     results = {'success': [], 'failed': []}
-    for pid in product_ids:
-        try:
-            r = _clone_one_product(src_url, src_ck, src_cs, tgt_url, tgt_ck, tgt_cs, pid, options)
-        except Exception as e:
-            results['failed'].append({'product_id': pid, 'error': f'未知错误: {e}'})
-            continue
+    for pid, r in zip(product_ids, outcomes):
         if r.get('error'):
             results['failed'].append({'product_id': pid, 'error': r['error']})
         else:
@@ -8331,6 +9321,7 @@ def add_site():
             (url, consumer_key, consumer_secret, manager, mask_id, country, product_master_id)
             VALUES (?, ?, ?, ?, ?, ?, ?)''',
                      (url, ck, cs, manager, mask_id, country, product_master_id))
+        order_index.bump_versions(conn, ['sites'])
         conn.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -8377,6 +9368,11 @@ def update_site(site_id):
                          (url, ck, cs, manager, mask_id, country, product_master_id, site_id))
         else:
             cod_on_hold_val = 1 if cod_on_hold_raw in (1, '1', True, 'true', 'on') else 0
+            before = conn.execute('SELECT url, cod_on_hold_is_shipped FROM sites WHERE id = ?',
+                                  (site_id,)).fetchone()
+            if before and (before['cod_on_hold_is_shipped'] or 0) != cod_on_hold_val:
+                # on-hold counts as successful (or stops counting) for this site's customers
+                customer_stats.mark_sources(conn, [before['url']])
             conn.execute('''UPDATE sites
                 SET url = ?, consumer_key = ?, consumer_secret = ?,
                     manager = ?, mask_id = ?, country = ?, product_master_id = ?,
@@ -8384,6 +9380,7 @@ def update_site(site_id):
                 WHERE id = ?''',
                          (url, ck, cs, manager, mask_id, country, product_master_id,
                           cod_on_hold_val, site_id))
+        order_index.bump_versions(conn, ['sites'])
         conn.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -8400,6 +9397,7 @@ def delete_site(site_id):
     conn = get_db_connection()
     try:
         conn.execute('DELETE FROM sites WHERE id = ?', (site_id,))
+        order_index.bump_versions(conn, ['sites'])
         conn.commit()
         print(f"Successfully deleted site_id: {site_id}") # Debug log
         return jsonify({'success': True})
@@ -8499,6 +9497,7 @@ def sync_data():
                     conn = get_db_connection()
                     conn.execute('UPDATE sites SET last_sync = ? WHERE id = ?', 
                                  (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), site_id))
+                    order_index.bump_versions(conn, ['sites'])
                     conn.commit()
                     conn.close()
                     
@@ -8617,6 +9616,7 @@ def deep_sync_site(site_id):
                             conn = get_db_connection()
                             conn.execute('UPDATE sites SET api_status = ?, last_api_error = ? WHERE id = ?', 
                                          ('error', error_msg, site_id))
+                            order_index.bump_versions(conn, ['sites'])
                             conn.commit()
                             conn.close()
                             return
@@ -8650,6 +9650,8 @@ def deep_sync_site(site_id):
                 conn = get_db_connection()
                 conn.execute('UPDATE sites SET last_sync = ?, api_status = ?, last_api_error = NULL WHERE id = ?', 
                              (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'ok', site_id))
+                site_profile.refresh_site(conn, site_url)  # rescan tracking format / carriers
+                order_index.bump_versions(conn, ['sites'])
                 conn.commit()
                 conn.close()
                 
@@ -8756,6 +9758,7 @@ def check_site_api(site_id):
             SET api_read_status = ?, api_write_status = ?, last_api_error = ?
             WHERE id = ?
         ''', (read_status, write_status, error_msg, site_id))
+        order_index.bump_versions(conn, ['sites'])
         conn.commit()
         conn.close()
 
@@ -8820,6 +9823,7 @@ def check_tracking_api(site_id):
         
         # Update database
         conn.execute('UPDATE sites SET tracking_api_status = ? WHERE id = ?', (tracking_status, site_id))
+        order_index.bump_versions(conn, ['sites'])
         conn.commit()
         conn.close()
         
@@ -8832,6 +9836,7 @@ def check_tracking_api(site_id):
         
     except req.exceptions.Timeout:
         conn.execute('UPDATE sites SET tracking_api_status = ? WHERE id = ?', ('timeout', site_id))
+        order_index.bump_versions(conn, ['sites'])
         conn.commit()
         conn.close()
         return jsonify({'success': False, 'tracking_api_status': 'timeout', 'error': '连接超时'})
@@ -9061,6 +10066,7 @@ def check_all_sites_api():
                         SET api_read_status = ?, api_write_status = ?, last_api_error = ?
                         WHERE id = ?
                     ''', (read_status, write_status, error_msg, site_id))
+                    order_index.bump_versions(conn, ['sites'])
                     conn.commit()
                     
                     results.append({
@@ -9192,6 +10198,11 @@ def clean_sync_site(site_id):
                     try:
                         conn = get_db_connection()
                         placeholders = ','.join(['?' for _ in draft_ids])
+                        order_index.bump_order_months(conn, draft_ids)
+                        order_search.remove_orders(conn, draft_ids)
+                        order_tracking.remove_orders(conn, draft_ids)
+                        shipping_view.remove_orders(conn, draft_ids)
+                        customer_stats.mark_orders(conn, draft_ids, identity_graph.remove_orders(conn, draft_ids))
                         conn.execute(f"DELETE FROM orders WHERE source = ? AND id IN ({placeholders})", 
                                      [site_url] + list(draft_ids))
                         conn.commit()
@@ -9329,6 +10340,7 @@ def sync_all_data():
                         conn = get_db_connection()
                         conn.execute('UPDATE sites SET last_sync = ? WHERE id = ?',
                                      (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), site_id))
+                        order_index.bump_versions(conn, ['sites'])
                         conn.commit()
                         conn.close()
                         SYNC_STATUS[ALL_SITES_ID]['logs'].append(f"[{datetime.now().strftime('%H:%M:%S')}] {site_url} Completed")
@@ -9680,6 +10692,7 @@ def set_autosync_status():
                  ('true' if new_enabled else 'false',))
     conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('autosync_interval', ?)", 
                  (str(new_interval),))
+    order_index.bump_versions(conn, ['settings'])
     conn.commit()
     conn.close()
     
@@ -10090,6 +11103,11 @@ def clean_all_sites():
                         
                         if draft_ids:
                             placeholders = ','.join(['?' for _ in draft_ids])
+                            order_index.bump_order_months(conn, draft_ids)
+                            order_search.remove_orders(conn, draft_ids)
+                            order_tracking.remove_orders(conn, draft_ids)
+                            shipping_view.remove_orders(conn, draft_ids)
+                            customer_stats.mark_orders(conn, draft_ids, identity_graph.remove_orders(conn, draft_ids))
                             conn.execute(f"DELETE FROM orders WHERE source = ? AND id IN ({placeholders})", 
                                          [site_url] + list(draft_ids))
                             conn.commit()
@@ -10406,6 +11424,7 @@ def add_user():
             INSERT INTO users (username, password_hash, name, role)
             VALUES (?, ?, ?, ?)
         ''', (username, generate_password_hash(password), name, role))
+        order_index.bump_versions(conn, ['users'])
         conn.commit()
         return jsonify({'success': True})
     except sqlite3.IntegrityError:
@@ -10496,6 +11515,7 @@ def update_user(user_id):
             else:
                 conn.execute('UPDATE users SET name=?, role=?, can_ship=?, can_view_shipping=?, can_view_report=?, can_manage_products=? WHERE id=?',
                             (name, role, can_ship, can_view_shipping_val, can_view_report, can_manage_products, user_id))
+        order_index.bump_versions(conn, ['users'])
         conn.commit()
         return jsonify({'success': True})
     finally:
@@ -10527,6 +11547,7 @@ def delete_user(user_id):
 
         conn.execute('DELETE FROM user_site_permissions WHERE user_id = ?', (user_id,))
         conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
+        order_index.bump_versions(conn, ['users'])
         conn.commit()
         return jsonify({'success': True})
     finally:
@@ -10607,6 +11628,7 @@ def update_user_permissions(user_id):
             conn.execute('INSERT OR IGNORE INTO user_country_permissions (user_id, country) VALUES (?, ?)', (user_id, c))
         for sid in site_exclusions:
             conn.execute('INSERT OR IGNORE INTO user_site_exclusions (user_id, site_id) VALUES (?, ?)', (user_id, sid))
+        order_index.bump_versions(conn, ['users'])
         conn.commit()
     finally:
         conn.close()
@@ -10674,60 +11696,99 @@ def _is_reconciliation_admin():
 # product_costs has effective_date — costs change over time. Same product can
 # have 2/28 entry @ 28 PLN and 3/15 entry @ 30 PLN. When valuing an order made
 # on 3/20, we need the 30 PLN row (latest effective_date <= order_date).
+#
+# The index is built once per 'product_costs' data version (bumped by
+# create/update/delete_product_cost) and shared by every sales-board /
+# reconciliation request of the process. Each key holds its effective dates
+# as an ascending list searched with bisect, and resolved lookups are memoized
+# per (brand, series, puffs, flavor, warehouse, day) — a month of line items
+# mostly repeats the same few products and dates.
+COST_INDEX_SCOPE = 'product_costs'
+COST_MEMO_MAX = 50000
+_cost_index_cache = None  # (version, index)
+
+
+def _load_dated_cost_index(conn):
+    """Build the full (all warehouses) index from product_costs."""
+    rows = conn.execute('''SELECT id, brand_id, series_id, puff_count, flavor, warehouse_id,
+                                 cost_price, cost_currency, effective_date
+                          FROM product_costs''').fetchall()
+
+    levels = {'exact': {}, 'bspw': {}, 'bpw': {}, 'bw': {}}
+    for r in rows:
+        b = r['brand_id']
+        s = r['series_id']
+        p = r['puff_count']
+        f = (r['flavor'] or '').strip() or None
+        w = r['warehouse_id']
+        entry = {
+            'effective_date': r['effective_date'] or '0000-00-00',
+            'price': float(r['cost_price'] or 0),
+            'currency': r['cost_currency'] or 'PLN',
+            'id': r['id'],
+        }
+        levels['exact'].setdefault((b, s, p, f, w), []).append(entry)    # brand+series+puffs+flavor+warehouse
+        levels['bspw'].setdefault((w, b, s, p), []).append(entry)        # drop flavor
+        levels['bpw'].setdefault((w, b, p), []).append(entry)            # drop series + flavor
+        levels['bw'].setdefault((w, b), []).append(entry)                # brand only
+
+    # key -> (dates ascending, entries in the same order). Equal dates keep
+    # the larger id last, so bisect lands on it — the row the old
+    # 'ORDER BY effective_date DESC, id DESC' scan returned first.
+    idx = {}
+    for level, groups in levels.items():
+        packed = {}
+        for key, entries in groups.items():
+            entries.sort(key=lambda e: (e['effective_date'], e['id']))
+            packed[key] = ([e['effective_date'] for e in entries],
+                           [{k: e[k] for k in ('effective_date', 'price', 'currency')} for e in entries])
+        idx[level] = packed
+    idx['warehouses'] = None
+    idx['memo'] = {}
+    return idx
 
-def _build_dated_cost_index(conn=None, only_warehouse_ids=None):
-    """Load all product_costs rows into a structure that supports
-    'cost at order date' lookups.
 
-    Returns a dict mapping
-      key = (brand_id, series_id_or_0, puff_count_or_0, flavor_or_blank, warehouse_id)
-      value = list of {effective_date, price, currency} sorted by effective_date DESC
+def _build_dated_cost_index(conn=None, only_warehouse_ids=None):
+    """Index of all product_costs rows for 'cost at order date' lookups.
 
-    Plus a coarse-match index keyed by (warehouse_id, brand_id, series_id, puff_count)
-    for the 'brand+puffs+series' fallback (drops flavor).
+    Returns a dict with one entry per match level:
+      exact  (brand_id, series_id_or_0, puff_count_or_0, flavor_or_blank, warehouse_id)
+      bspw   (warehouse_id, brand_id, series_id, puff_count)  — drops flavor
+      bpw    (warehouse_id, brand_id, puff_count)             — drops series too
+      bw     (warehouse_id, brand_id)                         — brand only
+    each mapping to (effective dates ascending, [{effective_date, price, currency}]).
 
-    Plus an even coarser brand-only fallback by (warehouse_id, brand_id).
+    only_warehouse_ids restricts lookups to those warehouses (a view over the
+    shared index, other warehouses resolve to None as if never loaded).
 
-    Caller passes a connection if reusing one, or None to open a fresh one.
+    Served from the per-process cache while the 'product_costs' version is
+    unchanged. Caller passes a connection if reusing one, or None to open a
+    fresh one. Callers only read the index and the entries it returns.
     """
+    global _cost_index_cache
     own_conn = conn is None
     if own_conn:
         conn = get_db_connection()
     try:
-        sql = '''SELECT brand_id, series_id, puff_count, flavor, warehouse_id,
-                        cost_price, cost_currency, effective_date
-                 FROM product_costs'''
-        params = []
-        if only_warehouse_ids:
-            placeholders = ','.join(['?'] * len(only_warehouse_ids))
-            sql += f' WHERE warehouse_id IN ({placeholders})'
-            params = list(only_warehouse_ids)
-        sql += ' ORDER BY effective_date DESC, id DESC'
-        rows = conn.execute(sql, params).fetchall()
+        try:
+            version = order_index.get_versions(conn, [COST_INDEX_SCOPE])[COST_INDEX_SCOPE]
+        except Exception:
+            version = None
+        cached = _cost_index_cache
+        if cached is not None and version is not None and cached[0] == version:
+            idx = cached[1]
+        else:
+            idx = _load_dated_cost_index(conn)
+            if version is not None:
+                _cost_index_cache = (version, idx)
     finally:
         if own_conn:
             conn.close()
 
-    exact = {}            # (b, s, p, f, w) -> [{date, price, currency}, ...]
-    by_bspw = {}          # (w, b, s, p) -> [...]
-    by_bpw = {}           # (w, b, p) -> [...]    (drop series + flavor)
-    by_bw = {}            # (w, b) -> [...]       (brand only)
-    for r in rows:
-        b = r['brand_id']
-        s = r['series_id']
-        p = r['puff_count']
-        f = (r['flavor'] or '').strip() or None
-        w = r['warehouse_id']
-        entry = {
-            'effective_date': r['effective_date'] or '0000-00-00',
-            'price': float(r['cost_price'] or 0),
-            'currency': r['cost_currency'] or 'PLN',
-        }
-        exact.setdefault((b, s, p, f, w), []).append(entry)
-        by_bspw.setdefault((w, b, s, p), []).append(entry)
-        by_bpw.setdefault((w, b, p), []).append(entry)
-        by_bw.setdefault((w, b), []).append(entry)
-    return {'exact': exact, 'bspw': by_bspw, 'bpw': by_bpw, 'bw': by_bw}
+    if only_warehouse_ids:
+        # Same levels and memo (results don't depend on the scope), plus the filter
+        idx = dict(idx, warehouses=frozenset(only_warehouse_ids))
+    return idx
 
 
 def _cost_at_date(idx, brand_id, series_id, puff_count, flavor, warehouse_id, order_date):
@@ -10744,7 +11805,15 @@ def _cost_at_date(idx, brand_id, series_id, puff_count, flavor, warehouse_id, or
     """
     if not brand_id or not warehouse_id:
         return None
+    if idx['warehouses'] is not None and warehouse_id not in idx['warehouses']:
+        return None
     flavor_key = (flavor or '').strip() or None
+    od = order_date or '9999-99-99'  # if no date, treat as "now" — pick latest cost
+
+    memo = idx['memo']
+    memo_key = (brand_id, series_id, puff_count, flavor_key, warehouse_id, od)
+    if memo_key in memo:
+        return memo[memo_key]
 
     candidates = [
         ('exact', idx['exact'].get((brand_id, series_id, puff_count, flavor_key, warehouse_id))),
@@ -10752,30 +11821,37 @@ def _cost_at_date(idx, brand_id, series_id, puff_count, flavor, warehouse_id, or
         ('bpw',   idx['bpw'].get((warehouse_id, brand_id, puff_count))),
         ('bw',    idx['bw'].get((warehouse_id, brand_id))),
     ]
-    od = order_date or '9999-99-99'  # if no date, treat as "now" — pick latest cost
-    for level, entries in candidates:
-        if not entries:
+    result = None
+    for level, packed in candidates:
+        if not packed:
             continue
-        # entries already sorted by effective_date DESC; pick first <= od
-        for e in entries:
-            if e['effective_date'] <= od:
-                return {
-                    'price': e['price'],
-                    'currency': e['currency'],
-                    'effective_date': e['effective_date'],
-                    'match_level': level,
-                }
-        # If all entries are AFTER order_date (e.g. cost was first set 2026-04
-        # but order is from 2025-12), fall back to oldest known cost as a best
-        # effort and tag it accordingly so the UI can warn.
-        oldest = entries[-1]
-        return {
-            'price': oldest['price'],
-            'currency': oldest['currency'],
-            'effective_date': oldest['effective_date'],
-            'match_level': level + '_future',  # cost record is newer than order
-        }
-    return None
+        dates, entries = packed
+        pos = bisect.bisect_right(dates, od) - 1
+        if pos >= 0:
+            e = entries[pos]
+            result = {
+                'price': e['price'],
+                'currency': e['currency'],
+                'effective_date': e['effective_date'],
+                'match_level': level,
+            }
+        else:
+            # If all entries are AFTER order_date (e.g. cost was first set 2026-04
+            # but order is from 2025-12), fall back to oldest known cost as a best
+            # effort and tag it accordingly so the UI can warn.
+            oldest = entries[0]
+            result = {
+                'price': oldest['price'],
+                'currency': oldest['currency'],
+                'effective_date': oldest['effective_date'],
+                'match_level': level + '_future',  # cost record is newer than order
+            }
+        break
+
+    if len(memo) >= COST_MEMO_MAX:
+        memo.clear()
+    memo[memo_key] = result
+    return result
 
 
 def _resolve_product_to_brand(product_name, source, brands_cache, product_mappings_cache):
@@ -10844,7 +11920,7 @@ def _calc_partner_net_sales(partner_id, year, month):
         FROM orders
         WHERE source IN ({placeholders})
         AND currency = ?
-        AND strftime('%Y-%m', date_created) = ?
+        AND year_month = ?
     '''
     params = site_urls + [currency, month_str]
     row = conn.execute(query, params).fetchone()
@@ -10859,11 +11935,79 @@ def _calc_partner_net_sales(partner_id, year, month):
     }
 
 
-def _calc_partner_recon_detail(partner_id, year, month, site_filter=None, manager_filter=None):
-    """Comprehensive monthly aggregation for the partner reconciliation drill-down.
+# Bump when _compute_partner_recon_detail's logic or output shape changes so
+# snapshots written by older code are recomputed instead of served.
+RECON_DETAIL_SNAPSHOT_FORMAT = 1
+# Partners' ratios / currency and their site bindings (a narrower scope than
+# 'reconciliation', which statements and receipts bump too).
+RECON_PARTNERS_SCOPE = 'partners'
+# Settings tables every partner month reads (data_versions scopes).
+_RECON_DETAIL_GLOBAL_SCOPES = (RECON_PARTNERS_SCOPE, 'sites', 'warehouses', 'exchange_rates',
+                               'product_costs', 'product_mappings', 'brands')
 
-    Returns the same numbers as _calc_partner_net_sales (so existing callers stay
-    consistent) plus per-status breakdown, per-site breakdown, per-product
+
+def _recon_detail_snapshot_version(conn, month_str):
+    """Version string a recon detail snapshot is valid for: the month's
+    orders counter plus the partner / site / cost / mapping / rate tables."""
+    scopes = [order_index.orders_scope(month_str)] + list(_RECON_DETAIL_GLOBAL_SCOPES)
+    versions = order_index.get_versions(conn, scopes)
+    return f'v{RECON_DETAIL_SNAPSHOT_FORMAT}:' + '.'.join(str(versions[sc]) for sc in scopes)
+
+
+def _calc_partner_recon_detail(partner_id, year, month, site_filter=None, manager_filter=None):
+    """_compute_partner_recon_detail, served from recon_detail_snapshots.
+
+    The drill-down of a partner month only changes when one of that month's
+    orders, the partner (ratios, currency, bound sites), a site, a warehouse,
+    a cost, a product mapping / brand or an exchange rate is written — each
+    bumps a data_versions counter. The payload is stored per (partner, month,
+    site filter, manager filter) with the version string it was computed
+    under and reused while the string still matches, so the preview, products
+    tab, trend / comparison dashboards and statement screens stop re-resolving
+    every line item. Each call returns a fresh copy (callers may modify it).
+    """
+    month_str = f'{year:04d}-{month:02d}'
+    snapshot_key = (partner_id, month_str, site_filter or '', manager_filter or '')
+
+    conn = get_db_connection()
+    try:
+        # Read the version BEFORE computing: a write landing mid-computation
+        # leaves the stored version behind, so the next request recomputes.
+        version = _recon_detail_snapshot_version(conn, month_str)
+        row = conn.execute('''
+            SELECT settings_version, payload FROM recon_detail_snapshots
+            WHERE partner_id = ? AND year_month = ? AND site_filter = ? AND manager_filter = ?
+        ''', snapshot_key).fetchone()
+        if row and row['settings_version'] == version:
+            try:
+                return json.loads(row['payload'])
+            except ValueError:
+                pass  # corrupt row — recompute and overwrite
+
+        data = _compute_partner_recon_detail(partner_id, year, month,
+                                             site_filter=site_filter, manager_filter=manager_filter)
+        if data is None:
+            return None
+        conn.execute('''
+            INSERT INTO recon_detail_snapshots
+                (partner_id, year_month, site_filter, manager_filter, settings_version, payload, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, datetime('now'))
+            ON CONFLICT(partner_id, year_month, site_filter, manager_filter) DO UPDATE SET
+                settings_version = excluded.settings_version,
+                payload = excluded.payload,
+                created_at = excluded.created_at
+        ''', snapshot_key + (version, json.dumps(data, ensure_ascii=False)))
+        conn.commit()
+        return data
+    finally:
+        conn.close()
+
+
+def _compute_partner_recon_detail(partner_id, year, month, site_filter=None, manager_filter=None):
+    """Comprehensive monthly aggregation for the partner reconciliation drill-down.
+
+    Returns the same numbers as _calc_partner_net_sales (so existing callers stay
+    consistent) plus per-status breakdown, per-site breakdown, per-product
     breakdown using DATE-AWARE actual product costs. Everything is in the
     partner's native currency unless explicitly suffixed.
 
@@ -10923,7 +12067,7 @@ def _calc_partner_recon_detail(partner_id, year, month, site_filter=None, manage
             FROM orders
             WHERE source IN ({placeholders})
             AND currency = ?
-            AND strftime('%Y-%m', date_created) = ?
+            AND year_month = ?
             ORDER BY date_created DESC
         ''', site_urls + [currency, month_str]).fetchall()
 
@@ -11416,7 +12560,7 @@ def _snapshot_statement_orders(statement_id, partner_id, year, month, conn):
         FROM orders
         WHERE source IN ({placeholders})
           AND currency = ?
-          AND strftime('%Y-%m', date_created) = ?
+          AND year_month = ?
     ''', site_urls + [currency, month_str]).fetchall()
 
     # Wipe + replace
@@ -11539,6 +12683,7 @@ def api_create_partner():
               float(data.get('partner_profit_ratio', 0.25)),
               float(data.get('our_profit_ratio', 0.25)),
               data.get('currency', 'PLN')))
+        order_index.bump_versions(conn, ['reconciliation', RECON_PARTNERS_SCOPE])
         conn.commit()
         return jsonify({'success': True, 'id': cursor.lastrowid})
     except sqlite3.IntegrityError as e:
@@ -11568,6 +12713,7 @@ def api_update_partner(partner_id):
               float(data.get('our_profit_ratio', 0.25)),
               data.get('currency', 'PLN'),
               partner_id))
+        order_index.bump_versions(conn, ['reconciliation', RECON_PARTNERS_SCOPE])
         conn.commit()
         return jsonify({'success': True})
     finally:
@@ -11584,6 +12730,8 @@ def api_delete_partner(partner_id):
     conn = get_db_connection()
     try:
         conn.execute('DELETE FROM partners WHERE id = ?', (partner_id,))
+        conn.execute('DELETE FROM recon_detail_snapshots WHERE partner_id = ?', (partner_id,))
+        order_index.bump_versions(conn, ['reconciliation', RECON_PARTNERS_SCOPE])
         conn.commit()
         return jsonify({'success': True})
     finally:
@@ -11620,6 +12768,7 @@ def api_update_partner_sites(partner_id):
         for sid in site_ids:
             conn.execute('INSERT OR IGNORE INTO partner_sites (partner_id, site_id) VALUES (?, ?)',
                         (partner_id, sid))
+        order_index.bump_versions(conn, ['reconciliation', RECON_PARTNERS_SCOPE])
         conn.commit()
         return jsonify({'success': True})
     finally:
@@ -11665,6 +12814,7 @@ def api_update_partner_users(partner_id):
         for uid in user_ids:
             conn.execute('INSERT OR IGNORE INTO partner_users (partner_id, user_id) VALUES (?, ?)',
                         (partner_id, uid))
+        order_index.bump_versions(conn, ['reconciliation'])
         conn.commit()
         return jsonify({'success': True})
     finally:
@@ -11684,6 +12834,7 @@ def _check_partner_access(partner_id):
 @app.route('/api/reconciliation/statements')
 @login_required
 @reconciliation_api_required
+@conditional_json
 def api_list_statements():
     """List statements, filtered by access + optional partner_id/year"""
     partner_id = request.args.get('partner_id', type=int)
@@ -11726,6 +12877,7 @@ def api_list_statements():
 @app.route('/api/reconciliation/statements/preview')
 @login_required
 @reconciliation_api_required
+@conditional_json
 def api_preview_statement():
     """Preview a statement without saving — full drill-down detail.
 
@@ -11748,17 +12900,199 @@ def api_preview_statement():
     return jsonify(detail)
 
 
+# 订单明细 tab: rows are sent in keyset chunks (cursor = last row's
+# date_created|id) so a partner month with thousands of orders renders the
+# first rows immediately; "本页合计" comes from one aggregate query per filter.
+RECON_ORDERS_CHUNK = 500
+RECON_ORDERS_MAX_CHUNK = 2000
+RECON_ORDERS_SHOWN_PRODUCTS = 3  # the list shows 3 lines + "…还有 N 项"
+
+
+def _recon_orders_revenue_cond():
+    """SQL form of the order list's revenue test. Unlike _revenue_status_cond
+    it keeps refunded / 问题退货 orders, as this list always has."""
+    return f"""(COALESCE(status, '') NOT IN ('failed','cancelled','checkout-draft','trash','cheat')
+        AND NOT (COALESCE(status, '') = 'pending' AND COALESCE(NULLIF(payment_method, ''), 'cod') != 'cod')
+        AND NOT (COALESCE(status, '') = 'on-hold' AND COALESCE(payment_method, '') = 'bacs')
+        AND NOT (COALESCE(status, '') = 'on-hold' AND NOT {_on_hold_is_shipped_clause()})
+        AND COALESCE(is_undelivered, 0) = 0)"""
+
+
+def _recon_order_costing(conn, currency, year, month):
+    """Per-request line-item costing for the reconciliation order list.
+
+    Returns cost_of(source, date_created, items) -> (cost, unmapped_qty): the
+    date-aware product cost in the partner's currency, looked up in the order
+    country's default warehouses (cost currency converted via CNY). Unmapped
+    lines, or lines whose rate is missing, add 0 cost and count as unmapped.
+    """
+    cost_idx = _build_dated_cost_index(conn=conn)
+    country_default_wh_ids = {}
+    for w in conn.execute('SELECT id, country FROM warehouses ORDER BY country, id').fetchall():
+        country_default_wh_ids.setdefault(w['country'], []).append(w['id'])
+    site_country_map = {s['url']: s['country'] for s in conn.execute('SELECT url, country FROM sites').fetchall()}
+    brands_cache = []
+    for row in conn.execute('SELECT id, name, aliases FROM brands').fetchall():
+        try:
+            aliases = json.loads(row['aliases']) if row['aliases'] else []
+        except Exception:
+            aliases = []
+        brands_cache.append({
+            'id': row['id'], 'name': row['name'], 'aliases': aliases,
+            'patterns': [row['name'].upper()] + [a.upper() for a in aliases]
+        })
+    product_mappings_cache = {}
+    for pm in conn.execute('SELECT raw_name, source, brand_id, series_id, puff_count, flavor FROM product_mappings').fetchall():
+        product_mappings_cache[(normalize_raw_name(pm['raw_name']), pm['source'])] = pm
+
+    resolved = {}   # (raw_name, source) -> (brand_id, series_id, puff_count, flavor)
+    rates = {}      # (cost_currency, year, month) -> (rate_cost_cny, rate_partner_cny)
+
+    def unit_in_partner(price, cost_currency, y, m):
+        if cost_currency == currency:
+            return price
+        key = (cost_currency, y, m)
+        if key not in rates:
+            rates[key] = (_lookup_partner_rate(cost_currency, y, m)[0], _lookup_partner_rate(currency, y, m)[0])
+        rcost, rpart = rates[key]
+        if rcost and rpart:
+            return price * (rcost / rpart)
+        return None  # rate unavailable — caller treats as unmapped
+
+    def cost_of(source, date_created, items):
+        order_date = (date_created or '')[:10]
+        effective_wh_ids = country_default_wh_ids.get(site_country_map.get(source, 'PL') or 'PL', [])
+        try:
+            od_y, od_m = (date_created or '0000-00')[:7].split('-')
+            od_y, od_m = int(od_y), int(od_m)
+        except Exception:
+            od_y, od_m = (year or 0), (month or 0)
+        cost = 0.0
+        unmapped_qty = 0
+        for it in items:
+            qty = int(it.get('quantity', 0) or 0)
+            if qty <= 0:
+                continue
+            raw_name = it.get('name', '') or ''
+            key = (raw_name, source)
+            if key not in resolved:
+                resolved[key] = _resolve_product_to_brand(raw_name, source, brands_cache, product_mappings_cache)
+            b_id, s_id, p_cnt, flav = resolved[key]
+            cost_entry = None
+            if b_id:
+                for ewh in effective_wh_ids:
+                    cost_entry = _cost_at_date(cost_idx, b_id, s_id, p_cnt, flav, ewh, order_date)
+                    if cost_entry:
+                        break
+            unit = unit_in_partner(cost_entry['price'], cost_entry['currency'], od_y, od_m) if cost_entry else None
+            if unit is None:
+                # POLICY: unmapped lines contribute 0 to the order cost. Margin%
+                # is inflated for these orders on purpose — a forcing function
+                # for cost data quality; the unmapped warning flags them.
+                unmapped_qty += qty
+            else:
+                cost += unit * qty
+        return round(cost, 2), unmapped_qty
+
+    return cost_of
+
+
+def _recon_orders_totals(where_sql, params, currency, year, month, period_rate):
+    """(total, displayed_totals) of every order matching the list filter.
+
+    Counts, amounts, net, losses and item quantities come from one GROUP BY
+    year_month query (the month picks the CNY rate when no period rate is
+    set); only the revenue orders' line items are read again, for the cost.
+    """
+    revenue_sql = _recon_orders_revenue_cond()
+    totals = _empty_displayed_totals(currency)
+    totals['rate_to_cny'] = period_rate
+    conn = get_db_connection()
+    try:
+        months = conn.execute(f'''
+            SELECT year_month,
+                   COUNT(*) AS order_count,
+                   SUM(CASE WHEN COALESCE(is_undelivered, 0) = 1 THEN 1 ELSE 0 END) AS undelivered_count,
+                   SUM(COALESCE(total, 0)) AS amount,
+                   SUM(COALESCE(shipping_total, 0)) AS shipping,
+                   SUM(CASE WHEN COALESCE(is_undelivered, 0) = 1
+                            THEN COALESCE(shipping_loss_amount, 0) ELSE 0 END) AS shipping_loss,
+                   SUM(CASE WHEN {revenue_sql}
+                            THEN MAX(0, COALESCE(total, 0) - COALESCE(shipping_total, 0)) ELSE 0 END) AS net,
+                   SUM((SELECT COALESCE(SUM(CAST(json_extract(j.value, '$.quantity') AS INTEGER)), 0)
+                        FROM json_each(COALESCE(CASE WHEN json_valid(line_items) THEN
+                                                    CASE WHEN json_type(line_items) = 'array' THEN line_items END
+                                                END, '[]')) j)) AS product_count
+            FROM orders WHERE {where_sql}
+            GROUP BY year_month
+        ''', params).fetchall()
+
+        cost_of = _recon_order_costing(conn, currency, year, month)
+        cost_by_month = {}
+        unmapped_qty = 0
+        for r in conn.execute(f'''
+                SELECT year_month, source, date_created, line_items
+                FROM orders WHERE {where_sql} AND {revenue_sql}
+        ''', params):
+            items = parse_json_field(r['line_items'])
+            if not isinstance(items, list):
+                continue
+            cost, unmapped = cost_of(r['source'], r['date_created'], items)
+            cost_by_month[r['year_month']] = cost_by_month.get(r['year_month'], 0.0) + cost
+            unmapped_qty += unmapped
+
+        rate_cache = {}
+        for m in months:
+            rate = period_rate
+            if rate is None and m['year_month']:
+                if m['year_month'] not in rate_cache:
+                    y, mo = m['year_month'].split('-')
+                    rate_cache[m['year_month']] = _lookup_partner_rate(currency, int(y), int(mo))[0]
+                rate = rate_cache[m['year_month']]
+            cost = cost_by_month.get(m['year_month'], 0.0)
+            net = float(m['net'] or 0)
+            loss = float(m['shipping_loss'] or 0)
+            totals['order_count'] += m['order_count']
+            totals['undelivered_count'] += m['undelivered_count'] or 0
+            totals['product_count'] += m['product_count'] or 0
+            totals['amount'] += float(m['amount'] or 0)
+            totals['shipping'] += float(m['shipping'] or 0)
+            totals['shipping_loss'] += loss
+            totals['net'] += net
+            totals['cost'] += cost
+            totals['margin'] += net - cost
+            if rate:
+                totals['net_cny'] += net * rate
+                totals['shipping_loss_cny'] += loss * rate
+                totals['cost_cny'] += cost * rate
+                totals['margin_cny'] += (net - cost) * rate
+        totals['unmapped_qty'] = unmapped_qty
+    finally:
+        conn.close()
+
+    # Round totals for display
+    for k in ('amount', 'shipping', 'net', 'shipping_loss',
+              'cost', 'margin', 'net_cny', 'shipping_loss_cny',
+              'cost_cny', 'margin_cny'):
+        totals[k] = round(totals[k], 2)
+    totals['final_net_cny'] = round(totals['net_cny'] - totals['shipping_loss_cny'], 2)
+    totals['margin_pct'] = round(totals['margin'] / totals['net'] * 100, 1) if totals['net'] > 0 else None
+    return totals['order_count'], totals
+
+
 @app.route('/api/reconciliation/orders')
 @login_required
 @reconciliation_api_required
+@conditional_json
 def api_recon_orders():
     """Order list filtered by partner (their bound sites + currency + period).
 
     Replicates the data-shape of /orders for embedding inside the partner
-    reconciliation page, INCLUDING the page-totals summary row used by the
-    "本页合计" header. When a year+month filter is set, returns ALL orders
-    for that month (capped at 5000) — no internal pagination, matching the
-    /orders page behavior where one month = one page.
+    reconciliation page. Rows come newest first in keyset chunks of ?limit=
+    (default RECON_ORDERS_CHUNK): pass the previous response's next_cursor
+    as ?cursor= for the next chunk; next_cursor is null after the last one.
+    The first chunk (no cursor) also carries total and the "本页合计"
+    displayed_totals over ALL matching orders.
     """
     partner_id = request.args.get('partner_id', type=int)
     year = request.args.get('year', type=int)
@@ -11766,16 +13100,19 @@ def api_recon_orders():
     status_filter = (request.args.get('status') or '').strip()
     source_filter = (request.args.get('source') or '').strip()
     search = (request.args.get('search') or '').strip()
-    # Pagination — only kicks in when a month filter is NOT set. With a month
-    # filter, we dump the entire month in one response (5000-row safety cap).
-    requested_page = max(1, request.args.get('page', 1, type=int))
-    requested_per_page = min(5000, max(20, request.args.get('per_page', 200, type=int)))
-    use_pagination = not (year and month)
+    cursor = request.args.get('cursor') or ''
+    limit = min(RECON_ORDERS_MAX_CHUNK, max(50, request.args.get('limit', RECON_ORDERS_CHUNK, type=int)))
 
     if not partner_id:
         return jsonify({'error': '缺少 partner_id 参数'}), 400
     if not _check_partner_access(partner_id):
         return jsonify({'error': '无权查看此合伙人'}), 403
+    after = None
+    if cursor:
+        cursor_date, sep, cursor_id = cursor.rpartition('|')
+        if not sep or not cursor_id:
+            return jsonify({'error': 'cursor 无效'}), 400
+        after = (cursor_date, cursor_id)
 
     conn = get_db_connection()
     try:
@@ -11790,8 +13127,8 @@ def api_recon_orders():
             WHERE ps.partner_id = ?
         ''', (partner_id,)).fetchall()
         if not sites:
-            return jsonify({'orders': [], 'total': 0, 'page': requested_page,
-                            'per_page': requested_per_page, 'currency': currency,
+            return jsonify({'orders': [], 'total': 0, 'next_cursor': None, 'limit': limit,
+                            'currency': currency, 'partner_id': partner_id,
                             'displayed_totals': _empty_displayed_totals(currency)})
         site_urls = [s['url'] for s in sites]
         if source_filter:
@@ -11805,11 +13142,11 @@ def api_recon_orders():
         conditions = [f'source IN ({placeholders})', 'currency = ?']
         params = list(allowed_urls) + [currency]
         if year and month:
-            conditions.append("strftime('%Y-%m', date_created) = ?")
+            conditions.append("year_month = ?")
             params.append(f'{year:04d}-{month:02d}')
         elif year:
-            conditions.append("strftime('%Y', date_created) = ?")
-            params.append(str(year))
+            conditions.append("year_month BETWEEN ? AND ?")
+            params.extend([f'{year:04d}-01', f'{year:04d}-12'])
         if status_filter:
             if status_filter == 'undelivered':
                 conditions.append('COALESCE(is_undelivered, 0) = 1')
@@ -11819,42 +13156,16 @@ def api_recon_orders():
                 conditions.append('status = ?')
                 params.append(status_filter)
         if search:
-            conditions.append("(number LIKE ? OR id LIKE ? OR billing LIKE ?)")
-            like = f'%{search}%'
-            params.extend([like, like, like])
+            fts = order_search.match_clause(search, ('order_id', 'number', 'customer'))
+            if fts:
+                conditions.append(fts[0])
+                params.extend(fts[1])
+            else:
+                conditions.append("(number LIKE ? OR id LIKE ? OR billing LIKE ?)")
+                like = f'%{search}%'
+                params.extend([like, like, like])
         where_sql = ' AND '.join(conditions)
 
-        total = conn.execute(f'SELECT COUNT(*) FROM orders WHERE {where_sql}', params).fetchone()[0]
-
-        # Fetch rows — paginated only if no month filter
-        if use_pagination:
-            offset = (requested_page - 1) * requested_per_page
-            limit_sql = f'LIMIT {requested_per_page} OFFSET {offset}'
-            page_returned = requested_page
-            per_page_returned = requested_per_page
-        else:
-            # All-in-one-page mode: cap at 5000 rows for safety
-            limit_sql = 'LIMIT 5000'
-            page_returned = 1
-            per_page_returned = max(total, 1)
-
-        rows = conn.execute(f'''
-            SELECT id, number, status, payment_method, currency, date_created,
-                   total, shipping_total, line_items, source, billing,
-                   is_undelivered, shipping_loss_amount
-            FROM orders WHERE {where_sql}
-            ORDER BY date_created DESC
-            {limit_sql}
-        ''', params).fetchall()
-
-        site_managers = {s['url']: s['manager'] for s in conn.execute('SELECT url, manager FROM sites').fetchall()}
-        site_country_map = {s['url']: s['country'] for s in conn.execute('SELECT url, country FROM sites').fetchall()}
-        on_hold_shipped_sources = {
-            r['url'] for r in conn.execute(
-                "SELECT url FROM sites WHERE cod_on_hold_is_shipped = 1"
-            ).fetchall()
-        }
-
         # Lookup CNY rate for the period (used per-order net_cny conversion).
         # Fall back to month-of-order if no period rate, so multi-month dumps
         # still get correct conversions.
@@ -11862,190 +13173,79 @@ def api_recon_orders():
         if year and month:
             period_rate, _ = _lookup_partner_rate(currency, year, month)
 
-        # ---------- per-order COST machinery ----------
-        # Build the date-aware cost index + brand/product-mappings caches once
-        # per request. Then for each order's line items, look up the cost that
-        # was effective on the order date and sum to a per-order cost.
-        # Cost is in partner's native currency (we convert from cost_currency
-        # via CNY when they differ).
-        cost_idx = _build_dated_cost_index(conn=conn)
-        country_default_wh_ids = {}
-        for w in conn.execute('SELECT id, country FROM warehouses ORDER BY country, id').fetchall():
-            country_default_wh_ids.setdefault(w['country'], []).append(w['id'])
-        brands_rows = conn.execute('SELECT id, name, aliases FROM brands').fetchall()
-        brands_cache = []
-        for row in brands_rows:
-            try:
-                aliases = json.loads(row['aliases']) if row['aliases'] else []
-            except Exception:
-                aliases = []
-            brands_cache.append({
-                'id': row['id'], 'name': row['name'], 'aliases': aliases,
-                'patterns': [row['name'].upper()] + [a.upper() for a in aliases]
-            })
-        pm_rows = conn.execute('SELECT raw_name, source, brand_id, series_id, puff_count, flavor FROM product_mappings').fetchall()
-        product_mappings_cache = {}
-        for pm in pm_rows:
-            product_mappings_cache[(normalize_raw_name(pm['raw_name']), pm['source'])] = pm
-
-        # Aggregator for "本页合计" — mirrors the orders.html displayed_totals.
-        totals = {
-            'order_count': 0,
-            'undelivered_count': 0,
-            'product_count': 0,
-            'currency': currency,
-            'amount': 0.0,
-            'shipping': 0.0,
-            'net': 0.0,                # gross-shipping for revenue-status orders only
-            'shipping_loss': 0.0,      # loss from undelivered orders
-            # ── new cost / margin aggregates ──
-            'cost': 0.0,               # total actual product cost (revenue orders only)
-            'margin': 0.0,             # net − cost
-            'unmapped_qty': 0,         # qty of line items without cost mapping
-            'rate_to_cny': period_rate,
-            'net_cny': 0.0,
-            'shipping_loss_cny': 0.0,
-            'final_net_cny': 0.0,
-            'cost_cny': 0.0,
-            'margin_cny': 0.0,
-        }
-
-        def _is_revenue(status, pm, is_undel, src=None):
-            if status in ('failed', 'cancelled', 'checkout-draft', 'trash', 'cheat'):
-                return False
-            if status == 'pending' and (pm or 'cod') != 'cod':
-                return False
-            if status == 'on-hold' and pm == 'bacs':
-                return False
-            if status == 'on-hold' and src not in on_hold_shipped_sources:
-                # AU/AE etc — on-hold is "received, waiting", never shipped.
-                return False
-            if is_undel:
-                return False
-            return True
+        # Keyset page: only the columns the list shows; customer name / email
+        # are pulled out of billing by SQLite instead of parsing it here.
+        page_sql = where_sql
+        page_params = list(params)
+        if after:
+            page_sql += " AND (COALESCE(date_created, ''), id) < (?, ?)"
+            page_params.extend(after)
+        rows = conn.execute(f'''
+            SELECT id, number, status, payment_method, date_created,
+                   total, shipping_total, line_items, source,
+                   CASE WHEN json_valid(billing) THEN json_extract(billing, '$.first_name') END AS first_name,
+                   CASE WHEN json_valid(billing) THEN json_extract(billing, '$.last_name') END AS last_name,
+                   CASE WHEN json_valid(billing) THEN json_extract(billing, '$.email') END AS email,
+                   is_undelivered, shipping_loss_amount,
+                   CASE WHEN {_recon_orders_revenue_cond()} THEN 1 ELSE 0 END AS is_revenue
+            FROM orders WHERE {page_sql}
+            ORDER BY COALESCE(date_created, '') DESC, id DESC
+            LIMIT ?
+        ''', page_params + [limit + 1]).fetchall()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = f"{rows[-1]['date_created'] or ''}|{rows[-1]['id']}"
 
-        # Per-request cache for warehouse-lookup-by-source (avoids repeat DB hits).
-        # Each order needs to know which warehouse(s) to look up costs against.
-        order_warehouse_cache = {}  # source_url -> [warehouse_ids]
-
-        # Cache for partner-currency conversion of cost-currency (avoids
-        # repeat _lookup_partner_rate calls for the same currency in a request)
-        _cost_rate_cache = {}
-        def _convert_cost_to_partner(price, cost_currency, year, month):
-            """Convert a single-unit cost price from cost_currency to partner currency."""
-            if cost_currency == currency:
-                return price
-            cache_key = (cost_currency, year, month)
-            if cache_key not in _cost_rate_cache:
-                rcost, _ = _lookup_partner_rate(cost_currency, year, month)
-                rpart, _ = _lookup_partner_rate(currency, year, month)
-                _cost_rate_cache[cache_key] = (rcost, rpart)
-            rcost, rpart = _cost_rate_cache[cache_key]
-            if rcost and rpart:
-                return price * (rcost / rpart)
-            return None  # rate unavailable — caller treats as unmapped
+        site_managers = {s['url']: s['manager'] for s in conn.execute('SELECT url, manager FROM sites').fetchall()}
+        cost_of = _recon_order_costing(conn, currency, year, month)
 
         result_orders = []
+        month_rates = {}
         for r in rows:
             items = parse_json_field(r['line_items']) or []
+            if not isinstance(items, list):
+                items = []
             products = []
             qty_total = 0
-            for it in items if isinstance(items, list) else []:
+            for i, it in enumerate(items):
                 qty = int(it.get('quantity', 0) or 0)
                 qty_total += qty
-                products.append({
-                    'name': it.get('name', ''),
-                    'quantity': qty,
-                    'total': float(it.get('total', 0) or 0),
-                })
-            billing = parse_json_field(r['billing']) or {}
-            customer_name = ''
-            customer_email = ''
-            if isinstance(billing, dict):
-                customer_name = ((billing.get('first_name') or '') + ' ' + (billing.get('last_name') or '')).strip()
-                customer_email = billing.get('email', '') or ''
-
-            shipping_loss = float(r['shipping_loss_amount'] or 0)
+                if i < RECON_ORDERS_SHOWN_PRODUCTS:
+                    products.append({'name': it.get('name', '') or '', 'quantity': qty})
+            customer_name = (str(r['first_name'] or '') + ' ' + str(r['last_name'] or '')).strip()
+
             is_undel = bool(r['is_undelivered'])
             gross = float(r['total'] or 0)
             ship = float(r['shipping_total'] or 0)
             net = max(0, gross - ship)
             order_rate = period_rate
-            if order_rate is None:
+            if order_rate is None and r['date_created']:
                 # multi-month dump: look up the order's own month
-                if r['date_created']:
+                ym = r['date_created'][:7]
+                if ym not in month_rates:
                     try:
-                        y, m = r['date_created'][:7].split('-')
-                        order_rate, _ = _lookup_partner_rate(currency, int(y), int(m))
+                        y, m = ym.split('-')
+                        month_rates[ym] = _lookup_partner_rate(currency, int(y), int(m))[0]
                     except Exception:
-                        order_rate = None
+                        month_rates[ym] = None
+                order_rate = month_rates[ym]
             net_cny = round(net * order_rate, 2) if (order_rate and net) else None
 
-            # ── COST CALCULATION (per-order, line-item level, date-aware) ──
-            # When a line item has no real cost in product_costs, fall back to
-            # 50% of revenue. Same logic as _calc_partner_recon_detail so the
-            # 订单明细 tab and 产品明细 tab agree on totals.
-            UNMAPPED_FALLBACK_RATIO = 0.5
-            order_is_revenue = _is_revenue(r['status'] or '', r['payment_method'], is_undel, r['source'])
-            order_cost = 0.0
-            order_unmapped_qty = 0
-            cost_eligible = order_is_revenue and not is_undel  # only revenue orders consume inventory
-            if cost_eligible and isinstance(items, list):
-                order_date = (r['date_created'] or '')[:10]
-                order_country = site_country_map.get(r['source'], 'PL') or 'PL'
-                # Get year/month from order date for cost-currency conversion
-                try:
-                    od_y, od_m = (r['date_created'] or '0000-00')[:7].split('-')
-                    od_y, od_m = int(od_y), int(od_m)
-                except Exception:
-                    od_y, od_m = (year or 0), (month or 0)
-                effective_wh_ids = country_default_wh_ids.get(order_country, [])
-                for it in items:
-                    qty = int(it.get('quantity', 0) or 0)
-                    if qty <= 0:
-                        continue
-                    raw_name = it.get('name', '') or ''
-                    line_total = float(it.get('total', 0) or 0)
-                    b_id, s_id, p_cnt, flav = _resolve_product_to_brand(
-                        raw_name, r['source'], brands_cache, product_mappings_cache
-                    )
-                    cost_entry = None
-                    if b_id and effective_wh_ids:
-                        for ewh in effective_wh_ids:
-                            cost_entry = _cost_at_date(cost_idx, b_id, s_id, p_cnt, flav, ewh, order_date)
-                            if cost_entry:
-                                break
-                    line_cost = None
-                    if cost_entry:
-                        unit_in_partner = _convert_cost_to_partner(
-                            cost_entry['price'], cost_entry['currency'], od_y, od_m
-                        )
-                        if unit_in_partner is not None:
-                            line_cost = unit_in_partner * qty
-                    if line_cost is None:
-                        # POLICY: unmapped lines contribute 0 to order_cost.
-                        # Margin% will be inflated for these orders, which is
-                        # the intended forcing function to drive cost data
-                        # quality. The unmapped warning still flags them.
-                        order_unmapped_qty += qty
-                    else:
-                        order_cost += line_cost
-
-            order_cost = round(order_cost, 2)
+            # ── COST (per-order, line-item level, date-aware) — revenue orders
+            # only, they are the ones that consume inventory.
+            cost_eligible = bool(r['is_revenue'])
+            order_cost, order_unmapped_qty = cost_of(r['source'], r['date_created'], items) if cost_eligible else (0.0, 0)
             order_margin = round(net - order_cost, 2) if cost_eligible else None
             order_margin_pct = None
             if cost_eligible and net > 0:
                 order_margin_pct = round((net - order_cost) / net * 100, 1)
-            order_cost_cny = round(order_cost * order_rate, 2) if (order_rate and cost_eligible) else None
-            order_margin_cny = round(order_margin * order_rate, 2) if (order_rate and order_margin is not None) else None
 
             result_orders.append({
-                'id': r['id'],
                 'number': r['number'],
                 'date_created': r['date_created'],
                 'status': r['status'],
                 'payment_method': r['payment_method'],
-                'currency': r['currency'],
                 'source': r['source'],
                 'manager': site_managers.get(r['source'], ''),
                 'total': gross,
@@ -12055,60 +13255,33 @@ def api_recon_orders():
                 'rate_to_cny': order_rate,
                 'product_count': qty_total,
                 'products': products,
+                'more_products': max(0, len(items) - RECON_ORDERS_SHOWN_PRODUCTS),
                 'customer_name': customer_name,
-                'customer_email': customer_email,
+                'customer_email': r['email'] or '',
                 'is_undelivered': is_undel,
-                'shipping_loss_amount': shipping_loss,
+                'shipping_loss_amount': float(r['shipping_loss_amount'] or 0),
                 # ── cost/margin fields (margin% may be inflated for orders
                 #     with unmapped products — by design, see policy comment) ──
                 'cost_eligible': cost_eligible,
                 'cost': order_cost if cost_eligible else None,
-                'cost_cny': order_cost_cny,
                 'margin': order_margin,
-                'margin_cny': order_margin_cny,
                 'margin_pct': order_margin_pct,
                 'unmapped_qty': order_unmapped_qty,
             })
 
-            # Aggregate totals row
-            totals['order_count'] += 1
-            totals['product_count'] += qty_total
-            totals['amount'] += gross
-            totals['shipping'] += ship
-            if is_undel:
-                totals['undelivered_count'] += 1
-                totals['shipping_loss'] += shipping_loss
-                if order_rate:
-                    totals['shipping_loss_cny'] += shipping_loss * order_rate
-            elif order_is_revenue:
-                totals['net'] += net
-                if net_cny is not None:
-                    totals['net_cny'] += net_cny
-                totals['cost'] += order_cost
-                totals['margin'] += (net - order_cost)
-                if order_rate:
-                    totals['cost_cny'] += order_cost * order_rate
-                    totals['margin_cny'] += (net - order_cost) * order_rate
-                totals['unmapped_qty'] += order_unmapped_qty
-
-        # Round totals for display
-        for k in ('amount', 'shipping', 'net', 'shipping_loss',
-                  'cost', 'margin', 'net_cny', 'shipping_loss_cny',
-                  'cost_cny', 'margin_cny'):
-            totals[k] = round(totals[k], 2)
-        totals['final_net_cny'] = round(totals['net_cny'] - totals['shipping_loss_cny'], 2)
-        totals['margin_pct'] = round(totals['margin'] / totals['net'] * 100, 1) if totals['net'] > 0 else None
-
-        return jsonify({
+        payload = {
             'orders': result_orders,
-            'total': total,
-            'page': page_returned,
-            'per_page': per_page_returned,
-            'use_pagination': use_pagination,
+            'next_cursor': next_cursor,
+            'limit': limit,
             'currency': currency,
             'partner_id': partner_id,
-            'displayed_totals': totals,
-        })
+        }
+        if not after:
+            payload['total'], payload['displayed_totals'] = _cached_view(
+                'recon_orders_totals',
+                lambda: _recon_orders_totals(where_sql, params, currency, year, month, period_rate),
+                partner_id)
+        return jsonify(payload)
     finally:
         conn.close()
 
@@ -12127,6 +13300,7 @@ def _empty_displayed_totals(currency):
 @app.route('/api/reconciliation/summary-stats')
 @login_required
 @reconciliation_api_required
+@conditional_json
 def api_recon_summary_stats():
     """Per-site summary statistics for the partner — replicates the
     "筛选结果统计" table from /orders, scoped to partner-bound sites."""
@@ -12138,11 +13312,18 @@ def api_recon_summary_stats():
     if not _check_partner_access(partner_id):
         return jsonify({'error': '无权查看此合伙人'}), 403
 
+    payload, status = _cached_view('recon_summary_stats',
+                                   lambda: _recon_summary_stats(partner_id, year, month))
+    return jsonify(payload), status
+
+
+def _recon_summary_stats(partner_id, year, month):
+    """(payload, status) of /api/reconciliation/summary-stats (cached by the route)."""
     conn = get_db_connection()
     try:
         partner = conn.execute('SELECT id, currency FROM partners WHERE id = ?', (partner_id,)).fetchone()
         if not partner:
-            return jsonify({'error': '合伙人不存在'}), 404
+            return {'error': '合伙人不存在'}, 404
         currency = partner['currency'] or 'PLN'
 
         sites = conn.execute('''
@@ -12152,7 +13333,7 @@ def api_recon_summary_stats():
             WHERE ps.partner_id = ?
         ''', (partner_id,)).fetchall()
         if not sites:
-            return jsonify({'rows': [], 'totals': {}, 'currency': currency})
+            return {'rows': [], 'totals': {}, 'currency': currency}, 200
 
         site_urls = [s['url'] for s in sites]
         site_meta = {s['url']: {'country': s['country'], 'manager': s['manager']} for s in sites}
@@ -12161,11 +13342,11 @@ def api_recon_summary_stats():
         params = list(site_urls) + [currency]
         date_cond = ''
         if year and month:
-            date_cond = " AND strftime('%Y-%m', date_created) = ?"
+            date_cond = " AND year_month = ?"
             params.append(f'{year:04d}-{month:02d}')
         elif year:
-            date_cond = " AND strftime('%Y', date_created) = ?"
-            params.append(str(year))
+            date_cond = " AND year_month BETWEEN ? AND ?"
+            params.extend([f'{year:04d}-01', f'{year:04d}-12'])
 
         # Per-site aggregation
         success_cond = _revenue_status_cond()
@@ -12235,12 +13416,12 @@ def api_recon_summary_stats():
         for k in totals:
             totals[k] = round(totals[k], 2) if isinstance(totals[k], float) else totals[k]
 
-        return jsonify({
+        return {
             'rows': result_rows,
             'totals': totals,
             'currency': currency,
             'rate_to_cny': rate,
-        })
+        }, 200
     finally:
         conn.close()
 
@@ -12248,6 +13429,7 @@ def api_recon_summary_stats():
 @app.route('/api/reconciliation/products')
 @login_required
 @reconciliation_api_required
+@conditional_json
 def api_recon_products():
     """Per-product breakdown for the period: qty, revenue, cost (date-aware), margin.
     Optional ?source=<site_url> and ?manager=<name> narrow the scope to a
@@ -12295,6 +13477,7 @@ def api_recon_products():
 @app.route('/api/reconciliation/unmapped-products')
 @login_required
 @reconciliation_api_required
+@conditional_json
 def api_recon_unmapped_products():
     """Aggregate unmapped products (no cost row matching brand+series+puffs at
     order date) for the partner's bound sites in the given month.
@@ -12339,7 +13522,7 @@ def api_recon_unmapped_products():
             FROM orders
             WHERE source IN ({placeholders})
             AND currency = ?
-            AND strftime('%Y-%m', date_created) = ?
+            AND year_month = ?
             AND {_revenue_status_cond()}
         ''', site_urls + [currency, month_str]).fetchall()
 
@@ -12462,6 +13645,7 @@ def api_recon_unmapped_products():
 @app.route('/api/reconciliation/dashboard/monthly-trend')
 @login_required
 @reconciliation_api_required
+@conditional_json
 def api_recon_dashboard_monthly_trend():
     """Per-partner trend across the last N months.
 
@@ -12511,7 +13695,7 @@ def api_recon_dashboard_monthly_trend():
         ym_max = f'{month_list[-1][0]:04d}-{month_list[-1][1]:02d}'
         rows = conn.execute(f'''
             SELECT
-                strftime('%Y-%m', date_created) AS ym,
+                year_month AS ym,
                 COUNT(*) AS total_count,
                 SUM(CASE WHEN {success_cond} THEN 1 ELSE 0 END) AS success_count,
                 SUM(CASE WHEN status='failed' THEN 1 ELSE 0 END) AS failed_count,
@@ -12524,7 +13708,7 @@ def api_recon_dashboard_monthly_trend():
             FROM orders
             WHERE source IN ({placeholders})
               AND currency = ?
-              AND strftime('%Y-%m', date_created) BETWEEN ? AND ?
+              AND year_month BETWEEN ? AND ?
             GROUP BY ym
             ORDER BY ym
         ''', site_urls + [currency, ym_min, ym_max]).fetchall()
@@ -12605,6 +13789,7 @@ def api_recon_dashboard_monthly_trend():
 @app.route('/api/reconciliation/dashboard/aging')
 @login_required
 @reconciliation_api_required
+@conditional_json
 def api_recon_dashboard_aging():
     """Aging analysis for unpaid statements.
 
@@ -12710,6 +13895,7 @@ def api_recon_dashboard_aging():
 @app.route('/api/reconciliation/dashboard/comparison')
 @login_required
 @reconciliation_api_required
+@conditional_json
 def api_recon_dashboard_comparison():
     """Current month vs previous month vs same-month-last-year.
 
@@ -12907,6 +14093,7 @@ def api_generate_statement():
         _audit_log(stmt_id, 'regenerate' if is_regenerate else 'create',
                    note=f'口径={mode_label}, 净销售={net} {partner["currency"] or "PLN"}, 实际成本={actual_cost_snapshot}, 快照订单 {snapshot_count} 条', conn=conn)
 
+        order_index.bump_versions(conn, ['reconciliation'])
         conn.commit()
         return jsonify({'success': True, 'id': stmt_id, 'exchange_rate_cny': rate,
                         'snapshot_orders': snapshot_count, 'actual_cost_pln': actual_cost_snapshot,
@@ -12955,6 +14142,7 @@ def api_manual_statement():
              net, cost, p_profit, our_recv,
              rate, our_recv_cny,
              data.get('notes', '手工录入历史数据')))
+        order_index.bump_versions(conn, ['reconciliation'])
         conn.commit()
         return jsonify({'success': True, 'exchange_rate_cny': rate})
     finally:
@@ -12964,6 +14152,7 @@ def api_manual_statement():
 @app.route('/api/reconciliation/statements/<int:stmt_id>', methods=['GET'])
 @login_required
 @reconciliation_api_required
+@conditional_json
 def api_get_statement(stmt_id):
     """Get statement detail"""
     conn = get_db_connection()
@@ -13032,20 +14221,48 @@ def api_get_statement(stmt_id):
 @login_required
 @reconciliation_api_required
 def api_export_statement(stmt_id):
-    """Export one reconciliation statement as a styled multi-sheet .xlsx.
-
-    Sheets: 对账单汇总 / 按站点 / 按产品 / 收款记录. Read-only — access mirrors
-    the detail view (via _check_partner_access), so a partner can export their
-    own statement. Top-line amounts come from the saved snapshot; the
-    by-site / by-product drill-down is recomputed live, exactly like the
-    detail modal. Manual statements have no live drill-down → only the
-    summary (+ receipts) sheet is produced.
+    """Queue the export of one reconciliation statement as a styled .xlsx.
+
+    Read-only — access mirrors the detail view (via _check_partner_access),
+    so a partner can export their own statement. The workbook itself is built
+    by _build_statement_export on the export pool.
     """
-    from io import BytesIO
+    conn = get_db_connection()
+    stmt = conn.execute('''
+        SELECT s.partner_id, s.period_year, s.period_month, p.name AS partner_name
+        FROM reconciliation_statements s
+        JOIN partners p ON s.partner_id = p.id
+        WHERE s.id = ?
+    ''', (stmt_id,)).fetchone()
+    conn.close()
+    if not stmt:
+        return jsonify({'error': '对账单不存在'}), 404
+    if not _check_partner_access(stmt['partner_id']):
+        return jsonify({'error': '无权查看'}), 403
+    label = f"对账单_{stmt['partner_name'] or ''}_{stmt['period_year']}-{stmt['period_month']:02d}"
+    job_id = _submit_export_job('statement', label, {'stmt_id': stmt_id}, _build_statement_export)
+    return jsonify({'success': True, 'job_id': job_id})
+
+
+def _build_statement_export(job_id, options):
+    """Build the statement workbook for api_export_statement.
+
+    Sheets: 对账单汇总 / 按站点 / 按产品 / 收款记录. Top-line amounts come
+    from the saved snapshot; the by-site / by-product drill-down is
+    recomputed live, exactly like the detail modal. Manual statements have no
+    live drill-down → only the summary (+ receipts) sheet is produced.
+
+    Write-only workbook with named styles: every row is assembled in order
+    and appended once, merges / widths / heights are declared up front.
+    """
+    from copy import copy
     from openpyxl import Workbook
-    from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, PatternFill, Alignment, Border, Side, NamedStyle
+    from openpyxl.styles.fonts import DEFAULT_FONT
     from openpyxl.utils import get_column_letter
 
+    stmt_id = options['stmt_id']
     conn = get_db_connection()
     stmt = conn.execute('''
         SELECT s.*, p.name AS partner_name, p.currency
@@ -13055,10 +14272,7 @@ def api_export_statement(stmt_id):
     ''', (stmt_id,)).fetchone()
     if not stmt:
         conn.close()
-        return jsonify({'error': '对账单不存在'}), 404
-    if not _check_partner_access(stmt['partner_id']):
-        conn.close()
-        return jsonify({'error': '无权查看'}), 403
+        raise ValueError('对账单不存在')
     receipts = conn.execute(
         'SELECT * FROM partner_receipts WHERE statement_id = ? ORDER BY receipt_date DESC',
         (stmt_id,)
@@ -13102,60 +14316,79 @@ def api_export_statement(stmt_id):
     MONEY = '#,##0.00'
     thin = Side(style='thin', color='D1D5DB')
     border = Border(left=thin, right=thin, top=thin, bottom=thin)
+    no_border = Border()
     C = Alignment(horizontal='center', vertical='center')
     R = Alignment(horizontal='right', vertical='center')
     L = Alignment(horizontal='left', vertical='center', wrap_text=True)
 
-    def put(ws, r, c, value=None, font=None, fill=None, align=None, fmt=None, bd=True):
-        cell = ws.cell(row=r, column=c, value=value)
-        if font: cell.font = font
-        if fill: cell.fill = fill
-        if align: cell.alignment = align
-        if fmt: cell.number_format = fmt
-        if bd: cell.border = border
+    wb = Workbook(write_only=True)
+    # (font, fill, alignment, border) combos used by the sheets below
+    for name, font, fill, align, bd in (
+        ('stmt_title',      title_font, title_fill, C,           no_border),
+        ('stmt_title_fill', None,       title_fill, Alignment(), no_border),
+        ('stmt_hdr',        hdr_font,   hdr_fill,   C,           border),
+        ('stmt_hdr_fill',   None,       hdr_fill,   Alignment(), border),
+        ('stmt_key',        key_font,   key_fill,   L,           border),
+        ('stmt_label',      key_font,   None,       L,           border),
+        ('stmt_val',        val_font,   None,       L,           border),
+        ('stmt_val_r',      val_font,   None,       R,           border),
+        ('stmt_total_l',    total_font, total_fill, L,           border),
+        ('stmt_total_r',    total_font, total_fill, R,           border),
+        ('stmt_total_fill', None,       total_fill, Alignment(), border),
+        ('stmt_border',     None,       None,       Alignment(), border),
+    ):
+        style = NamedStyle(name=name, font=font or copy(DEFAULT_FONT), alignment=align, border=bd)
+        if fill:
+            style.fill = fill
+        wb.add_named_style(style)
+
+    def put(ws, value, style, fmt=None):
+        cell = WriteOnlyCell(ws, value=value)
+        cell.style = style
+        if fmt:
+            cell.number_format = fmt
         return cell
 
     def disp_w(s):
         # CJK chars take ~2 cells of width
         return sum(2 if ord(ch) > 0x2E7F else 1 for ch in str(s))
 
-    def write_table(ws, columns, rows, money_cols=(), int_cols=(), total_last=False):
+    def write_table(title, columns, rows, money_cols=(), int_cols=(), total_last=False):
+        ws = wb.create_sheet(title)
         ws.sheet_view.showGridLines = False
-        for ci, h in enumerate(columns, 1):
-            put(ws, 1, ci, h, font=hdr_font, fill=hdr_fill, align=C)
+        ws.freeze_panes = 'A2'
+        for ci in range(1, len(columns) + 1):
+            vals = [columns[ci - 1]] + [r[ci - 1] for r in rows]
+            w = max((disp_w(x) for x in vals), default=10)
+            ws.column_dimensions[get_column_letter(ci)].width = min(46, max(10, w + 3))
+        ws.append([put(ws, h, 'stmt_hdr') for h in columns])
         n = len(rows)
         for ri, rowvals in enumerate(rows, 2):
             is_tot = total_last and ri == n + 1
+            out = []
             for ci, v in enumerate(rowvals, 1):
                 num = ci in money_cols or ci in int_cols
-                cell = put(ws, ri, ci, v,
-                           font=(total_font if is_tot else val_font),
-                           fill=(total_fill if is_tot else None),
-                           align=(R if num else L))
+                if is_tot:
+                    style = 'stmt_total_r' if num else 'stmt_total_l'
+                else:
+                    style = 'stmt_val_r' if num else 'stmt_val'
+                fmt = None
                 if ci in money_cols and isinstance(v, (int, float)):
-                    cell.number_format = MONEY
+                    fmt = MONEY
                 elif ci in int_cols and isinstance(v, (int, float)):
-                    cell.number_format = '#,##0'
-        for ci in range(1, len(columns) + 1):
-            vals = [columns[ci - 1]] + [r[ci - 1] for r in rows]
-            w = max((disp_w(x) for x in vals), default=10)
-            ws.column_dimensions[get_column_letter(ci)].width = min(46, max(10, w + 3))
-        ws.freeze_panes = 'A2'
-
-    wb = Workbook()
+                    fmt = '#,##0'
+                out.append(put(ws, v, style, fmt))
+            ws.append(out)
 
     # ===================== Sheet 1: 对账单汇总 =====================
-    ws = wb.active
-    ws.title = '对账单汇总'
+    ws = wb.create_sheet('对账单汇总')
     ws.sheet_view.showGridLines = False
     for i, w in enumerate([26, 18, 18, 18], 1):
         ws.column_dimensions[get_column_letter(i)].width = w
 
-    ws.merge_cells('A1:D1')
-    put(ws, 1, 1, '合伙人对账单', font=title_font, fill=title_fill, align=C, bd=False)
-    for c in range(2, 5):
-        put(ws, 1, c, None, fill=title_fill, bd=False)
+    ws.merged_cells.add('A1:D1')
     ws.row_dimensions[1].height = 30
+    ws.append([put(ws, '合伙人对账单', 'stmt_title')] + [put(ws, None, 'stmt_title_fill') for _ in range(3)])
 
     rate_txt = f'1 {currency} = {rate} CNY' if rate else '未配置'
     confirm_txt = '—'
@@ -13174,18 +14407,15 @@ def api_export_statement(stmt_id):
     ]
     r = 2
     for k1, v1, k2, v2 in info_pairs:
-        put(ws, r, 1, k1, font=key_font, fill=key_fill, align=L)
-        put(ws, r, 2, v1, font=val_font, align=L)
-        put(ws, r, 3, k2, font=key_font, fill=key_fill, align=L)
-        put(ws, r, 4, v2, font=val_font, align=L)
+        ws.append([put(ws, k1, 'stmt_key'), put(ws, v1, 'stmt_val'),
+                   put(ws, k2, 'stmt_key'), put(ws, v2, 'stmt_val')])
         r += 1
 
-    r += 1  # spacer
-    put(ws, r, 1, '项目', font=hdr_font, fill=hdr_fill, align=C)
-    put(ws, r, 2, f'金额（{currency}）', font=hdr_font, fill=hdr_fill, align=C)
-    put(ws, r, 3, '金额（CNY）', font=hdr_font, fill=hdr_fill, align=C)
-    put(ws, r, 4, None, fill=hdr_fill)
-    ws.merge_cells(start_row=r, start_column=3, end_row=r, end_column=4)
+    ws.append([])  # spacer
+    r += 1
+    ws.append([put(ws, '项目', 'stmt_hdr'), put(ws, f'金额（{currency}）', 'stmt_hdr'),
+               put(ws, '金额（CNY）', 'stmt_hdr'), put(ws, None, 'stmt_hdr_fill')])
+    ws.merged_cells.add(f'C{r}:D{r}')
     r += 1
 
     net = data.get('total_net_pln') or 0
@@ -13227,23 +14457,23 @@ def api_export_statement(stmt_id):
     summary_rows.append(('未收', outstanding, outstanding_cny, True, False))
 
     for label, pln, cny, is_total, is_count in summary_rows:
-        fl = total_fill if is_total else None
-        vf = total_font if is_total else val_font
-        put(ws, r, 1, label, font=(total_font if is_total else key_font), fill=fl, align=L)
-        put(ws, r, 2, pln, font=vf, fill=fl, align=R, fmt=('#,##0' if is_count else MONEY))
-        put(ws, r, 3, (cny if cny is not None else None), font=vf, fill=fl, align=R, fmt=(None if is_count else MONEY))
-        put(ws, r, 4, None, fill=fl)
-        ws.merge_cells(start_row=r, start_column=3, end_row=r, end_column=4)
+        vs = 'stmt_total_r' if is_total else 'stmt_val_r'
+        ws.append([
+            put(ws, label, 'stmt_total_l' if is_total else 'stmt_label'),
+            put(ws, pln, vs, '#,##0' if is_count else MONEY),
+            put(ws, (cny if cny is not None else None), vs, None if is_count else MONEY),
+            put(ws, None, 'stmt_total_fill' if is_total else 'stmt_border'),
+        ])
+        ws.merged_cells.add(f'C{r}:D{r}')
         r += 1
 
     if data.get('notes'):
+        ws.append([])
         r += 1
-        put(ws, r, 1, '备注', font=key_font, fill=key_fill, align=L)
-        put(ws, r, 2, data.get('notes'), font=val_font, align=L)
-        put(ws, r, 3, None)
-        put(ws, r, 4, None)
-        ws.merge_cells(start_row=r, start_column=2, end_row=r, end_column=4)
         ws.row_dimensions[r].height = 40
+        ws.append([put(ws, '备注', 'stmt_key'), put(ws, data.get('notes'), 'stmt_val'),
+                   put(ws, None, 'stmt_border'), put(ws, None, 'stmt_border')])
+        ws.merged_cells.add(f'B{r}:D{r}')
 
     # ===================== Sheet 2: 按站点 =====================
     if live and live.get('by_site'):
@@ -13264,7 +14494,7 @@ def api_export_statement(stmt_id):
                 round(sum(x[6] for x in site_rows), 2), round(sum(x[7] for x in site_rows), 2),
                 round(sum(x[8] for x in site_rows), 2), round(sum(x[9] for x in site_rows), 2),
             ])
-        write_table(wb.create_sheet('按站点'), site_cols, site_rows,
+        write_table('按站点', site_cols, site_rows,
                     money_cols=(7, 8, 9, 10), int_cols=(4, 5, 6), total_last=True)
 
     # ===================== Sheet 3: 按产品 =====================
@@ -13280,8 +14510,7 @@ def api_export_statement(stmt_id):
                 round(p.get('margin', 0), 2), (round(mp, 1) if mp is not None else ''),
                 ('是' if p.get('has_cost') else '否'),
             ])
-        write_table(wb.create_sheet('按产品'), prod_cols, prod_rows,
-                    money_cols=(6, 7, 8), int_cols=(3, 5))
+        write_table('按产品', prod_cols, prod_rows, money_cols=(6, 7, 8), int_cols=(3, 5))
 
     # ===================== Sheet 4: 收款记录 =====================
     if receipts:
@@ -13294,18 +14523,12 @@ def api_export_statement(stmt_id):
                 (round(rc['amount_cny'], 2) if rc['amount_cny'] is not None else ''),
                 rc['payment_method'] or '', rc['reference_no'] or '', rc['notes'] or '',
             ])
-        write_table(wb.create_sheet('收款记录'), rcpt_cols, rcpt_rows, money_cols=(2, 4))
+        write_table('收款记录', rcpt_cols, rcpt_rows, money_cols=(2, 4))
 
-    output = BytesIO()
-    wb.save(output)
-    output.seek(0)
     filename = f"对账单_{data.get('partner_name') or ''}_{data['period_year']}-{data['period_month']:02d}.xlsx"
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name=filename
-    )
+    file_path = _export_job_path('statement', job_id, filename)
+    wb.save(file_path)
+    return filename, file_path
 
 
 @app.route('/api/reconciliation/statements/<int:stmt_id>', methods=['PUT'])
@@ -13350,6 +14573,7 @@ def api_update_statement(stmt_id):
                     WHERE id=?''', (current_user.id, typed_name, ip, stmt_id))
                 _audit_log(stmt_id, 'confirm', field='status', old='generated', new='confirmed',
                            note=f'电子确认：{typed_name} ({ip})', conn=conn)
+                order_index.bump_versions(conn, ['reconciliation'])
                 conn.commit()
                 return jsonify({'success': True})
             return jsonify({'error': '无权执行此操作'}), 403
@@ -13403,6 +14627,7 @@ def api_update_statement(stmt_id):
             conn.execute(f'UPDATE reconciliation_statements SET {", ".join(updates)} WHERE id=?', params)
             for (a, f, o, n, note) in audit_entries:
                 _audit_log(stmt_id, a, field=f, old=o, new=n, note=note, conn=conn)
+            order_index.bump_versions(conn, ['reconciliation'])
             conn.commit()
         return jsonify({'success': True})
     finally:
@@ -13452,6 +14677,7 @@ def api_dispute_statement(stmt_id):
             SET status='disputed', updated_at=CURRENT_TIMESTAMP WHERE id=?''', (stmt_id,))
         _audit_log(stmt_id, 'dispute', field='status', old=old_status, new='disputed',
                    note=note, conn=conn)
+        order_index.bump_versions(conn, ['reconciliation'])
         conn.commit()
         return jsonify({'success': True, 'new_status': 'disputed'})
     finally:
@@ -13519,6 +14745,7 @@ def api_resolve_dispute(stmt_id):
                 SET status='generated', updated_at=CURRENT_TIMESTAMP WHERE id=?''', (stmt_id,))
             _audit_log(stmt_id, 'resolve_dispute', field='status', old='disputed', new='generated',
                        note=f'已处理：{note}', conn=conn)
+        order_index.bump_versions(conn, ['reconciliation'])
         conn.commit()
         return jsonify({'success': True, 'new_status': 'generated'})
     finally:
@@ -13528,6 +14755,7 @@ def api_resolve_dispute(stmt_id):
 @app.route('/api/reconciliation/statements/<int:stmt_id>/audit-log')
 @login_required
 @reconciliation_api_required
+@conditional_json
 def api_get_statement_audit_log(stmt_id):
     """Return the timeline of changes for a statement."""
     conn = get_db_connection()
@@ -13552,6 +14780,7 @@ def api_get_statement_audit_log(stmt_id):
 @app.route('/api/reconciliation/statements/<int:stmt_id>/snapshot-orders')
 @login_required
 @reconciliation_api_required
+@conditional_json
 def api_get_statement_snapshot_orders(stmt_id):
     """Return the frozen order list (with optional comparison to current state)."""
     conn = get_db_connection()
@@ -13619,6 +14848,7 @@ def api_delete_statement(stmt_id):
         # Note: reconciliation_audit_log is intentionally retained as history.
         conn.execute('DELETE FROM reconciliation_statement_orders WHERE statement_id = ?', (stmt_id,))
         conn.execute('DELETE FROM reconciliation_statements WHERE id = ?', (stmt_id,))
+        order_index.bump_versions(conn, ['reconciliation'])
         conn.commit()
         return jsonify({'success': True})
     finally:
@@ -13630,6 +14860,7 @@ def api_delete_statement(stmt_id):
 @app.route('/api/reconciliation/receipts')
 @login_required
 @reconciliation_api_required
+@conditional_json
 def api_list_receipts():
     """List receipts, filtered by access + optional partner_id"""
     partner_id = request.args.get('partner_id', type=int)
@@ -13714,6 +14945,7 @@ def api_create_receipt():
             _audit_log(int(stmt_id), 'attach_receipt', field='receipt',
                        new=f'#{receipt_id}',
                        note=f'新增收款 {amount_pln} (rate {rate_val}, ref {data.get("reference_no", "-")})', conn=conn)
+        order_index.bump_versions(conn, ['reconciliation'])
         conn.commit()
         return jsonify({'success': True, 'id': receipt_id})
     finally:
@@ -13769,6 +15001,7 @@ def api_update_receipt(receipt_id):
         if old_stmt_id and old_stmt_id != new_stmt_id:
             _audit_log(int(old_stmt_id), 'detach_receipt', field='receipt',
                        old=f'#{receipt_id}', note='移除关联', conn=conn)
+        order_index.bump_versions(conn, ['reconciliation'])
         conn.commit()
         return jsonify({'success': True})
     finally:
@@ -13791,6 +15024,7 @@ def api_delete_receipt(receipt_id):
                        old=f'#{receipt_id} {receipt["amount_pln"]}',
                        note='删除收款记录', conn=conn)
         conn.execute('DELETE FROM partner_receipts WHERE id = ?', (receipt_id,))
+        order_index.bump_versions(conn, ['reconciliation'])
         conn.commit()
         return jsonify({'success': True})
     finally:
@@ -13800,6 +15034,7 @@ def api_delete_receipt(receipt_id):
 @app.route('/api/reconciliation/rate')
 @login_required
 @reconciliation_api_required
+@conditional_json
 def api_get_reconciliation_rate():
     """Lookup system exchange rate for a currency+year-month. Used by frontend to prefill rates."""
     currency = request.args.get('currency', 'PLN')
@@ -13820,9 +15055,17 @@ def api_get_reconciliation_rate():
 @app.route('/api/reconciliation/overview')
 @login_required
 @reconciliation_api_required
+@conditional_json
 def api_reconciliation_overview():
     """Overview: total receivable, total received, outstanding, per partner"""
     allowed_ids = current_user.get_accessible_partner_ids()
+    return jsonify(_cached_view('recon_overview', lambda: _reconciliation_overview(allowed_ids),
+                                sorted(allowed_ids) if allowed_ids is not None else None))
+
+
+def _reconciliation_overview(allowed_ids):
+    """Payload of /api/reconciliation/overview for the given partner ids
+    (None = all partners); cached by the route."""
     conn = get_db_connection()
 
     # Get partners
@@ -13830,7 +15073,7 @@ def api_reconciliation_overview():
         partners = conn.execute('SELECT * FROM partners ORDER BY id').fetchall()
     elif len(allowed_ids) == 0:
         conn.close()
-        return jsonify({'partners': [], 'totals': {}})
+        return {'partners': [], 'totals': {}}
     else:
         placeholders = ','.join(['?'] * len(allowed_ids))
         partners = conn.execute(f'SELECT * FROM partners WHERE id IN ({placeholders}) ORDER BY id', allowed_ids).fetchall()
@@ -13902,7 +15145,7 @@ def api_reconciliation_overview():
             'outstanding_cny': round(p_receivable_cny - p_received_cny, 2)
         })
     conn.close()
-    return jsonify({
+    return {
         'partners': result,
         'totals': {
             'total_receivable_pln': round(total_receivable, 2),
@@ -13912,7 +15155,7 @@ def api_reconciliation_overview():
             'total_received_cny': round(total_received_cny, 2),
             'outstanding_cny': round(total_receivable_cny - total_received_cny, 2)
         }
-    })
+    }
 
 
 # ============== PRODUCT ANALYSIS ==============
@@ -14636,12 +15879,14 @@ def add_brand():
                 existing_aliases.append(a)
         conn.execute('UPDATE brands SET aliases = ? WHERE id = ?',
                     (json.dumps(existing_aliases) if existing_aliases else None, existing['id']))
+        order_index.bump_versions(conn, ['brands'])
         conn.commit()
         conn.close()
         return jsonify({'success': True, 'id': existing['id'], 'merged': True})
     try:
         conn.execute('INSERT INTO brands (name, aliases) VALUES (?, ?)',
                     (name, json.dumps(aliases) if aliases else None))
+        order_index.bump_versions(conn, ['brands'])
         conn.commit()
         brand_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
         conn.close()
@@ -14666,6 +15911,7 @@ def update_brand(brand_id):
     conn = get_db_connection()
     conn.execute('UPDATE brands SET name = ?, aliases = ? WHERE id = ?',
                 (name, json.dumps(aliases) if aliases else None, brand_id))
+    order_index.bump_versions(conn, ['brands'])
     conn.commit()
     conn.close()
     
@@ -14680,6 +15926,7 @@ def delete_brand(brand_id):
     conn = get_db_connection()
     conn.execute('DELETE FROM brands WHERE id = ?', (brand_id,))
     conn.execute('UPDATE product_mappings SET brand_id = NULL WHERE brand_id = ?', (brand_id,))
+    order_index.bump_versions(conn, ['brands', 'product_mappings'])
     conn.commit()
     conn.close()
     
@@ -14717,6 +15964,7 @@ def add_series():
         if existing:
             return jsonify({'success': True, 'id': existing['id'], 'existed': True})
         conn.execute('INSERT INTO series (brand_id, name) VALUES (?, ?)', (brand_id, name))
+        order_index.bump_versions(conn, ['series'])
         conn.commit()
         new_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
         return jsonify({'success': True, 'id': new_id})
@@ -14726,6 +15974,7 @@ def add_series():
 
 @app.route('/api/products/stats')
 @login_required
+@conditional_json
 def get_product_stats():
     """Get product statistics API"""
     from datetime import date, timedelta
@@ -15027,6 +16276,7 @@ def product_mapping():
                     VALUES (?, ?, ?, ?, ?, 1)
                 ''', (raw_name, brand_id, series_id, puff_count, flavor))
 
+            order_index.bump_versions(conn, ['product_mappings'])
             conn.commit()
             conn.close()
             return jsonify({'success': True})
@@ -15268,6 +16518,7 @@ def settings_api():
                         # format as carrier_status_at) so ONLY deliveries detected after
                         # turning on get auto-confirmed — never the existing backlog.
                         conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('auto_confirm_delivered_since', datetime('now'))")
+            order_index.bump_versions(conn, ['settings'])
             conn.commit()
             
             # 如果自动同步设置发生变更，同步更新 Crontab 定时任务
@@ -15344,6 +16595,7 @@ def user_preferences_api():
                         INSERT OR REPLACE INTO user_preferences (user_id, preference_key, preference_value)
                         VALUES (?, ?, ?)
                     ''', (current_user.id, key, str(value)))
+            order_index.bump_versions(conn, ['user_preferences'])
             conn.commit()
             conn.close()
             return jsonify({'success': True})
@@ -15438,11 +16690,7 @@ def au_orders_sheet():
                o.customer_note, o.payment_method,
                n.note AS internal_note
         FROM orders o
-        LEFT JOIN (
-            SELECT order_id, note, date_created FROM order_notes
-            WHERE customer_note = 0 AND added_by_user = 1
-            GROUP BY order_id HAVING date_created = MAX(date_created)
-        ) n ON o.id = n.order_id
+        LEFT JOIN order_notes n ON n.id = o.latest_user_note_id
         WHERE o.source IN ({ph})
           AND o.status NOT IN ('checkout-draft', 'trash')
         ORDER BY o.date_created DESC
@@ -15650,41 +16898,6 @@ def au_orders_sheet():
                            generated_at=_dt.now().strftime('%Y-%m-%d %H:%M'))
 
 
-def extract_custom_billing_fields(meta_data):
-    """Extract custom billing fields from meta_data"""
-    custom_fields = {
-        'customer_inpost_id': '',
-        'customer_social': '',
-        'dpd_street': '',
-        'dpd_house': '',
-        'dpd_zip': '',
-        'dpd_city': ''
-    }
-    
-    if not meta_data:
-        return custom_fields
-        
-    for meta in meta_data:
-        if isinstance(meta, dict):
-            key = meta.get('key')
-            value = meta.get('value')
-            
-            if key == '_billing_inpost':
-                custom_fields['customer_inpost_id'] = value
-            elif key == '_billing_social':
-                custom_fields['customer_social'] = value
-            elif key == '_billing_adres_dpd':
-                custom_fields['dpd_street'] = value
-            elif key == '_billing_numer_domu':
-                custom_fields['dpd_house'] = value
-            elif key == '_billing_kod_pocztowy':
-                custom_fields['dpd_zip'] = value
-            elif key == '_billing_miejscowosc':
-                custom_fields['dpd_city'] = value
-                
-    return custom_fields
-
-
 def get_big_order_thresholds(conn):
     """Read big-order alert thresholds from settings (with defaults).
 
@@ -15722,11 +16935,110 @@ def evaluate_big_order(product_count, total, qty_threshold, amount_threshold):
     return (len(reasons) > 0, reasons)
 
 
+# The shipping queues (/api/shipping/pending, /pending-outcome, /shipped) read
+# their display fields from shipping_view (derived at sync time) and page
+# through ?page=&per_page= when the caller asks for a page: the response is
+# then {orders, total, page, per_page}. Without ?page= they still return the
+# whole queue as a plain JSON array (bulk confirm, scripts).
+SHIPPING_QUEUE_PER_PAGE = 50
+SHIPPING_QUEUE_MAX_PER_PAGE = 500
+
+# ?sort= key -> ORDER BY expression, shared by the three queues (?dir=asc|desc)
+SHIPPING_QUEUE_SORTS = {
+    'date': 'o.date_created',
+    'number': 'CAST(o.number AS INTEGER)',
+    'total': 'CAST(o.total AS REAL)',
+    'items': 'sv.product_count',
+    'customer': 'sv.customer_name COLLATE NOCASE',
+    'source': 'o.source',
+    'method': 'sv.shipping_method',
+}
+
+
+def _shipping_queue_order(args, default_order, extra_sorts=None):
+    """ORDER BY clause for ?sort=&dir=, default_order when sort is unknown."""
+    sorts = dict(SHIPPING_QUEUE_SORTS, **(extra_sorts or {}))
+    sort = args.get('sort', '')
+    if sort not in sorts:
+        return default_order
+    direction = 'ASC' if (args.get('dir') or '').lower() == 'asc' else 'DESC'
+    return f'{sorts[sort]} {direction}, o.id {direction}'
+
+
+def _shipping_queue_page(args):
+    """(page, per_page) from ?page=&per_page=; (None, None) = whole list."""
+    page = args.get('page', type=int)
+    if page is None:
+        return None, None
+    per_page = args.get('per_page', SHIPPING_QUEUE_PER_PAGE, type=int)
+    return max(1, page), max(1, min(per_page, SHIPPING_QUEUE_MAX_PER_PAGE))
+
+
+def _shipping_view_filters(args):
+    """WHERE fragment + params for the shipping_view filters every queue
+    accepts: ?method= (exact shipping method title), ?state_mismatch=1."""
+    sql, params = '', []
+    method = (args.get('method') or '').strip()
+    if method:
+        sql += ' AND sv.shipping_method = ?'
+        params.append(method)
+    if args.get('state_mismatch') == '1':
+        sql += ' AND sv.state_mismatch IS NOT NULL'
+    return sql, params
+
+
+def _run_shipping_queue(conn, select, from_where, params, order_by, page, per_page):
+    """Run a queue query; returns (rows, total). total is None for the
+    whole-list form, otherwise the COUNT(*) of from_where."""
+    query = f'SELECT {select} {from_where} ORDER BY {order_by}'
+    if page is None:
+        return conn.execute(query, params).fetchall(), None
+    total = conn.execute(f'SELECT COUNT(*) {from_where}', params).fetchone()[0]
+    rows = conn.execute(query + ' LIMIT ? OFFSET ?', list(params) + [per_page, (page - 1) * per_page]).fetchall()
+    return rows, total
+
+
+def _shipping_queue_response(result, total, page, per_page, **extra):
+    if page is None:
+        return jsonify(result)
+    return jsonify({'orders': result, 'total': total, 'page': page, 'per_page': per_page, **extra})
+
+
+def _latest_internal_notes(conn, order_ids):
+    """{order_id: row(note, date_created, author)} — the newest private note
+    of each given order, through orders.latest_note_id (see latest_note.py)."""
+    notes = {}
+    order_ids = [str(i) for i in order_ids]
+    for i in range(0, len(order_ids), 500):
+        chunk = order_ids[i:i + 500]
+        ph = ','.join('?' * len(chunk))
+        for r in conn.execute(f'''
+                SELECT o.id AS order_id, n.note, n.date_created, n.author
+                FROM orders o
+                JOIN order_notes n ON n.id = o.latest_note_id
+                WHERE o.id IN ({ph})''', chunk).fetchall():
+            notes[r['order_id']] = r
+    return notes
+
+
+def _latest_note_fields(notes, order_id):
+    n = notes.get(order_id)
+    return {
+        'latest_note': (n['note'] if n else '') or '',
+        'latest_note_date': (n['date_created'] if n else '') or '',
+        'latest_note_author': (n['author'] if n else '') or '',
+    }
+
+
 @app.route('/api/shipping/pending')
 @login_required
 @shipping_view_required
+@conditional_json
 def get_pending_orders():
-    """Get orders pending shipment (status=processing)"""
+    """Get orders pending shipment (status=processing)
+
+    Paged / sorted / filtered when ?page= is given (see SHIPPING_QUEUE_SORTS,
+    _shipping_view_filters; ?big=1 keeps only big orders)."""
     conn = get_db_connection()
     qty_threshold, amount_threshold = get_big_order_thresholds(conn)
 
@@ -15735,23 +17047,11 @@ def get_pending_orders():
     manager_filter = request.args.get('manager', '')
     country_filter = request.args.get('country', '')
     
-    query = '''
-        SELECT o.id, o.number, o.status, o.total, o.currency, o.date_created,
-               o.source, o.billing, o.shipping, o.line_items, o.meta_data, o.shipping_total, o.shipping_lines,
-               o.customer_note, o.warehouse_id,
-               s.manager,
-               w.name as warehouse_name,
-               n.note as latest_note, n.date_created as latest_note_date, n.author as latest_note_author
+    from_where = '''
         FROM orders o
         LEFT JOIN sites s ON o.source = s.url
         LEFT JOIN warehouses w ON o.warehouse_id = w.id
-        LEFT JOIN (
-            SELECT order_id, note, date_created, author
-            FROM order_notes
-            WHERE customer_note = 0
-            GROUP BY order_id
-            HAVING date_created = MAX(date_created)
-        ) n ON o.id = n.order_id
+        LEFT JOIN shipping_view sv ON sv.order_id = o.id
         WHERE o.status IN ('processing', 'offline')
     '''
     params = []
@@ -15761,22 +17061,22 @@ def get_pending_orders():
     if allowed_sources is not None:
         if not allowed_sources:
             # User has restricted access but valid sources list is empty -> no access
-            query += ' AND 1=0'
+            from_where += ' AND 1=0'
         else:
             placeholders = ','.join(['?' for _ in allowed_sources])
-            query += f' AND o.source IN ({placeholders})'
+            from_where += f' AND o.source IN ({placeholders})'
             params.extend(allowed_sources)
     
     if source_filter:
-        query += ' AND o.source = ?'
+        from_where += ' AND o.source = ?'
         params.append(source_filter)
     
     if manager_filter:
-        query += ' AND s.manager = ?'
+        from_where += ' AND s.manager = ?'
         params.append(manager_filter)
         
     if country_filter:
-        query += ' AND s.country = ?'
+        from_where += ' AND s.country = ?'
         params.append(country_filter)
     
     start_date = request.args.get('start_date')
@@ -15784,21 +17084,42 @@ def get_pending_orders():
     search = request.args.get('search')
     
     if start_date:
-        query += ' AND o.date_created >= ?'
+        from_where += ' AND o.date_created >= ?'
         params.append(start_date + ' 00:00:00')
     
     if end_date:
-        query += ' AND o.date_created <= ?'
+        from_where += ' AND o.date_created <= ?'
         params.append(end_date + ' 23:59:59')
     
     if search:
-        search_term = f'%{search}%'
-        query += ' AND (o.number LIKE ? OR o.billing LIKE ? OR o.shipping LIKE ?)'
-        params.extend([search_term, search_term, search_term])
-    
-    query += ' ORDER BY o.date_created DESC'
-    
-    orders = conn.execute(query, params).fetchall()
+        fts = order_search.match_clause(search, ('number', 'customer'), id_column='o.id')
+        if fts:
+            from_where += ' AND ' + fts[0]
+            params.extend(fts[1])
+        else:
+            search_term = f'%{search}%'
+            from_where += ' AND (o.number LIKE ? OR o.billing LIKE ? OR o.shipping LIKE ?)'
+            params.extend([search_term, search_term, search_term])
+
+    view_sql, view_params = _shipping_view_filters(request.args)
+    from_where += view_sql
+    params.extend(view_params)
+    if request.args.get('big') == '1':
+        big = []
+        if qty_threshold:
+            big.append('sv.product_count >= ?')
+            params.append(qty_threshold)
+        if amount_threshold:
+            big.append('CAST(o.total AS REAL) >= ?')
+            params.append(amount_threshold)
+        from_where += f" AND ({' OR '.join(big) or '1=0'})"
+
+    page, per_page = _shipping_queue_page(request.args)
+    orders, total = _run_shipping_queue(
+        conn, '''o.id, o.number, o.status, o.total, o.currency, o.date_created, o.source,
+               o.shipping_total, o.customer_note, o.warehouse_id,
+               s.manager, w.name as warehouse_name''',
+        from_where, params, _shipping_queue_order(request.args, 'o.date_created DESC'), page, per_page)
 
     # Parcels already shipped for these orders (split shipment / 分批发货).
     # shipping_logs is local-only and untouched by sync, so a partial order
@@ -15820,6 +17141,8 @@ def get_pending_orders():
                 'carrier_name': r['carrier_name'] or r['carrier_slug'],
                 'shipped_at': r['shipped_at'],
             })
+    views = shipping_view.load(conn, order_ids)
+    notes = _latest_internal_notes(conn, order_ids)
 
     # Build the risk index once (small scan over flagged orders only) and
     # reuse it for every row in this listing. Closing conn AFTER the build.
@@ -15828,34 +17151,13 @@ def get_pending_orders():
 
     result = []
     for order in orders:
-        billing = parse_json_field(order['billing'])
-        shipping_info = parse_json_field(order['shipping'])
-        line_items = parse_json_field(order['line_items'])
-        shipping_lines = parse_json_field(order['shipping_lines'])
-        shipping_method = shipping_lines[0].get('method_title', 'Unknown') if shipping_lines and len(shipping_lines) > 0 else ''
-
-        # Get shipping address (prefer shipping, fallback to billing)
-        addr = shipping_info if shipping_info and shipping_info.get('address_1') else billing
-        meta_data = parse_json_field(order['meta_data'])
-        custom_fields = extract_custom_billing_fields(meta_data)
-
-        # Calculate customer address (Standard)
-        customer_address = _compose_address(addr)
-
-        # DPD Fallback: If standard address is empty but DPD fields exist
-        if not addr.get('address_1') and (custom_fields.get('dpd_street') or custom_fields.get('dpd_city')):
-            dpd_parts = [
-                f"{custom_fields.get('dpd_street', '')} {custom_fields.get('dpd_house', '')}".strip(),
-                custom_fields.get('dpd_zip', ''),
-                custom_fields.get('dpd_city', '')
-            ]
-            customer_address = ', '.join(filter(None, dpd_parts))
-
-        product_count = sum(item.get('quantity', 1) for item in (line_items or []))
+        v = views[order['id']]
         order_total = float(order['total'] or 0)
         is_big_order, big_order_reasons = evaluate_big_order(
-            product_count, order_total, qty_threshold, amount_threshold)
-        customer_risk = _assess_customer_risk(billing, shipping_info, risk_idx, current_order_id=order['id'])
+            v['product_count'], order_total, qty_threshold, amount_threshold)
+        customer_risk = _assess_customer_risk(
+            None, None, risk_idx, current_order_id=order['id'],
+            keys=(v['email_key'], v['phone_key'], v['addr_key']))
 
         result.append({
             'id': order['id'],
@@ -15865,17 +17167,17 @@ def get_pending_orders():
             'date_created': order['date_created'],
             'source': order['source'].replace('https://www.', '').replace('https://', ''),
             'manager': order['manager'] or '',
-            'customer_name': f"{addr.get('first_name', '')} {addr.get('last_name', '')}".strip(),
-            'customer_email': billing.get('email', ''),
-            'customer_phone': addr.get('phone') or billing.get('phone', ''),
-            'customer_address': customer_address,
-            'state_mismatch': _au_state_mismatch(addr),
-            'customer_inpost_id': custom_fields['customer_inpost_id'],
-            'customer_social': custom_fields['customer_social'],
-            'products': [{'name': item.get('name', ''), 'quantity': item.get('quantity', 1), 'total': float(item.get('total', 0))} for item in (line_items or [])],
+            'customer_name': v['customer_name'],
+            'customer_email': v['customer_email'],
+            'customer_phone': v['customer_phone'],
+            'customer_address': v['customer_address'],
+            'state_mismatch': v['state_mismatch'],
+            'customer_inpost_id': v['inpost_id'],
+            'customer_social': v['social'],
+            'products': v['products'],
             'shipping_total': float(order['shipping_total'] or 0),
-            'shipping_method': shipping_method,
-            'product_count': product_count,
+            'shipping_method': v['shipping_method'],
+            'product_count': v['product_count'],
             'is_big_order': is_big_order,
             'big_order_reasons': big_order_reasons,
             'customer_note': order['customer_note'] or '',
@@ -15884,12 +17186,10 @@ def get_pending_orders():
             'customer_risk': customer_risk,
             'parcels': parcels_map.get(order['id'], []),
             'parcels_shipped': len(parcels_map.get(order['id'], [])),
-            'latest_note': order['latest_note'] or '',
-            'latest_note_date': order['latest_note_date'] or '',
-            'latest_note_author': order['latest_note_author'] or ''
+            **_latest_note_fields(notes, order['id']),
         })
 
-    return jsonify(result)
+    return _shipping_queue_response(result, total, page, per_page)
 
 
 @app.route('/api/shipping/pending-outcome')
@@ -15902,7 +17202,9 @@ def get_pending_outcome_orders():
     every refusal hiding here is a risk signal that never got fed back.
 
     Oldest first, so the shipper works the backlog down. The risk badge is
-    attached so a refusal from a known bad customer is obvious at a glance."""
+    attached so a refusal from a known bad customer is obvious at a glance.
+    ?carrier= keeps one carrier_status ('none' = never detected); the paged
+    form also returns carrier_counts for the queue before that filter."""
     from datetime import timedelta
     conn = get_db_connection()
 
@@ -15918,28 +17220,14 @@ def get_pending_outcome_orders():
     source_filter = request.args.get('source', '')
     country_filter = request.args.get('country', '')
 
-    query = '''
-        SELECT o.id, o.number, o.status, o.total, o.currency, o.date_created,
-               o.source, o.billing, o.shipping, o.line_items, o.meta_data,
-               o.shipping_total, o.customer_note, o.warehouse_id,
-               o.carrier_status, o.carrier_status_at,
-               s.manager,
-               w.name AS warehouse_name,
-               sl.tracking_number, sl.carrier_slug, sl.shipped_at,
-               n.note AS latest_note, n.date_created AS latest_note_date, n.author AS latest_note_author
+    from_where = '''
         FROM orders o
         LEFT JOIN sites s ON o.source = s.url
         LEFT JOIN warehouses w ON o.warehouse_id = w.id
         LEFT JOIN shipping_logs sl ON sl.id = (
             SELECT id FROM shipping_logs WHERE order_id = o.id ORDER BY id DESC LIMIT 1
         )
-        LEFT JOIN (
-            SELECT order_id, note, date_created, author
-            FROM order_notes
-            WHERE customer_note = 0
-            GROUP BY order_id
-            HAVING date_created = MAX(date_created)
-        ) n ON o.id = n.order_id
+        LEFT JOIN shipping_view sv ON sv.order_id = o.id
         WHERE o.status IN ('on-hold', 'shipped', 'partial-shipped')
           AND o.payment_method = 'cod'
           AND COALESCE(o.is_undelivered, 0) = 0
@@ -15952,50 +17240,61 @@ def get_pending_outcome_orders():
     allowed_sources = get_user_allowed_sources(current_user.id, current_user.is_admin(), current_user.is_viewer())
     if allowed_sources is not None:
         if not allowed_sources:
-            query += ' AND 1=0'
+            from_where += ' AND 1=0'
         else:
             placeholders = ','.join(['?' for _ in allowed_sources])
-            query += f' AND o.source IN ({placeholders})'
+            from_where += f' AND o.source IN ({placeholders})'
             params.extend(allowed_sources)
 
     if source_filter:
-        query += ' AND o.source = ?'
+        from_where += ' AND o.source = ?'
         params.append(source_filter)
     if country_filter:
-        query += ' AND s.country = ?'
+        from_where += ' AND s.country = ?'
         params.append(country_filter)
+    view_sql, view_params = _shipping_view_filters(request.args)
+    from_where += view_sql
+    params.extend(view_params)
+
+    page, per_page = _shipping_queue_page(request.args)
+    carrier_counts = None
+    if page is not None:
+        carrier_counts = {r[0]: r[1] for r in conn.execute(
+            f"SELECT COALESCE(o.carrier_status, ''), COUNT(*) {from_where} GROUP BY 1", params)}
+    carrier = request.args.get('carrier', '')
+    if carrier:
+        from_where += " AND COALESCE(o.carrier_status, '') = ?"
+        params.append('' if carrier == 'none' else carrier)
 
     # Surface the most actionable rows first: detected returns (need a 拒收
     # decision), then attention, then carrier-confirmed deliveries (ready to
     # batch-approve), then everything still in transit / unchecked — each group
     # oldest-first so the backlog drains.
-    query += """ ORDER BY CASE COALESCE(o.carrier_status,'')
+    default_order = """CASE COALESCE(o.carrier_status,'')
                             WHEN 'returned' THEN 0
                             WHEN 'attention' THEN 1
                             WHEN 'delivered' THEN 2
                             WHEN 'in_transit' THEN 3
                             ELSE 4 END, o.date_created ASC"""
 
-    orders = conn.execute(query, params).fetchall()
+    orders, total = _run_shipping_queue(
+        conn, '''o.id, o.number, o.status, o.total, o.currency, o.date_created, o.source,
+               o.shipping_total, o.carrier_status, o.carrier_status_at,
+               s.manager,
+               w.name AS warehouse_name,
+               sl.tracking_number, sl.carrier_slug, sl.shipped_at''',
+        from_where,
+        params, _shipping_queue_order(request.args, default_order), page, per_page)
+    order_ids = [o['id'] for o in orders]
+    views = shipping_view.load(conn, order_ids)
+    notes = _latest_internal_notes(conn, order_ids)
     risk_idx = _build_risk_index(conn)
     conn.close()
 
     now = datetime.now()
     result = []
     for order in orders:
-        billing = parse_json_field(order['billing']) or {}
-        shipping_info = parse_json_field(order['shipping']) or {}
-        line_items = parse_json_field(order['line_items'])
-        addr = shipping_info if shipping_info and shipping_info.get('address_1') else billing
-        meta_data = parse_json_field(order['meta_data'])
-        custom_fields = extract_custom_billing_fields(meta_data)
-
-        customer_address = _compose_address(addr)
-        if not addr.get('address_1') and (custom_fields.get('dpd_street') or custom_fields.get('dpd_city')):
-            dpd_parts = [f"{custom_fields.get('dpd_street', '')} {custom_fields.get('dpd_house', '')}".strip(),
-                         custom_fields.get('dpd_zip', ''), custom_fields.get('dpd_city', '')]
-            customer_address = ', '.join(filter(None, dpd_parts))
-
+        v = views[order['id']]
         days_pending = None
         try:
             d = datetime.fromisoformat((order['date_created'] or '')[:19])
@@ -16015,23 +17314,23 @@ def get_pending_outcome_orders():
             'carrier_status_at': order['carrier_status_at'] or '',
             'source': order['source'].replace('https://www.', '').replace('https://', ''),
             'manager': order['manager'] or '',
-            'customer_name': f"{addr.get('first_name', '')} {addr.get('last_name', '')}".strip(),
-            'customer_email': billing.get('email', ''),
-            'customer_phone': addr.get('phone') or billing.get('phone', ''),
-            'customer_address': customer_address,
-            'state_mismatch': _au_state_mismatch(addr),
+            'customer_name': v['customer_name'],
+            'customer_email': v['customer_email'],
+            'customer_phone': v['customer_phone'],
+            'customer_address': v['customer_address'],
+            'state_mismatch': v['state_mismatch'],
             'shipping_total': float(order['shipping_total'] or 0),
-            'products': [{'name': item.get('name', ''), 'quantity': item.get('quantity', 1)} for item in (line_items or [])],
+            'products': [{'name': p['name'], 'quantity': p['quantity']} for p in v['products']],
             'tracking_number': order['tracking_number'] or '',
             'carrier_slug': order['carrier_slug'] or '',
             'warehouse_name': order['warehouse_name'] or '',
-            'customer_risk': _assess_customer_risk(billing, shipping_info, risk_idx, current_order_id=order['id']),
-            'latest_note': order['latest_note'] or '',
-            'latest_note_date': order['latest_note_date'] or '',
-            'latest_note_author': order['latest_note_author'] or '',
+            'customer_risk': _assess_customer_risk(
+                None, None, risk_idx, current_order_id=order['id'],
+                keys=(v['email_key'], v['phone_key'], v['addr_key'])),
+            **_latest_note_fields(notes, order['id']),
         })
 
-    return jsonify(result)
+    return _shipping_queue_response(result, total, page, per_page, carrier_counts=carrier_counts)
 
 
 @app.route('/api/shipping/pending-outcome/ids-before')
@@ -16080,24 +17379,17 @@ def pending_outcome_ids_before():
 @login_required
 @shipping_view_required
 def get_shipped_orders():
-    """Get shipped orders (status=on-hold) with tracking info"""
+    """Get shipped orders (status=on-hold) with tracking info
+
+    Paged / sorted / filtered when ?page= is given (?sort=shipped is the
+    default newest-parcel-first order)."""
     conn = get_db_connection()
     
     # Get filter parameters
     source_filter = request.args.get('source', '')
     country_filter = request.args.get('country', '')
     
-    query = '''
-        SELECT o.id, o.number, o.status, o.total, o.currency, o.date_created, o.date_modified,
-               o.source, o.billing, o.shipping, o.line_items, o.meta_data, o.shipping_lines, o.shipping_total,
-               o.customer_note, o.warehouse_id,
-               o.is_undelivered, o.shipping_loss_amount, o.undelivered_at, o.undelivered_note,
-               o.is_problem_return, o.carrier_status, o.carrier_status_at,
-               s.manager,
-               w.name AS warehouse_name,
-               sl.tracking_number, sl.carrier_slug, sl.shipped_at,
-               u.name AS undelivered_by_name,
-               n.note as latest_note, n.date_created as latest_note_date, n.author as latest_note_author
+    from_where = '''
         FROM orders o
         LEFT JOIN sites s ON o.source = s.url
         LEFT JOIN warehouses w ON o.warehouse_id = w.id
@@ -16108,13 +17400,7 @@ def get_shipped_orders():
             SELECT id FROM shipping_logs WHERE order_id = o.id ORDER BY id DESC LIMIT 1
         )
         LEFT JOIN users u ON o.undelivered_by = u.id
-        LEFT JOIN (
-            SELECT order_id, note, date_created, author
-            FROM order_notes
-            WHERE customer_note = 0
-            GROUP BY order_id
-            HAVING date_created = MAX(date_created)
-        ) n ON o.id = n.order_id
+        LEFT JOIN shipping_view sv ON sv.order_id = o.id
         WHERE o.status IN ('on-hold', 'shipped', 'partial-shipped')
     '''
     params = []
@@ -16122,20 +17408,20 @@ def get_shipped_orders():
     allowed_sources = get_user_allowed_sources(current_user.id, current_user.is_admin(), current_user.is_viewer())
     if allowed_sources is not None:
         placeholders = ','.join(['?' for _ in allowed_sources])
-        query += f' AND o.source IN ({placeholders})'
+        from_where += f' AND o.source IN ({placeholders})'
         params.extend(allowed_sources)
     
     if source_filter:
-        query += ' AND o.source = ?'
+        from_where += ' AND o.source = ?'
         params.append(source_filter)
         
     if country_filter:
-        query += ' AND s.country = ?'
+        from_where += ' AND s.country = ?'
         params.append(country_filter)
 
     manager_filter = request.args.get('manager', '')
     if manager_filter:
-        query += ' AND s.manager = ?'
+        from_where += ' AND s.manager = ?'
         params.append(manager_filter)
         
     start_date = request.args.get('start_date')
@@ -16143,32 +17429,51 @@ def get_shipped_orders():
     search = request.args.get('search')
     
     if start_date:
-        query += ' AND o.date_created >= ?'
+        from_where += ' AND o.date_created >= ?'
         params.append(start_date + ' 00:00:00')
     
     if end_date:
-        query += ' AND o.date_created <= ?'
+        from_where += ' AND o.date_created <= ?'
         params.append(end_date + ' 23:59:59')
     
     if search:
-        search_term = f'%{search}%'
-        # Also match tracking numbers stored by external plugins (AST / VillaTheme / custom):
-        # they live in meta_data, shipping_lines or line_items as JSON. LIKE on the raw JSON
-        # is good enough for the typical case where tracking numbers are 10+ alphanumeric chars.
-        query += ''' AND (
-            o.number LIKE ?
-            OR o.billing LIKE ?
-            OR o.shipping LIKE ?
-            OR EXISTS (SELECT 1 FROM shipping_logs slx WHERE slx.order_id = o.id AND slx.tracking_number LIKE ?)
-            OR o.meta_data LIKE ?
-            OR o.shipping_lines LIKE ?
-            OR o.line_items LIKE ?
-        )'''
-        params.extend([search_term] * 7)
-
-    query += ' ORDER BY sl.shipped_at DESC, o.date_modified DESC, o.date_created DESC'
-    
-    orders = conn.execute(query, params).fetchall()
+        # Also match tracking numbers stored by external plugins (AST / VillaTheme / custom)
+        # and our shipping_logs — orders_fts extracts them into its tracking column.
+        fts = order_search.match_clause(search, ('number', 'customer', 'products', 'tracking'), id_column='o.id')
+        if fts:
+            from_where += ' AND ' + fts[0]
+            params.extend(fts[1])
+        else:
+            search_term = f'%{search}%'
+            from_where += ''' AND (
+                o.number LIKE ?
+                OR o.billing LIKE ?
+                OR o.shipping LIKE ?
+                OR EXISTS (SELECT 1 FROM shipping_logs slx WHERE slx.order_id = o.id AND slx.tracking_number LIKE ?)
+                OR o.meta_data LIKE ?
+                OR o.shipping_lines LIKE ?
+                OR o.line_items LIKE ?
+            )'''
+            params.extend([search_term] * 7)
+
+    view_sql, view_params = _shipping_view_filters(request.args)
+    from_where += view_sql
+    params.extend(view_params)
+
+    page, per_page = _shipping_queue_page(request.args)
+    orders, total = _run_shipping_queue(
+        conn, '''o.id, o.number, o.status, o.total, o.currency, o.date_created, o.date_modified,
+               o.source, o.shipping_total, o.customer_note, o.warehouse_id,
+               o.is_undelivered, o.shipping_loss_amount, o.undelivered_at, o.undelivered_note,
+               o.is_problem_return, o.carrier_status, o.carrier_status_at,
+               s.manager,
+               w.name AS warehouse_name,
+               sl.tracking_number, sl.carrier_slug, sl.shipped_at,
+               u.name AS undelivered_by_name''',
+        from_where, params,
+        _shipping_queue_order(request.args, 'sl.shipped_at DESC, o.date_modified DESC, o.date_created DESC',
+                              {'shipped': 'sl.shipped_at'}),
+        page, per_page)
 
     # All parcels per order (split shipment / 分批发货) so a completed multi-
     # parcel order can show every tracking number, not just the latest.
@@ -16196,9 +17501,12 @@ def get_shipped_orders():
                 'reship_reason': (r['reship_reason'] if 'reship_reason' in rk else '') or '',
             })
 
+    tracking_map = order_tracking.load(conn, shipped_ids)
+    views = shipping_view.load(conn, shipped_ids)
+    notes = _latest_internal_notes(conn, shipped_ids)
+
     # Get carriers for tracking URL
     carriers = {c['slug']: c for c in conn.execute('SELECT * FROM shipping_carriers').fetchall()}
-    conn.close()
     
     # Mapping for Advanced Shipment Tracking Pro provider slugs
     ast_provider_mapping = {
@@ -16208,34 +17516,32 @@ def get_shipped_orders():
         'dpd-pl': ('dpd', 'DPD'),
     }
     
-    # Build risk index once and pass into each row (cheaper than rebuilding
-    # per-order; same orders' billing/shipping JSON is parsed once inside
-    # process_shipped_order, so we can't easily share that — but the index
-    # itself is the expensive part).
+    # Build risk index once and pass into each row; each row is matched on
+    # the email / phone / address keys shipping_view stored at sync time.
     risk_idx = _build_risk_index(conn)
 
     result = []
     for order in orders:
         try:
-            payload = process_shipped_order(order, conn, carriers, ast_provider_mapping)
+            v = views[order['id']]
+            payload = process_shipped_order(order, conn, carriers, ast_provider_mapping, tracking_map, v)
             payload['date_created'] = order['date_created']  # 下单日期 (shown in the 订单 column)
+            payload.update(_latest_note_fields(notes, order['id']))
             _ps = shipped_parcels_map.get(order['id'], [])
             payload['parcels'] = _ps
             payload['parcels_shipped'] = len(_ps)
             payload['carrier_status'] = order['carrier_status']
             payload['carrier_status_at'] = order['carrier_status_at']
             payload['customer_risk'] = _assess_customer_risk(
-                parse_json_field(order['billing']),
-                parse_json_field(order['shipping']),
-                risk_idx,
-                current_order_id=order['id'],
-            )
+                None, None, risk_idx, current_order_id=order['id'],
+                keys=(v['email_key'], v['phone_key'], v['addr_key']))
             result.append(payload)
         except Exception as e:
             print(f"Error processing shipped order {order['number']}: {e}")
             continue
+    conn.close()
 
-    return jsonify(result)
+    return _shipping_queue_response(result, total, page, per_page)
 
 
 @app.route('/api/shipping/find-by-tracking')
@@ -16246,12 +17552,15 @@ def find_orders_by_tracking():
 
     Tracking numbers can live in many places depending on which WooCommerce plugin
     the site uses (Advanced Shipment Tracking Pro, Orders Tracking for WooCommerce,
-    custom shipping_lines meta, our own shipping_logs, etc.). This endpoint:
-      1. uses LIKE on number + every JSON column we know holds tracking data
-         to get a candidate list across ALL statuses,
-      2. runs each candidate through process_shipped_order() to extract the actual
-         tracking number, then keeps only rows where the extracted number matches
-         the user's query (substring, case-insensitive).
+    custom shipping_lines meta, our own shipping_logs, etc.). All of them are
+    extracted at sync / ship time into order_tracking (see order_tracking.py).
+    This endpoint:
+      1. seeks order_tracking for tracking numbers equal to / starting with the
+         query, plus orders_fts for number / tracking substrings, to get the
+         candidates across ALL statuses (no cap — both are index lookups),
+      2. keeps only rows where the order number or one of the order's tracking
+         numbers contains the query (case-insensitive), then builds each row
+         with process_shipped_order().
     """
     q = (request.args.get('q') or '').strip()
     if not q or len(q) < 4:
@@ -16275,23 +17584,21 @@ def find_orders_by_tracking():
             SELECT id FROM shipping_logs WHERE order_id = o.id ORDER BY id DESC LIMIT 1
         )
         LEFT JOIN users u ON o.undelivered_by = u.id
-        LEFT JOIN (
-            SELECT order_id, note, date_created, author
-            FROM order_notes
-            WHERE customer_note = 0
-            GROUP BY order_id
-            HAVING date_created = MAX(date_created)
-        ) n ON o.id = n.order_id
-        WHERE (
-            o.number LIKE ?
-            OR sl.tracking_number LIKE ?
-            OR o.meta_data LIKE ?
-            OR o.line_items LIKE ?
-            OR o.shipping_lines LIKE ?
-        )
+        LEFT JOIN order_notes n ON n.id = o.latest_note_id
     '''
-    like_term = f'%{q}%'
-    params = [like_term] * 5
+    seek = order_tracking.lookup_clause(q, id_column='o.id')
+    fts = order_search.match_clause(q, ('number', 'tracking'), id_column='o.id')
+    if fts:
+        base_query += f' WHERE ({seek[0]} OR {fts[0]})'
+        params = seek[1] + fts[1]
+    else:
+        like_term = f'%{q}%'
+        base_query += f''' WHERE (
+            {seek[0]}
+            OR o.number LIKE ?
+            OR o.id IN (SELECT order_id FROM order_tracking WHERE tracking_number LIKE ?)
+        )'''
+        params = seek[1] + [like_term, like_term]
 
     allowed_sources = get_user_allowed_sources(current_user.id, current_user.is_admin(), current_user.is_viewer())
     if allowed_sources is not None:
@@ -16302,10 +17609,11 @@ def find_orders_by_tracking():
         base_query += f' AND o.source IN ({placeholders})'
         params.extend(allowed_sources)
 
-    # Limit candidates to keep the JSON-parsing post-filter cheap
-    base_query += ' ORDER BY o.date_modified DESC, o.date_created DESC LIMIT 200'
+    base_query += ' ORDER BY o.date_modified DESC, o.date_created DESC'
 
     candidates = conn.execute(base_query, params).fetchall()
+    tracking_map = order_tracking.load(conn, [row['id'] for row in candidates])
+    views = shipping_view.load(conn, [row['id'] for row in candidates])
 
     carriers = {c['slug']: c for c in conn.execute('SELECT * FROM shipping_carriers').fetchall()}
     ast_provider_mapping = {
@@ -16318,19 +17626,21 @@ def find_orders_by_tracking():
     q_lower = q.lower()
     results = []
     for row in candidates:
+        # Confirm the match against the order number or any of the order's
+        # tracking numbers — the trigram match is per document column, so this
+        # drops orders where the query only spans two different numbers.
+        order_no = str(row['number'] or '').lower()
+        numbers = [r['tracking_number'].lower() for r in tracking_map.get(row['id'], [])]
+        if q_lower not in order_no and not any(q_lower in t for t in numbers):
+            continue
         try:
-            payload = process_shipped_order(row, conn, carriers, ast_provider_mapping)
+            payload = process_shipped_order(row, conn, carriers, ast_provider_mapping, tracking_map,
+                                            views.get(row['id']))
         except Exception as e:
             print(f"Error parsing order {row['number']} for tracking lookup: {e}")
             continue
-        # Confirm the LIKE match by checking either the order number or the
-        # extracted tracking number — drops false positives where the query
-        # string happens to appear elsewhere in the JSON blob.
-        order_no = str(payload.get('number') or '').lower()
-        tracking = str(payload.get('tracking_number') or '').lower()
-        if q_lower in order_no or (tracking and q_lower in tracking):
-            payload['status'] = row['status']
-            results.append(payload)
+        payload['status'] = row['status']
+        results.append(payload)
 
     conn.close()
     return jsonify({'success': True, 'orders': results, 'count': len(results)})
@@ -16353,40 +17663,57 @@ def find_orders_by_tracking():
 # keys so legacy themes and `wc_get_order_tracking_number()` still find it.
 # ============================================================================
 
-def detect_site_tracking_format(conn, site_url):
-    """Look at recent shipped orders for this site to figure out which plugin
-    holds the tracking. Returns 'ast' | 'villatheme' | 'custom_lineitem' | 'unknown'."""
-    rows = conn.execute("""
-        SELECT meta_data, line_items FROM orders
-        WHERE source = ? AND status IN ('on-hold','shipped','completed')
-        ORDER BY date_modified DESC LIMIT 10
-    """, (site_url,)).fetchall()
+# The detection itself (format + carriers) lives in site_profile.py and runs
+# at sync time; the ship path reads the cached per-site profile.
 
-    ast = villa = custom = 0
-    for r in rows:
-        md = r['meta_data'] or ''
-        li = r['line_items'] or ''
-        if '_wc_shipment_tracking_items' in md:
-            ast += 1
-        if '_vi_wot_order_item_tracking_data' in li:
-            villa += 1
-        elif '"key":"tracking_number"' in li or '"key": "tracking_number"' in li:
-            custom += 1
-
-    if ast and ast >= max(villa, custom):
-        return 'ast'
-    if villa and villa >= custom:
-        return 'villatheme'
-    if custom:
-        return 'custom_lineitem'
-    return 'unknown'
-
-
-def _ast_provider_for_carrier(carrier_slug):
+_SITE_PROFILE_GUARD = threading.Lock()
+_site_profile_refreshing = set()
+
+
+def _refresh_site_profile_async(site_url):
+    """Rebuild one site's tracking profile in a background thread (at most one
+    rebuild per site at a time; readers keep using the stored profile)."""
+    with _SITE_PROFILE_GUARD:
+        if site_url in _site_profile_refreshing:
+            return
+        _site_profile_refreshing.add(site_url)
+
+    def run(app_context):
+        with app_context:
+            conn = get_db_connection()
+            try:
+                site_profile.refresh_site(conn, site_url)
+                conn.commit()
+            except Exception as e:
+                app.logger.error(f'Tracking profile refresh of {site_url} failed: {e}')
+            finally:
+                conn.close()
+                with _SITE_PROFILE_GUARD:
+                    _site_profile_refreshing.discard(site_url)
+
+    threading.Thread(target=run, args=(app.app_context(),), daemon=True).start()
+
+
+def site_tracking_profile(conn, site_url):
+    """The cached tracking profile of a site (see site_profile.py). Past its
+    TTL the stored one is still returned and a rebuild is queued; a site that
+    was never scanned is scanned here, once."""
+    profile, stale = site_profile.load(conn, site_url)
+    if profile is None:
+        profile = site_profile.refresh_site(conn, site_url)
+        conn.commit()
+    elif stale:
+        _refresh_site_profile_async(site_url)
+    return profile
+
+
+def _ast_provider_for_carrier(carrier_slug, site_providers=None):
     """Map our carrier slug to the AST plugin's tracking_provider value.
 
     Most slugs already match AST's expected provider name (australia-post,
     dhl-express, fedex, ups, ...). A few legacy short slugs need aliasing.
+    Slugs without an alias use the provider the site's own AST records use
+    for them (`site_providers`, the profile's ast_providers), if any.
     """
     cs = (carrier_slug or '').lower().strip()
     aliases = {
@@ -16395,7 +17722,9 @@ def _ast_provider_for_carrier(carrier_slug):
         'auspost': 'australia-post',
         'australia_post': 'australia-post',
     }
-    return aliases.get(cs, cs or 'custom')
+    if cs in aliases:
+        return aliases[cs]
+    return (site_providers or {}).get(cs) or cs or 'custom'
 
 
 def build_ast_tracking_value(tracking_number, carrier_slug, line_items):
@@ -16466,12 +17795,13 @@ def build_villatheme_lineitem_payload(tracking_number, carrier_slug, carrier_nam
 # from the parcel list and PUT it (the PUT replaces the meta), so AST/VillaTheme
 # end up holding every parcel's tracking number, not just the latest.
 
-def build_ast_tracking_items(parcels, line_items):
+def build_ast_tracking_items(parcels, line_items, site_providers=None):
     """Build _wc_shipment_tracking_items as a list with ONE record per parcel.
 
     AST natively renders each list entry as a separate shipment, so a split
     order shows all its tracking numbers. Single-parcel orders pass a 1-element
-    list and behave exactly as before.
+    list and behave exactly as before. `site_providers` is passed on to
+    _ast_provider_for_carrier.
     """
     import time, hashlib
     products = []
@@ -16491,7 +17821,7 @@ def build_ast_tracking_items(parcels, line_items):
         items.append({
             'tracking_number': tn,
             'shipping_note': '',
-            'tracking_provider': _ast_provider_for_carrier(p.get('carrier_slug')),
+            'tracking_provider': _ast_provider_for_carrier(p.get('carrier_slug'), site_providers),
             'custom_tracking_link': '',
             'tracking_product_code': '',
             'date_shipped': ds,
@@ -16533,6 +17863,17 @@ def build_villatheme_lineitem_payload_multi(parcels, line_items):
     return out
 
 
+def _shipment_fallback_note(carrier_name, tracking_number, tracking_url):
+    """Text of the customer note sent when the site has no native shipment email."""
+    if tracking_url:
+        return (
+            f"Order has been shipped via {carrier_name}. "
+            f"Tracking Number: <a href='{tracking_url}'>{tracking_number}</a>"
+            f"\n<br>Track your package: <a href='{tracking_url}'>{tracking_url}</a>"
+        )
+    return f"Order has been shipped via {carrier_name}. Tracking Number: {tracking_number}"
+
+
 def _post_fallback_customer_note(req, site, order, carrier_name, tracking_number, tracking_url, api_headers, warnings):
     """Last-resort fallback when the trigger-shipment-email endpoint is missing
     on the site (mu-plugin not installed yet). Posts a customer_note=true so
@@ -16540,17 +17881,9 @@ def _post_fallback_customer_note(req, site, order, carrier_name, tracking_number
     plugin-native one but better than no notification at all."""
     try:
         note_url = f"{site['url']}/wp-json/wc/v3/orders/{woo_post_id(order['id'])}/notes"
-        if tracking_url:
-            note_content = (
-                f"Order has been shipped via {carrier_name}. "
-                f"Tracking Number: <a href='{tracking_url}'>{tracking_number}</a>"
-                f"\n<br>Track your package: <a href='{tracking_url}'>{tracking_url}</a>"
-            )
-        else:
-            note_content = f"Order has been shipped via {carrier_name}. Tracking Number: {tracking_number}"
         note_resp = req.post(
             note_url,
-            json={'note': note_content, 'customer_note': True},
+            json={'note': _shipment_fallback_note(carrier_name, tracking_number, tracking_url), 'customer_note': True},
             auth=(site['consumer_key'], site['consumer_secret']),
             timeout=45,
             headers=api_headers,
@@ -16586,63 +17919,31 @@ def build_custom_lineitem_payload(tracking_number, carrier_slug, tracking_url, l
     return out
 
 
-@app.route('/api/shipping/ship', methods=['POST'])
-@login_required
-@shipper_required
-@order_site_editable
-def ship_order():
-    """Mirror manual tracking entry in WP-admin.
+def _prepare_shipment(conn, order_id, tracking_number, carrier_slug,
+                      new_parcel=False, more_batches=False, reship_reason=''):
+    """Everything a ship action needs before talking to WP. Returns
+    (ship, None, None) or (None, error_message, http_status).
 
-    For the chosen site we detect which tracking plugin it uses, then PUT
-    /orders/{id} with the right meta_data shape AND status=on-hold in a single
-    request. After that we (optionally) post a customer-visible note so WC
-    sends the shipment email — same path the WP admin order-edit screen takes.
-    """
-    import requests as req
+    `ship` carries the order / site rows, the detected tracking format, the
+    full parcel list and the orders PUT payload (tracking meta + status), so
+    the single ship endpoint and the batch job build the exact same write."""
     import time
 
-    data = request.json or {}
-    order_id = data.get('order_id')
-    tracking_number = (data.get('tracking_number') or '').strip()
-    carrier_slug = (data.get('carrier_slug') or '').strip()
-    send_email = data.get('send_email', True)
-    # 分批发货 (split shipment) flags:
-    #   new_parcel   → this action adds ANOTHER parcel: append a shipping_logs
-    #                  row and rebuild the WP tracking value from ALL parcels.
-    #   more_batches → not the final batch: leave the order status untouched so
-    #                  it stays in the 待发货 queue and survives WC re-sync
-    #                  (sync overwrites status). Status only advances on the
-    #                  final batch (more_batches=False).
-    new_parcel = bool(data.get('new_parcel'))
-    more_batches = bool(data.get('more_batches'))
-    # 补发货 (re-shipment): re-send a NEW tracking after the first parcel was
-    # lost / never sent. A non-empty reship_reason flags it. A reship writes ONLY
-    # the new parcel to WP (replace — the customer sees just the live tracking),
-    # but keeps the original parcel row locally for history and records the
-    # reason in an audit note. It is never a split / partial batch.
-    reship_reason = (data.get('reship_reason') or '').strip()
     is_reship = bool(reship_reason)
     if is_reship:
         new_parcel = False
         more_batches = False
 
-    if not all([order_id, tracking_number, carrier_slug]):
-        return jsonify({'success': False, 'error': '缺少必填字段'}), 400
-
-    conn = get_db_connection()
-
     order = conn.execute(
         'SELECT id, number, source, status, line_items FROM orders WHERE id = ?',
         (order_id,)
     ).fetchone()
     if not order:
-        conn.close()
-        return jsonify({'success': False, 'error': '订单不存在'}), 404
+        return None, '订单不存在', 404
 
     site = conn.execute('SELECT * FROM sites WHERE url = ?', (order['source'],)).fetchone()
     if not site:
-        conn.close()
-        return jsonify({'success': False, 'error': '站点配置不存在'}), 404
+        return None, '站点配置不存在', 404
 
     carrier = conn.execute('SELECT name, tracking_url FROM shipping_carriers WHERE slug = ?', (carrier_slug,)).fetchone()
     carrier_name = carrier['name'] if carrier else carrier_slug
@@ -16656,16 +17957,11 @@ def ship_order():
         tracking_url = tracking_url_template.replace('{tracking}', tracking_number).replace('{tracking_number}', tracking_number)
 
     line_items = parse_json_field(order['line_items']) or []
-    fmt = detect_site_tracking_format(conn, order['source'])
+    profile = site_tracking_profile(conn, order['source'])
+    fmt = profile.get('format') or 'unknown'
     fmt_label = {'ast': 'AST', 'villatheme': 'VillaTheme', 'custom_lineitem': '自定义', 'unknown': '默认(AST)'}.get(fmt, fmt)
     target_status = target_status_for_format(fmt)
 
-    api_headers = {
-        "User-Agent": "WooCommerce API Client-Python/3.0.0",
-        "Content-Type": "application/json",
-        "Accept": "application/json"
-    }
-
     # Assemble the FULL parcel list to write to WP. shipping_logs is the source
     # of truth for already-shipped parcels; on a new_parcel action we append,
     # otherwise (normal ship / correction) we replace with just this one.
@@ -16733,27 +18029,48 @@ def ship_order():
         # already understand _wc_shipment_tracking_items.
         put_payload['meta_data'] = base_meta + [
             {'key': '_wc_shipment_tracking_items',
-             'value': build_ast_tracking_items(parcels, line_items)},
+             'value': build_ast_tracking_items(parcels, line_items, profile.get('ast_providers'))},
         ]
 
-    status_url = f"{site['url']}/wp-json/wc/v3/orders/{woo_post_id(order['id'])}"
-    warnings = []
-    remote_success = False
+    return {
+        'order_id': order_id,
+        'order': order,
+        'site': site,
+        'tracking_number': tracking_number,
+        'carrier_slug': carrier_slug,
+        'carrier_name': carrier_name,
+        'tracking_url': tracking_url,
+        'fmt': fmt,
+        'fmt_label': fmt_label,
+        'target_status': target_status,
+        'parcels': parcels,
+        'put_payload': put_payload,
+        'status_url': f"{site['url']}/wp-json/wc/v3/orders/{woo_post_id(order['id'])}",
+        'new_parcel': new_parcel,
+        'more_batches': more_batches,
+        'is_reship': is_reship,
+        'reship_reason': reship_reason,
+    }, None, None
+
+
+def _put_shipment(req, ship, api_headers, warnings):
+    """PUT the shipment to WP, retrying up to 3 times. Returns True when WP
+    took it. The same payload is idempotent so retrying after timeout is safe."""
+    import time
 
-    # PUT with retry. The same payload is idempotent so retrying after timeout is safe.
+    site, order = ship['site'], ship['order']
     for attempt in range(3):
         try:
             resp = req.put(
-                status_url,
-                json=put_payload,
+                ship['status_url'],
+                json=ship['put_payload'],
                 auth=(site['consumer_key'], site['consumer_secret']),
                 timeout=60,
                 headers=api_headers
             )
-            print(f"[SHIP] {site['url']} order {order['id']} fmt={fmt} attempt={attempt+1} status={resp.status_code}")
+            print(f"[SHIP] {site['url']} order {order['id']} fmt={ship['fmt']} attempt={attempt+1} status={resp.status_code}")
             if resp.status_code in (200, 201):
-                remote_success = True
-                break
+                return True
             body = (resp.text or '')[:300]
             if body.lstrip().startswith(('<!', '<html')):
                 warnings.append(f"WP 返回 HTML（疑似 WAF 拦截 / 认证失败），HTTP {resp.status_code}")
@@ -16764,15 +18081,14 @@ def ship_order():
             # Verify by GET — the PUT may have actually applied even if the
             # response never made it back.
             try:
-                check = req.get(status_url, auth=(site['consumer_key'], site['consumer_secret']), timeout=30)
+                check = req.get(ship['status_url'], auth=(site['consumer_key'], site['consumer_secret']), timeout=30)
                 # On a final batch we confirm via the status flip; during a
                 # partial batch (more_batches) status is intentionally unchanged,
                 # so a reachable 200 is the best confirmation we can get (the PUT
                 # is idempotent, so retrying is harmless anyway).
-                if check.status_code == 200 and (more_batches or check.json().get('status') == target_status):
-                    remote_success = True
+                if check.status_code == 200 and (ship['more_batches'] or check.json().get('status') == ship['target_status']):
                     warnings.append("PUT 响应超时，但二次查询确认订单可达")
-                    break
+                    return True
             except Exception as verify_err:
                 print(f"[SHIP] verify after timeout failed: {verify_err}")
             if attempt < 2:
@@ -16780,42 +18096,58 @@ def ship_order():
         except Exception as e:
             warnings.append(f"远程异常: {e}")
             break
+    return False
 
-    if not remote_success:
-        # For a NEW parcel (split shipment) we don't stash anything: the parcel
-        # didn't actually ship, and inserting a row would create a phantom
-        # parcel. The user just retries. For a normal/first shipment we stash
-        # the tracking number locally so it doesn't have to be retyped on retry.
-        if not new_parcel and not is_reship:
-            existing_log = conn.execute('SELECT id FROM shipping_logs WHERE order_id = ?', (order_id,)).fetchone()
-            if existing_log:
-                conn.execute(
-                    "UPDATE shipping_logs SET tracking_number=?, carrier_slug=?, shipped_by=?, shipped_at=datetime('now') WHERE order_id=?",
-                    (tracking_number, carrier_slug, current_user.id, order_id)
-                )
-            else:
-                conn.execute(
-                    '''INSERT INTO shipping_logs (order_id, woo_order_id, source, tracking_number, carrier_slug, shipped_by)
-                       VALUES (?, ?, ?, ?, ?, ?)''',
-                    (order_id, order['number'], order['source'], tracking_number, carrier_slug, current_user.id)
-                )
-            conn.commit()
-        # A failed reship must NOT stash/overwrite the original tracking row.
-        stash_note = '' if (new_parcel or is_reship) else '运单号已暂存本地，请稍后重试。'
-        conn.close()
-        return jsonify({
-            'success': False,
-            'error': f"发货失败（{fmt_label}）：{'; '.join(warnings) or '远程未返回成功'}。{stash_note}"
-        }), 500
+
+def _stash_failed_shipment(conn, ship, user_id):
+    """After a failed PUT. For a NEW parcel (split shipment) we don't stash
+    anything: the parcel didn't actually ship, and inserting a row would create
+    a phantom parcel. The user just retries. For a normal/first shipment we
+    stash the tracking number locally so it doesn't have to be retyped on retry.
+    A failed reship must NOT stash/overwrite the original tracking row.
+    Returns the hint to append to the error message."""
+    if ship['new_parcel'] or ship['is_reship']:
+        return ''
+    order_id, order = ship['order_id'], ship['order']
+    existing_log = conn.execute('SELECT id FROM shipping_logs WHERE order_id = ?', (order_id,)).fetchone()
+    if existing_log:
+        conn.execute(
+            "UPDATE shipping_logs SET tracking_number=?, carrier_slug=?, shipped_by=?, shipped_at=datetime('now') WHERE order_id=?",
+            (ship['tracking_number'], ship['carrier_slug'], user_id, order_id)
+        )
+    else:
+        conn.execute(
+            '''INSERT INTO shipping_logs (order_id, woo_order_id, source, tracking_number, carrier_slug, shipped_by)
+               VALUES (?, ?, ?, ?, ?, ?)''',
+            (order_id, order['number'], order['source'], ship['tracking_number'], ship['carrier_slug'], user_id)
+        )
+    order_search.index_orders(conn, [order_id])
+    order_tracking.refresh_orders(conn, [order_id])
+    order_index.bump_order_months(conn, [order_id])
+    conn.commit()
+    return '运单号已暂存本地，请稍后重试。'
+
+
+def _reship_log_line(ship, user_name):
+    """Audit line of a re-shipment ('' for a normal ship)."""
+    if not ship['is_reship']:
+        return ''
+    return (
+        f"「补发货」由 {user_name} 操作：物流商 {ship['carrier_name']}，"
+        f"新运单号 {ship['tracking_number']}。补发原因：{ship['reship_reason']}"
+    )
+
+
+def _notify_shipment(req, ship, send_email, api_headers, warnings, user_name):
+    """Customer notification + reship audit note after WP took the shipment.
+    Returns (email_trigger_info, customer_notified, reship_log_line)."""
+    site, order = ship['site'], ship['order']
+    tracking_number, carrier_slug = ship['tracking_number'], ship['carrier_slug']
+    carrier_name, tracking_url = ship['carrier_name'], ship['tracking_url']
 
     # Build the re-shipment audit line once; reused for the local order_notes
     # row and the best-effort remote WC note below.
-    reship_log_line = ''
-    if is_reship:
-        reship_log_line = (
-            f"「补发货」由 {current_user.name} 操作：物流商 {carrier_name}，"
-            f"新运单号 {tracking_number}。补发原因：{reship_reason}"
-        )
+    reship_log_line = _reship_log_line(ship, user_name)
 
     # Trigger the site's native shipment email.
     #
@@ -16872,13 +18204,13 @@ def ship_order():
     # (the order is already shipped), and custom/unknown sites have no native
     # trigger at all. So whenever nothing customer-facing went out above, fall
     # back to a WooCommerce customer note that emails the buyer the new tracking.
-    if is_reship and send_email and not customer_notified:
+    if ship['is_reship'] and send_email and not customer_notified:
         _post_fallback_customer_note(req, site, order, carrier_name, tracking_number, tracking_url, api_headers, warnings)
 
     # Re-shipment: leave an explicit audit note on the WC order so the WP admin
     # reflects WHY a second tracking went out (best-effort; mirrors the
     # mark-undelivered remote-note path).
-    if is_reship and reship_log_line:
+    if ship['is_reship'] and reship_log_line:
         try:
             req.post(
                 f"{site['url']}/wp-json/wc/v3/orders/{woo_post_id(order['id'])}/notes",
@@ -16888,67 +18220,86 @@ def ship_order():
                 headers=api_headers,
             )
         except Exception as remote_err:
-            app.logger.warning(f"Remote reship note for order {order_id} failed: {remote_err}")
-
-    # Local DB: status + shipping_logs (mirror the remote state we just set).
-    try:
-        # Advance status only on the final batch. During a partial shipment the
-        # order keeps its pre-ship status so it stays in the 待发货 queue.
-        if not more_batches:
-            conn.execute("UPDATE orders SET status=? WHERE id=?", (target_status, order_id))
-        if new_parcel:
-            # Split shipment: record this parcel as its own row.
-            conn.execute(
-                '''INSERT INTO shipping_logs (order_id, woo_order_id, source, tracking_number, carrier_slug, shipped_by)
-                   VALUES (?, ?, ?, ?, ?, ?)''',
-                (order_id, order['number'], order['source'], tracking_number, carrier_slug, current_user.id)
-            )
-        elif is_reship:
-            # Re-shipment: keep the original parcel row(s) untouched and append a
-            # NEW row flagged is_reship with the reason, so the full history is
-            # preserved locally even though WP only carries the new (replacing)
-            # tracking. Also write an order_notes audit row (local source of
-            # truth, always succeeds even if the remote note above failed).
+            app.logger.warning(f"Remote reship note for order {ship['order_id']} failed: {remote_err}")
+
+    return email_trigger_info, customer_notified, reship_log_line
+
+
+def _record_shipment(conn, ship, user_id, user_name, reship_log_line):
+    """Local DB: status + shipping_logs (mirror the remote state we just set).
+    Commits; raises on a database error."""
+    order_id, order = ship['order_id'], ship['order']
+    tracking_number, carrier_slug = ship['tracking_number'], ship['carrier_slug']
+    # Advance status only on the final batch. During a partial shipment the
+    # order keeps its pre-ship status so it stays in the 待发货 queue.
+    if not ship['more_batches']:
+        conn.execute("UPDATE orders SET status=? WHERE id=?", (ship['target_status'], order_id))
+        customer_stats.mark_orders(conn, [order_id])
+    order_index.bump_order_months(conn, [order_id])  # status and / or its parcels changed
+    if ship['new_parcel']:
+        # Split shipment: record this parcel as its own row.
+        conn.execute(
+            '''INSERT INTO shipping_logs (order_id, woo_order_id, source, tracking_number, carrier_slug, shipped_by)
+               VALUES (?, ?, ?, ?, ?, ?)''',
+            (order_id, order['number'], order['source'], tracking_number, carrier_slug, user_id)
+        )
+    elif ship['is_reship']:
+        # Re-shipment: keep the original parcel row(s) untouched and append a
+        # NEW row flagged is_reship with the reason, so the full history is
+        # preserved locally even though WP only carries the new (replacing)
+        # tracking. Also write an order_notes audit row (local source of
+        # truth, always succeeds even if the remote note above failed).
+        conn.execute(
+            '''INSERT INTO shipping_logs (order_id, woo_order_id, source, tracking_number, carrier_slug, shipped_by, reship_reason, is_reship)
+               VALUES (?, ?, ?, ?, ?, ?, ?, 1)''',
+            (order_id, order['number'], order['source'], tracking_number, carrier_slug, user_id, ship['reship_reason'])
+        )
+        conn.execute(
+            '''INSERT INTO order_notes (order_id, note, date_created, customer_note, author, added_by_user)
+               VALUES (?, ?, datetime('now'), 0, ?, 1)''',
+            (order_id, reship_log_line, user_name)
+        )
+        latest_note.refresh_orders(conn, [order_id])
+    else:
+        existing_log = conn.execute('SELECT id FROM shipping_logs WHERE order_id=?', (order_id,)).fetchone()
+        if existing_log:
             conn.execute(
-                '''INSERT INTO shipping_logs (order_id, woo_order_id, source, tracking_number, carrier_slug, shipped_by, reship_reason, is_reship)
-                   VALUES (?, ?, ?, ?, ?, ?, ?, 1)''',
-                (order_id, order['number'], order['source'], tracking_number, carrier_slug, current_user.id, reship_reason)
+                "UPDATE shipping_logs SET tracking_number=?, carrier_slug=?, shipped_by=?, shipped_at=datetime('now') WHERE order_id=?",
+                (tracking_number, carrier_slug, user_id, order_id)
             )
+        else:
             conn.execute(
-                '''INSERT INTO order_notes (order_id, note, date_created, customer_note, author, added_by_user)
-                   VALUES (?, ?, datetime('now'), 0, ?, 1)''',
-                (order_id, reship_log_line, current_user.name)
+                '''INSERT INTO shipping_logs (order_id, woo_order_id, source, tracking_number, carrier_slug, shipped_by)
+                   VALUES (?, ?, ?, ?, ?, ?)''',
+                (order_id, order['number'], order['source'], tracking_number, carrier_slug, user_id)
             )
-        else:
-            existing_log = conn.execute('SELECT id FROM shipping_logs WHERE order_id=?', (order_id,)).fetchone()
-            if existing_log:
-                conn.execute(
-                    "UPDATE shipping_logs SET tracking_number=?, carrier_slug=?, shipped_by=?, shipped_at=datetime('now') WHERE order_id=?",
-                    (tracking_number, carrier_slug, current_user.id, order_id)
-                )
-            else:
-                conn.execute(
-                    '''INSERT INTO shipping_logs (order_id, woo_order_id, source, tracking_number, carrier_slug, shipped_by)
-                       VALUES (?, ?, ?, ?, ?, ?)''',
-                    (order_id, order['number'], order['source'], tracking_number, carrier_slug, current_user.id)
-                )
-        conn.commit()
-    except Exception as e:
-        conn.close()
-        return jsonify({'success': False, 'error': f"本地数据库更新失败: {e}"}), 500
-    conn.close()
-
-    # Annotate the success message — split-shipment aware.
-    parcel_count = len(parcels)
-    if is_reship:
-        msg = f"补发成功（{fmt_label} 格式），新运单 {tracking_number}"
-    elif more_batches:
-        msg = f"第 {parcel_count} 个包裹已发货（分批中，订单仍在待发货，可继续添加包裹）"
-    elif new_parcel and parcel_count > 1:
-        msg = f"最后一个包裹已发货，共 {parcel_count} 个包裹，订单已完成发货（{fmt_label} 格式）"
-    else:
-        msg = f"发货成功（{fmt_label} 格式）"
-    if is_reship:
+    order_search.index_orders(conn, [order_id])  # new tracking number becomes searchable
+    order_tracking.refresh_orders(conn, [order_id])
+    # First ship with this carrier on the site: list it in the ship modal now
+    # (the order's tracking meta only comes back with the next sync) and rescan.
+    new_carrier = site_profile.note_carrier(conn, order['source'], carrier_slug)
+    conn.commit()
+    if new_carrier:
+        _refresh_site_profile_async(order['source'])
+
+
+def _shipment_headline(ship):
+    """First part of the success message — split-shipment aware."""
+    fmt_label, tracking_number = ship['fmt_label'], ship['tracking_number']
+    parcel_count = len(ship['parcels'])
+    if ship['is_reship']:
+        return f"补发成功（{fmt_label} 格式），新运单 {tracking_number}"
+    if ship['more_batches']:
+        return f"第 {parcel_count} 个包裹已发货（分批中，订单仍在待发货，可继续添加包裹）"
+    if ship['new_parcel'] and parcel_count > 1:
+        return f"最后一个包裹已发货，共 {parcel_count} 个包裹，订单已完成发货（{fmt_label} 格式）"
+    return f"发货成功（{fmt_label} 格式）"
+
+
+def _shipment_message(ship, send_email, email_trigger_info, customer_notified):
+    """The success message once WP took the shipment and the email step ran."""
+    msg = _shipment_headline(ship)
+    if ship['is_reship']:
         if not send_email:
             msg += "，未通知客户（未勾选发邮件）"
         elif customer_notified:
@@ -16968,12 +18319,340 @@ def ship_order():
             msg += "，AST 已自动安排发货邮件"
         elif sent is False:
             msg += f"，邮件未发送：{email_trigger_info.get('note', '未识别物流插件')}"
-    resp_extra = {'format': fmt, 'email_trigger': email_trigger_info,
-                  'parcel_count': parcel_count, 'more_batches': more_batches}
-    if warnings:
-        return jsonify({'success': True, 'warning': True,
-                        'message': msg + ' — 警告: ' + '; '.join(warnings), **resp_extra})
-    return jsonify({'success': True, 'message': msg, **resp_extra})
+    return msg
+
+
+@app.route('/api/shipping/ship', methods=['POST'])
+@login_required
+@shipper_required
+@order_site_editable
+def ship_order():
+    """Mirror manual tracking entry in WP-admin.
+
+    For the chosen site we detect which tracking plugin it uses and build the
+    PUT /orders/{id} with the right meta_data shape AND status=on-hold in a
+    single request, then (optionally) the shipment email trigger — same path
+    the WP admin order-edit screen takes. Both go out from the outbox
+    (wc_outbox: the PUT first, the email only once the PUT went through); the
+    shipment itself is recorded locally before this returns.
+    """
+    data = request.json or {}
+    order_id = data.get('order_id')
+    tracking_number = (data.get('tracking_number') or '').strip()
+    carrier_slug = (data.get('carrier_slug') or '').strip()
+    send_email = data.get('send_email', True)
+    # 分批发货 (split shipment) flags:
+    #   new_parcel   → this action adds ANOTHER parcel: append a shipping_logs
+    #                  row and rebuild the WP tracking value from ALL parcels.
+    #   more_batches → not the final batch: leave the order status untouched so
+    #                  it stays in the 待发货 queue and survives WC re-sync
+    #                  (sync overwrites status). Status only advances on the
+    #                  final batch (more_batches=False).
+    new_parcel = bool(data.get('new_parcel'))
+    more_batches = bool(data.get('more_batches'))
+    # 补发货 (re-shipment): re-send a NEW tracking after the first parcel was
+    # lost / never sent. A non-empty reship_reason flags it. A reship writes ONLY
+    # the new parcel to WP (replace — the customer sees just the live tracking),
+    # but keeps the original parcel row locally for history and records the
+    # reason in an audit note. It is never a split / partial batch.
+    reship_reason = (data.get('reship_reason') or '').strip()
+
+    if not all([order_id, tracking_number, carrier_slug]):
+        return jsonify({'success': False, 'error': '缺少必填字段'}), 400
+
+    conn = get_db_connection()
+    ship, err, code = _prepare_shipment(conn, order_id, tracking_number, carrier_slug,
+                                        new_parcel, more_batches, reship_reason)
+    if err:
+        conn.close()
+        return jsonify({'success': False, 'error': err}), code
+
+    # The same submit twice (double click) queues and records the parcel once
+    idem_key = f"ship:{order_id}:{tracking_number}:{int(ship['new_parcel'])}:{int(ship['more_batches'])}:{reship_reason}"
+    if wc_outbox.live_op(conn, idem_key):
+        conn.close()
+        return jsonify({'success': True, 'message': '该运单已在同步队列中',
+                        'format': ship['fmt'], 'parcel_count': len(ship['parcels']),
+                        'more_batches': ship['more_batches']})
+
+    reship_log_line = _reship_log_line(ship, current_user.name)
+    site = ship['site']
+    try:
+        push_id = wc_outbox.enqueue(
+            conn, site['url'], 'order_update', {'data': ship['put_payload']}, order_id=order_id,
+            local_status=None if ship['more_batches'] else ship['target_status'],
+            idem_key=idem_key, actor=current_user.name)
+        if send_email or reship_log_line:
+            wc_outbox.enqueue(conn, site['url'], 'shipment_email', {
+                'send_email': bool(send_email),
+                'tracking_number': tracking_number,
+                'carrier_slug': carrier_slug,
+                'fallback_note': _shipment_fallback_note(ship['carrier_name'], tracking_number, ship['tracking_url']),
+                'is_reship': ship['is_reship'],
+                'reship_note': reship_log_line,
+            }, order_id=order_id, depends_on=push_id, max_attempts=3, actor=current_user.name)
+        _record_shipment(conn, ship, current_user.id, current_user.name, reship_log_line)  # commits both
+    except Exception as e:
+        conn.rollback()
+        conn.close()
+        return jsonify({'success': False, 'error': f"本地数据库更新失败: {e}"}), 500
+    conn.close()
+    _kick_wc_outbox()
+
+    msg = _shipment_headline(ship) + ('，正在同步到站点并发送通知' if send_email else '，正在同步到站点')
+    return jsonify({'success': True, 'message': msg, 'push_id': push_id, 'format': ship['fmt'],
+                    'parcel_count': len(ship['parcels']), 'more_batches': ship['more_batches']})
+
+
+# ── Batch shipping (批量发货) ─────────────────────────────────────────────────
+# /api/shipping/ship-batch takes many (order, parcel) entries at once. Entries
+# are grouped by site; each site's tracking writes go out as WC orders/batch
+# calls (the same payload ship_order PUTs, built by _prepare_shipment), sites
+# run concurrently, and every order's result is stored as soon as it is known
+# so the page can poll them in while the rest is still going.
+
+SHIP_BATCH_MAX_ENTRIES = 300
+SHIP_BATCH_SITE_WORKERS = 4
+SHIP_BATCH_RETENTION_DAYS = 7
+def _add_ship_batch_result(conn, job_id, order_id, success, message, ship=None, warning=False):
+    """Store one order's outcome, advance the job's done counter and its
+    heartbeat (commits)."""
+    conn.execute(
+        '''INSERT INTO ship_batch_results (job_id, order_id, success, warning, message, format, parcel_count)
+           VALUES (?, ?, ?, ?, ?, ?, ?)''',
+        (job_id, str(order_id) if order_id is not None else None, int(bool(success)), int(bool(warning)),
+         message, ship['fmt'] if ship else None, len(ship['parcels']) if ship else None)
+    )
+    conn.execute("UPDATE ship_batch_jobs SET done = done + 1, heartbeat_at = datetime('now') WHERE id = ?",
+                 (job_id,))
+    conn.commit()
+
+
+def _ship_site_batch(job_id, ships, send_email, user_id, user_name):
+    """Ship one site's orders: orders/batch for the tracking writes, then per
+    order the email trigger and the local records, exactly as ship_order does.
+
+    A chunk whose batch call got no answer at all (timeout / connection drop)
+    may or may not have been applied, so its orders fall back to the single
+    PUT with retries + verify-by-GET (_put_shipment). Orders WC rejected
+    inside the batch fail like a rejected single PUT."""
+    import requests as req
+
+    api_headers = {
+        "User-Agent": "WooCommerce API Client-Python/3.0.0",
+        "Content-Type": "application/json",
+        "Accept": "application/json"
+    }
+    site = ships[0]['site']
+    ops = [dict(ship['put_payload'], id=woo_post_id(ship['order']['id'])) for ship in ships]
+    outcomes = _wc_batch(site['url'], site['consumer_key'], site['consumer_secret'],
+                         'orders', 'update', ops, timeout=120)
+
+    conn = get_db_connection()
+    try:
+        for ship, (_, err) in zip(ships, outcomes):
+            warnings = []
+            if err and err.startswith(WC_BATCH_UNREACHED):
+                remote_success = _put_shipment(req, ship, api_headers, warnings)
+            else:
+                remote_success = err is None
+                if err:
+                    warnings.append(err)
+            print(f"[SHIP-BATCH] job {job_id} {site['url']} order {ship['order_id']} ok={remote_success}")
+            if not remote_success:
+                stash_note = _stash_failed_shipment(conn, ship, user_id)
+                _add_ship_batch_result(
+                    conn, job_id, ship['order_id'], False,
+                    f"发货失败（{ship['fmt_label']}）：{'; '.join(warnings) or '远程未返回成功'}。{stash_note}", ship)
+                continue
+            email_trigger_info, customer_notified, reship_log_line = _notify_shipment(
+                req, ship, send_email, api_headers, warnings, user_name)
+            try:
+                _record_shipment(conn, ship, user_id, user_name, reship_log_line)
+            except Exception as e:
+                conn.rollback()
+                _add_ship_batch_result(conn, job_id, ship['order_id'], False, f"本地数据库更新失败: {e}", ship)
+                continue
+            msg = _shipment_message(ship, send_email, email_trigger_info, customer_notified)
+            if warnings:
+                msg += ' — 警告: ' + '; '.join(warnings)
+            _add_ship_batch_result(conn, job_id, ship['order_id'], True, msg, ship, warning=bool(warnings))
+    finally:
+        conn.close()
+
+
+def _run_ship_batch(app_context, job_id, entries, send_email, user_id, user_name):
+    import concurrent.futures
+
+    with app_context:
+        conn = get_db_connection()
+        try:
+            by_site = {}
+            for e in entries:
+                ship, err, _ = _prepare_shipment(conn, e['order_id'], e['tracking_number'], e['carrier_slug'],
+                                                 e['new_parcel'], e['more_batches'])
+                if err:
+                    _add_ship_batch_result(conn, job_id, e['order_id'], False, err)
+                    continue
+                by_site.setdefault(ship['site']['url'], []).append(ship)
+        finally:
+            conn.close()
+
+        def run_site(ships):
+            try:
+                _ship_site_batch(job_id, ships, send_email, user_id, user_name)
+            except Exception as e:
+                app.logger.exception(f"ship batch {job_id} failed for {ships[0]['site']['url']}")
+                return f"{ships[0]['site']['url']}: {e}"
+            return None
+
+        errors = []
+        if by_site:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=min(SHIP_BATCH_SITE_WORKERS, len(by_site))) as ex:
+                errors = [e for e in ex.map(run_site, list(by_site.values())) if e]
+
+        conn = get_db_connection()
+        try:
+            conn.execute("""UPDATE ship_batch_jobs SET status = ?, error = ?, finished_at = datetime('now')
+                            WHERE id = ?""",
+                         ('error' if errors else 'done', '; '.join(errors)[:500] or None, job_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+
+@app.route('/api/shipping/ship-batch', methods=['POST'])
+@login_required
+@shipper_required
+def ship_orders_batch():
+    """Ship many orders in one request (runs in the background).
+
+    Request body:
+      {
+        "send_email": true,
+        "entries": [
+          {"order_id": "...", "carrier_slug": "dpd", "tracking_number": "...",
+           "new_parcel": false, "more_batches": false},
+          ...
+        ]
+      }
+
+    Same per-order semantics as /api/shipping/ship (split shipments via
+    new_parcel / more_batches); re-shipments stay single-order. Returns the
+    job id; poll /api/shipping/ship-batch/<job_id> for per-order results."""
+    data = request.json or {}
+    entries_in = data.get('entries') or []
+    send_email = bool(data.get('send_email', True))
+    if not isinstance(entries_in, list) or not entries_in:
+        return jsonify({'success': False, 'error': '请提供非空 entries 列表'}), 400
+    if len(entries_in) > SHIP_BATCH_MAX_ENTRIES:
+        return jsonify({'success': False, 'error': f'单次最多 {SHIP_BATCH_MAX_ENTRIES} 个订单，请分批'}), 400
+
+    entries, rejected, seen = [], [], set()
+    for e in entries_in:
+        e = e if isinstance(e, dict) else {}
+        order_id = e.get('order_id')
+        tracking_number = (e.get('tracking_number') or '').strip()
+        carrier_slug = (e.get('carrier_slug') or '').strip()
+        if not all([order_id, tracking_number, carrier_slug]):
+            rejected.append((order_id, '缺少必填字段'))
+        elif (e.get('reship_reason') or '').strip():
+            rejected.append((order_id, '补发货请在订单上单独操作'))
+        elif str(order_id) in seen:
+            # parcels are rebuilt from shipping_logs per order — one entry per order per batch
+            rejected.append((order_id, '同一订单在本批中重复，请分批提交'))
+        else:
+            seen.add(str(order_id))
+            entries.append({'order_id': order_id, 'tracking_number': tracking_number,
+                            'carrier_slug': carrier_slug,
+                            'new_parcel': bool(e.get('new_parcel')),
+                            'more_batches': bool(e.get('more_batches'))})
+
+    conn = get_db_connection()
+    try:
+        scope = get_user_editable_sources(current_user)
+        if scope is not None and entries:
+            ids = [e['order_id'] for e in entries]
+            sources = {}
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                for r in conn.execute(f"SELECT id, source FROM orders WHERE id IN ({','.join('?' * len(chunk))})",
+                                      chunk):
+                    sources[str(r['id'])] = r['source']
+            allowed = []
+            for e in entries:
+                src = sources.get(str(e['order_id']))
+                if src is not None and src not in scope:
+                    rejected.append((e['order_id'], '无权编辑该站点的订单（只能操作已授权的站点）'))
+                else:
+                    allowed.append(e)
+            entries = allowed
+
+        conn.execute("DELETE FROM ship_batch_results WHERE job_id IN (SELECT id FROM ship_batch_jobs "
+                     "WHERE created_at < datetime('now', ?))", (f'-{SHIP_BATCH_RETENTION_DAYS} days',))
+        conn.execute("DELETE FROM ship_batch_jobs WHERE created_at < datetime('now', ?)",
+                     (f'-{SHIP_BATCH_RETENTION_DAYS} days',))
+        cur = conn.execute(
+            "INSERT INTO ship_batch_jobs (total, send_email, created_by, status, heartbeat_at) "
+            "VALUES (?, ?, ?, ?, datetime('now'))",
+            (len(entries) + len(rejected), int(send_email), int(current_user.id),
+             'running' if entries else 'done'))
+        job_id = cur.lastrowid
+        conn.commit()
+        for order_id, err in rejected:
+            _add_ship_batch_result(conn, job_id, order_id, False, err)
+    finally:
+        conn.close()
+
+    if entries:
+        thread = threading.Thread(target=_run_ship_batch, args=(
+            app.app_context(), job_id, entries, send_email, current_user.id, current_user.name))
+        thread.start()
+    return jsonify({'success': True, 'job_id': job_id, 'total': len(entries) + len(rejected)})
+
+
+@app.route('/api/shipping/ship-batch/<int:job_id>')
+@login_required
+@shipper_required
+def ship_orders_batch_status(job_id):
+    """Progress of a batch: job status plus the per-order results stored
+    after result id `after` (pass the last id seen to get only new ones)."""
+    after = request.args.get('after', 0, type=int)
+    conn = get_db_connection()
+    try:
+        job = conn.execute('SELECT * FROM ship_batch_jobs WHERE id = ? AND created_by = ?',
+                           (job_id, int(current_user.id))).fetchone()
+        if not job:
+            return jsonify({'success': False, 'error': '任务不存在'}), 404
+        if job['status'] == 'running' and conn.execute(
+                "SELECT COALESCE(?, ?) < datetime('now', ?)",
+                (job['heartbeat_at'], job['created_at'], f'-{SHIP_BATCH_STALE_SECONDS} seconds')).fetchone()[0]:
+            _expire_stale_ship_batches(conn)
+            conn.commit()
+            job = conn.execute('SELECT * FROM ship_batch_jobs WHERE id = ?', (job_id,)).fetchone()
+        rows = conn.execute(
+            'SELECT * FROM ship_batch_results WHERE job_id = ? AND id > ? ORDER BY id',
+            (job_id, after)).fetchall()
+    finally:
+        conn.close()
+    return jsonify({
+        'success': True,
+        'job_id': job_id,
+        'status': job['status'],
+        'error': job['error'],
+        'total': job['total'],
+        'done': job['done'],
+        'results': [{
+            'id': r['id'],
+            'order_id': r['order_id'],
+            'success': bool(r['success']),
+            'warning': bool(r['warning']),
+            'message': r['message'],
+            'format': r['format'],
+            'parcel_count': r['parcel_count'],
+        } for r in rows],
+    })
 
 
 @app.route('/api/shipping/debug/<order_id>', methods=['POST'])
@@ -17078,9 +18757,7 @@ def debug_tracking_sync(order_id):
 @shipper_required
 @order_site_editable
 def complete_order(order_id):
-    """Mark order as completed"""
-    import requests as req
-    
+    """Mark order as completed (WooCommerce is updated from the outbox)"""
     conn = get_db_connection()
     
     order = conn.execute('SELECT id, number, source FROM orders WHERE id = ?', (order_id,)).fetchone()
@@ -17094,27 +18771,21 @@ def complete_order(order_id):
         return jsonify({'success': False, 'error': '站点配置不存在'}), 404
     
     try:
-        # Update order status via WooCommerce API
-        url = f"{site['url']}/wp-json/wc/v3/orders/{woo_post_id(order['id'])}"
-        resp = req.put(
-            url,
-            json={'status': 'completed'},
-            auth=(site['consumer_key'], site['consumer_secret']),
-            timeout=30
-        )
-        
-        if resp.status_code not in [200, 201]:
-            raise Exception(f"API错误: {resp.text}")
-        
-        # Update local database
+        # Update local database, queue the WooCommerce status update
         conn.execute("UPDATE orders SET status = 'completed' WHERE id = ?", (order_id,))
+        order_index.bump_order_months(conn, [order_id])
+        customer_stats.mark_orders(conn, [order_id])
         conn.execute("UPDATE shipping_logs SET status = 'completed', completed_at = datetime('now') WHERE order_id = ?", (order_id,))
+        push_id = wc_outbox.enqueue(conn, site['url'], 'order_update', {'data': {'status': 'completed'}},
+                                    order_id=order_id, local_status='completed', actor=current_user.name)
         conn.commit()
         conn.close()
+        _kick_wc_outbox()
         
-        return jsonify({'success': True, 'message': '订单已完成'})
+        return jsonify({'success': True, 'message': '订单已完成，正在同步到站点', 'push_id': push_id})
         
     except Exception as e:
+        conn.rollback()
         conn.close()
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -17161,129 +18832,16 @@ def get_carriers():
     return jsonify(sorted(by_slug.values(), key=lambda x: -x.get('usage_count', 0)))
 
 
-def detect_carriers_for_site(conn, site_url, lookback_orders=80):
-    """Return the carriers a specific site has actually used, by inspecting
-    recent shipped orders' tracking meta_data. Lets the ship modal show only
-    options that make sense for *this* site (PL site → InPost/DPD; AU site →
+def detect_carriers_for_site(conn, site_url):
+    """Return the carriers a specific site has actually used, from its cached
+    tracking profile (site_profile.py: recent shipped orders' tracking meta,
+    plus carriers shipped with since). Lets the ship modal show only options
+    that make sense for *this* site (PL site → InPost/DPD; AU site →
     Australia Post) instead of one global cluttered dropdown.
 
-    Slugs are enriched with name + tracking_url from the shipping_carriers
-    table when available; otherwise we fall back to the slug itself as the
-    display name and an empty URL.
+    Each entry: {slug, name, tracking_url, usage_count}, most used first.
     """
-    rows = conn.execute("""
-        SELECT meta_data, line_items FROM orders
-        WHERE source = ? AND status IN ('on-hold','shipped','partial-shipped','completed','delivered')
-        ORDER BY date_modified DESC LIMIT ?
-    """, (site_url, lookback_orders)).fetchall()
-
-    import re
-    # VillaTheme generates per-entry slugs like 'custom_1775723085' when the
-    # admin types a name freehand. Skip those and use carrier_name instead.
-    custom_slug_re = re.compile(r'^custom_\d+$')
-    # Lowercased carrier_name → canonical slug we want to surface.
-    name_to_slug = {
-        'inpost': 'inpost', 'inpost paczkomaty': 'inpost', 'paczkomaty': 'inpost',
-        'dpd': 'dpd', 'dpd polska': 'dpd', 'dpd poland': 'dpd', 'dpd-pl': 'dpd',
-        'australia post': 'australia-post', 'auspost': 'australia-post', 'australia-post': 'australia-post',
-        # EMS shipments out of China to overseas (mostly used on AU sites for
-        # the 国内发 warehouse fulfillment). Cover common ways WC plugins or
-        # shippers label these so detection picks them up regardless of region.
-        'ems': 'ems', 'ems china': 'ems', 'china ems': 'ems', 'china post ems': 'ems',
-        'china post': 'ems', 'ems express': 'ems', 'epacket': 'ems',
-        '中国邮政': 'ems', '中国邮政ems': 'ems', '邮政ems': 'ems',
-    }
-    # Slug aliases — collapse AST's regional variants down to our shipping_carriers
-    # canonical slug so the URL lookup works in ship_order.
-    slug_aliases = {
-        'inpost-paczkomaty': 'inpost',
-        'inpost-pl': 'inpost',
-        'dpd-pl': 'dpd',
-        'dpd-polska': 'dpd',
-        'auspost': 'australia-post',
-        'china-ems': 'ems',
-        'china-post': 'ems',
-        'china-post-ems': 'ems',
-        'ems-china': 'ems',
-        'epacket': 'ems',
-    }
-
-    def _record_slug(slug, fallback_name):
-        """Normalize one tracking record's slug. Drop noise; map custom_NNN
-        to a real carrier via its display name; collapse regional aliases."""
-        s = (slug or '').strip().lower()
-        n = (fallback_name or '').strip().lower()
-        if not s and not n:
-            return None
-        if s and not custom_slug_re.match(s):
-            return slug_aliases.get(s, s)
-        # Custom_TIMESTAMP — recover a real carrier from carrier_name
-        return name_to_slug.get(n)
-
-    seen = {}  # slug → count
-    for r in rows:
-        # AST format: meta_data._wc_shipment_tracking_items[].tracking_provider
-        try:
-            md = json.loads(r['meta_data'] or '[]')
-            for m in md:
-                if isinstance(m, dict) and m.get('key') == '_wc_shipment_tracking_items':
-                    items = m.get('value', [])
-                    if isinstance(items, list):
-                        for it in items:
-                            if isinstance(it, dict):
-                                slug = _record_slug(it.get('tracking_provider'), '')
-                                if slug:
-                                    seen[slug] = seen.get(slug, 0) + 1
-        except Exception:
-            pass
-
-        # VillaTheme: line_items[*].meta_data._vi_wot_order_item_tracking_data
-        try:
-            li = json.loads(r['line_items'] or '[]')
-            for item in li:
-                if not isinstance(item, dict):
-                    continue
-                for m in item.get('meta_data', []):
-                    if not isinstance(m, dict):
-                        continue
-                    if m.get('key') == '_vi_wot_order_item_tracking_data':
-                        v = m.get('value')
-                        try:
-                            recs = json.loads(v) if isinstance(v, str) else v
-                        except Exception:
-                            recs = None
-                        if isinstance(recs, list):
-                            for rec in recs:
-                                if isinstance(rec, dict):
-                                    slug = _record_slug(rec.get('carrier_slug'), rec.get('carrier_name'))
-                                    if slug:
-                                        seen[slug] = seen.get(slug, 0) + 1
-        except Exception:
-            pass
-
-    if not seen:
-        return []
-
-    # Pull names + URLs for the slugs we found
-    db_carriers = {c['slug']: c for c in conn.execute(
-        'SELECT slug, name, tracking_url FROM shipping_carriers'
-    ).fetchall()}
-
-    out = []
-    for slug, count in sorted(seen.items(), key=lambda kv: -kv[1]):
-        c = db_carriers.get(slug)
-        # AST aliases: 'inpost-paczkomaty' → our DB row 'inpost'; 'dpd-pl' → 'dpd'
-        if not c:
-            alias = {'inpost-paczkomaty': 'inpost', 'dpd-pl': 'dpd', 'auspost': 'australia-post'}.get(slug)
-            if alias:
-                c = db_carriers.get(alias)
-        out.append({
-            'slug': slug,
-            'name': (c['name'] if c else slug.replace('-', ' ').title()),
-            'tracking_url': (c['tracking_url'] if c else ''),
-            'usage_count': count,
-        })
-    return out
+    return [dict(c) for c in site_tracking_profile(conn, site_url).get('carriers', [])]
 
 
 @app.route('/api/shipping/carriers-for-site')
@@ -17560,16 +19118,12 @@ def get_order_notes(order_id):
 def add_order_note(order_id):
     """Add a note to an order, optionally notifying the customer.
 
-    When notify_customer is True, WP runs the email send synchronously through
-    whatever SMTP plugin is installed (FluentSMTP, etc) BEFORE returning the
-    response. A slow SMTP relay can easily push that past the default 30 s
-    timeout. So we:
-      - bump the read timeout to 90 s when an email is involved
-      - on timeout, do a verify GET to see if the note actually landed
-        (the POST likely succeeded server-side; only the response was lost)
+    The note is stored locally right away and POSTed to WooCommerce from the
+    outbox (wc_outbox). With notify_customer WP sends the email inline
+    through its SMTP plugin, which can take over a minute — the outbox gives
+    that POST a 90 s read timeout and, before any retry, looks the note up
+    on the order so a lost response never produces a second email.
     """
-    import requests as req
-
     data = request.json
     note = data.get('note', '')
     notify_customer = data.get('notify_customer', False)
@@ -17584,82 +19138,37 @@ def add_order_note(order_id):
         return jsonify({'success': False, 'error': '订单不存在'}), 404
 
     site = conn.execute('SELECT * FROM sites WHERE url = ?', (order['source'],)).fetchone()
-    conn.close()
-
     if not site:
+        conn.close()
         return jsonify({'success': False, 'error': '站点配置不存在'}), 404
 
-    url = f"{site['url']}/wp-json/wc/v3/orders/{woo_post_id(order_id)}/notes"
-    headers = {
-        "User-Agent": "WooCommerce API Client-Python/3.0.0",
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-    }
-    auth = (site['consumer_key'], site['consumer_secret'])
-    # (connect, read) — connect should be fast; read needs to absorb SMTP latency
-    timeout = (10, 90 if notify_customer else 30)
-
+    # A double-submitted form queues the note once
+    idem_key = f"note:{order_id}:{hashlib.sha1(note.strip().encode('utf-8')).hexdigest()}"
     try:
-        try:
-            resp = req.post(
-                url,
-                json={'note': note, 'customer_note': notify_customer},
-                auth=auth, timeout=timeout, headers=headers,
-            )
-        except req.exceptions.ReadTimeout:
-            # The note POST likely succeeded but the response never arrived.
-            # Fetch the latest notes and look for ours by exact content match.
-            app.logger.warning(f"add_order_note: read timeout for order {order_id}, verifying via GET...")
-            try:
-                check = req.get(url, auth=auth, timeout=(10, 30), headers=headers)
-                if check.status_code == 200:
-                    for n in check.json() or []:
-                        if str(n.get('note', '')).strip() == note.strip():
-                            return jsonify({
-                                'success': True,
-                                'message': '备注已添加（远端响应超时，但已确认入库）'
-                                           + ('，邮件可能仍在发送中' if notify_customer else ''),
-                                'verified_by_get': True,
-                            })
-            except Exception as verify_err:
-                app.logger.warning(f"add_order_note verify GET failed: {verify_err}")
-            return jsonify({
-                'success': False,
-                'error': '请求超时（90s）。如果勾选了「发送邮件」，邮件服务器响应可能慢；'
-                         '请稍后到 WordPress 后台确认备注是否已添加。',
-            }), 504
-
-        if resp.status_code not in (200, 201):
-            return jsonify({'success': False, 'error': f"API错误 {resp.status_code}: {resp.text[:200]}"}), 502
-
-        # Save the new note locally so it shows up immediately without waiting for the next sync
-        try:
-            note_data = resp.json()
-            if note_data and 'id' in note_data:
-                from datetime import datetime
-                conn = get_db_connection()
-                conn.execute('''
-                    INSERT OR REPLACE INTO order_notes (
-                        wc_note_id, order_id, note, date_created, customer_note, author, added_by_user
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    note_data.get('id'),
-                    order_id,
-                    note_data.get('note', note),
-                    note_data.get('date_created', datetime.now().isoformat()),
-                    1 if notify_customer else 0,
-                    note_data.get('author', current_user.username if current_user.is_authenticated else ''),
-                    1,
-                ))
-                conn.commit()
-                conn.close()
-        except Exception as db_err:
-            app.logger.error(f"Failed to save note to local DB: {db_err}")
-
-        return jsonify({'success': True, 'message': '备注已添加' + ('，已通知客户' if notify_customer else '')})
-
+        if wc_outbox.live_op(conn, idem_key):
+            conn.close()
+            return jsonify({'success': True, 'message': '相同备注已在同步队列中'})
+        # Save the note locally so it shows up immediately; the outbox links it
+        # to the WC note id once the POST went through.
+        cur = conn.execute('''
+            INSERT INTO order_notes (order_id, note, date_created, customer_note, author, added_by_user)
+            VALUES (?, ?, ?, ?, ?, 1)
+        ''', (order_id, note, datetime.now().isoformat(), 1 if notify_customer else 0, current_user.username))
+        latest_note.refresh_orders(conn, [order_id])
+        push_id = wc_outbox.enqueue(
+            conn, site['url'], 'order_note',
+            {'note': note, 'customer_note': bool(notify_customer), 'local_note_id': cur.lastrowid},
+            order_id=order_id, idem_key=idem_key, actor=current_user.name)
+        conn.commit()
     except Exception as e:
+        conn.rollback()
+        conn.close()
         return jsonify({'success': False, 'error': str(e)}), 500
+    conn.close()
+    _kick_wc_outbox()
+
+    return jsonify({'success': True, 'push_id': push_id,
+                    'message': '备注已添加，正在同步到站点' + ('（同步后通知客户）' if notify_customer else '')})
 
 
 @app.route('/api/order/<order_id>/status', methods=['POST'])
@@ -17667,9 +19176,8 @@ def add_order_note(order_id):
 @editor_required
 @order_site_editable
 def update_order_status(order_id):
-    """Update order status manually"""
-    import requests as req
-    
+    """Update order status manually. The store is updated from the outbox
+    (wc_outbox), so this returns as soon as the local row is written."""
     data = request.json
     new_status = data.get('status', '').strip()
     
@@ -17709,13 +19217,6 @@ def update_order_status(order_id):
         conn.close()
         return jsonify({'success': False, 'error': '该站点没有API写入权限，无法修改订单状态'}), 403
     
-    # Headers for WooCommerce API
-    api_headers = {
-        "User-Agent": "WooCommerce API Client-Python/3.0.0",
-        "Content-Type": "application/json",
-        "Accept": "application/json"
-    }
-    
     # Status labels for note
     status_labels = {
         'pending': '待付款',
@@ -17727,67 +19228,34 @@ def update_order_status(order_id):
         'failed': '失败',
         'checkout-draft': '草稿'
     }
-    
-    try:
-        # 1. Update order status via WooCommerce API.
-        # Use orders.id (WC internal post ID), not order['number'], because sites
-        # using Sequential Order Numbers have number != id and the REST API only
-        # accepts the post ID.
-        status_url = f"{site['url']}/wp-json/wc/v3/orders/{woo_post_id(order['id'])}"
-
-        print(f"[DEBUG] Update Status - URL: {status_url}")
-        print(f"[DEBUG] Update Status - Order ID: {order['id']}, Number: {order['number']}, New Status: {new_status}")
-
-        status_resp = req.put(
-            status_url,
-            json={'status': new_status},
-            auth=(site['consumer_key'], site['consumer_secret']),
-            timeout=60,
-            headers=api_headers
-        )
-
-        print(f"[DEBUG] Update Status - Response Code: {status_resp.status_code}")
-
-        # Check if response is HTML instead of JSON
-        response_text = status_resp.text or ''
-        if response_text.strip().startswith('<!') or response_text.strip().startswith('<html'):
-            print(f"[DEBUG] API returned HTML: {response_text[:200]}")
-            raise Exception(f"WordPress返回HTML而非JSON，可能是WAF阻止或认证问题")
-
-        if status_resp.status_code not in [200, 201]:
-            raise Exception(f"远程API错误: {status_resp.status_code} - {response_text[:200]}")
+    note_content = f"订单状态由 {current_user.name} 从 {status_labels.get(old_status, old_status)} 手动修改为 {status_labels.get(new_status, new_status)}"
 
-        # 2. Add order note documenting the change
-        note_url = f"{site['url']}/wp-json/wc/v3/orders/{woo_post_id(order['id'])}/notes"
-        note_content = f"订单状态由 {current_user.name} 从 {status_labels.get(old_status, old_status)} 手动修改为 {status_labels.get(new_status, new_status)}"
-        
-        try:
-            note_resp = req.post(
-                note_url,
-                json={'note': note_content, 'customer_note': False},
-                auth=(site['consumer_key'], site['consumer_secret']),
-                timeout=30,
-                headers=api_headers
-            )
-            # Note failure is not critical, just log it
-            if note_resp.status_code not in [200, 201]:
-                print(f"Warning: Failed to add status change note: {note_resp.status_code}")
-        except Exception as note_e:
-            print(f"Warning: Failed to add status change note: {note_e}")
-        
-        # 3. Update local database
+    try:
+        # Local status first; the WooCommerce PUT (by orders.id → WC post ID,
+        # never order['number']: Sequential Order Numbers sites have
+        # number != id) and the audit note after it go through the outbox.
         conn.execute("UPDATE orders SET status = ? WHERE id = ?", (new_status, order_id))
+        order_index.bump_order_months(conn, [order_id])
+        customer_stats.mark_orders(conn, [order_id])
+        push_id = wc_outbox.enqueue(conn, site['url'], 'order_update', {'data': {'status': new_status}},
+                                    order_id=order_id, local_status=new_status, actor=current_user.name)
+        # Note failure is not critical — it only shows up in the dead-letter list
+        wc_outbox.enqueue(conn, site['url'], 'order_note', {'note': note_content, 'customer_note': False},
+                          order_id=order_id, depends_on=push_id, max_attempts=3, actor=current_user.name)
         conn.commit()
         conn.close()
-        
+        _kick_wc_outbox()
+
         return jsonify({
             'success': True, 
-            'message': f'订单状态已从 {status_labels.get(old_status, old_status)} 修改为 {status_labels.get(new_status, new_status)}',
+            'message': f'订单状态已从 {status_labels.get(old_status, old_status)} 修改为 {status_labels.get(new_status, new_status)}，正在同步到站点',
             'old_status': old_status,
-            'new_status': new_status
+            'new_status': new_status,
+            'push_id': push_id
         })
         
     except Exception as e:
+        conn.rollback()
         conn.close()
         return jsonify({'success': False, 'error': str(e)}), 500
 
@@ -17836,6 +19304,10 @@ def mark_order_undelivered(order_id):
                    undelivered_note = ?
              WHERE id = ?
         ''', (loss_amount, int(current_user.id), note_text or None, order_id))
+        order_index.bump_order_months(conn, [order_id])  # closed-month snapshots depend on the loss flags
+        customer_stats.mark_orders(conn, [order_id])
+        order_search.index_orders(conn, [order_id])
+        _refresh_risk_keys(conn, [order_id])
 
         # Local order_notes audit row (always succeeds even if remote API is down)
         log_line = f"订单被 {current_user.name} 标记为「未送达/退回」，运费损失 {loss_amount:.2f}"
@@ -17845,6 +19317,7 @@ def mark_order_undelivered(order_id):
             INSERT INTO order_notes (order_id, note, date_created, customer_note, author, added_by_user)
             VALUES (?, ?, datetime('now'), 0, ?, 1)
         ''', (order_id, log_line, current_user.name))
+        latest_note.refresh_orders(conn, [order_id])
 
         conn.commit()
     except Exception as e:
@@ -17888,11 +19361,11 @@ def confirm_order_delivery(order_id):
     This is the human approval step in the 待确认结局 workflow. It:
       1. sets the local delivery_confirmed flag (clears it from the queue;
          a local-only column, so it survives every sync), then
-      2. pushes the WooCommerce status to 'completed' so the store reflects
-         reality. That fires WooCommerce's 'completed' customer email — the
-         operator accepted this trade-off. WC sync is best-effort: if it fails
-         the local confirm still stands and the order still leaves the queue."""
-    import requests as req
+      2. queues the WooCommerce status 'completed' (wc_outbox) so the store
+         reflects reality. That fires WooCommerce's 'completed' customer email
+         — the operator accepted this trade-off. If the push keeps failing the
+         local confirm still stands and the push shows up in the outbox's
+         dead-letter list."""
     conn = get_db_connection()
     order = conn.execute(
         'SELECT id, number, source, status, is_undelivered, is_problem_return, delivery_confirmed FROM orders WHERE id = ?',
@@ -17915,12 +19388,13 @@ def confirm_order_delivery(order_id):
             conn.execute('''INSERT INTO order_notes (order_id, note, date_created, customer_note, author, added_by_user)
                             VALUES (?, ?, datetime('now'), 0, ?, 1)''',
                          (order_id, f"订单被 {current_user.name} 确认「已签收」", current_user.name))
+            latest_note.refresh_orders(conn, [order_id])
             conn.commit()
         except Exception as e:
             conn.close()
             return jsonify({'success': False, 'error': f'本地写入失败: {e}'}), 500
 
-    # 2. Sync WooCommerce -> completed (best-effort; fires WC completed email).
+    # 2. Queue WooCommerce -> completed (fires WC completed email).
     site = conn.execute('SELECT url, consumer_key, consumer_secret, api_write_status FROM sites WHERE url = ?',
                         (order['source'],)).fetchone()
     sync_msg = ''
@@ -17929,20 +19403,18 @@ def confirm_order_delivery(order_id):
     elif site and site['consumer_key'] and site['consumer_secret'] and (
             'api_write_status' not in site.keys() or site['api_write_status'] != 'error'):
         try:
-            r = req.put(f"{site['url']}/wp-json/wc/v3/orders/{woo_post_id(order['id'])}",
-                        json={'status': 'completed'},
-                        auth=(site['consumer_key'], site['consumer_secret']), timeout=60,
-                        headers={'User-Agent': 'WooCommerce API Client-Python/3.0.0', 'Content-Type': 'application/json'})
-            if r.status_code in (200, 201):
-                conn.execute("UPDATE orders SET status='completed' WHERE id=?", (order_id,))
-                conn.commit()
-                sync_msg = '；已同步站点为「已完成」'
-            else:
-                sync_msg = f'；站点同步失败({r.status_code})，本地已标记签收'
-                app.logger.warning(f"confirm-delivery WC sync {order_id} -> {r.status_code}: {(r.text or '')[:200]}")
+            wc_outbox.enqueue(conn, site['url'], 'order_update', {'data': {'status': 'completed'}},
+                              order_id=order_id, local_status='completed', actor=current_user.name)
+            conn.execute("UPDATE orders SET status='completed' WHERE id=?", (order_id,))
+            order_index.bump_order_months(conn, [order_id])
+            customer_stats.mark_orders(conn, [order_id])
+            conn.commit()
+            _kick_wc_outbox()
+            sync_msg = '；正在同步站点为「已完成」'
         except Exception as e:
-            sync_msg = '；站点同步异常，本地已标记签收'
-            app.logger.warning(f"confirm-delivery WC sync {order_id} error: {e}")
+            conn.rollback()
+            sync_msg = '；站点同步排队失败，本地已标记签收'
+            app.logger.warning(f"confirm-delivery WC push {order_id} not queued: {e}")
     else:
         sync_msg = '；该站点无写权限，仅本地标记签收'
 
@@ -17962,6 +19434,7 @@ def _persist_carrier_status(order_id, outcome):
         c = get_db_connection()
         c.execute("UPDATE orders SET carrier_status=?, carrier_status_at=datetime('now') WHERE id=?",
                   (outcome, order_id))
+        order_index.bump_order_months(c, [order_id])
         c.commit()
         c.close()
     except Exception as e:
@@ -18111,10 +19584,15 @@ def unmark_order_undelivered(order_id):
                    undelivered_note = NULL
              WHERE id = ?
         ''', (order_id,))
+        order_index.bump_order_months(conn, [order_id])
+        customer_stats.mark_orders(conn, [order_id])
+        order_search.index_orders(conn, [order_id])
+        _refresh_risk_keys(conn, [order_id])
         conn.execute('''
             INSERT INTO order_notes (order_id, note, date_created, customer_note, author, added_by_user)
             VALUES (?, ?, datetime('now'), 0, ?, 1)
         ''', (order_id, f"{current_user.name} 撤销了「未送达」标记", current_user.name))
+        latest_note.refresh_orders(conn, [order_id])
         conn.commit()
     except Exception as e:
         conn.close()
@@ -18191,6 +19669,10 @@ def mark_order_problem_return(order_id):
              WHERE id = ?
         ''', (return_type, loss_amount, shipping_loss, int(current_user.id),
               note_text or None, evidence_text or None, order_id))
+        order_index.bump_order_months(conn, [order_id])
+        customer_stats.mark_orders(conn, [order_id])
+        order_search.index_orders(conn, [order_id])
+        _refresh_risk_keys(conn, [order_id])
 
         log_line = (f"订单被 {current_user.name} 标记为「问题退货 · {type_label}」，"
                     f"货值损失 {loss_amount:.2f}，运费损失 {shipping_loss:.2f}")
@@ -18202,6 +19684,7 @@ def mark_order_problem_return(order_id):
             INSERT INTO order_notes (order_id, note, date_created, customer_note, author, added_by_user)
             VALUES (?, ?, datetime('now'), 0, ?, 1)
         ''', (order_id, log_line, current_user.name))
+        latest_note.refresh_orders(conn, [order_id])
 
         conn.commit()
     except Exception as e:
@@ -18285,6 +19768,11 @@ def unmark_order_problem_return(order_id):
             INSERT INTO order_notes (order_id, note, date_created, customer_note, author, added_by_user)
             VALUES (?, ?, datetime('now'), 0, ?, 1)
         ''', (order_id, f"{current_user.name} 撤销了「问题退货」标记", current_user.name))
+        latest_note.refresh_orders(conn, [order_id])
+        order_index.bump_order_months(conn, [order_id])
+        customer_stats.mark_orders(conn, [order_id])
+        order_search.index_orders(conn, [order_id])
+        _refresh_risk_keys(conn, [order_id])
         conn.commit()
     except Exception as e:
         conn.close()
@@ -18571,26 +20059,13 @@ def export_pending_list():
     return output
 
 
-def process_shipped_order(order, conn, carriers, ast_provider_mapping):
-    billing = parse_json_field(order['billing'])
-    shipping_info = parse_json_field(order['shipping'])
-    meta_data = parse_json_field(order['meta_data'])
-    
-    # Get shipping address for display
-    addr = shipping_info if shipping_info and shipping_info.get('address_1') else billing
-    custom_fields = extract_custom_billing_fields(meta_data)
-    
-    # Calculate customer address (Standard)
-    customer_address = _compose_address(addr)
-
-    # DPD Fallback: If standard address is empty but DPD fields exist
-    if not addr.get('address_1') and (custom_fields.get('dpd_street') or custom_fields.get('dpd_city')):
-        dpd_parts = [
-            f"{custom_fields.get('dpd_street', '')} {custom_fields.get('dpd_house', '')}".strip(),
-            custom_fields.get('dpd_zip', ''),
-            custom_fields.get('dpd_city', '')
-        ]
-        customer_address = ', '.join(filter(None, dpd_parts))
+def process_shipped_order(order, conn, carriers, ast_provider_mapping, tracking=None, view=None):
+    """tracking: order_tracking.load() map prefetched by list endpoints;
+    loaded for this one order when None. view: the order's shipping_view.load()
+    fields; derived from the row's billing / shipping / line_items / meta_data /
+    shipping_lines when None."""
+    if view is None:
+        view = shipping_view.display_fields(order)
 
 
     # Get tracking info - first from shipping_logs, then from order meta_data
@@ -18600,117 +20075,52 @@ def process_shipped_order(order, conn, carriers, ast_provider_mapping):
     carrier_name = ''
     tracking_url = ''
     
-    # If no tracking in shipping_logs, try to get from wc_shipment_tracking_items (Advanced Shipment Tracking Pro)
-    if not tracking_number and meta_data:
-        for meta in meta_data:
-            if isinstance(meta, dict) and meta.get('key') == '_wc_shipment_tracking_items':
-                tracking_items = meta.get('value', [])
-                if isinstance(tracking_items, list) and len(tracking_items) > 0:
-                    first_item = tracking_items[0]
-                    if isinstance(first_item, dict):
-                        tracking_number = first_item.get('tracking_number', '')
-                        ast_provider = first_item.get('tracking_provider', '')
-                        
-                        # Map AST provider to our carrier slugs
-                        if ast_provider in ast_provider_mapping:
-                            carrier_slug, carrier_name = ast_provider_mapping[ast_provider]
-                        else:
-                            carrier_slug = ast_provider
-                            carrier_name = ast_provider.replace('-', ' ').title()
-                        
-                        # Parse date_shipped (Unix timestamp)
-                        date_shipped = first_item.get('date_shipped')
-                        if date_shipped:
-                            try:
-                                from datetime import datetime
-                                shipped_at = datetime.fromtimestamp(int(date_shipped)).strftime('%Y-%m-%d %H:%M:%S')
-                            except:
-                                pass
-                break
-    
-    # If still no tracking, try line_items meta_data for Orders Tracking for WooCommerce (VillaTheme)
+    # If no tracking in shipping_logs, take the first tracking number the site
+    # itself carries — AST items, line-item meta (VillaTheme Orders Tracking /
+    # custom 'tracking_number'), shipping_lines meta, then '_tracking_number'.
+    # Extracted once at sync / ship time into order_tracking (see order_tracking.py).
     if not tracking_number:
-        line_items = parse_json_field(order['line_items'])
-        if line_items:
-            for item in line_items:
-                if isinstance(item, dict):
-                    item_meta = item.get('meta_data', [])
-                    for meta in item_meta:
-                        if isinstance(meta, dict) and meta.get('key') == '_vi_wot_order_item_tracking_data':
-                            try:
-                                tracking_data_str = meta.get('value', '')
-                                if isinstance(tracking_data_str, str):
-                                    import json
-                                    tracking_data = json.loads(tracking_data_str)
-                                else:
-                                    tracking_data = tracking_data_str
-                                
-                                if isinstance(tracking_data, list) and len(tracking_data) > 0:
-                                    first_track = tracking_data[0]
-                                    if isinstance(first_track, dict):
-                                        tracking_number = first_track.get('tracking_number', '')
-                                        # Get carrier name and slug
-                                        raw_carrier_name = first_track.get('carrier_name', '')
-                                        raw_carrier_slug = first_track.get('carrier_slug', '')
-                                        
-                                        carrier_name = raw_carrier_name.title() if raw_carrier_name else raw_carrier_slug.title()
-                                        carrier_slug = raw_carrier_slug
-                                        
-                                        # Normalize carrier slug for known carriers to ensure we use our verified DB URLs
-                                        cn_lower = carrier_name.lower()
-                                        plugin_tracking_url = first_track.get('carrier_url', '')
-
-                                        if 'dpd' in cn_lower:
-                                            carrier_slug = 'dpd'
-                                            carrier_name = 'DPD'
-                                            plugin_tracking_url = '' # Force use of DB configured URL
-                                        elif 'inpost' in cn_lower:
-                                            carrier_slug = 'inpost'
-                                            carrier_name = 'InPost' 
-                                            plugin_tracking_url = '' # Force use of DB configured URL
-
-                                        # Get tracking URL from plugin data only if we didn't clear it
-                                        if plugin_tracking_url and tracking_number:
-                                            tracking_url = plugin_tracking_url.replace('{tracking_number}', tracking_number)
-                                            # Fix common placeholder issues from plugins
-                                            tracking_url = tracking_url.replace('{Tracking_number}', tracking_number)
-                                        
-                                        # Parse time (Unix timestamp)
-                                        track_time = first_track.get('time')
-                                        if track_time:
-                                            try:
-                                                from datetime import datetime
-                                                shipped_at = datetime.fromtimestamp(int(track_time)).strftime('%Y-%m-%d %H:%M:%S')
-                                            except:
-                                                pass
-                            except:
-                                pass
-                        elif isinstance(meta, dict) and meta.get('key') == 'tracking_number':
-                            tracking_number = str(meta.get('value', '')).strip()
-                        
-                        if tracking_number: break
-                if tracking_number: break
-
-    # If still no tracking, try shipping_lines meta_data 'tracking_number'
-    shipping_lines = parse_json_field(order['shipping_lines'])
-    if not tracking_number and shipping_lines:
-        for item in shipping_lines:
-            if isinstance(item, dict):
-                for meta in item.get('meta_data', []):
-                    if isinstance(meta, dict) and meta.get('key') == 'tracking_number':
-                        tracking_number = meta.get('value', '').strip()
-                        if tracking_number:
-                            break
-            if tracking_number:
-                break
-
-    # If still no tracking, try order meta_data '_tracking_number'
-    if not tracking_number and meta_data:
-            for meta in meta_data:
-                if isinstance(meta, dict) and meta.get('key') == '_tracking_number':
-                    tracking_number = meta.get('value', '').strip()
-                    if tracking_number:
-                        break
+        if tracking is None:
+            tracking = order_tracking.load(conn, [order['id']])
+        record = order_tracking.site_record(tracking.get(order['id']))
+        if record:
+            tracking_number = record['tracking_number']
+            kind = record['source_kind']
+            if kind == 'ast':
+                # Map AST provider to our carrier slugs
+                ast_provider = record['provider']
+                if ast_provider in ast_provider_mapping:
+                    carrier_slug, carrier_name = ast_provider_mapping[ast_provider]
+                else:
+                    carrier_slug = ast_provider
+                    carrier_name = ast_provider.replace('-', ' ').title()
+            elif kind == 'villatheme':
+                raw_carrier_name = record['carrier_name']
+                raw_carrier_slug = record['provider']
+                carrier_name = raw_carrier_name.title() if raw_carrier_name else raw_carrier_slug.title()
+                carrier_slug = raw_carrier_slug
+
+                # Normalize carrier slug for known carriers to ensure we use our verified DB URLs
+                cn_lower = carrier_name.lower()
+                plugin_tracking_url = record['carrier_url']
+
+                if 'dpd' in cn_lower:
+                    carrier_slug = 'dpd'
+                    carrier_name = 'DPD'
+                    plugin_tracking_url = '' # Force use of DB configured URL
+                elif 'inpost' in cn_lower:
+                    carrier_slug = 'inpost'
+                    carrier_name = 'InPost'
+                    plugin_tracking_url = '' # Force use of DB configured URL
+
+                # Get tracking URL from plugin data only if we didn't clear it
+                if plugin_tracking_url:
+                    tracking_url = plugin_tracking_url.replace('{tracking_number}', tracking_number)
+                    # Fix common placeholder issues from plugins
+                    tracking_url = tracking_url.replace('{Tracking_number}', tracking_number)
+            # AST date_shipped / VillaTheme time, already formatted at extraction
+            if record['shipped_at']:
+                shipped_at = record['shipped_at']
 
     # Determine carrier if we found a tracking number via custom methods but no slug
     if tracking_number and not carrier_slug:
@@ -18729,8 +20139,8 @@ def process_shipped_order(order, conn, carriers, ast_provider_mapping):
             carrier_name = 'DPD'
         
         # If still unsure, check shipping method title
-        if not carrier_slug and shipping_lines and len(shipping_lines) > 0:
-            method_title = str(shipping_lines[0].get('method_title', '')).lower()
+        if not carrier_slug and view['shipping_method']:
+            method_title = str(view['shipping_method']).lower()
             if 'inpost' in method_title:
                 carrier_slug = 'inpost'
                 carrier_name = 'InPost'
@@ -18754,7 +20164,6 @@ def process_shipped_order(order, conn, carriers, ast_provider_mapping):
 
     keys = order.keys() if hasattr(order, 'keys') else []
     is_undelivered = bool(order['is_undelivered']) if 'is_undelivered' in keys else False
-    shipping_method = shipping_lines[0].get('method_title', '') if shipping_lines and len(shipping_lines) > 0 else ''
 
     return {
         'id': order['id'],
@@ -18765,15 +20174,15 @@ def process_shipped_order(order, conn, carriers, ast_provider_mapping):
         'manager': order['manager'] or '',
         'warehouse_id': order['warehouse_id'] if 'warehouse_id' in keys else None,
         'warehouse_name': (order['warehouse_name'] if 'warehouse_name' in keys else '') or '',
-        'customer_name': f"{addr.get('first_name', '')} {addr.get('last_name', '')}".strip(),
-        'customer_email': billing.get('email', ''),
-        'customer_phone': addr.get('phone') or billing.get('phone', ''),
-        'customer_address': customer_address,
-        'customer_address_2': addr.get('address_2', ''),
-        'customer_inpost_id': custom_fields['customer_inpost_id'],
-        'customer_social': custom_fields['customer_social'],
+        'customer_name': view['customer_name'],
+        'customer_email': view['customer_email'],
+        'customer_phone': view['customer_phone'],
+        'customer_address': view['customer_address'],
+        'customer_address_2': view['customer_address_2'],
+        'customer_inpost_id': view['inpost_id'],
+        'customer_social': view['social'],
         'customer_note': (order['customer_note'] if 'customer_note' in keys else '') or '',
-        'shipping_method': shipping_method,
+        'shipping_method': view['shipping_method'],
         'tracking_number': tracking_number,
         'carrier_slug': carrier_slug,
         'carrier_name': carrier_name,
@@ -18786,114 +20195,166 @@ def process_shipped_order(order, conn, carriers, ast_provider_mapping):
         'undelivered_note': order['undelivered_note'] if 'undelivered_note' in keys else None,
         'undelivered_by_name': order['undelivered_by_name'] if 'undelivered_by_name' in keys else None,
         'is_problem_return': bool(order['is_problem_return']) if 'is_problem_return' in keys else False,
-        'products': [{'name': item.get('name', ''), 'quantity': item.get('quantity', 1), 'total': float(item.get('total', 0))} for item in (parse_json_field(order['line_items']) or [])],
+        'products': view['products'],
         'shipping_total': float(order['shipping_total'] or 0),
-        'product_count': sum(item.get('quantity', 1) for item in (parse_json_field(order['line_items']) or [])),
+        'product_count': view['product_count'],
         'latest_note': (order['latest_note'] if 'latest_note' in keys else '') or '',
         'latest_note_date': (order['latest_note_date'] if 'latest_note_date' in keys else '') or '',
         'latest_note_author': (order['latest_note_author'] if 'latest_note_author' in keys else '') or ''
     }
 
 
+EXPORT_ORDERS_BATCH = 1000
+EXPORT_ORDERS_COLUMNS = 'id, number, date_created, status, source, currency, total, shipping_total, billing, line_items'
+
+
+def _iter_export_order_batches(conn, source_sql, source_params):
+    """Yield orders newest-first in keyset pages of EXPORT_ORDERS_BATCH.
+
+    Seeks on (date_created, id) via idx_orders_created_id instead of OFFSET,
+    so every page costs the same. Undated orders come last, as they did
+    under ORDER BY date_created DESC.
+    """
+    last = None
+    while True:
+        if last is None:
+            where, args = 'date_created IS NOT NULL', []
+        else:
+            where = '(date_created < ? OR (date_created = ? AND id < ?))'
+            args = [last['date_created'], last['date_created'], last['id']]
+        rows = conn.execute(
+            f'SELECT {EXPORT_ORDERS_COLUMNS} FROM orders WHERE {where}{source_sql} '
+            f'ORDER BY date_created DESC, id DESC LIMIT ?',
+            args + source_params + [EXPORT_ORDERS_BATCH]
+        ).fetchall()
+        if not rows:
+            break
+        yield rows
+        last = rows[-1]
+
+    last_id = None
+    while True:
+        where, args = 'date_created IS NULL', []
+        if last_id is not None:
+            where += ' AND id < ?'
+            args.append(last_id)
+        rows = conn.execute(
+            f'SELECT {EXPORT_ORDERS_COLUMNS} FROM orders WHERE {where}{source_sql} '
+            f'ORDER BY id DESC LIMIT ?',
+            args + source_params + [EXPORT_ORDERS_BATCH]
+        ).fetchall()
+        if not rows:
+            break
+        yield rows
+        last_id = rows[-1]['id']
+
+
 @app.route('/api/export_orders')
 @login_required
 @admin_required
 def export_orders():
-    """Export all orders to CSV"""
+    """Export all orders to CSV.
+
+    Streamed: one keyset page is read, formatted and sent before the next is
+    fetched (JSON columns are decoded row by row inside the page), so memory
+    stays flat and the download starts right away even for a full year.
+    """
     import csv
     import io
-    from flask import make_response
+    from flask import Response, stream_with_context
 
-    conn = get_db_connection()
-    
     # Get user's allowed sources
     allowed_sources = get_user_allowed_sources(current_user.id, current_user.is_admin(), current_user.is_viewer())
-    
-    # Build query
-    query = 'SELECT o.*, s.manager FROM orders o LEFT JOIN sites s ON o.source = s.url'
-    conditions = []
-    params = []
-    
+
+    source_sql = ''
+    source_params = []
     if allowed_sources is not None:
         if allowed_sources:
             placeholders = ','.join(['?' for _ in allowed_sources])
-            conditions.append(f'o.source IN ({placeholders})')
-            params.extend(allowed_sources)
+            source_sql = f' AND source IN ({placeholders})'
+            source_params = list(allowed_sources)
         else:
-            conditions.append('1=0')
-            
-    if conditions:
-        query += ' WHERE ' + ' AND '.join(conditions)
-        
-    query += ' ORDER BY o.date_created DESC'
-    
-    orders = conn.execute(query, params).fetchall()
-    conn.close()
-    
-    # Prepare CSV
-    si = io.StringIO()
-    cw = csv.writer(si)
-    
-    # Write BOM for Excel support with UTF-8
-    si.write('\ufeff')
-    
-    # Header
-    cw.writerow(['订单号', '创建日期', '状态', '来源', '负责人', '客户姓名', '客户邮箱', '产品明细', '总数量', '运费', '订单金额', '净额', '汇率', '货币', '¥净额'])
-    
-    for order in orders:
-        # Calculate CNY amount
-        currency = order['currency']
-        total = float(order['total'] or 0)
-        shipping = float(order['shipping_total'] or 0)
-        net_total = total - shipping
-        
-        month = order['date_created'][:7] if order['date_created'] else None
-        rate, _ = get_cny_rate(currency, month)
-        net_total_cny = round(net_total * rate, 2) if rate else 0
-        
-        status_text = STATUS_LABELS.get(order['status'], order['status'])
-        source = order['source'].replace('https://www.', '').replace('https://', '')
-        
-        billing = parse_json_field(order['billing'])
-        customer_name = f"{billing.get('first_name', '')} {billing.get('last_name', '')}".strip()
-        
-        # Process product details
-        line_items = parse_json_field(order['line_items'])
-        product_details = []
-        total_quantity = 0
-        if isinstance(line_items, list):
-            for item in line_items:
-                qty = item.get('quantity', 0)
-                name = item.get('name', 'Unknown')
-                # Extract simplified name if possible or use full name ?? 
-                # For now use the name from line_item
-                product_details.append(f"{name} x{qty}")
-                total_quantity += qty
-        
-        products_str = " | ".join(product_details)
-        
-        cw.writerow([
-            f"#{order['number']}",
-            order['date_created'],
-            status_text,
-            source,
-            order['manager'] or '',
-            customer_name,
-            billing.get('email', ''),
-            products_str,
-            total_quantity,
-            f"{shipping:.2f}",
-            f"{total:.2f}",
-            f"{net_total:.2f}",
-            rate or '',
-            currency,
-            f"{net_total_cny:.2f}"
-        ])
-        
-    output = make_response(si.getvalue())
-    output.headers["Content-Disposition"] = f"attachment; filename=orders_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-    output.headers["Content-type"] = "text/csv"
-    return output
+            source_sql = ' AND 1=0'
+
+    def generate():
+        conn = get_db_connection()
+        try:
+            managers = {row['url']: row['manager'] for row in conn.execute('SELECT url, manager FROM sites')}
+            rates = {}  # (currency, month) → rate; get_cny_rate opens a connection per call
+
+            si = io.StringIO()
+            cw = csv.writer(si)
+
+            # Write BOM for Excel support with UTF-8
+            si.write('\ufeff')
+
+            # Header
+            cw.writerow(['订单号', '创建日期', '状态', '来源', '负责人', '客户姓名', '客户邮箱', '产品明细', '总数量', '运费', '订单金额', '净额', '汇率', '货币', '¥净额'])
+            yield si.getvalue()
+
+            for batch in _iter_export_order_batches(conn, source_sql, source_params):
+                si.seek(0)
+                si.truncate()
+                for order in batch:
+                    # Calculate CNY amount
+                    currency = order['currency']
+                    total = float(order['total'] or 0)
+                    shipping = float(order['shipping_total'] or 0)
+                    net_total = total - shipping
+
+                    month = order['date_created'][:7] if order['date_created'] else None
+                    key = (currency, month)
+                    if key not in rates:
+                        rates[key] = get_cny_rate(currency, month)[0]
+                    rate = rates[key]
+                    net_total_cny = round(net_total * rate, 2) if rate else 0
+
+                    status_text = STATUS_LABELS.get(order['status'], order['status'])
+                    source = order['source'].replace('https://www.', '').replace('https://', '')
+
+                    billing = parse_json_field(order['billing'])
+                    customer_name = f"{billing.get('first_name', '')} {billing.get('last_name', '')}".strip()
+
+                    # Process product details
+                    line_items = parse_json_field(order['line_items'])
+                    product_details = []
+                    total_quantity = 0
+                    if isinstance(line_items, list):
+                        for item in line_items:
+                            qty = item.get('quantity', 0)
+                            name = item.get('name', 'Unknown')
+                            product_details.append(f"{name} x{qty}")
+                            total_quantity += qty
+
+                    products_str = " | ".join(product_details)
+
+                    cw.writerow([
+                        f"#{order['number']}",
+                        order['date_created'],
+                        status_text,
+                        source,
+                        managers.get(order['source']) or '',
+                        customer_name,
+                        billing.get('email', ''),
+                        products_str,
+                        total_quantity,
+                        f"{shipping:.2f}",
+                        f"{total:.2f}",
+                        f"{net_total:.2f}",
+                        rate or '',
+                        currency,
+                        f"{net_total_cny:.2f}"
+                    ])
+                yield si.getvalue()
+        finally:
+            conn.close()
+
+    filename = f"orders_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
 
 
 
@@ -18915,10 +20376,12 @@ LA_API_CONFIG = {
 }
 
 
-def fetch_51la_traffic(mask_id, start_day, end_day):
+def fetch_51la_traffic(mask_id, start_day, end_day, strict=False):
     """
     Fetch traffic data from 51.la API
     Low security mode: sign = accessKey
+    strict=True returns None instead of [] when the call fails, so callers
+    can tell "no traffic" from "no answer".
     """
     import requests
     import time
@@ -18948,10 +20411,10 @@ def fetch_51la_traffic(mask_id, start_day, end_day):
             return result.get('data', [])
         else:
             app.logger.error(f"51.la API error: {result.get('message')}")
-            return []
+            return None if strict else []
     except Exception as e:
         app.logger.error(f"51.la API request failed: {e}")
-        return []
+        return None if strict else []
 
 
 def get_all_traffic_data(start_day, end_day):
@@ -18965,6 +20428,40 @@ def get_all_traffic_data(start_day, end_day):
     return all_traffic
 
 
+def sync_site_traffic(conn, mask_ids, start_day, end_day, force=False):
+    """Fetch the days site_traffic_daily is missing (or whose numbers may
+    still change) for each 51.la site and store them. Sites are fetched in
+    parallel; a site whose call fails keeps what it had and is retried on
+    the next load. force=True refetches the whole range."""
+    import concurrent.futures
+
+    last_day = min(end_day, datetime.now().strftime('%Y-%m-%d'))
+    jobs = []
+    for mask_id in dict.fromkeys(m for m in mask_ids if m):
+        if force:
+            rng = (start_day, last_day) if start_day <= last_day else None
+        else:
+            rng = site_traffic.stale_range(conn, mask_id, start_day, end_day)
+        if rng:
+            jobs.append((mask_id, rng[0], rng[1]))
+    if not jobs:
+        return 0
+
+    def fetch(job):
+        return job, fetch_51la_traffic(job[0], job[1], job[2], strict=True)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(jobs))) as ex:
+        results = list(ex.map(fetch, jobs))
+    stored = 0
+    for (mask_id, first, last), days in results:
+        if days is None:
+            continue
+        site_traffic.store_days(conn, mask_id, first, last, days)
+        stored += 1
+    conn.commit()
+    return stored
+
+
 def aggregate_traffic_by_month(traffic_data):
     """Aggregate daily traffic data by month"""
     from collections import defaultdict
@@ -19072,12 +20569,12 @@ def get_orders_for_report(start_date, end_date, granularity='month', source=None
     
     # Build time grouping expression based on granularity
     if granularity == 'day':
-        time_expr = "strftime('%Y-%m-%d', date_created)"
+        time_expr = "day"
     elif granularity == 'week':
         # ISO week format: YYYY-Www
         time_expr = "strftime('%Y-W%W', date_created)"
     else:  # month
-        time_expr = "strftime('%Y-%m', date_created)"
+        time_expr = "year_month"
     
     # success_net excludes undelivered (via _revenue_status_cond) AND deducts
     # the shipping_loss that those undelivered orders cost us — keeps the
@@ -19095,10 +20592,10 @@ def get_orders_for_report(start_date, end_date, granularity='month', source=None
             - SUM(CASE WHEN COALESCE(is_undelivered, 0) = 1
                 THEN COALESCE(shipping_loss_amount, 0) ELSE 0 END) as success_net
         FROM orders
-        WHERE date_created >= ? AND date_created <= ?
+        WHERE day >= ? AND day <= ?
           AND status NOT IN ('checkout-draft', 'trash')
     '''
-    params = [start_date, end_date + 'T23:59:59']
+    params = [start_date, end_date]
     
     if country:
         country_sites = conn.execute('SELECT url FROM sites WHERE country = ?', (country,)).fetchall()
@@ -19186,23 +20683,15 @@ def api_report_data():
         start_dt = datetime.now() - timedelta(days=180)
         start_date = start_dt.strftime('%Y-%m-%d')
     
-    # Cache Logic - include granularity and country in key
-    cache_key = f"traffic_{start_date}_{end_date}_{granularity}_{country}"
+    try:
+        datetime.strptime(start_date, '%Y-%m-%d')
+        datetime.strptime(end_date, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'success': False, 'error': '日期格式应为 YYYY-MM-DD'}), 400
+
     force_refresh = request.args.get('force', 'false') == 'true'
-    
-    # Try load from server cache first (if not forced)
     conn = get_db_connection()
-    if not force_refresh:
-        try:
-            cached_row = conn.execute('SELECT cache_value FROM report_cache WHERE cache_key = ?', (cache_key,)).fetchone()
-            if cached_row and cached_row['cache_value']:
-                print(f"DEBUG: Hit server cache for {cache_key}")
-                cached_data = json.loads(cached_row['cache_value'])
-                conn.close()
-                return jsonify(cached_data)
-        except Exception as e:
-            print(f"Cache read error: {e}")
-    
+
     all_traffic = {}
     # Use the new function with granularity support
     orders_data = get_orders_for_report(start_date, end_date, granularity, country=country)
@@ -19242,9 +20731,11 @@ def api_report_data():
         if norm_site not in site_mask_map:
             site_mask_map[norm_site] = mask_id
             
-    # Fetch traffic data for each site
+    # 只向 51.la 取库里还没有(或近几天可能变动)的日期，其余从 site_traffic_daily 本地聚合
+    sync_site_traffic(conn, site_mask_map.values(), start_date, end_date, force=force_refresh)
+    stored_traffic = site_traffic.load_days(conn, site_mask_map.values(), start_date, end_date)
     for site_name, mask_id in site_mask_map.items():
-        traffic = fetch_51la_traffic(mask_id, start_date, end_date)
+        traffic = stored_traffic.get(mask_id)
         if traffic:
             all_traffic[site_name] = traffic
 
@@ -19336,62 +20827,10 @@ def api_report_data():
         'granularity': granularity
     }
 
-    
-    # Save to server cache if we have traffic data (to avoid caching empty/failed API calls)
-    # Only cache if at least one site has traffic data
-    has_traffic = any('uv' in m for s in combined.values() for m in s.values())
-    if has_traffic:
-        try:
-            conn.execute('INSERT OR REPLACE INTO report_cache (cache_key, cache_value) VALUES (?, ?)', 
-                        (cache_key, json.dumps(final_result)))
-            conn.commit()
-            print(f"DEBUG: Updated server cache for {cache_key}")
-        except Exception as e:
-            print(f"Cache write error: {e}")
-            
     conn.close()
     return jsonify(final_result)
 
 
-@app.route('/api/report/cache/sync', methods=['POST'])
-@login_required
-def report_cache_sync():
-    """Sync client-side traffic data cache to server"""
-    # Only admin should start this (or anyone with report view permission)
-    if not current_user.can_view_report():
-         return jsonify({'success': False, 'error': '无权限'}), 403
-         
-    try:
-        data = request.json
-        if not data:
-             return jsonify({'success': False, 'error': '无数据'}), 400
-             
-        start_date = data.get('start_date')
-        end_date = data.get('end_date')
-        traffic_data = data.get('data') # Expecting the full result object structure
-        
-        if not start_date or not end_date or not traffic_data:
-            return jsonify({'success': False, 'error': '数据不完整'}), 400
-            
-        cache_key = f"traffic_{start_date}_{end_date}"
-        
-        # Verify structure roughly
-        if 'data' not in traffic_data or 'months' not in traffic_data:
-             return jsonify({'success': False, 'error': '数据格式错误'}), 400
-             
-        # Save to DB
-        conn = get_db_connection()
-        conn.execute('INSERT OR REPLACE INTO report_cache (cache_key, cache_value) VALUES (?, ?)', 
-                    (cache_key, json.dumps(traffic_data)))
-        conn.commit()
-        conn.close()
-        
-        return jsonify({'success': True, 'message': '缓存已同步到服务器'})
-        
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 500
-
-
 ## ==================== Sales Board (销售看板) ====================
 
 def sales_board_required(f):
@@ -19445,13 +20884,17 @@ def _get_board_cny_rate(currency, year_month, overrides=None):
     return (rate or 0), 'system'
 
 
-def _compute_sales_board_data(selected_month, restrict_manager=None):
+def _compute_sales_board_data(selected_month, restrict_manager=None, prev_net_by_manager=None):
     """Compute sales board data (shared by view and export).
 
     restrict_manager: when set (self-only view), the board is limited to just
     that one manager's sites — no other people's rows/salary are computed, so a
     self-view user never receives anyone else's data.
 
+    prev_net_by_manager: optional {manager: previous month net CNY} (the
+    previous month board's month_net_cny). When given, the previous-month
+    order passes are skipped and growth is computed against these values.
+
     Returns a dict with all the data needed to render the sales board.
     """
     import datetime
@@ -19561,62 +21004,109 @@ def _compute_sales_board_data(selected_month, restrict_manager=None):
     # Determine which week number in the month (1-based)
     current_week_num = (today.day - 1) // 7 + 1
 
+    # One grouped pass over orders per period for ALL board sites, bucketed
+    # per manager through the site->manager map. Previously every manager ran
+    # five queries of their own (15 managers = 75 scans per render).
+    site_managers = defaultdict(list)
+    for m, urls in manager_sites.items():
+        for url in urls:
+            site_managers[url].append(m)
+
+    def _rows_by_manager(columns, condition, cond_params):
+        buckets = defaultdict(list)
+        if not site_managers:
+            return buckets
+        all_urls = list(site_managers)
+        placeholders = ', '.join(['?' for _ in all_urls])
+        rows = conn.execute(f'''
+            SELECT source, {columns}
+            FROM orders
+            WHERE source IN ({placeholders})
+            AND {condition}
+        ''', all_urls + list(cond_params)).fetchall()
+        for r in rows:
+            for m in site_managers[r['source']]:
+                buckets[m].append(r)
+        return buckets
+
+    revenue_cond = _revenue_status_cond()
+    loss_cond = '(is_undelivered = 1 OR is_problem_return = 1)'
+    # Current month successful orders
+    month_orders_by_mgr = _rows_by_manager(
+        'id, total, shipping_total, currency, line_items, date_created, warehouse_id',
+        f'year_month = ? AND {revenue_cond}', [selected_month])
+    # Previous month successful orders (for growth)
+    if prev_net_by_manager is None:
+        prev_orders_by_mgr = _rows_by_manager(
+            'total, shipping_total, currency',
+            f'year_month = ? AND {revenue_cond}', [prev_month])
+    else:
+        prev_orders_by_mgr = {}
+    # Current week orders
+    week_orders_by_mgr = _rows_by_manager(
+        'id, total, shipping_total, currency, line_items',
+        f'day >= ? AND day <= ? AND {revenue_cond}', [week_start.isoformat(), week_end.isoformat()])
+    # Undelivered + 问题退货 orders (shipping/product loss visibility — separate
+    # from revenue). Both flows live on shared shipping_loss_amount column;
+    # product_loss_amount is problem-return only. Previous month is needed so
+    # the 上月销售 card uses the same net definition as the current month (and
+    # as /monthly / dashboard).
+    undelivered_by_mgr = _rows_by_manager(
+        'shipping_loss_amount, product_loss_amount, currency, is_undelivered, is_problem_return',
+        f'year_month = ? AND {loss_cond}', [selected_month])
+    if prev_net_by_manager is None:
+        prev_undelivered_by_mgr = _rows_by_manager(
+            'shipping_loss_amount, product_loss_amount, currency, is_undelivered, is_problem_return',
+            f'year_month = ? AND {loss_cond}', [prev_month])
+    else:
+        prev_undelivered_by_mgr = {}
+
+    # line_items are decoded once per order (the current week overlaps the
+    # month) and product-name resolution once per distinct name, instead of
+    # per line item per manager.
+    _items_cache = {}
+    def _order_items(order):
+        oid = order['id']
+        if oid not in _items_cache:
+            items = parse_json_field(order['line_items'])
+            _items_cache[oid] = items if isinstance(items, list) else []
+        return _items_cache[oid]
+
+    _excluded_brand_cache = {}
+    def _excluded_brand_for(product_name_raw):
+        if product_name_raw not in _excluded_brand_cache:
+            product_name = product_name_raw.upper()
+            excluded_brand = None
+            for nc_brand in no_commission_brands:
+                if nc_brand in product_name:
+                    excluded_brand = nc_brand
+                    break
+            # Also check against brands_cache for better matching
+            if not excluded_brand:
+                parsed = parse_product_name(product_name_raw, brands_cache)
+                if parsed.get('brand') and parsed['brand'].upper() in no_commission_brands:
+                    excluded_brand = parsed['brand'].upper()
+            _excluded_brand_cache[product_name_raw] = excluded_brand
+        return _excluded_brand_cache[product_name_raw]
+
+    _brand_resolution_cache = {}
+    def _resolve_brand(product_name_raw, source):
+        key = (product_name_raw, source)
+        if key not in _brand_resolution_cache:
+            _brand_resolution_cache[key] = _resolve_product_to_brand(
+                product_name_raw, source, brands_cache, product_mappings_cache
+            )
+        return _brand_resolution_cache[key]
+
     # Build manager performance data
     board_data = []
     for manager in managers:
         site_urls = manager_sites[manager]
-        placeholders = ', '.join(['?' for _ in site_urls])
-
-        # Current month successful orders
-        month_orders = conn.execute(f'''
-            SELECT id, total, shipping_total, currency, line_items, source, date_created, warehouse_id
-            FROM orders
-            WHERE source IN ({placeholders})
-            AND strftime('%Y-%m', date_created) = ?
-            AND {_revenue_status_cond()}
-        ''', site_urls + [selected_month]).fetchall()
-
-        # Previous month successful orders (for growth)
-        prev_orders = conn.execute(f'''
-            SELECT total, shipping_total, currency, line_items
-            FROM orders
-            WHERE source IN ({placeholders})
-            AND strftime('%Y-%m', date_created) = ?
-            AND {_revenue_status_cond()}
-        ''', site_urls + [prev_month]).fetchall()
-
-        # Current week orders
-        week_orders = conn.execute(f'''
-            SELECT total, shipping_total, currency, line_items, source
-            FROM orders
-            WHERE source IN ({placeholders})
-            AND date(date_created) >= ? AND date(date_created) <= ?
-            AND {_revenue_status_cond()}
-        ''', site_urls + [week_start.isoformat(), week_end.isoformat()]).fetchall()
-
-        # Undelivered + 问题退货 orders for this manager (shipping/product loss
-        # visibility — separate from revenue). Both flows live on shared
-        # shipping_loss_amount column; product_loss_amount is problem-return only.
-        undelivered_rows = conn.execute(f'''
-            SELECT shipping_loss_amount, product_loss_amount, currency, source,
-                   is_undelivered, is_problem_return
-            FROM orders
-            WHERE source IN ({placeholders})
-            AND strftime('%Y-%m', date_created) = ?
-            AND (is_undelivered = 1 OR is_problem_return = 1)
-        ''', site_urls + [selected_month]).fetchall()
-
-        # Previous-month shipping + product loss — needed so the 上月销售 card on
-        # the board uses the same net definition as the current month (and as
-        # /monthly / dashboard).
-        prev_undelivered_rows = conn.execute(f'''
-            SELECT shipping_loss_amount, product_loss_amount, currency,
-                   is_undelivered, is_problem_return
-            FROM orders
-            WHERE source IN ({placeholders})
-            AND strftime('%Y-%m', date_created) = ?
-            AND (is_undelivered = 1 OR is_problem_return = 1)
-        ''', site_urls + [prev_month]).fetchall()
+        month_orders = month_orders_by_mgr.get(manager, [])
+        prev_orders = prev_orders_by_mgr.get(manager, [])
+        week_orders = week_orders_by_mgr.get(manager, [])
+        undelivered_rows = undelivered_by_mgr.get(manager, [])
+        prev_undelivered_rows = prev_undelivered_by_mgr.get(manager, [])
 
         # Calculate month amounts by currency and total products
         month_currency_amounts = defaultdict(lambda: {'net_amount': 0, 'amount': 0, 'shipping': 0})
@@ -19660,25 +21150,15 @@ def _compute_sales_board_data(selected_month, restrict_manager=None):
             order_wh_id = order['warehouse_id'] if profit_mode == 'actual' else None
 
             # Products count
-            items = parse_json_field(order['line_items'])
-            if isinstance(items, list):
+            items = _order_items(order)
+            if items:
                 for item in items:
                     qty = item.get('quantity', 0) or 0
                     month_total_products += qty
 
                     # Check if product brand is excluded from commission
                     product_name_raw = item.get('name', '') or ''
-                    product_name = product_name_raw.upper()
-                    excluded_brand = None
-                    for nc_brand in no_commission_brands:
-                        if nc_brand in product_name:
-                            excluded_brand = nc_brand
-                            break
-                    # Also check against brands_cache for better matching
-                    if not excluded_brand:
-                        parsed = parse_product_name(product_name_raw, brands_cache)
-                        if parsed.get('brand') and parsed['brand'].upper() in no_commission_brands:
-                            excluded_brand = parsed['brand'].upper()
+                    excluded_brand = _excluded_brand_for(product_name_raw)
 
                     item_total = float(item.get('total', 0) or 0)
                     if excluded_brand:
@@ -19699,9 +21179,7 @@ def _compute_sales_board_data(selected_month, restrict_manager=None):
                         source = order['source']
                         order_date = (order['date_created'] or '')[:10]  # YYYY-MM-DD
                         wh_id = order_wh_id
-                        b_id, s_id, p_cnt, flav = _resolve_product_to_brand(
-                            product_name_raw, source, brands_cache, product_mappings_cache
-                        )
+                        b_id, s_id, p_cnt, flav = _resolve_brand(product_name_raw, source)
                         # Find cost entry matching this warehouse (priority fallback).
                         # If the order has no warehouse_id, fall back to country
                         # defaults rather than declaring the product unmapped.
@@ -19758,6 +21236,8 @@ def _compute_sales_board_data(selected_month, restrict_manager=None):
             r = _prev_rate(cur)
             if r:
                 prev_net_cny -= (amt + p_amt) * r
+        if prev_net_by_manager is not None:
+            prev_net_cny = prev_net_by_manager.get(manager, 0)
 
         # Current week amounts by currency
         week_currency_amounts = defaultdict(lambda: {'net_amount': 0})
@@ -19769,9 +21249,7 @@ def _compute_sales_board_data(selected_month, restrict_manager=None):
             shipping = float(order['shipping_total'] or 0)
             net = total - shipping
             week_currency_amounts[currency]['net_amount'] += net
-            items = parse_json_field(order['line_items'])
-            if isinstance(items, list):
-                week_total_products += sum(i.get('quantity', 0) for i in items)
+            week_total_products += sum(i.get('quantity', 0) for i in _order_items(order))
             rate = _rate_for(currency)
             if rate:
                 week_net_cny += net * rate
@@ -20073,6 +21551,93 @@ def _compute_sales_board_data(selected_month, restrict_manager=None):
     }
 
 
+# Bump when _compute_sales_board_data's logic or output shape changes so
+# snapshots written by older code are recomputed instead of served.
+SALES_BOARD_SNAPSHOT_FORMAT = 1
+# Settings tables every month's board reads (data_versions scopes).
+_SALES_BOARD_GLOBAL_SCOPES = ('exchange_rates', 'product_costs', 'product_mappings', 'brands',
+                              'no_commission_brands', 'sales_groups', 'sites', 'warehouses')
+
+
+def _sales_board_snapshot_version(conn, selected_month, prev_month):
+    """Version string a board snapshot is valid for: the data_versions counters
+    of the month's (and previous month's) orders and board settings plus the
+    global settings tables. Any write to an input changes it."""
+    scopes = [order_index.orders_scope(selected_month), order_index.orders_scope(prev_month),
+              f'sales_board:{selected_month}', f'sales_board:{prev_month}']
+    scopes += list(_SALES_BOARD_GLOBAL_SCOPES)
+    versions = order_index.get_versions(conn, scopes)
+    return f'v{SALES_BOARD_SNAPSHOT_FORMAT}:' + '.'.join(str(versions[sc]) for sc in scopes)
+
+
+def _get_sales_board_data(selected_month, restrict_manager=None):
+    """_compute_sales_board_data, served from sales_board_snapshots for closed months.
+
+    A month before the current one is effectively frozen — its board only
+    changes when targets, profit settings, rate overrides, costs, mappings or
+    one of its orders are written, and every such write bumps a data_versions
+    counter. The payload is stored with the version string it was computed
+    under and reused while the string still matches. The current month is
+    always computed live, with its growth base read from the previous month's
+    snapshot; later months and anything that doesn't look like YYYY-MM are
+    computed live on their own.
+
+    Current-week fields inside a snapshot are frozen at build time; the page
+    and the export only show them for the current month.
+    """
+    import datetime
+
+    if not re.fullmatch(r'\d{4}-\d{2}', selected_month or ''):
+        return _compute_sales_board_data(selected_month, restrict_manager=restrict_manager)
+
+    sel_year, sel_mon = int(selected_month[:4]), int(selected_month[5:])
+    prev_month = f"{sel_year - 1}-12" if sel_mon == 1 else f"{sel_year}-{sel_mon - 1:02d}"
+
+    current_month = datetime.date.today().strftime('%Y-%m')
+    if selected_month > current_month:
+        # Future month (?month= typed by hand): computed live, growth base
+        # included. Never walk back through the months in between.
+        return _compute_sales_board_data(selected_month, restrict_manager=restrict_manager)
+    if selected_month == current_month:
+        # Live month: the 上月销售 / growth base is exactly the previous
+        # month board's net, so take it from that (closed, snapshotted)
+        # month instead of re-scanning last month's orders on every render.
+        prev_board = _get_sales_board_data(prev_month, restrict_manager=restrict_manager)
+        prev_net = {d['manager']: d['month_net_cny'] for d in prev_board['board_data']}
+        return _compute_sales_board_data(selected_month, restrict_manager=restrict_manager,
+                                         prev_net_by_manager=prev_net)
+    snapshot_key = (selected_month, restrict_manager or '')
+
+    conn = get_db_connection()
+    try:
+        # Read the version BEFORE computing: a write landing mid-computation
+        # leaves the stored version behind, so the next request recomputes.
+        version = _sales_board_snapshot_version(conn, selected_month, prev_month)
+        row = conn.execute(
+            'SELECT settings_version, payload FROM sales_board_snapshots WHERE year_month = ? AND restrict_manager = ?',
+            snapshot_key
+        ).fetchone()
+        if row and row['settings_version'] == version:
+            try:
+                return json.loads(row['payload'])
+            except ValueError:
+                pass  # corrupt row — recompute and overwrite
+
+        data = _compute_sales_board_data(selected_month, restrict_manager=restrict_manager)
+        conn.execute('''
+            INSERT INTO sales_board_snapshots (year_month, restrict_manager, settings_version, payload, created_at)
+            VALUES (?, ?, ?, ?, datetime('now'))
+            ON CONFLICT(year_month, restrict_manager) DO UPDATE SET
+                settings_version = excluded.settings_version,
+                payload = excluded.payload,
+                created_at = excluded.created_at
+        ''', snapshot_key + (version, json.dumps(data, ensure_ascii=False)))
+        conn.commit()
+        return data
+    finally:
+        conn.close()
+
+
 @app.route('/sales-board')
 @login_required
 @sales_board_required
@@ -20095,7 +21660,7 @@ def sales_board():
     # the full team (never fall back to None here, that would show everyone).
     restrict_manager = (own_manager or '\x00__no_sites__') if self_view else None
 
-    data = _compute_sales_board_data(selected_month, restrict_manager=restrict_manager)
+    data = _get_sales_board_data(selected_month, restrict_manager=restrict_manager)
     data['self_view'] = self_view
     data['own_manager'] = own_manager or ''
     return render_template('sales_board.html', **data)
@@ -20146,6 +21711,7 @@ def save_sales_target():
                 notes = excluded.notes,
                 updated_at = datetime('now')
         ''', (year_month, manager, monthly_target, json.dumps(weekly_targets), base_salary, commission_rate, notes))
+        order_index.bump_versions(conn, [f'sales_board:{year_month}'])
         conn.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -20187,6 +21753,8 @@ def batch_save_sales_targets():
                   t.get('base_salary', 7000),
                   t.get('commission_rate', 0.05),
                   t.get('notes', '')))
+        order_index.bump_versions(conn, {f"sales_board:{(t.get('year_month') or '').strip()}"
+                                     for t in targets if (t.get('year_month') or '').strip()})
         conn.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -20220,6 +21788,7 @@ def update_no_commission_brands():
             brand = brand.strip()
             if brand:
                 conn.execute('INSERT INTO no_commission_brands (brand_name) VALUES (?)', (brand,))
+        order_index.bump_versions(conn, ['no_commission_brands'])
         conn.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -20287,6 +21856,7 @@ def save_sales_group():
             if m:
                 conn.execute('INSERT INTO sales_group_members (group_id, manager) VALUES (?, ?)', (group_id, m))
 
+        order_index.bump_versions(conn, ['sales_groups'])
         conn.commit()
         return jsonify({'success': True, 'id': group_id})
     except Exception as e:
@@ -20304,6 +21874,7 @@ def delete_sales_group(group_id):
     try:
         conn.execute('DELETE FROM sales_group_members WHERE group_id = ?', (group_id,))
         conn.execute('DELETE FROM sales_groups WHERE id = ?', (group_id,))
+        order_index.bump_versions(conn, ['sales_groups'])
         conn.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -20316,6 +21887,7 @@ def delete_sales_group(group_id):
 @app.route('/api/sales-board/exchange-rates', methods=['GET'])
 @login_required
 @admin_required
+@conditional_json
 def get_sales_board_exchange_rates():
     """List custom rates + applicable system rates for a given month.
 
@@ -20336,7 +21908,7 @@ def get_sales_board_exchange_rates():
             FROM orders o
             INNER JOIN sites s ON o.source = s.url
             WHERE s.manager IS NOT NULL AND s.manager != ''
-              AND strftime('%Y-%m', o.date_created) = ?
+              AND o.year_month = ?
               AND o.currency IS NOT NULL AND o.currency != ''
         ''', (month,)).fetchall()
         currencies = sorted({(r['currency'] or '').upper() for r in rows if r['currency']})
@@ -20404,6 +21976,7 @@ def save_sales_board_exchange_rates():
                         updated_at = CURRENT_TIMESTAMP,
                         updated_by = excluded.updated_by
                 ''', (month, cur, rate, getattr(current_user, 'username', '') or ''))
+        order_index.bump_versions(conn, [f'sales_board:{month}'])
         conn.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -21056,46 +22629,53 @@ def _generate_sales_board_excel(data, hide_leader=False):
 @login_required
 @super_admin_required
 def export_sales_board():
-    """Generate an Excel export for the sales board and save to history."""
-    import datetime, os
+    """Queue an Excel export of the sales board; the file lands in the export history."""
+    import datetime
     payload = request.get_json(silent=True) or {}
     month = payload.get('month') or datetime.date.today().strftime('%Y-%m')
     hide_leader = bool(payload.get('hide_leader', False))
+    params = {
+        'month': month,
+        'hide_leader': hide_leader,
+        'created_by': getattr(current_user, 'username', '') or '',
+    }
+    suffix = '（演示版）' if hide_leader else ''
+    job_id = _submit_export_job('sales_board', f'销售看板 {month}{suffix}', params, _build_sales_board_export)
+    return jsonify({'success': True, 'job_id': job_id})
 
-    try:
-        data = _compute_sales_board_data(month)
-        bio = _generate_sales_board_excel(data, hide_leader=hide_leader)
 
-        ts = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-        suffix = '_演示版' if hide_leader else ''
-        filename = f"销售看板_{month}{suffix}_{ts}.xlsx"
-        file_path = os.path.join(_get_sales_board_exports_dir(), filename)
-        with open(file_path, 'wb') as f:
-            f.write(bio.getvalue())
-        file_size = os.path.getsize(file_path)
+def _build_sales_board_export(job_id, options):
+    """Build the sales board workbook and save it to sales_board_exports history.
 
-        conn = get_db_connection()
-        cur = conn.execute(
+    _generate_sales_board_excel keeps a regular (random-access) workbook: the
+    board is a few dozen rows and the layout autofits / merges after writing.
+    """
+    import datetime, os
+    month = options['month']
+    hide_leader = options['hide_leader']
+    data = _get_sales_board_data(month)
+    bio = _generate_sales_board_excel(data, hide_leader=hide_leader)
+
+    ts = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    suffix = '_演示版' if hide_leader else ''
+    filename = f"销售看板_{month}{suffix}_{ts}.xlsx"
+    file_path = os.path.join(_get_sales_board_exports_dir(), filename)
+    with open(file_path, 'wb') as f:
+        f.write(bio.getvalue())
+    file_size = os.path.getsize(file_path)
+
+    conn = get_db_connection()
+    try:
+        conn.execute(
             '''INSERT INTO sales_board_exports
                (year_month, filename, file_path, file_size, hide_leader, created_by)
                VALUES (?, ?, ?, ?, ?, ?)''',
-            (month, filename, file_path, file_size, 1 if hide_leader else 0,
-             getattr(current_user, 'username', '') or '')
+            (month, filename, file_path, file_size, 1 if hide_leader else 0, options['created_by'])
         )
         conn.commit()
-        export_id = cur.lastrowid
+    finally:
         conn.close()
-
-        return jsonify({
-            'success': True,
-            'id': export_id,
-            'filename': filename,
-            'file_size': file_size,
-        })
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({'success': False, 'error': str(e)}), 500
+    return filename, file_path
 
 
 @app.route('/api/sales-board/exports', methods=['GET'])
@@ -21395,6 +22975,7 @@ def create_product_cost():
             return jsonify({
                 'error': '该产品在此生效日期已有成本记录，如需修改请编辑现有记录，或选择不同的生效日期来新增一个版本。'
             }), 409
+        order_index.bump_versions(conn, ['product_costs'])
         conn.commit()
         return jsonify({'success': True, 'id': conn.execute('SELECT last_insert_rowid()').fetchone()[0]})
     except Exception as e:
@@ -21441,6 +23022,7 @@ def update_product_cost(cost_id):
             data.get('cost_currency', 'PLN'), data.get('effective_date', '2024-01-01'),
             data.get('notes', ''), cost_id
         ))
+        order_index.bump_versions(conn, ['product_costs'])
         conn.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -21463,6 +23045,7 @@ def delete_product_cost(cost_id):
             return jsonify({'error': '无权删除此仓库的成本',
                             'permission': 'warehouse_scope'}), 403
         conn.execute('DELETE FROM product_costs WHERE id = ?', (cost_id,))
+        order_index.bump_versions(conn, ['product_costs'])
         conn.commit()
         return jsonify({'success': True})
     finally:
@@ -21492,7 +23075,7 @@ def get_unmapped_products():
         orders = conn.execute(f'''
             SELECT line_items, source FROM orders
             WHERE source IN ({placeholders})
-            AND strftime('%Y-%m', date_created) = ?
+            AND year_month = ?
             AND {_revenue_status_cond()}
         ''', country_urls + [year_month]).fetchall()
 
@@ -21668,6 +23251,7 @@ def _find_cost_price(brand_id, series_id, puff_count, flavor, cost_lookup):
 
 @app.route('/api/sales-board/profit-settings', methods=['GET'])
 @login_required
+@conditional_json
 def get_profit_settings():
     """Get profit settings for a given month"""
     import datetime
@@ -21720,6 +23304,7 @@ def save_profit_settings():
                 country_percentages = excluded.country_percentages,
                 updated_at = CURRENT_TIMESTAMP
         ''', (year_month, profit_mode, profit_percentage, country_percentages_json))
+        order_index.bump_versions(conn, [f'sales_board:{year_month}'])
         conn.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -21755,6 +23340,7 @@ def create_warehouse():
     try:
         conn.execute('INSERT INTO warehouses (name, code, country, default_currency, notes) VALUES (?, ?, ?, ?, ?)',
                      (name, code, country, default_currency, notes))
+        order_index.bump_versions(conn, ['warehouses'])
         conn.commit()
         return jsonify({'success': True, 'id': conn.execute('SELECT last_insert_rowid()').fetchone()[0]})
     except Exception as e:
@@ -21777,6 +23363,7 @@ def update_warehouse(wid):
                      (data.get('name'), data.get('code'), data.get('country'),
                       data.get('default_currency', 'PLN'), data.get('notes', ''),
                       1 if data.get('is_active', True) else 0, wid))
+        order_index.bump_versions(conn, ['warehouses'])
         conn.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -21796,6 +23383,7 @@ def delete_warehouse(wid):
         if cost_count > 0 or order_count > 0:
             return jsonify({'error': f'无法删除：有 {cost_count} 条成本记录和 {order_count} 个订单关联此仓库'}), 400
         conn.execute('DELETE FROM warehouses WHERE id=?', (wid,))
+        order_index.bump_versions(conn, ['warehouses'])
         conn.commit()
         return jsonify({'success': True})
     finally:
@@ -21804,6 +23392,7 @@ def delete_warehouse(wid):
 
 @app.route('/api/sales-board/unmapped', methods=['GET'])
 @login_required
+@conditional_json
 def get_sales_board_unmapped():
     """Return unmapped products for the sales board (actual cost mode)."""
     import datetime as _dt
@@ -21870,7 +23459,7 @@ def get_sales_board_unmapped():
         orders = conn.execute(f'''
             SELECT id, line_items, source, currency, total, shipping_total, warehouse_id
             FROM orders
-            WHERE strftime('%Y-%m', date_created) = ?
+            WHERE year_month = ?
             AND {_revenue_status_cond()}
         ''', (year_month,)).fetchall()
 
@@ -22029,6 +23618,7 @@ def set_order_warehouse(order_id):
             if site_country and wh['country'] and wh['country'] != site_country:
                 return jsonify({'error': f'订单来自 {site_country} 站点，不能指派到 {wh["country"]} 仓库「{wh["name"]}」。请选择 {site_country} 的仓库。'}), 400
         conn.execute('UPDATE orders SET warehouse_id=? WHERE id=?', (warehouse_id, order_id))
+        order_index.bump_order_months(conn, [order_id])
         conn.commit()
         return jsonify({'success': True})
     finally:
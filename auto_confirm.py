@@ -6,27 +6,30 @@ in the 待确认结局 queue whose carrier_status is 'delivered' (🟢物流已
 automatically confirmed — the unattended equivalent of a human clicking 已签收
 (or the "批量确认所有「物流已签收」" button). For each such order it:
   1. sets the local delivery_confirmed flag (so it leaves the queue), and
-  2. pushes WooCommerce status -> 'completed' (this fires WC's 'completed'
-     customer email, same as a manual 已签收), adding an order note.
+  2. queues WooCommerce status -> 'completed' in the write-back outbox
+     (wc_outbox.py; this fires WC's 'completed' customer email, same as a
+     manual 已签收), adding an order note.
 
 ONLY carrier-confirmed deliveries are touched. returned / in_transit / unknown /
 problem-return / undelivered / already-confirmed orders are NEVER auto-confirmed.
 Default OFF — nothing happens until the operator turns the switch on.
 
-Ordering vs the manual confirm: a manual confirm sets the local flag FIRST
-(best-effort WC after), because a human is present to reconcile. Here, unattended,
-we push WC FIRST and only set the local flag on success — so a WC failure leaves
-the order UNCONFIRMED and it is retried next run, instead of silently drifting
-out of the queue while the store still shows on-hold. WC PUT completed is
-idempotent, so a retry after a lost-response is harmless.
+Like the manual confirm, the local flag and status are set at once and the
+WooCommerce push follows from the outbox, which the cron drains right after
+this pass. A push that keeps failing does not drift silently: the outbox
+retries it with backoff and lists it under 站点写回队列 in settings once it
+gives up. WC PUT completed is idempotent, so a retry after a lost response is
+harmless.
 
 Import-safe for the hourly cron (auto_sync.py): does NOT import the Flask app —
 it only needs a DB connection (sqlite3.Row factory) handed in.
 """
-import requests
 from datetime import datetime
 
-from oid_utils import woo_post_id  # raw WC post id for REST write-back
+import order_index  # data_versions bump on local status change
+import customer_stats  # the confirm changes the customer's success counts / spend
+import wc_outbox  # queued WooCommerce write-back (status -> completed)
+import latest_note  # orders.latest_note_id pointer for the new note
 
 ENABLE_KEY = 'auto_confirm_delivered_enabled'
 # Forward-only "effective start" timestamp, stamped (via SQL datetime('now'), so
@@ -45,12 +48,6 @@ SINCE_KEY = 'auto_confirm_delivered_since'
 # get confirmed, so it always converges).
 MAX_PER_RUN = 300
 
-_API_HEADERS = {
-    "User-Agent": "WooCommerce API Client-Python/3.0.0",
-    "Content-Type": "application/json",
-    "Accept": "application/json",
-}
-
 _NOTE = "系统自动确认「已签收」（物流已签收 / carrier delivered）。"
 
 
@@ -124,27 +121,6 @@ def _load_sites(conn):
     return {r['url']: r for r in conn.execute("SELECT * FROM sites").fetchall()}
 
 
-def _complete_remote(site, oid):
-    """PUT status=completed on WooCommerce. Returns (ok: bool, detail: str).
-    Mirrors app.confirm_order_delivery's WC push (fires the completed email)."""
-    wid = woo_post_id(oid)
-    url = f"{site['url']}/wp-json/wc/v3/orders/{wid}"
-    try:
-        resp = requests.put(
-            url, json={'status': 'completed'},
-            auth=(site['consumer_key'], site['consumer_secret']),
-            timeout=60, headers=_API_HEADERS,
-        )
-    except Exception as e:
-        return False, f"请求异常: {e}"
-    text = resp.text or ''
-    if text.strip().startswith('<!') or text.strip().startswith('<html'):
-        return False, "WP返回HTML(可能WAF/认证问题)"
-    if resp.status_code not in (200, 201):
-        return False, f"API {resp.status_code}: {text[:160]}"
-    return True, "ok"
-
-
 def _confirm_local(conn, oid, now):
     """Local confirm: set the queue-clearing flag + an attributable note.
     delivery_confirmed_by stays NULL (no human); the note carries attribution."""
@@ -154,15 +130,16 @@ def _confirm_local(conn, oid, now):
     conn.execute(
         "INSERT INTO order_notes (order_id, note, date_created, customer_note, author, added_by_user) "
         "VALUES (?, ?, ?, 0, ?, 1)", (oid, _NOTE, now, '系统自动确认'))
+    latest_note.refresh_orders(conn, [oid])
+    order_index.bump_order_months(conn, [oid])
 
 
 def enforce(conn, progress=None, dry_run=False, actor='auto'):
     """Confirm every carrier-delivered COD order in the queue. Returns a summary.
 
     Idempotent: a confirmed order (delivery_confirmed=1) drops out of the
-    candidate set, so this is safe to run every hour. A WC push failure leaves
-    the order untouched (no local flag set) and is retried next run, so local
-    and remote never drift apart.
+    candidate set, so this is safe to run every hour. The WC push is queued
+    (wc_outbox); summary['queued'] counts the pushes queued by this run.
     """
     def _log(m):
         if progress:
@@ -180,11 +157,11 @@ def enforce(conn, progress=None, dry_run=False, actor='auto'):
                 (SINCE_KEY,))
             conn.commit()
         _log("[auto-confirm] 无生效起点，已设为 now，本次不追溯历史单")
-        return {'checked': 0, 'confirmed': 0, 'synced': 0, 'local_only': 0,
+        return {'checked': 0, 'confirmed': 0, 'queued': 0, 'local_only': 0,
                 'errors': 0, 'capped': 0, 'dry_run': dry_run, 'no_since': True}
 
     candidates = find_confirmable_orders(conn, since)
-    summary = {'checked': len(candidates), 'confirmed': 0, 'synced': 0,
+    summary = {'checked': len(candidates), 'confirmed': 0, 'queued': 0,
                'local_only': 0, 'errors': 0, 'capped': 0, 'dry_run': dry_run, 'since': since}
     if not candidates:
         return summary
@@ -195,6 +172,8 @@ def enforce(conn, progress=None, dry_run=False, actor='auto'):
         _log(f"[auto-confirm] 候选 {summary['checked']} 单 > 单次上限 {MAX_PER_RUN}，"
              f"本次处理 {MAX_PER_RUN} 单，剩余 {summary['capped']} 单下次继续。")
 
+    wc_outbox.ensure_schema(conn)
+    latest_note.ensure_schema(conn)
     sites = _load_sites(conn)
     now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
@@ -221,15 +200,13 @@ def enforce(conn, progress=None, dry_run=False, actor='auto'):
                 _log(f"[auto-confirm] #{num} 无写权限，仅本地标记签收")
             continue
 
-        ok, detail = _complete_remote(site, oid)
-        if ok:
-            conn.execute("UPDATE orders SET status='completed' WHERE id=?", (oid,))
-            _confirm_local(conn, oid, now)
-            conn.commit()
-            summary['confirmed'] += 1
-            summary['synced'] += 1
-        else:
-            summary['errors'] += 1
-            _log(f"[auto-confirm] 失败 #{num} @ {o['source']}: {detail}（保持未确认，下次重试）")
+        wc_outbox.enqueue(conn, site['url'], 'order_update', {'data': {'status': 'completed'}},
+                          order_id=oid, local_status='completed', actor=actor)
+        conn.execute("UPDATE orders SET status='completed' WHERE id=?", (oid,))
+        customer_stats.mark_orders(conn, [oid])
+        _confirm_local(conn, oid, now)
+        conn.commit()
+        summary['confirmed'] += 1
+        summary['queued'] += 1
 
     return summary
@@ -16,6 +16,7 @@ import os
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 import sync_utils
+import order_index  # 'sites' data version: last_sync is shown on cached pages
 
 DB_FILE = 'woocommerce_orders.db'
 MAX_WORKERS = 4
@@ -74,6 +75,7 @@ def sync_one_site(site):
             conn = get_db_connection()
             conn.execute('UPDATE sites SET last_sync = ? WHERE id = ?',
                         (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), site_id))
+            order_index.bump_versions(conn, ['sites'])
             conn.commit()
             conn.close()
             
@@ -156,7 +158,7 @@ def main():
             if auto_confirm.is_enabled(conn):
                 ac = auto_confirm.enforce(conn, progress=safe_print, actor='auto-sync')
                 safe_print(f"[auto-confirm] checked={ac['checked']} confirmed={ac['confirmed']} "
-                           f"(synced={ac['synced']} local_only={ac['local_only']}) "
+                           f"(queued={ac['queued']} local_only={ac['local_only']}) "
                            f"errors={ac['errors']} deferred={ac['capped']}")
             else:
                 safe_print("[auto-confirm] disabled — skipped")
@@ -165,5 +167,20 @@ def main():
     except Exception as e:
         safe_print(f"[auto-confirm] enforcement failed: {e}")
 
+    # Push the queued WooCommerce write-backs: the cancels / confirms queued
+    # above, plus anything the web app has not delivered yet (retries whose
+    # backoff ran out while no web worker was up).
+    try:
+        import wc_outbox
+        conn = get_db_connection()
+        try:
+            wc_outbox.ensure_schema(conn)
+        finally:
+            conn.close()
+        ob = wc_outbox.drain(get_db_connection, progress=safe_print)
+        safe_print(f"[wc-outbox] done={ob['done']} retry={ob['retry']} dead={ob['dead']}")
+    except Exception as e:
+        safe_print(f"[wc-outbox] drain failed: {e}")
+
 if __name__ == '__main__':
     main()
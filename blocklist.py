@@ -3,7 +3,8 @@
 Layer 1 of the COD-refuser defense. A customer is blocked *by phone* (emails
 rotate; phone + address are the stable identity — see app.py's identity merge).
 When enabled, any of their COD orders that are still PRE-SHIPMENT get
-auto-cancelled via the WooCommerce REST API and an order note is added.
+cancelled locally and the WooCommerce cancel (+ order note) is queued in the
+write-back outbox (wc_outbox.py), which the cron drains right after.
 
 Prepaid orders (payment_method != 'cod') are NEVER touched: a blocked refuser who
 pays upfront is harmless and should still ship — that is the whole point of the
@@ -13,10 +14,11 @@ This module is import-safe for the hourly cron (auto_sync.py): it must NOT impor
 the Flask app. It only needs a DB connection (sqlite3.Row factory) handed in.
 """
 import json
-import requests
 from datetime import datetime
 
-from oid_utils import woo_post_id  # raw WC post id for REST write-back
+import order_index  # data_versions bump on local status change
+import customer_stats  # the cancel changes the customer's success counts / spend
+import wc_outbox  # queued WooCommerce write-back (cancel + note)
 
 GLOBAL_ENABLE_KEY = 'blocklist_auto_cancel_enabled'
 
@@ -26,12 +28,6 @@ GLOBAL_ENABLE_KEY = 'blocklist_auto_cancel_enabled'
 # trickle; raise this only if you deliberately blocklist many active customers.
 MAX_CANCELS_PER_RUN = 20
 
-_API_HEADERS = {
-    "User-Agent": "WooCommerce API Client-Python/3.0.0",
-    "Content-Type": "application/json",
-    "Accept": "application/json",
-}
-
 
 # --- phone normalization -----------------------------------------------------
 # MUST stay in sync with app.py:_normalize_phone / _is_placeholder_phone.
@@ -122,34 +118,14 @@ def _load_sites(conn):
     return {r['url']: r for r in conn.execute("SELECT * FROM sites").fetchall()}
 
 
-def _cancel_remote(site, oid, reason_note):
-    """PUT status=cancelled (+ best-effort note) on WooCommerce.
-    Returns (ok: bool, detail: str). Mirrors app.update_order_status."""
-    wid = woo_post_id(oid)
-    status_url = f"{site['url']}/wp-json/wc/v3/orders/{wid}"
-    try:
-        resp = requests.put(
-            status_url, json={'status': 'cancelled'},
-            auth=(site['consumer_key'], site['consumer_secret']),
-            timeout=60, headers=_API_HEADERS,
-        )
-    except Exception as e:
-        return False, f"请求异常: {e}"
-    text = resp.text or ''
-    if text.strip().startswith('<!') or text.strip().startswith('<html'):
-        return False, "WP返回HTML(可能WAF/认证问题)"
-    if resp.status_code not in (200, 201):
-        return False, f"API {resp.status_code}: {text[:160]}"
-    try:
-        requests.post(
-            f"{status_url}/notes",
-            json={'note': reason_note, 'customer_note': False},
-            auth=(site['consumer_key'], site['consumer_secret']),
-            timeout=30, headers=_API_HEADERS,
-        )
-    except Exception:
-        pass  # note is non-critical
-    return True, "ok"
+def _queue_cancel(conn, site, oid, reason_note, actor):
+    """Queue status=cancelled (+ a non-critical note after it) for WooCommerce.
+    Mirrors app.update_order_status."""
+    op = wc_outbox.enqueue(conn, site['url'], 'order_update', {'data': {'status': 'cancelled'}},
+                           order_id=oid, local_status='cancelled', actor=actor)
+    wc_outbox.enqueue(conn, site['url'], 'order_note', {'note': reason_note, 'customer_note': False},
+                      order_id=oid, depends_on=op, actor=actor)
+    return op
 
 
 def _log_row(conn, order, phone, result, detail, actor, now):
@@ -167,13 +143,15 @@ def enforce(conn, progress=None, dry_run=False, actor='auto'):
     """Cancel every cancellable blocklisted COD order. Returns a summary dict.
 
     Idempotent: already-cancelled orders drop out of the candidate set, so this
-    is safe to run every sync. Network/site errors leave the order untouched and
-    are retried next run.
+    is safe to run every sync. The WooCommerce side is queued (wc_outbox), so a
+    store that is down only delays the remote cancel — it is retried by the
+    outbox and ends up in its dead-letter list if it keeps failing.
     """
     def _log(m):
         if progress:
             progress(m)
 
+    wc_outbox.ensure_schema(conn)
     candidates = find_cancellable_orders(conn)
     summary = {'checked': len(candidates), 'cancelled': 0, 'errors': 0,
                'skipped': 0, 'dry_run': dry_run, 'aborted': False, 'details': []}
@@ -222,26 +200,21 @@ def enforce(conn, progress=None, dry_run=False, actor='auto'):
                  f"({order['total']} {order['currency']}) @ {order['source']}")
             continue
 
-        ok, detail = _cancel_remote(site, oid, note)
-        if ok:
-            conn.execute("UPDATE orders SET status='cancelled' WHERE id=?", (oid,))
-            _log_row(conn, order, phone, 'cancelled', note, actor, now)
-            conn.execute(
-                """UPDATE blocked_customers
-                   SET cancelled_count = COALESCE(cancelled_count,0)+1,
-                       last_cancelled_at = ?
-                   WHERE phone = ?""", (now, phone))
-            conn.commit()
-            summary['cancelled'] += 1
-            rec['result'], rec['detail'] = 'cancelled', 'ok'
-            _log(f"[blocklist] 已取消 #{order['number']} "
-                 f"({order['total']} {order['currency']}) @ {order['source']}")
-        else:
-            _log_row(conn, order, phone, 'error', detail, actor, now)
-            conn.commit()
-            summary['errors'] += 1
-            rec['result'], rec['detail'] = 'error', detail
-            _log(f"[blocklist] 取消失败 #{order['number']}: {detail}")
+        _queue_cancel(conn, site, oid, note, actor)
+        conn.execute("UPDATE orders SET status='cancelled' WHERE id=?", (oid,))
+        order_index.bump_order_months(conn, [oid])
+        customer_stats.mark_orders(conn, [oid])
+        _log_row(conn, order, phone, 'cancelled', note, actor, now)
+        conn.execute(
+            """UPDATE blocked_customers
+               SET cancelled_count = COALESCE(cancelled_count,0)+1,
+                   last_cancelled_at = ?
+               WHERE phone = ?""", (now, phone))
+        conn.commit()
+        summary['cancelled'] += 1
+        rec['result'], rec['detail'] = 'cancelled', 'queued'
+        _log(f"[blocklist] 已取消 #{order['number']} "
+             f"({order['total']} {order['currency']}) @ {order['source']}（站点同步已排队）")
         summary['details'].append(rec)
 
     return summary
@@ -0,0 +1,138 @@
+"""Match keys of flagged customers (customer_risk_keys table).
+
+The shipping lists badge an order when its customer matches an earlier
+undelivered / problem-return order by email, phone or delivery address
+(app._build_risk_index). The normalized keys of every flagged order are
+stored once
+
+    customer_risk_keys(key_type, key, order_id)
+        key_type 'email' / 'phone' / 'addr', key from
+        identity_graph.order_keys() — the same keys shipping_view stores
+        for the orders being assessed
+
+and the index is rebuilt from this table whenever the 'customer_risk' data
+version moves.
+
+The keys go stale whenever a flagged order's billing / shipping changes, and
+that happens outside the mark / unmark endpoints too: a sync re-fetches a
+flagged order after the customer or the shop corrected the address. So the
+sync writers call refresh_orders() after their upsert, next to
+shipping_view.refresh_orders(), inside their own transaction (it does not
+commit). The version is only bumped when stored keys actually changed — the
+7-day re-fetch of unchanged orders must not invalidate every worker's index.
+The app's mark / unmark endpoints call it as well and bump the version
+themselves, since a flag change alters the index even when the keys do not.
+
+Until the web app has added the undelivered / problem-return columns to
+orders (a database only the sync scripts have touched yet), nothing can be
+flagged: ensure_schema() then leaves the table alone and refresh_orders() is
+a no-op.
+"""
+import order_index
+from identity_graph import order_keys
+
+SCOPE = 'customer_risk'
+KEY_TYPES = ('email', 'phone', 'addr')
+BATCH = 500
+
+_FLAGGED = '(COALESCE(is_problem_return,0) = 1 OR COALESCE(is_undelivered,0) = 1)'
+
+
+def _chunks(values):
+    values = list(values)
+    for i in range(0, len(values), BATCH):
+        yield values[i:i + BATCH]
+
+
+def _stored_keys(conn, order_ids):
+    keys = {}
+    for chunk in _chunks(order_ids):
+        for r in conn.execute(
+                f"SELECT order_id, key_type, key FROM customer_risk_keys "
+                f"WHERE order_id IN ({','.join('?' * len(chunk))})", chunk):
+            keys.setdefault(r[0], set()).add((r[1], r[2]))
+    return keys
+
+
+def _current_keys(conn, order_ids):
+    """{order_id: {(key_type, key)}} of the given orders that are flagged."""
+    keys = {}
+    for chunk in _chunks(order_ids):
+        for r in conn.execute(
+                f"SELECT id, billing, shipping FROM orders "
+                f"WHERE id IN ({','.join('?' * len(chunk))}) AND {_FLAGGED}", chunk):
+            found = {(t, k) for t, k in zip(KEY_TYPES, order_keys(r[1], r[2])) if k}
+            if found:
+                keys[str(r[0])] = found
+    return keys
+
+
+def refresh_orders(conn, order_ids):
+    """Re-derive the risk keys of the given orders; orders that are not
+    flagged just lose theirs. Bumps the 'customer_risk' version when stored
+    keys changed and returns whether they did. Does not commit."""
+    if not _schema_ready:
+        return False
+    order_ids = list(dict.fromkeys(str(i) for i in order_ids if i is not None))
+    if not order_ids:
+        return False
+    old_keys = _stored_keys(conn, order_ids)
+    new_keys = _current_keys(conn, order_ids)
+    changed = [oid for oid in order_ids if old_keys.get(oid, set()) != new_keys.get(oid, set())]
+    if not changed:
+        return False
+    for chunk in _chunks(changed):
+        conn.execute(f"DELETE FROM customer_risk_keys WHERE order_id IN ({','.join('?' * len(chunk))})", chunk)
+    conn.executemany(
+        'INSERT OR IGNORE INTO customer_risk_keys (key_type, key, order_id) VALUES (?, ?, ?)',
+        [(t, k, oid) for oid in changed for t, k in sorted(new_keys.get(oid, ()))])
+    order_index.bump_versions(conn, [SCOPE])
+    return True
+
+
+def _has_flag_columns(conn):
+    columns = {r[1] for r in conn.execute('PRAGMA table_info(orders)')}
+    return {'is_problem_return', 'is_undelivered'} <= columns
+
+
+def ensure_risk_table(conn):
+    """Create customer_risk_keys and, the first time, derive the keys of every
+    flagged order. Table and backfill share one transaction. Returns False
+    (and creates nothing) while orders has no flag columns yet."""
+    if not _has_flag_columns(conn):
+        return False
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute('BEGIN')
+    created = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'customer_risk_keys'").fetchone() is None
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS customer_risk_keys (
+            key_type TEXT NOT NULL,
+            key TEXT NOT NULL,
+            order_id TEXT NOT NULL,
+            PRIMARY KEY (key_type, key, order_id)
+        )
+    """)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_customer_risk_keys_order ON customer_risk_keys(order_id)')
+    if created:
+        flagged = [str(r[0]) for r in conn.execute(f'SELECT id FROM orders WHERE {_FLAGGED}')]
+        conn.executemany(
+            'INSERT OR IGNORE INTO customer_risk_keys (key_type, key, order_id) VALUES (?, ?, ?)',
+            [(t, k, oid) for oid, keys in _current_keys(conn, flagged).items() for t, k in sorted(keys)])
+        order_index.bump_versions(conn, [SCOPE])
+    conn.commit()
+    return True
+
+
+_schema_ready = False
+
+
+def ensure_schema(conn):
+    """Run ensure_risk_table once per process (sync writers call this before
+    their first upsert, the web app at startup). Retried on the next call
+    while the flag columns are missing."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    _schema_ready = ensure_risk_table(conn)
@@ -0,0 +1,421 @@
+"""Materialized per-identity customer statistics (customer_stats).
+
+/customers used to aggregate every order with an email
+(`GROUP BY json_extract(billing, '$.email')`), fold the rows into identity
+clusters, compute tiers in Python and render the whole customer base into
+one HTML response — work proportional to the archive on every page view.
+
+Fix: two tables, kept current incrementally.
+
+    customer_accounts(cluster_key, source, email, ...)
+        one row per identity cluster x site x raw billing email: order
+        counts, successful orders / spend, undelivered / problem-return
+        counts and losses, first / last order, currency. Scoped views
+        (site permissions, manager / country / source filters) sum these
+        rows per cluster instead of touching orders.
+    customer_stats(cluster_key, ...)
+        the cluster across all sites, with the display fields already folded
+        (primary email / name / phone, merged emails, sites, spend per
+        currency, tier, search text). The unscoped list is an index walk over
+        this table: idx_customer_stats_<sort column>.
+
+Cluster = identity_graph.py's identity_clusters; checkout drafts and trash
+are not customers there, so they are not counted here either.
+
+Maintenance is deferred through customer_stats_dirty(email): writers call
+mark_orders() for orders they changed or are about to delete (plus the
+emails identity_graph re-clustered), mark_sources() when a site setting that
+changes what "successful" means flips. refresh() — run by the web app before
+it reads — recomputes only the clusters those emails belonged to or belong to
+now. The success condition is passed in by the caller (app.py owns it:
+_success_status_cond), so this module needs no copy of the status rules.
+"""
+import json
+
+import identity_graph
+
+BATCH = 500
+TIERS = ('VIP', '优质', '普通', '新客')
+SORT_COLUMNS = ('total_spent', 'successful_orders', 'total_loss', 'site_count', 'last_order_date')
+
+_ACCOUNT_COLUMNS = ('cluster_key', 'source', 'email', 'norm', 'name', 'phone', 'total_orders',
+                    'successful_orders', 'total_spent', 'undelivered_orders', 'shipping_loss_total',
+                    'problem_return_orders', 'product_loss_total', 'first_order_date',
+                    'last_order_date', 'currency', 'currencies')
+_STATS_COLUMNS = ('cluster_key', 'email', 'name', 'phone', 'identity_emails', 'identity_email_count',
+                  'identity_phone_count', 'matched_by', 'total_orders', 'successful_orders',
+                  'total_spent', 'spent_by_currency', 'undelivered_orders', 'shipping_loss_total',
+                  'problem_return_orders', 'product_loss_total', 'total_loss', 'first_order_date',
+                  'last_order_date', 'currency', 'currencies', 'sources', 'site_count', 'search')
+
+
+def _chunks(values):
+    values = list(values)
+    for i in range(0, len(values), BATCH):
+        yield values[i:i + BATCH]
+
+
+def tier_sql(successful, spent, first, last):
+    """SQL CASE giving the /customers tier label from identity-level columns.
+
+    Score = orders (max 30) + spend / 100 (max 40) + purchase frequency (avg
+    days between successful orders: < 60 → 30, otherwise < 120 → 15 — with
+    avg 0 for single-order customers, which therefore get the 15 as well).
+    """
+    days = f"((strftime('%s', {last}) - strftime('%s', {first})) / 86400)"
+    avg = (f"(CASE WHEN {successful} > 1 AND {first} IS NOT NULL AND {last} IS NOT NULL "
+           f"THEN (CASE WHEN {days} = 0 THEN 1 ELSE {days} END) * 1.0 / {successful} ELSE 0 END)")
+    score = (f"MIN(MIN({successful} * 10, 30) + MIN({spent} / 100.0, 40) + "
+             f"(CASE WHEN {avg} > 0 AND {avg} < 60 THEN 30 WHEN {avg} < 120 THEN 15 ELSE 0 END), 100)")
+    return (f"(CASE WHEN {score} >= 80 THEN 'VIP' WHEN {score} >= 60 THEN '优质' "
+            f"WHEN {score} >= 40 THEN '普通' ELSE '新客' END)")
+
+
+def _latest(expr):
+    """Aggregate: expr of the group's most recent order (ties: larger value)."""
+    tagged = f"MAX(o.date_created || char(31) || COALESCE({expr}, ''))"
+    return f"NULLIF(substr({tagged}, instr({tagged}, char(31)) + 1), '')"
+
+
+def account_select(success_cond, conditions=()):
+    """SELECT producing customer_accounts-shaped rows straight from orders.
+
+    success_cond: SQL condition over the `o` alias for a successful order.
+    name / phone are the ones on the account's most recent order.
+    conditions: extra WHERE conditions (unprefixed order columns are fine —
+    identity_keys / identity_clusters share no column name with orders).
+    """
+    where = ["json_extract(o.billing, '$.email') IS NOT NULL", "json_extract(o.billing, '$.email') != ''"]
+    where.extend(conditions)
+    return f"""
+        SELECT ic.cluster_key AS cluster_key,
+               o.source AS source,
+               json_extract(o.billing, '$.email') AS email,
+               k.email AS norm,
+               {_latest("json_extract(o.billing, '$.first_name') || ' ' || json_extract(o.billing, '$.last_name')")} AS name,
+               {_latest("json_extract(o.billing, '$.phone')")} AS phone,
+               COUNT(*) AS total_orders,
+               SUM(CASE WHEN {success_cond} THEN 1 ELSE 0 END) AS successful_orders,
+               SUM(CASE WHEN {success_cond} THEN o.total ELSE 0 END) AS total_spent,
+               SUM(CASE WHEN COALESCE(o.is_undelivered, 0) = 1 THEN 1 ELSE 0 END) AS undelivered_orders,
+               SUM(CASE WHEN COALESCE(o.is_undelivered, 0) = 1 OR COALESCE(o.is_problem_return, 0) = 1
+                        THEN COALESCE(o.shipping_loss_amount, 0) ELSE 0 END) AS shipping_loss_total,
+               SUM(CASE WHEN COALESCE(o.is_problem_return, 0) = 1 THEN 1 ELSE 0 END) AS problem_return_orders,
+               SUM(CASE WHEN COALESCE(o.is_problem_return, 0) = 1
+                        THEN COALESCE(o.product_loss_amount, 0) ELSE 0 END) AS product_loss_total,
+               MIN(o.date_created) AS first_order_date,
+               MAX(o.date_created) AS last_order_date,
+               MIN(o.currency) AS currency,
+               GROUP_CONCAT(DISTINCT o.currency) AS currencies
+        FROM orders o
+        JOIN identity_keys k ON k.order_id = o.id
+        JOIN identity_clusters ic ON ic.email = k.email
+        WHERE {' AND '.join(where)}
+        GROUP BY ic.cluster_key, o.source, json_extract(o.billing, '$.email')
+    """
+
+
+def identity_select(accounts):
+    """SELECT folding an account relation (table or CTE name) into one row per
+    cluster with the customer_stats numeric columns + tier."""
+    return f"""
+        SELECT *, {tier_sql('successful_orders', 'total_spent', 'first_order_date', 'last_order_date')} AS tier
+        FROM (
+            SELECT cluster_key,
+                   SUM(total_orders) AS total_orders,
+                   SUM(successful_orders) AS successful_orders,
+                   ROUND(SUM(total_spent), 2) AS total_spent,
+                   SUM(undelivered_orders) AS undelivered_orders,
+                   ROUND(SUM(shipping_loss_total), 2) AS shipping_loss_total,
+                   SUM(problem_return_orders) AS problem_return_orders,
+                   ROUND(SUM(product_loss_total), 2) AS product_loss_total,
+                   ROUND(ROUND(SUM(shipping_loss_total), 2) + ROUND(SUM(product_loss_total), 2), 2) AS total_loss,
+                   MIN(first_order_date) AS first_order_date,
+                   MAX(last_order_date) AS last_order_date,
+                   MIN(currency) AS currency,
+                   COUNT(DISTINCT source) AS site_count,
+                   COUNT(DISTINCT email) AS identity_email_count
+            FROM {accounts}
+            GROUP BY cluster_key
+        )
+    """
+
+
+def search_condition(accounts):
+    """(condition, needs one param) restricting clusters to those with an
+    account whose name / email / phone contains the lowercased term."""
+    return (f"cluster_key IN (SELECT cluster_key FROM {accounts} WHERE instr(lower("
+            f"COALESCE(name, '') || ' ' || COALESCE(email, '') || ' ' || COALESCE(phone, '')), ?) > 0)")
+
+
+def fold(accounts, matched_by=None):
+    """Display row of one identity from its account rows (dicts).
+
+    Primary email / name = the highest-spending account's; matched_by maps
+    normalized email -> set of link reasons (identity_graph.clusters_for).
+    """
+    spend_by_email = {}
+    names = []
+    phones = []
+    sources, currencies = set(), set()
+    spent_by_currency = {}
+    via = set()
+    c = {'total_orders': 0, 'successful_orders': 0, 'total_spent': 0.0, 'undelivered_orders': 0,
+         'shipping_loss_total': 0.0, 'problem_return_orders': 0, 'product_loss_total': 0.0,
+         'first_order_date': None, 'last_order_date': None}
+    for a in sorted(accounts, key=lambda a: (float(a['total_spent'] or 0), a['email'] or ''), reverse=True):
+        spend = float(a['total_spent'] or 0)
+        spend_by_email[a['email']] = spend_by_email.get(a['email'], 0.0) + spend
+        name = (a['name'] or '').strip()
+        if name:
+            names.append((spend, name))
+        phone = str(a['phone'] or '').strip()
+        if phone and phone not in phones:
+            phones.append(phone)
+        for key in ('total_orders', 'successful_orders', 'undelivered_orders', 'problem_return_orders'):
+            c[key] += int(a[key] or 0)
+        for key in ('total_spent', 'shipping_loss_total', 'product_loss_total'):
+            c[key] += float(a[key] or 0)
+        if a['first_order_date'] and (c['first_order_date'] is None or a['first_order_date'] < c['first_order_date']):
+            c['first_order_date'] = a['first_order_date']
+        if a['last_order_date'] and (c['last_order_date'] is None or a['last_order_date'] > c['last_order_date']):
+            c['last_order_date'] = a['last_order_date']
+        if a['source']:
+            sources.add(a['source'])
+        currencies.update(x.strip() for x in (a['currencies'] or '').split(',') if x.strip())
+        if a['currency'] and spend:
+            spent_by_currency[a['currency']] = round(spent_by_currency.get(a['currency'], 0.0) + spend, 2)
+        via |= (matched_by or {}).get(a['norm'], set())
+
+    emails_by_spend = sorted(((s, e) for e, s in spend_by_email.items()), reverse=True)
+    names.sort(reverse=True)
+    c['email'] = emails_by_spend[0][1] if emails_by_spend else ''
+    c['name'] = names[0][1] if names else (c['email'] or 'Unknown')
+    c['phone'] = phones[0] if phones else ''
+    c['identity_emails'] = sorted(spend_by_email, key=str.lower)
+    c['identity_email_count'] = len(spend_by_email)
+    c['identity_phone_count'] = len(phones)
+    c['identity_matched_by'] = sorted(via)
+    for key in ('total_spent', 'shipping_loss_total', 'product_loss_total'):
+        c[key] = round(c[key], 2)
+    c['total_loss'] = round(c['shipping_loss_total'] + c['product_loss_total'], 2)
+    c['spent_by_currency'] = spent_by_currency
+    c['currency'] = sorted(currencies)[0] if currencies else 'N/A'
+    c['currencies'] = ','.join(sorted(currencies))
+    c['all_sources'] = sorted(sources)
+    c['source'] = c['all_sources'][0] if sources else 'Unknown'
+    c['site_count'] = len(sources)
+    c['search'] = ' '.join([c['name']] + c['identity_emails'] + phones).lower()
+    return c
+
+
+def from_stats_row(row):
+    """customer_stats row -> the dict fold() returns (+ tier)."""
+    r = dict(row)
+    r['identity_emails'] = json.loads(r['identity_emails'] or '[]')
+    r['identity_matched_by'] = [m for m in (r.pop('matched_by') or '').split(',') if m]
+    r['spent_by_currency'] = json.loads(r['spent_by_currency'] or '{}')
+    r['all_sources'] = [s for s in (r.pop('sources') or '').split(',') if s]
+    r['source'] = r['all_sources'][0] if r['all_sources'] else 'Unknown'
+    return r
+
+
+# ── maintenance ──────────────────────────────────────────────────────────
+
+def mark_orders(conn, order_ids, emails=()):
+    """Queue the customers of these orders (plus any extra normalized emails,
+    e.g. what identity_graph.refresh_orders re-clustered) for refresh().
+    Call after an UPDATE, before a DELETE. Does not commit."""
+    dirty = {e for e in emails if e}
+    for chunk in _chunks(str(i) for i in order_ids if i is not None):
+        placeholders = ','.join('?' * len(chunk))
+        for r in conn.execute(
+                f"SELECT json_extract(billing, '$.email') FROM orders WHERE id IN ({placeholders}) "
+                f"UNION SELECT email FROM identity_keys WHERE order_id IN ({placeholders})", chunk + chunk):
+            e = identity_graph.normalize_email(r[0])
+            if e:
+                dirty.add(e)
+    conn.executemany('INSERT OR IGNORE INTO customer_stats_dirty (email) VALUES (?)', [(e,) for e in dirty])
+
+
+def mark_sources(conn, sources):
+    """Queue every customer of these sites (a site setting behind the success
+    rule changed). Does not commit."""
+    for chunk in _chunks(s for s in sources if s):
+        conn.execute(
+            f"INSERT OR IGNORE INTO customer_stats_dirty (email) "
+            f"SELECT DISTINCT norm FROM customer_accounts WHERE source IN ({','.join('?' * len(chunk))})", chunk)
+
+
+def _affected_clusters(conn, dirty):
+    """(old, current) cluster keys to rebuild for the dirty emails: the
+    clusters they were counted in and the ones they belong to now, closed over
+    the members of both (a merge or split moves other emails along)."""
+    seen = set(dirty)
+    frontier = set(dirty)
+    old, current = set(), set()
+    while frontier:
+        new_old, new_current = set(), set()
+        for chunk in _chunks(frontier):
+            placeholders = ','.join('?' * len(chunk))
+            new_old.update(r[0] for r in conn.execute(
+                f'SELECT DISTINCT cluster_key FROM customer_accounts WHERE norm IN ({placeholders})', chunk))
+            new_current.update(r[0] for r in conn.execute(
+                f'SELECT DISTINCT cluster_key FROM identity_clusters WHERE email IN ({placeholders})', chunk))
+        new_old -= old
+        new_current -= current
+        old |= new_old
+        current |= new_current
+        members = set()
+        for chunk in _chunks(new_old):
+            members.update(r[0] for r in conn.execute(
+                f"SELECT DISTINCT norm FROM customer_accounts WHERE cluster_key IN ({','.join('?' * len(chunk))})",
+                chunk))
+        for chunk in _chunks(new_current):
+            members.update(r[0] for r in conn.execute(
+                f"SELECT email FROM identity_clusters WHERE cluster_key IN ({','.join('?' * len(chunk))})", chunk))
+        frontier = members - seen
+        seen |= frontier
+    return old, current
+
+
+def _build(conn, success_cond, cluster_keys):
+    """(Re)insert the account and stats rows of the given clusters."""
+    for chunk in _chunks(sorted(cluster_keys)):
+        placeholders = ','.join('?' * len(chunk))
+        cur = conn.execute(account_select(success_cond, [f'ic.cluster_key IN ({placeholders})']), chunk)
+        names = [d[0] for d in cur.description]  # sync connections have no Row factory
+        accounts = [dict(zip(names, r)) for r in cur.fetchall()]
+        conn.executemany(
+            f"INSERT INTO customer_accounts ({', '.join(_ACCOUNT_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(_ACCOUNT_COLUMNS))})",
+            [tuple(a[k] for k in _ACCOUNT_COLUMNS) for a in accounts])
+        matched = identity_graph.clusters_for(conn, {a['norm'] for a in accounts})
+        matched = {e: m for e, (_ck, m) in matched.items()}
+        by_cluster = {}
+        for a in accounts:
+            by_cluster.setdefault(a['cluster_key'], []).append(a)
+        rows = []
+        for ck, rows_of in by_cluster.items():
+            c = fold(rows_of, matched)
+            c.update(cluster_key=ck, identity_emails=json.dumps(c['identity_emails'], ensure_ascii=False),
+                     matched_by=','.join(c['identity_matched_by']), sources=','.join(c['all_sources']),
+                     spent_by_currency=json.dumps(c['spent_by_currency'], ensure_ascii=False))
+            rows.append(tuple(c[k] for k in _STATS_COLUMNS))
+        conn.executemany(
+            f"INSERT INTO customer_stats ({', '.join(_STATS_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(_STATS_COLUMNS))})", rows)
+        conn.execute(
+            f"UPDATE customer_stats SET tier = "
+            f"{tier_sql('successful_orders', 'total_spent', 'first_order_date', 'last_order_date')}, "
+            f"updated_at = datetime('now') WHERE cluster_key IN ({placeholders})", chunk)
+
+
+def refresh(conn, success_cond):
+    """Fold the queued emails into customer_accounts / customer_stats and
+    commit. Returns the number of clusters rebuilt (0 = nothing queued)."""
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        dirty = [r[0] for r in conn.execute('SELECT email FROM customer_stats_dirty')]
+        if not dirty:
+            conn.commit()
+            return 0
+        old, current = _affected_clusters(conn, dirty)
+        for chunk in _chunks(old | current):
+            placeholders = ','.join('?' * len(chunk))
+            conn.execute(f'DELETE FROM customer_accounts WHERE cluster_key IN ({placeholders})', chunk)
+            conn.execute(f'DELETE FROM customer_stats WHERE cluster_key IN ({placeholders})', chunk)
+        _build(conn, success_cond, current)
+        for chunk in _chunks(dirty):
+            conn.execute(f"DELETE FROM customer_stats_dirty WHERE email IN ({','.join('?' * len(chunk))})", chunk)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(current)
+
+
+def ensure_stats_tables(conn):
+    """Create the tables; the first time, queue every identity so the next
+    refresh() builds them. Expects identity_graph's tables to exist."""
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute('BEGIN')
+    created = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'customer_stats'").fetchone() is None
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS customer_accounts (
+            cluster_key TEXT NOT NULL,
+            source TEXT NOT NULL,
+            email TEXT NOT NULL,
+            norm TEXT NOT NULL,
+            name TEXT,
+            phone TEXT,
+            total_orders INTEGER NOT NULL DEFAULT 0,
+            successful_orders INTEGER NOT NULL DEFAULT 0,
+            total_spent REAL NOT NULL DEFAULT 0,
+            undelivered_orders INTEGER NOT NULL DEFAULT 0,
+            shipping_loss_total REAL NOT NULL DEFAULT 0,
+            problem_return_orders INTEGER NOT NULL DEFAULT 0,
+            product_loss_total REAL NOT NULL DEFAULT 0,
+            first_order_date TEXT,
+            last_order_date TEXT,
+            currency TEXT,
+            currencies TEXT,
+            PRIMARY KEY (cluster_key, source, email)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS customer_stats (
+            cluster_key TEXT PRIMARY KEY,
+            email TEXT,
+            name TEXT,
+            phone TEXT,
+            identity_emails TEXT,
+            identity_email_count INTEGER NOT NULL DEFAULT 1,
+            identity_phone_count INTEGER NOT NULL DEFAULT 0,
+            matched_by TEXT,
+            total_orders INTEGER NOT NULL DEFAULT 0,
+            successful_orders INTEGER NOT NULL DEFAULT 0,
+            total_spent REAL NOT NULL DEFAULT 0,
+            spent_by_currency TEXT,
+            undelivered_orders INTEGER NOT NULL DEFAULT 0,
+            shipping_loss_total REAL NOT NULL DEFAULT 0,
+            problem_return_orders INTEGER NOT NULL DEFAULT 0,
+            product_loss_total REAL NOT NULL DEFAULT 0,
+            total_loss REAL NOT NULL DEFAULT 0,
+            first_order_date TEXT,
+            last_order_date TEXT,
+            currency TEXT,
+            currencies TEXT,
+            sources TEXT,
+            site_count INTEGER NOT NULL DEFAULT 0,
+            tier TEXT,
+            search TEXT,
+            updated_at TEXT
+        )
+    """)
+    conn.execute('CREATE TABLE IF NOT EXISTS customer_stats_dirty (email TEXT PRIMARY KEY)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_customer_accounts_norm ON customer_accounts(norm)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_customer_accounts_source ON customer_accounts(source, cluster_key)')
+    for column in SORT_COLUMNS:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_customer_stats_{column} '
+                     f'ON customer_stats({column}, cluster_key)')
+    if created:
+        conn.execute('INSERT OR IGNORE INTO customer_stats_dirty (email) SELECT email FROM identity_clusters')
+    conn.commit()
+
+
+_schema_ready = False
+
+
+def ensure_schema(conn):
+    """Run ensure_stats_tables once per process (sync writers call this before
+    their first upsert, the web app at startup)."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    ensure_stats_tables(conn)
+    _schema_ready = True
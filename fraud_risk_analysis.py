@@ -77,6 +77,19 @@ def identity_key(billing_json):
     return None, None
 
 
+def load_identity_clusters(conn):
+    """app 维护的持久化身份图 (identity_graph.py): {order_id: cluster_key}。
+    邮箱经共享电话/地址合并后的同一个人共用一个 cluster_key；
+    图还没建(app 未重启过)时返回 {}，回退到 identity_key()。"""
+    try:
+        return {r[0]: r[1] for r in conn.execute("""
+            SELECT k.order_id, c.cluster_key
+            FROM identity_keys k JOIN identity_clusters c ON c.email = k.email
+        """)}
+    except sqlite3.OperationalError:
+        return {}
+
+
 def parse_dt(s):
     if not s:
         return None
@@ -116,14 +129,20 @@ def main():
         FROM orders
         WHERE status NOT IN ('checkout-draft', 'trash')
     """).fetchall()
+    order_cluster = load_identity_clusters(conn)
     conn.close()
 
     # ---- 构建身份 -> 订单列表(按时间排序) ----
+    # 有邮箱的订单用身份图的 cluster (与 /customers 同一口径)，其余按电话/邮箱键
     identities = defaultdict(list)
     no_key = 0
     high_total_samples = []
     for o in rows:
-        key, kind = identity_key(o['billing'])
+        cluster = order_cluster.get(str(o['id']))
+        if cluster:
+            key, kind = f"id:{cluster}", 'cluster'
+        else:
+            key, kind = identity_key(o['billing'])
         if key is None:
             no_key += 1
             continue
@@ -148,6 +167,7 @@ def main():
     total_linkable = sum(len(v) for v in identities.values())
     phone_ids = sum(1 for k in identities if k.startswith('tel:'))
     email_ids = sum(1 for k in identities if k.startswith('mail:'))
+    cluster_ids = sum(1 for k in identities if k.startswith('id:'))
     repeat_ids = {k: v for k, v in identities.items() if len(v) >= 2}
     print("=" * 64)
     print("1. 身份归一化覆盖率")
@@ -155,7 +175,7 @@ def main():
     print(f"  非草稿订单总数        : {len(rows)}")
     print(f"  无法关联身份(无电话/邮箱): {no_key}  ({100*no_key//max(len(rows),1)}%)")
     print(f"  可关联订单            : {total_linkable}")
-    print(f"  独立身份数            : {len(identities)}  (电话 {phone_ids} / 邮箱 {email_ids})")
+    print(f"  独立身份数            : {len(identities)}  (身份图 {cluster_ids} / 电话 {phone_ids} / 邮箱 {email_ids})")
     print(f"  回头客身份(>=2单)     : {len(repeat_ids)}  覆盖 {sum(len(v) for v in repeat_ids.values())} 单")
     print(f"  '大额'阈值(好单75分位): {p75:.0f}")
 
@@ -0,0 +1,382 @@
+"""Persistent customer identity graph (email / phone / address).
+
+/customers and the customer detail view merge emails that belong to one
+person: emails sharing a phone number or delivery address are unioned, and a
+phone / address shared by more than SHARED_KEY_LIMIT distinct emails is
+treated as non-identifying (placeholder number, shared web form, apartment
+block). That used to be recomputed on every request: a full
+`SELECT billing, shipping FROM orders`, a JSON decode per row and a union-find
+over every email.
+
+Fix: two tables kept in step by the writers.
+
+    identity_keys(order_id, email, phone, addr)
+        the normalized keys of every order that has an email (checkout drafts
+        and trash excluded — they are not customers)
+    identity_clusters(email, cluster_key, matched_by)
+        connected components over the shared phone / address keys that pass
+        the SHARED_KEY_LIMIT guard; cluster_key is the lexicographically
+        smallest email of the component, matched_by 'phone' / 'address'
+
+Writers call refresh_orders() after upserting orders and remove_orders()
+before deleting them, inside their own transaction. Only orders whose keys
+actually changed are re-clustered, and only locally: every email touching a
+changed key, plus the current members of those emails' clusters, is
+re-walked. That covers both merges and splits — a key that crosses the shared
+limit stops linking, and the walk gives each side its own cluster again.
+
+The key counts behind the guard are answered by idx_identity_keys_phone /
+_addr (covering indexes), so they are never stale.
+
+Like order_index.py, this module is imported by the sync scripts and app.py
+so all writers normalize the same way; the normalizers below are the ones
+app.py uses for the risk index as well.
+"""
+import json
+import re
+
+SHARED_KEY_LIMIT = 4
+EXCLUDED_STATUSES = ('checkout-draft', 'trash')
+BATCH = 500
+
+
+def normalize_email(e):
+    s = (e or '').strip().lower()
+    return s or None
+
+
+def is_placeholder_phone(digits):
+    """True for obviously-fake numbers people type to bypass a required field:
+    all-same-digit (000000000), or a straight ascending/descending run
+    (123456789 / 987654321). These must never link unrelated customers."""
+    if not digits:
+        return True
+    if len(set(digits)) <= 1:
+        return True
+    if len(digits) >= 6:
+        diffs = {int(digits[i + 1]) - int(digits[i]) for i in range(len(digits) - 1)}
+        if diffs == {1} or diffs == {-1}:
+            return True
+    return False
+
+
+def normalize_phone(p):
+    """Keep digits only; collapse to the last 9 digits to fold away the
+    PL +48 / AU +61 / AE +971 country codes that customers add inconsistently.
+    Returns None if there's no plausible phone number left, or if it's an
+    obvious placeholder (so it can't merge / flag unrelated people)."""
+    digits = ''.join(c for c in (p or '') if c.isdigit())
+    if len(digits) < 7:  # too short to be a real number
+        return None
+    canonical = digits[-9:] if len(digits) >= 9 else digits
+    if is_placeholder_phone(canonical) or is_placeholder_phone(digits):
+        return None
+    return canonical
+
+
+def normalize_address(addr_dict):
+    """Build a tight match key from address_1 + postcode + city. All
+    lowercase, whitespace collapsed. Returns None when too sparse to be
+    a useful match (a country code alone isn't a customer)."""
+    if not isinstance(addr_dict, dict):
+        return None
+    a1 = re.sub(r'\s+', ' ', (addr_dict.get('address_1') or '').strip().lower())
+    pc = (addr_dict.get('postcode') or '').strip().replace(' ', '').lower()
+    city = re.sub(r'\s+', ' ', (addr_dict.get('city') or '').strip().lower())
+    parts = [p for p in (a1, pc, city) if p]
+    if len(parts) < 2 or not a1:
+        return None
+    return ' | '.join(parts)
+
+
+def addr_for_order(billing, shipping):
+    """Pick the more complete of (shipping, billing) for matching."""
+    if isinstance(shipping, dict) and shipping.get('address_1'):
+        return shipping
+    return billing if isinstance(billing, dict) else {}
+
+
+def _load_json(value):
+    if not value:
+        return {}
+    if isinstance(value, dict):
+        return value
+    try:
+        parsed = json.loads(value)
+    except (TypeError, ValueError):
+        return {}
+    return parsed if isinstance(parsed, dict) else {}
+
+
+def order_keys(billing, shipping):
+    """(email, phone, addr) identity keys of one order; email None = no identity."""
+    b = _load_json(billing)
+    s = _load_json(shipping)
+    ad = addr_for_order(b, s)
+    return (
+        normalize_email(b.get('email') or s.get('email')),
+        normalize_phone(ad.get('phone') or b.get('phone')),
+        normalize_address(ad),
+    )
+
+
+# ── maintenance ──────────────────────────────────────────────────────────
+
+def _chunks(values):
+    values = list(values)
+    for i in range(0, len(values), BATCH):
+        yield values[i:i + BATCH]
+
+
+def _stored_keys(conn, order_ids):
+    keys = {}
+    for chunk in _chunks(order_ids):
+        for r in conn.execute(
+                f"SELECT order_id, email, phone, addr FROM identity_keys "
+                f"WHERE order_id IN ({','.join('?' * len(chunk))})", chunk):
+            keys[r[0]] = (r[1], r[2], r[3])
+    return keys
+
+
+def _current_keys(conn, order_ids):
+    keys = {}
+    for chunk in _chunks(order_ids):
+        for r in conn.execute(
+                f"SELECT id, status, billing, shipping FROM orders "
+                f"WHERE id IN ({','.join('?' * len(chunk))})", chunk):
+            if r[1] in EXCLUDED_STATUSES:
+                continue
+            email, phone, addr = order_keys(r[2], r[3])
+            if email:
+                keys[str(r[0])] = (email, phone, addr)
+    return keys
+
+
+def _apply(conn, order_ids, new_keys):
+    """Replace the key rows of order_ids with new_keys and re-cluster what
+    changed. Returns the emails whose cluster rows were rewritten."""
+    order_ids = list(dict.fromkeys(str(i) for i in order_ids if i is not None))
+    if not order_ids:
+        return set()
+    old_keys = _stored_keys(conn, order_ids)
+    changed = [oid for oid in order_ids if old_keys.get(oid) != new_keys.get(oid)]
+    if not changed:
+        return set()
+    for chunk in _chunks(changed):
+        conn.execute(f"DELETE FROM identity_keys WHERE order_id IN ({','.join('?' * len(chunk))})", chunk)
+    conn.executemany(
+        'INSERT INTO identity_keys (order_id, email, phone, addr) VALUES (?, ?, ?, ?)',
+        [(oid,) + new_keys[oid] for oid in changed if oid in new_keys])
+    emails, phones, addrs = set(), set(), set()
+    for oid in changed:
+        for keys in (old_keys.get(oid), new_keys.get(oid)):
+            if keys:
+                emails.add(keys[0])
+                phones.add(keys[1])
+                addrs.add(keys[2])
+    return _recluster(conn, emails, phones, addrs)
+
+
+def refresh_orders(conn, order_ids):
+    """Re-derive the identity keys of the given orders (after an upsert) and
+    re-cluster the emails they touch. Returns the re-clustered emails (see
+    customer_stats.mark_orders). Does not commit."""
+    order_ids = [str(i) for i in order_ids if i is not None]
+    return _apply(conn, order_ids, _current_keys(conn, order_ids))
+
+
+def remove_orders(conn, order_ids):
+    """Drop the identity keys of orders about to be deleted. Returns the
+    re-clustered emails. Does not commit."""
+    return _apply(conn, order_ids, {})
+
+
+def _emails_with(conn, column, values):
+    found = set()
+    for chunk in _chunks(v for v in values if v):
+        found.update(r[0] for r in conn.execute(
+            f"SELECT DISTINCT email FROM identity_keys WHERE {column} IN ({','.join('?' * len(chunk))})", chunk))
+    return found
+
+
+def _recluster(conn, emails, phones, addrs):
+    """Recompute the components containing any of these emails / keys.
+    Returns every email whose identity_clusters row was rewritten or dropped."""
+    seeds = {e for e in emails if e}
+    seeds |= _emails_with(conn, 'phone', phones)
+    seeds |= _emails_with(conn, 'addr', addrs)
+    # Current cluster mates too: if a link broke, they may form a cluster of
+    # their own now and must not keep the old cluster_key.
+    for chunk in _chunks(seeds):
+        seeds.update(r[0] for r in conn.execute(
+            f"SELECT email FROM identity_clusters WHERE cluster_key IN ("
+            f"SELECT cluster_key FROM identity_clusters WHERE email IN ({','.join('?' * len(chunk))}))", chunk))
+
+    shared = {}  # (column, key) -> emails sharing it, if it passes the guard
+
+    def linked(column, key):
+        if (column, key) not in shared:
+            members = [r[0] for r in conn.execute(
+                f'SELECT DISTINCT email FROM identity_keys WHERE {column} = ? LIMIT ?',
+                (key, SHARED_KEY_LIMIT + 1))]
+            shared[(column, key)] = members if 2 <= len(members) <= SHARED_KEY_LIMIT else []
+        return shared[(column, key)]
+
+    visited = set()
+    rows = []
+    for seed in sorted(seeds):
+        if seed in visited:
+            continue
+        component = {seed}
+        via = {}
+        queue = [seed]
+        visited.add(seed)
+        known = False
+        while queue:
+            email = queue.pop()
+            for phone, addr in conn.execute(
+                    'SELECT DISTINCT phone, addr FROM identity_keys WHERE email = ?', (email,)).fetchall():
+                known = True
+                for column, key, reason in (('phone', phone, 'phone'), ('addr', addr, 'address')):
+                    if not key:
+                        continue
+                    for other in linked(column, key):
+                        via.setdefault(other, set()).add(reason)
+                        if other not in component:
+                            component.add(other)
+                            visited.add(other)
+                            queue.append(other)
+        if not known:
+            continue  # no order left with this email — drop it from the graph
+        cluster_key = min(component)
+        rows.extend((e, cluster_key, ','.join(sorted(via.get(e, ())))) for e in component)
+
+    touched = list(visited | seeds)
+    for chunk in _chunks(touched):
+        conn.execute(f"DELETE FROM identity_clusters WHERE email IN ({','.join('?' * len(chunk))})", chunk)
+    conn.executemany(
+        'INSERT INTO identity_clusters (email, cluster_key, matched_by) VALUES (?, ?, ?)', rows)
+    return set(touched)
+
+
+def rebuild(conn):
+    """Recompute every key and cluster from orders (first start). Does not commit."""
+    conn.execute('DELETE FROM identity_keys')
+    conn.execute('DELETE FROM identity_clusters')
+    cur = conn.execute(
+        f"SELECT id, billing, shipping FROM orders "
+        f"WHERE status NOT IN ({','.join('?' * len(EXCLUDED_STATUSES))})", EXCLUDED_STATUSES)
+    email_keys = {}   # email -> set of (column, key)
+    key_emails = {}   # (column, key) -> set(emails)
+    while True:
+        batch = cur.fetchmany(BATCH)
+        if not batch:
+            break
+        values = []
+        for r in batch:
+            email, phone, addr = order_keys(r[1], r[2])
+            if not email:
+                continue
+            values.append((str(r[0]), email, phone, addr))
+            ek = email_keys.setdefault(email, set())
+            for column, key in (('phone', phone), ('addr', addr)):
+                if key:
+                    ek.add((column, key))
+                    key_emails.setdefault((column, key), set()).add(email)
+        conn.executemany('INSERT INTO identity_keys (order_id, email, phone, addr) VALUES (?, ?, ?, ?)', values)
+
+    # Union-find over emails (same result as _recluster, in one pass).
+    parent = {e: e for e in email_keys}
+
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:  # path compression
+            parent[x], x = root, parent[x]
+        return root
+
+    via = {}
+    for (column, _key), es in key_emails.items():
+        if not 2 <= len(es) <= SHARED_KEY_LIMIT:
+            continue
+        es = sorted(es)
+        for other in es[1:]:
+            ra, rb = find(es[0]), find(other)
+            if ra != rb:
+                if rb < ra:
+                    ra, rb = rb, ra
+                parent[rb] = ra
+        for e in es:
+            via.setdefault(e, set()).add('phone' if column == 'phone' else 'address')
+    conn.executemany(
+        'INSERT INTO identity_clusters (email, cluster_key, matched_by) VALUES (?, ?, ?)',
+        [(e, find(e), ','.join(sorted(via.get(e, ())))) for e in email_keys])
+
+
+# ── readers ──────────────────────────────────────────────────────────────
+
+def clusters_for(conn, emails):
+    """{email: (cluster_key, set(matched_by))} for the given normalized emails.
+    Emails not in the graph are absent."""
+    out = {}
+    for chunk in _chunks(set(e for e in emails if e)):
+        for r in conn.execute(
+                f"SELECT email, cluster_key, matched_by FROM identity_clusters "
+                f"WHERE email IN ({','.join('?' * len(chunk))})", chunk):
+            out[r[0]] = (r[1], set(filter(None, (r[2] or '').split(','))))
+    return out
+
+
+def cluster_members(conn, cluster_key):
+    """Sorted emails of one cluster."""
+    return sorted(r[0] for r in conn.execute(
+        'SELECT email FROM identity_clusters WHERE cluster_key = ?', (cluster_key,)))
+
+
+def ensure_identity_tables(conn):
+    """Create the graph tables; on the first run build them from every order.
+
+    Tables and the initial build share one transaction, so an interrupted
+    build leaves nothing behind and simply runs again on the next start.
+    """
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute('BEGIN')
+    created = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'identity_clusters'").fetchone() is None
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS identity_keys (
+            order_id TEXT PRIMARY KEY,
+            email TEXT NOT NULL,
+            phone TEXT,
+            addr TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS identity_clusters (
+            email TEXT PRIMARY KEY,
+            cluster_key TEXT NOT NULL,
+            matched_by TEXT
+        )
+    """)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_identity_keys_email ON identity_keys(email, phone, addr)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_identity_keys_phone ON identity_keys(phone, email)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_identity_keys_addr ON identity_keys(addr, email)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_identity_clusters_key ON identity_clusters(cluster_key)')
+    if created:
+        rebuild(conn)
+    conn.commit()
+
+
+_schema_ready = False
+
+
+def ensure_schema(conn):
+    """Run ensure_identity_tables once per process (sync writers call this
+    before their first upsert, the web app at startup)."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    ensure_identity_tables(conn)
+    _schema_ready = True
@@ -0,0 +1,96 @@
+"""Per-order pointers to the newest private note (orders.latest_note_id).
+
+The shipping queues, the tracking lookup and /au-orders showed each order's
+newest internal note through a derived table
+
+    SELECT order_id, note, ... FROM order_notes WHERE customer_note = 0
+    GROUP BY order_id HAVING date_created = MAX(date_created)
+
+which grouped the whole order_notes table on every request, and the note
+sync keeps adding to that table. The cost grew with the total note history,
+not with the number of orders shown.
+
+Fix: two columns on orders, kept in step by every note writer
+
+    latest_note_id        order_notes.id of the newest note with
+                          customer_note = 0
+    latest_user_note_id   the same, limited to added_by_user = 1 (what
+                          /au-orders shows as 内部备注)
+
+so readers join `order_notes n ON n.id = o.latest_note_id` (a primary-key
+lookup). refresh_orders() re-derives both pointers from
+idx_order_notes_order_private (order_id, customer_note, date_created), one
+index seek per order. Ties on date_created go to the higher id, i.e. the note
+stored last.
+
+Writers call refresh_orders() after inserting, replacing (the note sync's
+INSERT OR REPLACE gives the row a new id) or deleting notes, inside their
+own transaction. It also bumps the order_notes data version (order_index),
+so the ETags / view caches built on it see the note. It does not commit. Imported by the note sync
+(sync_utils.py), auto_confirm.py, wc_outbox.py and app.py.
+"""
+import sqlite3
+
+import order_index  # order_notes data version, bumped with every pointer refresh
+
+BATCH = 500
+NOTES_SCOPE = 'order_notes'
+
+_POINTERS_SQL = """
+    UPDATE orders SET
+        latest_note_id = (
+            SELECT n.id FROM order_notes n
+            WHERE n.order_id = orders.id AND n.customer_note = 0
+            ORDER BY n.date_created DESC, n.id DESC LIMIT 1),
+        latest_user_note_id = (
+            SELECT n.id FROM order_notes n
+            WHERE n.order_id = orders.id AND n.customer_note = 0 AND n.added_by_user = 1
+            ORDER BY n.date_created DESC, n.id DESC LIMIT 1)
+"""
+
+
+def refresh_orders(conn, order_ids):
+    """Re-derive the note pointers of the given orders and bump the
+    order_notes version. Does not commit."""
+    order_ids = list(dict.fromkeys(str(i) for i in order_ids if i is not None))
+    for i in range(0, len(order_ids), BATCH):
+        chunk = order_ids[i:i + BATCH]
+        conn.execute(f"{_POINTERS_SQL} WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+    if order_ids:
+        order_index.bump_versions(conn, [NOTES_SCOPE])
+
+
+def ensure_pointer_columns(conn):
+    """Add orders.latest_note_id / latest_user_note_id and the order_notes
+    index; the first time, point every order that has notes."""
+    has_notes = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'order_notes'").fetchone() is not None
+    if has_notes:
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_order_notes_order_private '
+                     'ON order_notes(order_id, customer_note, date_created)')
+    added = False
+    for ddl in (
+        'ALTER TABLE orders ADD COLUMN latest_note_id INTEGER',
+        'ALTER TABLE orders ADD COLUMN latest_user_note_id INTEGER',
+    ):
+        try:
+            conn.execute(ddl)
+            added = True
+        except sqlite3.OperationalError:
+            pass  # Column already exists
+    if added and has_notes:
+        conn.execute(f'{_POINTERS_SQL} WHERE id IN (SELECT DISTINCT order_id FROM order_notes)')
+    conn.commit()
+
+
+_schema_ready = False
+
+
+def ensure_schema(conn):
+    """Run ensure_pointer_columns once per process (the note sync calls this
+    before its first write, the web app at startup)."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    ensure_pointer_columns(conn)
+    _schema_ready = True
@@ -0,0 +1,135 @@
+"""Remembered liveness of remote media URLs (url_liveness table).
+
+repair_inline_images.py probed every candidate image with a GET, one after
+the other (20 s timeout each), and probed the same URL again for every
+product embedding it and on every run. Cloning
+(app._migrate_inline_images_after_clone) did not probe at all, so one dead
+source image made WC reject the whole sideload PUT.
+
+Fix: answers are stored per URL
+
+    url_liveness(url, alive, status, checked_at)
+
+alive       1 when the URL answered 200 (after redirects), else 0
+status      the HTTP status seen
+
+and reused for ALIVE_TTL_SECONDS / DEAD_TTL_SECONDS. check_urls() probes
+only the URLs without a fresh answer, concurrently (MAX_WORKERS threads, at
+most PER_HOST at a time against one host): HEAD first, GET (streamed, body
+not read) when the server does not answer HEAD with 200 / 404 / 410.
+Connection errors and timeouts are not stored, so they are retried on the
+next call instead of marking a URL dead for a day.
+
+check_urls() does not commit.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+
+ALIVE_TTL_SECONDS = 3 * 24 * 3600
+DEAD_TTL_SECONDS = 24 * 3600
+MAX_WORKERS = 16
+PER_HOST = 4
+TIMEOUT = 20
+
+USER_AGENT = 'WooCommerce API Client-Python/3.0.0'
+
+_TS = '%Y-%m-%d %H:%M:%S'
+
+
+def probe(url, timeout=TIMEOUT):
+    """(alive, status) for one URL; status None on a connection error."""
+    import requests as req
+
+    headers = {'User-Agent': USER_AGENT}
+    try:
+        r = req.head(url, timeout=timeout, allow_redirects=True, headers=headers)
+        if r.status_code in (200, 404, 410):
+            return r.status_code == 200, r.status_code
+        # 403 / 405 / 501 ...: plenty of servers only mishandle HEAD
+        r = req.get(url, timeout=timeout, stream=True, headers=headers)
+        r.close()
+        return r.status_code == 200, r.status_code
+    except Exception:
+        return False, None
+
+
+def cached(conn, urls, now=None):
+    """{url: alive} for the URLs with an answer younger than their TTL."""
+    urls = list(dict.fromkeys(u for u in urls if u))
+    now = now or datetime.now()
+    alive_after = (now - timedelta(seconds=ALIVE_TTL_SECONDS)).strftime(_TS)
+    dead_after = (now - timedelta(seconds=DEAD_TTL_SECONDS)).strftime(_TS)
+    result = {}
+    for i in range(0, len(urls), 500):
+        chunk = urls[i:i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        for url, alive, checked_at in conn.execute(
+                f'SELECT url, alive, checked_at FROM url_liveness WHERE url IN ({placeholders})', chunk):
+            if checked_at >= (alive_after if alive else dead_after):
+                result[url] = bool(alive)
+    return result
+
+
+def check_urls(conn, urls, now=None, max_workers=MAX_WORKERS, per_host=PER_HOST):
+    """{url: alive} for every URL, probing only those without a fresh answer.
+
+    New answers are written to url_liveness (not committed). URLs that could
+    not be reached at all count as dead for this call only.
+    """
+    urls = list(dict.fromkeys(u for u in urls if u))
+    result = cached(conn, urls, now)
+    todo = [u for u in urls if u not in result]
+    if not todo:
+        return result
+
+    slots = {}
+    slots_lock = threading.Lock()
+
+    def run(url):
+        host = urlparse(url).netloc.lower()
+        with slots_lock:
+            slot = slots.setdefault(host, threading.BoundedSemaphore(per_host))
+        with slot:
+            return url, probe(url)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(todo)))) as ex:
+        answers = list(ex.map(run, todo))
+
+    checked_at = (now or datetime.now()).strftime(_TS)
+    rows = []
+    for url, (alive, status) in answers:
+        result[url] = alive
+        if status is not None:
+            rows.append((url, int(alive), status, checked_at))
+    conn.executemany("""
+        INSERT INTO url_liveness (url, alive, status, checked_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(url) DO UPDATE SET
+            alive = excluded.alive, status = excluded.status, checked_at = excluded.checked_at
+    """, rows)
+    return result
+
+
+def ensure_liveness_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS url_liveness (
+            url TEXT PRIMARY KEY,
+            alive INTEGER NOT NULL,
+            status INTEGER,
+            checked_at TEXT NOT NULL
+        )
+    """)
+    conn.commit()
+
+
+_schema_ready = False
+
+
+def ensure_schema(conn):
+    """Run ensure_liveness_table once per process."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    ensure_liveness_table(conn)
+    _schema_ready = True
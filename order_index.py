@@ -0,0 +1,211 @@
+"""Derived per-order index columns (sargable date buckets).
+
+Month- and day-scoped pages used to filter with
+`strftime('%Y-%m', date_created) = ?` / `date(date_created) >= ?`. SQLite has
+to evaluate the function on every row, so no index on date_created can be
+used and every month page scanned the whole `orders` table.
+
+Fix: two plain TEXT columns stored next to date_created and kept in step by
+every writer:
+
+    year_month = "YYYY-MM"       (== strftime('%Y-%m', date_created))
+    day        = "YYYY-MM-DD"    (== date(date_created))
+
+Queries then filter with equality / range predicates (`year_month = ?`,
+`day BETWEEN ? AND ?`) which hit idx_orders_ym_source / idx_orders_day_source.
+
+WooCommerce always sends date_created as local ISO-8601
+("2025-03-14T10:22:05"), so slicing the string is exactly what strftime()
+returned before — no timezone shift is introduced.
+
+Like oid_utils.py, this module is the single source of truth. It is imported
+by the sync (sync_utils.py, 1.wooorders_sqlite.py) and the web app (app.py)
+so all writers derive the columns the same way.
+
+Data versions
+-------------
+`data_versions(scope, version)` holds monotonically increasing counters that
+writers bump when something a cached/derived view depends on changes:
+
+    orders:YYYY-MM     an order in that month was inserted / changed / deleted
+    <table name>       a settings table changed (product_costs, brands, ...)
+    sales_board:YYYY-MM  month-scoped sales-board settings (targets, profit
+                       settings, board exchange-rate overrides)
+    order_notes        an order note was added / changed / removed (every note
+                       writer goes through latest_note.refresh_orders)
+    customer_risk      an order's undelivered / problem-return flag changed
+                       (customer_risk_keys, app._build_risk_index)
+    reconciliation     partners, partner sites / users, statements, receipts
+    partners           partners' ratios / currency and partner sites only
+                       (app._calc_partner_recon_detail snapshots)
+    users              users and their site / country permissions
+    sites              site rows: API / sync status, country, flags
+    product_masters    WooMultistore master sites and their API status
+    user_preferences   per-user UI preferences
+    series             product series
+    all                bumped together with every other scope (GLOBAL_SCOPE)
+
+Readers compare the counters they saw when building a snapshot with the
+current ones; equal counters mean nothing relevant was written since. The
+sync only bumps a month when an order is new or its date_modified moved, so
+re-fetching an unchanged order window does not invalidate anything.
+
+`all` is the global counter: any write anywhere moves it. Views that read too
+many tables to list their scopes (app.conditional_json, the ETag on the polled
+JSON APIs) compare just this one.
+"""
+import sqlite3
+
+GLOBAL_SCOPE = 'all'
+
+
+def date_keys(date_created):
+    """Return (year_month, day) for an order's date_created string.
+
+    Returns (None, None) when the value is missing or not ISO-shaped, which
+    matches strftime() yielding NULL for those rows.
+    """
+    if not date_created:
+        return None, None
+    s = str(date_created)
+    if len(s) < 10 or s[4] != '-' or s[7] != '-':
+        return None, None
+    return s[:7], s[:10]
+
+
+def ensure_date_columns(conn):
+    """Add + backfill orders.year_month / orders.day and their indexes.
+
+    Idempotent and cheap after the first run: the backfill only touches rows
+    whose columns are still NULL (pre-migration rows, or rows written by an
+    older sync process that didn't know about the columns yet).
+    """
+    for ddl in (
+        'ALTER TABLE orders ADD COLUMN year_month TEXT',
+        'ALTER TABLE orders ADD COLUMN day TEXT',
+    ):
+        try:
+            conn.execute(ddl)
+        except sqlite3.OperationalError:
+            pass  # Column already exists
+    conn.execute("""
+        UPDATE orders
+        SET year_month = substr(date_created, 1, 7),
+            day        = substr(date_created, 1, 10)
+        WHERE (year_month IS NULL OR day IS NULL)
+          AND date_created IS NOT NULL AND length(date_created) >= 10
+    """)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_ym_source ON orders(year_month, source)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_day_source ON orders(day, source)')
+    conn.commit()
+
+
+def ensure_version_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS data_versions (
+            scope TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT
+        )
+    """)
+    conn.commit()
+
+
+def orders_scope(year_month):
+    return f'orders:{year_month}'
+
+
+def bump_versions(conn, scopes):
+    """Increment the counter of every scope (created at 1 if missing), and
+    GLOBAL_SCOPE with them.
+
+    Does not commit — the bump belongs to the caller's write transaction so a
+    rolled-back write never invalidates anything.
+    """
+    scopes = {s for s in scopes if s}
+    if not scopes:
+        return
+    scopes = sorted(scopes | {GLOBAL_SCOPE})
+    conn.executemany("""
+        INSERT INTO data_versions (scope, version, updated_at)
+        VALUES (?, 1, datetime('now'))
+        ON CONFLICT(scope) DO UPDATE SET
+            version = version + 1,
+            updated_at = excluded.updated_at
+    """, [(s,) for s in scopes])
+
+
+def bump_order_months(conn, order_ids):
+    """Bump orders:<year_month> for the months the given order ids live in.
+
+    Call it BEFORE a DELETE (the rows must still exist to find their month);
+    for UPDATEs either side of the statement works.
+    """
+    order_ids = [str(i) for i in order_ids if i is not None]
+    months = set()
+    for i in range(0, len(order_ids), 500):
+        chunk = order_ids[i:i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        for row in conn.execute(
+                f'SELECT DISTINCT year_month FROM orders WHERE id IN ({placeholders})', chunk):
+            if row[0]:
+                months.add(row[0])
+    bump_versions(conn, [orders_scope(m) for m in months])
+    return months
+
+
+def changed_upsert_months(conn, rows):
+    """Months an upsert batch actually changes.
+
+    rows: iterable of (id, date_modified, year_month) for the incoming orders.
+    An order counts as changed when it is new, its date_modified differs from
+    the stored one, or it moved month (both months are returned then).
+    """
+    rows = list(rows)
+    stored = {}
+    ids = [r[0] for r in rows]
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        for row in conn.execute(
+                f'SELECT id, date_modified, year_month FROM orders WHERE id IN ({placeholders})', chunk):
+            stored[row[0]] = (row[1], row[2])
+    months = set()
+    for oid, date_modified, year_month in rows:
+        old = stored.get(oid)
+        if old is None or old[0] != date_modified or old[1] != year_month:
+            if year_month:
+                months.add(year_month)
+            if old is not None and old[1] and old[1] != year_month:
+                months.add(old[1])
+    return months
+
+
+def get_versions(conn, scopes):
+    """{scope: version} for the given scopes (0 for never-bumped scopes)."""
+    scopes = list(scopes)
+    versions = {s: 0 for s in scopes}
+    if not scopes:
+        return versions
+    placeholders = ','.join('?' * len(scopes))
+    for row in conn.execute(
+            f'SELECT scope, version FROM data_versions WHERE scope IN ({placeholders})', scopes):
+        versions[row[0]] = row[1]
+    return versions
+
+
+_schema_ready = False
+
+
+def ensure_schema(conn):
+    """Run this module's idempotent migrations once per process.
+
+    Called by the sync writers before their first upsert so a cron sync that
+    starts before the web app has been restarted still finds the columns.
+    """
+    global _schema_ready
+    if _schema_ready:
+        return
+    ensure_date_columns(conn)
+    ensure_version_table(conn)
+    _schema_ready = True
@@ -0,0 +1,268 @@
+"""Full-text search index over orders (SQLite FTS5, trigram tokenizer).
+
+The order search boxes (/orders, /shipping, reconciliation, tracking lookup)
+used `LIKE '%term%'` over number, id and the raw billing / shipping /
+meta_data / line_items / shipping_lines JSON, plus a shipping_logs subquery.
+That is a full scan through multi-KB blobs per search, and it gets slower
+with every archived order.
+
+Fix: `orders_fts` keeps one small document per order:
+
+    order_id   "<sites.id>-<woo_id>"  (see oid_utils.py)
+    number     WC order number
+    customer   billing + shipping name / company / email / phone / address
+    products   line item names + SKUs
+    tracking   tracking numbers: AST / VillaTheme / custom line-item meta,
+               shipping_lines meta and our shipping_logs
+    notes      customer note + local undelivered / problem-return notes
+
+The trigram tokenizer indexes every 3-character window, so MATCH on a quoted
+phrase is a case-insensitive substring match — what the LIKE did, answered
+from the index. Terms shorter than 3 characters can't use it; match_clause()
+returns None for them and callers keep their LIKE path.
+
+Writers call index_orders() after changing an indexed field (sync upsert,
+ship / mark endpoints) and remove_orders() before deleting orders, inside
+their own transaction. Like order_index.py, this module is imported by both
+the sync scripts and app.py so all writers build the same document.
+
+SQLite builds without FTS5: ensure_schema() notes the table is missing,
+index/remove become no-ops and match_clause() returns None (LIKE fallback).
+"""
+import json
+import sqlite3
+
+FTS_TABLE = 'orders_fts'
+MIN_TERM_LEN = 3  # trigram tokens are 3 chars; shorter terms can't hit the index
+BACKFILL_BATCH = 500
+
+_NOTE_COLUMNS = ('customer_note', 'undelivered_note', 'problem_return_note')
+_ADDRESS_FIELDS = ('first_name', 'last_name', 'company', 'email', 'phone',
+                   'address_1', 'address_2', 'city', 'state', 'postcode')
+
+_available = None     # orders_fts exists in this DB (None = not checked yet)
+_note_columns = None  # subset of _NOTE_COLUMNS present on orders
+_has_logs = None      # shipping_logs exists
+
+
+def _load_json(value):
+    if not value:
+        return None
+    if isinstance(value, (dict, list)):
+        return value
+    try:
+        return json.loads(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _tracking_values(value, out):
+    """Collect tracking_number values from a (possibly JSON-encoded) meta value.
+
+    AST stores a list of dicts, VillaTheme a JSON *string* holding a list of
+    dicts, custom sites a bare string under a 'tracking_number' key.
+    """
+    if isinstance(value, str):
+        parsed = _load_json(value) if value[:1] in '[{' else None
+        if parsed is None:
+            return
+        value = parsed
+    if isinstance(value, list):
+        for v in value:
+            _tracking_values(v, out)
+    elif isinstance(value, dict):
+        for k, v in value.items():
+            if k == 'tracking_number' and isinstance(v, (str, int)) and str(v).strip():
+                out.append(str(v).strip())
+            elif isinstance(v, (list, dict, str)):
+                _tracking_values(v, out)
+
+
+def _meta_tracking(meta_list, out):
+    for m in meta_list or []:
+        if not isinstance(m, dict):
+            continue
+        key = str(m.get('key') or '')
+        if 'tracking' not in key.lower():
+            continue
+        value = m.get('value')
+        if key.lstrip('_') == 'tracking_number':
+            if isinstance(value, (str, int)) and str(value).strip():
+                out.append(str(value).strip())
+        else:
+            _tracking_values(value, out)
+
+
+def build_document(row, log_numbers=()):
+    """(number, customer, products, tracking, notes) text for one orders row.
+
+    row is a dict with number, billing, shipping, line_items, meta_data,
+    shipping_lines and whichever note columns exist.
+    """
+    customer = []
+    for col in ('billing', 'shipping'):
+        addr = _load_json(row[col])
+        if isinstance(addr, dict):
+            customer.extend(str(addr[f]).strip() for f in _ADDRESS_FIELDS if addr.get(f))
+    # Billing and shipping usually repeat the same name / address.
+    customer = list(dict.fromkeys(c for c in customer if c))
+
+    products = []
+    tracking = []
+    line_items = _load_json(row['line_items'])
+    if isinstance(line_items, list):
+        for item in line_items:
+            if not isinstance(item, dict):
+                continue
+            products.extend(str(item[f]) for f in ('name', 'sku') if item.get(f))
+            _meta_tracking(item.get('meta_data'), tracking)
+    meta = _load_json(row['meta_data'])
+    if isinstance(meta, list):
+        _meta_tracking(meta, tracking)
+    shipping_lines = _load_json(row['shipping_lines'])
+    if isinstance(shipping_lines, list):
+        for line in shipping_lines:
+            if isinstance(line, dict):
+                _meta_tracking(line.get('meta_data'), tracking)
+    tracking.extend(str(t).strip() for t in log_numbers if t and str(t).strip())
+
+    notes = [str(row[c]) for c in _NOTE_COLUMNS if row.get(c)]
+
+    return (
+        str(row['number'] or ''),
+        ' | '.join(customer),
+        ' | '.join(dict.fromkeys(products)),
+        ' '.join(dict.fromkeys(tracking)),
+        ' | '.join(notes),
+    )
+
+
+def _probe(conn):
+    global _available, _note_columns, _has_logs
+    _available = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (FTS_TABLE,)).fetchone() is not None
+    cols = {r[1] for r in conn.execute('PRAGMA table_info(orders)')}
+    _note_columns = [c for c in _NOTE_COLUMNS if c in cols]
+    _has_logs = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'shipping_logs'").fetchone() is not None
+
+
+def _delete_docs(conn, order_ids):
+    for oid in order_ids:
+        if len(oid) < MIN_TERM_LEN:
+            # Too short for a trigram MATCH (legacy bare ids) — plain scan.
+            conn.execute(f'DELETE FROM {FTS_TABLE} WHERE order_id = ?', (oid,))
+            continue
+        phrase = '"' + oid.replace('"', '""') + '"'
+        # The MATCH finds the candidates through the index (trigram = substring,
+        # so "14-90" also hits "14-901"); the equality keeps the exact one.
+        conn.execute(
+            f'DELETE FROM {FTS_TABLE} WHERE rowid IN ('
+            f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH ? AND order_id = ?)',
+            (f'order_id : {phrase}', oid))
+
+
+def _insert_docs(conn, order_ids):
+    note_sql = ''.join(f', {c}' for c in _note_columns)
+    for i in range(0, len(order_ids), BACKFILL_BATCH):
+        chunk = order_ids[i:i + BACKFILL_BATCH]
+        placeholders = ','.join('?' * len(chunk))
+        logs = {}
+        if _has_logs:
+            for r in conn.execute(
+                    f'SELECT order_id, tracking_number FROM shipping_logs WHERE order_id IN ({placeholders})', chunk):
+                logs.setdefault(str(r[0]), []).append(r[1])
+        cur = conn.execute(
+            f'SELECT id, number, billing, shipping, line_items, meta_data, shipping_lines{note_sql} '
+            f'FROM orders WHERE id IN ({placeholders})', chunk)
+        names = [d[0] for d in cur.description]  # sync connections have no Row factory
+        rows = [dict(zip(names, r)) for r in cur.fetchall()]
+        conn.executemany(
+            f'INSERT INTO {FTS_TABLE} (order_id, number, customer, products, tracking, notes) '
+            f'VALUES (?, ?, ?, ?, ?, ?)',
+            [(str(r['id']),) + build_document(r, logs.get(str(r['id']), ())) for r in rows])
+
+
+def index_orders(conn, order_ids):
+    """(Re)build the search documents of the given orders. Does not commit."""
+    if _available is None:
+        _probe(conn)
+    if not _available:
+        return
+    order_ids = list(dict.fromkeys(str(i) for i in order_ids if i is not None))
+    if not order_ids:
+        return
+    _delete_docs(conn, order_ids)
+    _insert_docs(conn, order_ids)
+
+
+def remove_orders(conn, order_ids):
+    """Drop the search documents of orders about to be deleted. Does not commit."""
+    if _available is None:
+        _probe(conn)
+    if not _available:
+        return
+    _delete_docs(conn, [str(i) for i in order_ids if i is not None])
+
+
+def ensure_search_index(conn):
+    """Create orders_fts and index any order that has no document yet.
+
+    The first run indexes the whole archive in batches; afterwards the count
+    check is all it costs. Stale documents (orders deleted by a tool that
+    doesn't know about the index) are dropped at the same time.
+    """
+    try:
+        conn.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+                order_id, number, customer, products, tracking, notes,
+                tokenize = 'trigram'
+            )
+        """)
+    except sqlite3.OperationalError:
+        pass  # No FTS5 / trigram in this SQLite build → LIKE fallback
+    _probe(conn)
+    if _has_logs:
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_shipping_logs_order ON shipping_logs(order_id)')
+    if not _available:
+        conn.commit()
+        return
+    indexed = conn.execute(f'SELECT COUNT(*) FROM {FTS_TABLE}').fetchone()[0]
+    total = conn.execute('SELECT COUNT(*) FROM orders').fetchone()[0]
+    if indexed != total:
+        conn.execute(f'DELETE FROM {FTS_TABLE} WHERE order_id NOT IN (SELECT id FROM orders)')
+        missing = [r[0] for r in conn.execute(
+            f'SELECT id FROM orders WHERE id NOT IN (SELECT order_id FROM {FTS_TABLE})')]
+        for i in range(0, len(missing), BACKFILL_BATCH):
+            _insert_docs(conn, missing[i:i + BACKFILL_BATCH])
+            conn.commit()
+    conn.commit()
+
+
+def match_clause(term, columns=None, id_column='id'):
+    """SQL condition + params restricting id_column to orders matching term.
+
+    columns limits the match to some document columns (e.g. ('number',
+    'tracking')). Returns None when the index can't answer — term shorter
+    than MIN_TERM_LEN or no FTS5 — so the caller keeps its LIKE condition.
+    """
+    term = (term or '').strip()
+    if not _available or len(term) < MIN_TERM_LEN:
+        return None
+    query = '"' + term.replace('"', '""') + '"'
+    if columns:
+        query = '{' + ' '.join(columns) + '} : ' + query
+    return f'{id_column} IN (SELECT order_id FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH ?)', [query]
+
+
+_schema_ready = False
+
+
+def ensure_schema(conn):
+    """Run ensure_search_index once per process (sync writers call this before
+    their first upsert, the web app at startup)."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    ensure_search_index(conn)
+    _schema_ready = True
@@ -0,0 +1,260 @@
+"""Extracted tracking numbers per order (order_tracking table).
+
+Tracking numbers live in a different place per WooCommerce plugin: Advanced
+Shipment Tracking (`_wc_shipment_tracking_items`), VillaTheme Orders Tracking
+(`_vi_wot_order_item_tracking_data` on line items, a JSON *string*), custom
+`tracking_number` line-item / shipping-line meta, a bare `_tracking_number`,
+and our own shipping_logs. process_shipped_order, find_orders_by_tracking and
+resolve_outcomes.py each re-parsed the meta_data / line_items / shipping_lines
+JSON of every row they touched, and the tracking lookup had to cap its
+candidate list at 200 to keep that affordable.
+
+Fix: the numbers are extracted once, when an order is written (sync upsert,
+ship endpoint), into
+
+    order_tracking(order_id, tracking_number, provider, carrier_name,
+                   carrier_url, source_kind, shipped_at, rank)
+
+source_kind   log | ast | villatheme | lineitem | shipping_line | meta
+provider      the raw slug the source carried (shipping_logs.carrier_slug,
+              AST tracking_provider, VillaTheme carrier_slug, _tracking_provider)
+rank          the order readers must honour: shipping_logs newest first, then
+              AST items, line-item meta (document order), shipping_lines,
+              _tracking_number — the priority process_shipped_order always used.
+
+Readers pick the first row by rank, or skip 'log' rows when they want what
+the site itself reports. tracking_number is COLLATE NOCASE, so
+`tracking_number = ?` and `LIKE 'prefix%'` are index seeks.
+
+Writers call refresh_orders() after changing an order's meta or shipping_logs
+and remove_orders() before deleting orders, inside their own transaction. Like
+order_index.py / order_search.py, this module is imported by the sync scripts,
+resolve_outcomes.py and app.py so all of them extract the same way.
+"""
+import json
+from datetime import datetime
+
+BACKFILL_BATCH = 500
+
+_has_logs = None  # shipping_logs exists (None = not checked yet)
+
+
+def _load_json(value):
+    if not value:
+        return None
+    if isinstance(value, (dict, list)):
+        return value
+    try:
+        return json.loads(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _timestamp(value):
+    """Unix timestamp (AST date_shipped / VillaTheme time) -> local datetime string."""
+    if not value:
+        return None
+    try:
+        return datetime.fromtimestamp(int(value)).strftime('%Y-%m-%d %H:%M:%S')
+    except (TypeError, ValueError, OverflowError, OSError):
+        return None
+
+
+def _record(kind, number, provider='', carrier_name='', carrier_url='', shipped_at=None):
+    return {
+        'tracking_number': number,
+        'provider': provider or '',
+        'carrier_name': carrier_name or '',
+        'carrier_url': carrier_url or '',
+        'source_kind': kind,
+        'shipped_at': shipped_at,
+    }
+
+
+def extract_records(row, logs=()):
+    """Tracking records of one order, in rank order.
+
+    row: dict with meta_data, line_items and shipping_lines (raw JSON or
+    parsed). logs: shipping_logs rows as (tracking_number, carrier_slug,
+    shipped_at), newest first.
+    """
+    records = []
+    for number, slug, shipped_at in logs:
+        number = str(number or '').strip()
+        if number:
+            records.append(_record('log', number, slug, shipped_at=shipped_at))
+
+    meta = _load_json(row.get('meta_data'))
+    meta = meta if isinstance(meta, list) else []
+    for m in meta:
+        if isinstance(m, dict) and m.get('key') == '_wc_shipment_tracking_items':
+            items = m.get('value')
+            for item in items if isinstance(items, list) else []:
+                if isinstance(item, dict) and str(item.get('tracking_number') or '').strip():
+                    records.append(_record(
+                        'ast', str(item['tracking_number']).strip(),
+                        str(item.get('tracking_provider') or ''),
+                        shipped_at=_timestamp(item.get('date_shipped'))))
+            break
+
+    line_items = _load_json(row.get('line_items'))
+    for item in line_items if isinstance(line_items, list) else []:
+        if not isinstance(item, dict):
+            continue
+        for m in item.get('meta_data') or []:
+            if not isinstance(m, dict):
+                continue
+            if m.get('key') == '_vi_wot_order_item_tracking_data':
+                tracks = _load_json(m.get('value'))
+                for track in tracks if isinstance(tracks, list) else []:
+                    if isinstance(track, dict) and str(track.get('tracking_number') or '').strip():
+                        records.append(_record(
+                            'villatheme', str(track['tracking_number']).strip(),
+                            str(track.get('carrier_slug') or ''),
+                            str(track.get('carrier_name') or ''),
+                            str(track.get('carrier_url') or ''),
+                            _timestamp(track.get('time'))))
+            elif m.get('key') == 'tracking_number' and str(m.get('value') or '').strip():
+                records.append(_record('lineitem', str(m['value']).strip()))
+
+    shipping_lines = _load_json(row.get('shipping_lines'))
+    for line in shipping_lines if isinstance(shipping_lines, list) else []:
+        if not isinstance(line, dict):
+            continue
+        for m in line.get('meta_data') or []:
+            if isinstance(m, dict) and m.get('key') == 'tracking_number' and str(m.get('value') or '').strip():
+                records.append(_record('shipping_line', str(m['value']).strip()))
+
+    provider = ''
+    for m in meta:
+        if isinstance(m, dict) and m.get('key') == '_tracking_provider':
+            provider = str(m.get('value') or '')
+    for m in meta:
+        if isinstance(m, dict) and m.get('key') == '_tracking_number' and str(m.get('value') or '').strip():
+            records.append(_record('meta', str(m['value']).strip(), provider))
+    return records
+
+
+def _probe(conn):
+    global _has_logs
+    _has_logs = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'shipping_logs'").fetchone() is not None
+
+
+def _insert_records(conn, order_ids):
+    for i in range(0, len(order_ids), BACKFILL_BATCH):
+        chunk = order_ids[i:i + BACKFILL_BATCH]
+        placeholders = ','.join('?' * len(chunk))
+        logs = {}
+        if _has_logs:
+            for r in conn.execute(
+                    f'SELECT order_id, tracking_number, carrier_slug, shipped_at FROM shipping_logs '
+                    f'WHERE order_id IN ({placeholders}) ORDER BY id DESC', chunk):
+                logs.setdefault(str(r[0]), []).append((r[1], r[2], r[3]))
+        cur = conn.execute(
+            f'SELECT id, meta_data, line_items, shipping_lines FROM orders WHERE id IN ({placeholders})', chunk)
+        names = [d[0] for d in cur.description]  # sync connections have no Row factory
+        values = []
+        for r in cur.fetchall():
+            r = dict(zip(names, r))
+            oid = str(r['id'])
+            for rank, rec in enumerate(extract_records(r, logs.get(oid, ()))):
+                values.append((oid, rec['tracking_number'], rec['provider'], rec['carrier_name'],
+                               rec['carrier_url'], rec['source_kind'], rec['shipped_at'], rank))
+        conn.executemany(
+            'INSERT INTO order_tracking (order_id, tracking_number, provider, carrier_name, '
+            'carrier_url, source_kind, shipped_at, rank) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', values)
+
+
+def remove_orders(conn, order_ids):
+    """Drop the tracking rows of orders about to be deleted. Does not commit."""
+    order_ids = [str(i) for i in order_ids if i is not None]
+    for i in range(0, len(order_ids), BACKFILL_BATCH):
+        chunk = order_ids[i:i + BACKFILL_BATCH]
+        conn.execute(f"DELETE FROM order_tracking WHERE order_id IN ({','.join('?' * len(chunk))})", chunk)
+
+
+def refresh_orders(conn, order_ids):
+    """Re-extract the tracking rows of the given orders. Does not commit."""
+    if _has_logs is None:
+        _probe(conn)
+    order_ids = list(dict.fromkeys(str(i) for i in order_ids if i is not None))
+    if not order_ids:
+        return
+    remove_orders(conn, order_ids)
+    _insert_records(conn, order_ids)
+
+
+def load(conn, order_ids):
+    """{order_id: [record dict, ...]} in rank order for the given orders."""
+    order_ids = list(dict.fromkeys(str(i) for i in order_ids if i is not None))
+    result = {}
+    for i in range(0, len(order_ids), BACKFILL_BATCH):
+        chunk = order_ids[i:i + BACKFILL_BATCH]
+        cur = conn.execute(
+            f'SELECT order_id, tracking_number, provider, carrier_name, carrier_url, source_kind, shipped_at '
+            f"FROM order_tracking WHERE order_id IN ({','.join('?' * len(chunk))}) ORDER BY order_id, rank", chunk)
+        names = [d[0] for d in cur.description]
+        for r in cur.fetchall():
+            r = dict(zip(names, r))
+            result.setdefault(r.pop('order_id'), []).append(r)
+    return result
+
+
+def site_record(records):
+    """First record the site itself reports (skips our shipping_logs), or None."""
+    return next((r for r in records or [] if r['source_kind'] != 'log'), None)
+
+
+def lookup_clause(term, id_column='id'):
+    """SQL condition + params: id_column has a tracking number equal to or
+    starting with term (case-insensitive, answered by idx_order_tracking_number)."""
+    return (f'{id_column} IN (SELECT order_id FROM order_tracking WHERE tracking_number LIKE ?)',
+            [(term or '').strip() + '%'])
+
+
+def ensure_tracking_table(conn):
+    """Create order_tracking and, the first time, extract every order into it.
+
+    Table and backfill share one transaction: a backfill interrupted half-way
+    leaves no table behind, so the next start simply runs it again.
+    """
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute('BEGIN')
+    created = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'order_tracking'").fetchone() is None
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS order_tracking (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id TEXT NOT NULL,
+            tracking_number TEXT NOT NULL COLLATE NOCASE,
+            provider TEXT,
+            carrier_name TEXT,
+            carrier_url TEXT,
+            source_kind TEXT NOT NULL,
+            shipped_at TEXT,
+            rank INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_order_tracking_number ON order_tracking(tracking_number)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_order_tracking_order ON order_tracking(order_id, rank)')
+    _probe(conn)
+    if created:
+        ids = [r[0] for r in conn.execute('SELECT id FROM orders')]
+        for i in range(0, len(ids), BACKFILL_BATCH):
+            _insert_records(conn, ids[i:i + BACKFILL_BATCH])
+    conn.commit()
+
+
+_schema_ready = False
+
+
+def ensure_schema(conn):
+    """Run ensure_tracking_table once per process (sync writers call this before
+    their first upsert, the web app at startup)."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    ensure_tracking_table(conn)
+    _schema_ready = True
@@ -14,6 +14,11 @@ Usage:
   venv/bin/python repair_inline_images.py --apply     # actually fix
   venv/bin/python repair_inline_images.py --master-id 3 --apply
   venv/bin/python repair_inline_images.py --apply --only 11345,9946
+
+Source links are checked for the whole page of products at once,
+concurrently, and the answers are remembered in url_liveness (see
+link_check.py), so reruns and other products embedding the same image do
+not probe it again.
 """
 import argparse
 import re
@@ -23,6 +28,8 @@ from urllib.parse import urlparse
 
 import requests as req
 
+import link_check
+
 DB = '/www/wwwroot/woo-analysis/woocommerce_orders.db'
 WC_HEADERS = {
     'User-Agent': 'WooCommerce API Client-Python/3.0.0',
@@ -88,17 +95,15 @@ def parse(resp):
         return None, f'非JSON响应: {resp.text[:200]}'
 
 
-def url_alive(u):
-    try:
-        r = req.get(u, timeout=20, stream=True,
-                    headers={'User-Agent': WC_HEADERS['User-Agent']})
-        r.close()
-        return r.status_code == 200
-    except Exception:
-        return False
+def leaked_image_urls(p, fam):
+    """Source URLs of p's leaked images (what repair_product will probe)."""
+    html = (p.get('description', '') or '') + '\n' + (p.get('short_description', '') or '')
+    order, groups, _oth_order, _oth_groups = extract_leaked(html, fam)
+    return [groups[k]['submit'] for k in order]
 
 
-def repair_product(base, ck, cs, p, fam, apply):
+def repair_product(base, ck, cs, p, fam, apply, alive=None):
+    """alive: {url: bool} from link_check.check_urls for this product's images."""
     pid = p['id']
     desc = p.get('description', '') or ''
     short = p.get('short_description', '') or ''
@@ -118,8 +123,9 @@ def repair_product(base, ck, cs, p, fam, apply):
 
     # Drop dead source links (can't re-host a deleted image).
     live_keys = []
+    alive = alive or {}
     for k in order:
-        if url_alive(groups[k]['submit']):
+        if alive.get(groups[k]['submit']):
             live_keys.append(k)
         else:
             info['dead'] += 1
@@ -199,9 +205,10 @@ def main():
     conn.row_factory = sqlite3.Row
     m = conn.execute('SELECT url, consumer_key, consumer_secret FROM product_masters WHERE id=?',
                      (args.master_id,)).fetchone()
-    conn.close()
     if not m:
+        conn.close()
         print(f'master id {args.master_id} 不存在'); sys.exit(1)
+    link_check.ensure_schema(conn)
     base = m['url'].rstrip('/')
     ck, cs = m['consumer_key'], m['consumer_secret']
     fam = family_domain(urlparse(base).netloc)
@@ -219,10 +226,14 @@ def main():
             print('拉取产品失败:', err); break
         if not data:
             break
-        for p in data:
-            if only and p['id'] not in only:
-                continue
-            r = repair_product(base, ck, cs, p, fam, args.apply)
+        todo = [p for p in data if not only or p['id'] in only]
+        alive = {}
+        if args.apply:
+            # one concurrent, cached liveness pass for the whole page
+            alive = link_check.check_urls(conn, [u for p in todo for u in leaked_image_urls(p, fam)])
+            conn.commit()
+        for p in todo:
+            r = repair_product(base, ck, cs, p, fam, args.apply, alive)
             if r:
                 affected.append(r)
                 print(f"  [{r['status']:>7}] ID {r['id']:<6} 图片{r['leaked']:>2} "
@@ -232,6 +243,7 @@ def main():
             break
         page += 1
 
+    conn.close()
     print('=' * 78)
     tot_leaked = sum(a['leaked'] for a in affected)
     tot_video = sum(a['video'] for a in affected)
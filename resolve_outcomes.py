@@ -38,6 +38,8 @@ os.chdir(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 import carrier_tracking as ct
+import order_tracking  # tracking numbers extracted at sync time
+import order_index  # data_versions bump on carrier_status change
 
 DB_FILE = 'woocommerce_orders.db'
 DEFAULT_MIN_AGE_DAYS = 7
@@ -55,55 +57,16 @@ def get_setting(conn, key):
     return row['value'] if row else None
 
 
-def extract_tracking(order):
-    """Mirror app.process_shipped_order priority. Returns (number, provider)."""
-    try:
-        md = json.loads(order['meta_data'] or '[]')
-    except (ValueError, TypeError):
-        md = []
-    try:
-        li = json.loads(order['line_items'] or '[]')
-    except (ValueError, TypeError):
-        li = []
-    try:
-        sl = json.loads(order['shipping_lines'] or '[]')
-    except (ValueError, TypeError):
-        sl = []
-
-    for m in md if isinstance(md, list) else []:
-        if isinstance(m, dict) and m.get('key') == '_wc_shipment_tracking_items':
-            v = m.get('value') or []
-            if isinstance(v, list) and v and isinstance(v[0], dict) and v[0].get('tracking_number'):
-                return str(v[0]['tracking_number']).strip(), str(v[0].get('tracking_provider', ''))
-    for it in li if isinstance(li, list) else []:
-        if not isinstance(it, dict):
-            continue
-        for m in it.get('meta_data', []):
-            if not isinstance(m, dict):
-                continue
-            if m.get('key') == '_vi_wot_order_item_tracking_data':
-                try:
-                    td = m.get('value')
-                    td = json.loads(td) if isinstance(td, str) else td
-                    if isinstance(td, list) and td and td[0].get('tracking_number'):
-                        return str(td[0]['tracking_number']).strip(), str(td[0].get('carrier_slug') or td[0].get('carrier_name') or '')
-                except (ValueError, TypeError, AttributeError, KeyError):
-                    pass
-            if m.get('key') == 'tracking_number' and str(m.get('value', '')).strip():
-                return str(m['value']).strip(), ''
-    for it in sl if isinstance(sl, list) else []:
-        if isinstance(it, dict):
-            for m in it.get('meta_data', []):
-                if isinstance(m, dict) and m.get('key') == 'tracking_number' and str(m.get('value', '')).strip():
-                    return str(m['value']).strip(), ''
-    provider = ''
-    for m in md if isinstance(md, list) else []:
-        if isinstance(m, dict) and m.get('key') == '_tracking_provider':
-            provider = str(m.get('value', ''))
-    for m in md if isinstance(md, list) else []:
-        if isinstance(m, dict) and m.get('key') == '_tracking_number' and str(m.get('value', '')).strip():
-            return str(m['value']).strip(), provider
-    return None, ''
+def extract_tracking(records):
+    """Mirror app.process_shipped_order priority over the order's order_tracking
+    rows (shipping_logs excluded). Returns (number, provider)."""
+    rec = order_tracking.site_record(records)
+    if not rec:
+        return None, ''
+    provider = rec['provider']
+    if rec['source_kind'] == 'villatheme':
+        provider = provider or rec['carrier_name']
+    return rec['tracking_number'], provider
 
 
 def fetch_candidates(conn, min_age_days, limit, recheck_hours, live, au_sites=None):
@@ -129,7 +92,7 @@ def fetch_candidates(conn, min_age_days, limit, recheck_hours, live, au_sites=No
         pay_clause = "payment_method = 'cod'"
     params.append(cutoff)
     q = f"""
-        SELECT id, number, date_created, billing, meta_data, line_items, shipping_lines
+        SELECT id, number, date_created, billing
         FROM orders
         WHERE {pay_clause}
           AND status IN ('on-hold', 'shipped', 'partial-shipped')
@@ -147,6 +110,7 @@ def fetch_candidates(conn, min_age_days, limit, recheck_hours, live, au_sites=No
 def write_status(conn, order_id, outcome):
     conn.execute("UPDATE orders SET carrier_status=?, carrier_status_at=datetime('now') WHERE id=?",
                  (outcome, order_id))
+    order_index.bump_order_months(conn, [order_id])
 
 
 def main():
@@ -161,6 +125,8 @@ def main():
     live = args.live
 
     conn = get_conn()
+    order_tracking.ensure_schema(conn)  # first run before the web app restarted: extract now
+    order_index.ensure_schema(conn)  # data_versions for the carrier_status bumps
     has_cols = 'carrier_status' in {r[1] for r in conn.execute("PRAGMA table_info(orders)")}
     if live and not has_cols:
         print("ERROR: carrier_status columns missing. ALTER TABLE orders ADD COLUMN carrier_status TEXT / carrier_status_at TEXT first.")
@@ -175,6 +141,7 @@ def main():
         au_sites = [r['url'] for r in conn.execute("SELECT url FROM sites WHERE country='AU'").fetchall()]
 
     candidates = fetch_candidates(conn, args.min_age_days, args.limit, args.recheck_hours, live, au_sites)
+    tracking = order_tracking.load(conn, [o['id'] for o in candidates])
     print(f"[{datetime.now():%Y-%m-%d %H:%M:%S}] resolve_outcomes "
           f"{'LIVE' if live else 'DRY-RUN'} — {len(candidates)} candidates, carrier={args.carrier}, "
           f"AU auto-track={'ON' if au_enabled else 'OFF'}({len(au_sites)} sites)")
@@ -185,7 +152,7 @@ def main():
     generic = []  # (order_id, number, provider) — EMS/中国邮政/Australia Post/… via Track718 auto-detect
     skipped = Counter()
     for o in candidates:
-        number, provider = extract_tracking(o)
+        number, provider = extract_tracking(tracking.get(o['id']))
         if not number:
             skipped['no_tracking'] += 1
             continue
@@ -0,0 +1,312 @@
+"""Precomputed shipping-queue display fields (shipping_view table).
+
+/api/shipping/pending, /pending-outcome and /shipped returned the whole
+queue on every poll, and for every row parsed billing, shipping,
+line_items, meta_data and shipping_lines, rebuilt the address
+(compose_address + the DPD fallback from extract_custom_billing_fields)
+and normalized email / phone / address for the risk lookup. On a busy day
+the shipping page waited for all of it before showing the first row.
+
+Fix: the fields are derived once, when an order is written (sync upsert),
+into one compact row per order
+
+    shipping_view(order_id, customer_name, customer_email, customer_phone,
+                  customer_address, customer_address_2, state_mismatch,
+                  inpost_id, social, products, product_summary,
+                  product_count, shipping_method, email_key, phone_key,
+                  addr_key, built_at)
+
+customer_address  compose_address() of shipping (billing when shipping has
+                  no address_1), or the DPD custom billing fields when
+                  neither has a street
+state_mismatch    expected AU state(s) when the chosen state cannot hold the
+                  postcode, else NULL
+products          JSON [{name, quantity, total}] in line-item order
+product_summary   "name ×qty; ..." for print / export views
+*_key             identity_graph.order_keys() — what app._build_risk_index
+                  is matched against, so the queues never parse billing /
+                  shipping just to assess risk
+
+The queue endpoints join this table to filter / sort in SQL and load it
+for the rows of the requested page only. Writers call refresh_orders()
+after their upsert and remove_orders() before deleting orders, inside
+their own transaction (neither commits). load() derives rows that are
+missing (an order written by a process that predates the table) on the
+fly without storing them.
+"""
+import json
+from datetime import datetime
+
+from identity_graph import order_keys
+
+BATCH = 500
+
+# AU postcode -> expected state (Australia Post ranges). Checkout's state
+# dropdown is customer-chosen and never validated by WC, so e.g. Perth+6000
+# can arrive with state=ACT. Gray-zone ranges list every state they can
+# legitimately belong to, so only impossible combinations get flagged.
+_AU_POSTCODE_STATES = (
+    ((200, 299), {'ACT'}), ((800, 999), {'NT'}),
+    ((1000, 2599), {'NSW'}), ((2600, 2620), {'ACT', 'NSW'}),
+    ((2621, 2899), {'NSW'}), ((2900, 2920), {'ACT', 'NSW'}),
+    ((2921, 2999), {'NSW'}), ((3000, 3999), {'VIC'}),
+    ((4000, 4999), {'QLD'}), ((5000, 5999), {'SA'}),
+    ((6000, 6999), {'WA'}), ((7000, 7999), {'TAS'}),
+    ((8000, 8999), {'VIC'}), ((9000, 9999), {'QLD'}),
+)
+
+_COLUMNS = ('customer_name', 'customer_email', 'customer_phone', 'customer_address',
+            'customer_address_2', 'state_mismatch', 'inpost_id', 'social', 'products',
+            'product_summary', 'product_count', 'shipping_method', 'email_key',
+            'phone_key', 'addr_key')
+
+
+def _load_json(value, default):
+    if not value:
+        return default
+    if isinstance(value, (dict, list)):
+        return value
+    try:
+        parsed = json.loads(value)
+    except (TypeError, ValueError):
+        return default
+    return parsed if isinstance(parsed, type(default)) else default
+
+
+def compose_address(addr, sep=', '):
+    """Compose a human-readable shipping address from a billing/shipping dict.
+
+    The locality line is "City State Postcode" (e.g. "Brassall QLD 4305") so the
+    destination state is always shown. It used to be dropped from every shipping
+    view, which made AU/US parcels ambiguous — the same suburb name recurs across
+    states, and packers/carriers need the state to route correctly. Polish (DPD/
+    InPost) addresses simply have no state, so it falls away cleanly there."""
+    if not isinstance(addr, dict):
+        return ''
+    locality = ' '.join(p for p in (
+        str(addr.get('city') or '').strip(),
+        str(addr.get('state') or '').strip(),
+        str(addr.get('postcode') or '').strip(),
+    ) if p)
+    parts = [
+        str(addr.get('address_1') or '').strip(),
+        str(addr.get('address_2') or '').strip(),
+        locality,
+        str(addr.get('country') or '').strip(),
+    ]
+    return sep.join(p for p in parts if p)
+
+
+def au_state_mismatch(addr):
+    """Return the expected AU state code(s) ('WA' / 'ACT/NSW') when the chosen
+    state cannot contain the postcode; None when consistent or not checkable."""
+    if not isinstance(addr, dict) or str(addr.get('country') or '').upper() != 'AU':
+        return None
+    state = str(addr.get('state') or '').strip().upper()
+    pc_raw = str(addr.get('postcode') or '').strip()
+    if not state or not pc_raw.isdigit():
+        return None
+    pc = int(pc_raw)
+    if pc == 872:  # tri-state remote zone (NT/SA/WA), never flag
+        return None
+    for (lo, hi), states in _AU_POSTCODE_STATES:
+        if lo <= pc <= hi:
+            return None if state in states else '/'.join(sorted(states))
+    return None
+
+
+def extract_custom_billing_fields(meta_data):
+    """Extract custom billing fields from meta_data"""
+    custom_fields = {
+        'customer_inpost_id': '',
+        'customer_social': '',
+        'dpd_street': '',
+        'dpd_house': '',
+        'dpd_zip': '',
+        'dpd_city': ''
+    }
+
+    if not meta_data:
+        return custom_fields
+
+    for meta in meta_data:
+        if isinstance(meta, dict):
+            key = meta.get('key')
+            value = meta.get('value')
+
+            if key == '_billing_inpost':
+                custom_fields['customer_inpost_id'] = value
+            elif key == '_billing_social':
+                custom_fields['customer_social'] = value
+            elif key == '_billing_adres_dpd':
+                custom_fields['dpd_street'] = value
+            elif key == '_billing_numer_domu':
+                custom_fields['dpd_house'] = value
+            elif key == '_billing_kod_pocztowy':
+                custom_fields['dpd_zip'] = value
+            elif key == '_billing_miejscowosc':
+                custom_fields['dpd_city'] = value
+
+    return custom_fields
+
+
+def display_fields(row):
+    """The shipping_view fields of one order.
+
+    row: mapping with billing, shipping, line_items, meta_data and
+    shipping_lines (raw JSON or parsed). products comes back as a list.
+    """
+    billing = _load_json(row['billing'], {})
+    shipping = _load_json(row['shipping'], {})
+    line_items = [it for it in _load_json(row['line_items'], []) if isinstance(it, dict)]
+    shipping_lines = _load_json(row['shipping_lines'], [])
+    custom = extract_custom_billing_fields(_load_json(row['meta_data'], []))
+
+    addr = shipping if shipping.get('address_1') else billing
+    address = compose_address(addr)
+    # DPD fallback: no standard street, but the Polish checkout's DPD fields are filled
+    if not addr.get('address_1') and (custom.get('dpd_street') or custom.get('dpd_city')):
+        address = ', '.join(filter(None, [
+            f"{custom.get('dpd_street') or ''} {custom.get('dpd_house') or ''}".strip(),
+            custom.get('dpd_zip') or '',
+            custom.get('dpd_city') or '',
+        ]))
+
+    products = []
+    for it in line_items:
+        try:
+            total = float(it.get('total') or 0)
+        except (TypeError, ValueError):
+            total = 0.0
+        products.append({'name': it.get('name', ''), 'quantity': it.get('quantity', 1), 'total': total})
+    first_line = shipping_lines[0] if shipping_lines and isinstance(shipping_lines[0], dict) else {}
+    email_key, phone_key, addr_key = order_keys(billing, shipping)
+
+    return {
+        'customer_name': f"{addr.get('first_name', '')} {addr.get('last_name', '')}".strip(),
+        'customer_email': billing.get('email', '') or '',
+        'customer_phone': addr.get('phone') or billing.get('phone', '') or '',
+        'customer_address': address,
+        'customer_address_2': addr.get('address_2', '') or '',
+        'state_mismatch': au_state_mismatch(addr),
+        'inpost_id': custom['customer_inpost_id'] or '',
+        'social': custom['customer_social'] or '',
+        'products': products,
+        'product_summary': '; '.join(f"{p['name']} ×{p['quantity']}" for p in products),
+        'product_count': sum(p['quantity'] or 0 for p in products),
+        'shipping_method': first_line.get('method_title', '') or '',
+        'email_key': email_key,
+        'phone_key': phone_key,
+        'addr_key': addr_key,
+    }
+
+
+def _select_orders(conn, chunk):
+    placeholders = ','.join('?' * len(chunk))
+    cur = conn.execute(
+        f'SELECT id, billing, shipping, line_items, meta_data, shipping_lines '
+        f'FROM orders WHERE id IN ({placeholders})', chunk)
+    names = [d[0] for d in cur.description]  # sync connections have no Row factory
+    return [dict(zip(names, r)) for r in cur.fetchall()]
+
+
+def _insert_rows(conn, order_ids):
+    built_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    for i in range(0, len(order_ids), BATCH):
+        values = []
+        for r in _select_orders(conn, order_ids[i:i + BATCH]):
+            f = display_fields(r)
+            f['products'] = json.dumps(f['products'], ensure_ascii=False)
+            values.append((str(r['id']),) + tuple(f[c] for c in _COLUMNS) + (built_at,))
+        conn.executemany(
+            f"INSERT OR REPLACE INTO shipping_view (order_id, {', '.join(_COLUMNS)}, built_at) "
+            f"VALUES ({','.join('?' * (len(_COLUMNS) + 2))})", values)
+
+
+def remove_orders(conn, order_ids):
+    """Drop the rows of orders about to be deleted. Does not commit."""
+    order_ids = [str(i) for i in order_ids if i is not None]
+    for i in range(0, len(order_ids), BATCH):
+        chunk = order_ids[i:i + BATCH]
+        conn.execute(f"DELETE FROM shipping_view WHERE order_id IN ({','.join('?' * len(chunk))})", chunk)
+
+
+def refresh_orders(conn, order_ids):
+    """Re-derive the rows of the given orders. Does not commit."""
+    order_ids = list(dict.fromkeys(str(i) for i in order_ids if i is not None))
+    if not order_ids:
+        return
+    remove_orders(conn, order_ids)
+    _insert_rows(conn, order_ids)
+
+
+def load(conn, order_ids):
+    """{order_id: fields dict} for the given orders, products parsed."""
+    order_ids = list(dict.fromkeys(str(i) for i in order_ids if i is not None))
+    result = {}
+    for i in range(0, len(order_ids), BATCH):
+        chunk = order_ids[i:i + BATCH]
+        cur = conn.execute(
+            f"SELECT order_id, {', '.join(_COLUMNS)} FROM shipping_view "
+            f"WHERE order_id IN ({','.join('?' * len(chunk))})", chunk)
+        names = [d[0] for d in cur.description]
+        for r in cur.fetchall():
+            r = dict(zip(names, r))
+            r['products'] = _load_json(r['products'], [])
+            result[r.pop('order_id')] = r
+    missing = [oid for oid in order_ids if oid not in result]
+    for i in range(0, len(missing), BATCH):
+        for r in _select_orders(conn, missing[i:i + BATCH]):
+            result[str(r['id'])] = display_fields(r)
+    return result
+
+
+def ensure_view_table(conn):
+    """Create shipping_view and, the first time, derive every order into it.
+
+    Table and backfill share one transaction: a backfill interrupted half-way
+    leaves no table behind, so the next start simply runs it again.
+    """
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute('BEGIN')
+    created = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'shipping_view'").fetchone() is None
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS shipping_view (
+            order_id TEXT PRIMARY KEY,
+            customer_name TEXT,
+            customer_email TEXT,
+            customer_phone TEXT,
+            customer_address TEXT,
+            customer_address_2 TEXT,
+            state_mismatch TEXT,
+            inpost_id TEXT,
+            social TEXT,
+            products TEXT,
+            product_summary TEXT,
+            product_count INTEGER NOT NULL DEFAULT 0,
+            shipping_method TEXT,
+            email_key TEXT,
+            phone_key TEXT,
+            addr_key TEXT,
+            built_at TEXT
+        ) WITHOUT ROWID
+    """)
+    if created:
+        ids = [r[0] for r in conn.execute('SELECT id FROM orders')]
+        _insert_rows(conn, ids)
+    conn.commit()
+
+
+_schema_ready = False
+
+
+def ensure_schema(conn):
+    """Run ensure_view_table once per process (sync writers call this before
+    their first upsert, the web app at startup)."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    ensure_view_table(conn)
+    _schema_ready = True
@@ -0,0 +1,314 @@
+"""Per-site tracking profile cached on the sites row (sites.tracking_profile).
+
+Every time the ship modal opened, /api/shipping/carriers-for-site (and, for
+restricted users, /api/shipping/carriers once per allowed site) ran
+detect_carriers_for_site, which loaded up to 80 recent shipped orders and
+parsed their meta_data and line_items JSON. Every ship_order / batch entry
+ran detect_site_tracking_format over 10 more. The answer — which tracking
+plugin a site uses and which carriers it ships with — changes a few times a
+year.
+
+Fix: both scans run once per site and the result is stored as JSON on the
+sites row
+
+    tracking_profile     {"format": "ast" | "villatheme" | "custom_lineitem" | "unknown",
+                          "carriers": [{slug, name, tracking_url, usage_count}, ...],
+                          "ast_providers": {our slug: tracking_provider the site's
+                                            AST records use for it},
+                          "added": [slugs learned from ships, not from the scan]}
+    tracking_profile_at  when the scan ran
+
+The sync rebuilds the profile of the site it just synced (sync_utils.sync_site,
+the app's per-site deep sync). Readers take the stored profile as is and only
+queue a background rebuild once it is older than TTL_HOURS, so opening the
+ship modal never scans order blobs. A site without a profile yet (added after
+the columns were created) is scanned once, on first read.
+
+A ship with a carrier the profile does not list adds it right away
+(note_carrier): the tracking only reaches orders.meta_data with the next sync,
+and custom_lineitem sites never expose their carrier to the scan at all. Those
+slugs are kept in "added" and survive rebuilds until the scan finds them.
+
+refresh_site() and note_carrier() do not commit. Imported by sync_utils.py and
+app.py.
+"""
+import json
+import re
+import sqlite3
+from datetime import datetime, timedelta
+
+TTL_HOURS = 24
+FORMAT_LOOKBACK = 10
+CARRIER_LOOKBACK = 80
+
+# VillaTheme generates per-entry slugs like 'custom_1775723085' when the
+# admin types a name freehand. Skip those and use carrier_name instead.
+_CUSTOM_SLUG_RE = re.compile(r'^custom_\d+$')
+# Lowercased carrier_name → canonical slug we want to surface.
+_NAME_TO_SLUG = {
+    'inpost': 'inpost', 'inpost paczkomaty': 'inpost', 'paczkomaty': 'inpost',
+    'dpd': 'dpd', 'dpd polska': 'dpd', 'dpd poland': 'dpd', 'dpd-pl': 'dpd',
+    'australia post': 'australia-post', 'auspost': 'australia-post', 'australia-post': 'australia-post',
+    # EMS shipments out of China to overseas (mostly used on AU sites for
+    # the 国内发 warehouse fulfillment). Cover common ways WC plugins or
+    # shippers label these so detection picks them up regardless of region.
+    'ems': 'ems', 'ems china': 'ems', 'china ems': 'ems', 'china post ems': 'ems',
+    'china post': 'ems', 'ems express': 'ems', 'epacket': 'ems',
+    '中国邮政': 'ems', '中国邮政ems': 'ems', '邮政ems': 'ems',
+}
+# Slug aliases — collapse AST's regional variants down to our shipping_carriers
+# canonical slug so the URL lookup works in ship_order.
+_SLUG_ALIASES = {
+    'inpost-paczkomaty': 'inpost',
+    'inpost-pl': 'inpost',
+    'dpd-pl': 'dpd',
+    'dpd-polska': 'dpd',
+    'auspost': 'australia-post',
+    'china-ems': 'ems',
+    'china-post': 'ems',
+    'china-post-ems': 'ems',
+    'ems-china': 'ems',
+    'epacket': 'ems',
+}
+
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def detect_format(conn, site_url):
+    """Look at recent shipped orders for this site to figure out which plugin
+    holds the tracking. Returns 'ast' | 'villatheme' | 'custom_lineitem' | 'unknown'."""
+    rows = conn.execute("""
+        SELECT meta_data, line_items FROM orders
+        WHERE source = ? AND status IN ('on-hold','shipped','completed')
+        ORDER BY date_modified DESC LIMIT ?
+    """, (site_url, FORMAT_LOOKBACK)).fetchall()
+
+    ast = villa = custom = 0
+    for md, li in rows:
+        md = md or ''
+        li = li or ''
+        if '_wc_shipment_tracking_items' in md:
+            ast += 1
+        if '_vi_wot_order_item_tracking_data' in li:
+            villa += 1
+        elif '"key":"tracking_number"' in li or '"key": "tracking_number"' in li:
+            custom += 1
+
+    if ast and ast >= max(villa, custom):
+        return 'ast'
+    if villa and villa >= custom:
+        return 'villatheme'
+    if custom:
+        return 'custom_lineitem'
+    return 'unknown'
+
+
+def _record_slug(slug, fallback_name):
+    """Normalize one tracking record's slug. Drop noise; map custom_NNN
+    to a real carrier via its display name; collapse regional aliases."""
+    s = (slug or '').strip().lower()
+    n = (fallback_name or '').strip().lower()
+    if not s and not n:
+        return None
+    if s and not _CUSTOM_SLUG_RE.match(s):
+        return _SLUG_ALIASES.get(s, s)
+    # Custom_TIMESTAMP — recover a real carrier from carrier_name
+    return _NAME_TO_SLUG.get(n)
+
+
+def _carrier_rows(conn):
+    return {r[0]: {'name': r[1], 'tracking_url': r[2]} for r in conn.execute(
+        'SELECT slug, name, tracking_url FROM shipping_carriers').fetchall()}
+
+
+def _carrier_entry(db_carriers, slug, count):
+    c = db_carriers.get(slug)
+    # AST aliases: 'inpost-paczkomaty' → our DB row 'inpost'; 'dpd-pl' → 'dpd'
+    if not c:
+        alias = {'inpost-paczkomaty': 'inpost', 'dpd-pl': 'dpd', 'auspost': 'australia-post'}.get(slug)
+        if alias:
+            c = db_carriers.get(alias)
+    return {
+        'slug': slug,
+        'name': (c['name'] if c else slug.replace('-', ' ').title()),
+        'tracking_url': (c['tracking_url'] if c else ''),
+        'usage_count': count,
+    }
+
+
+def detect_carriers(conn, site_url, lookback_orders=CARRIER_LOOKBACK):
+    """Return (carriers, ast_providers) for a site by inspecting recent shipped
+    orders' tracking meta_data.
+
+    carriers: [{slug, name, tracking_url, usage_count}], most used first.
+    Slugs are enriched with name + tracking_url from the shipping_carriers
+    table when available; otherwise the slug itself is the display name and
+    the URL is empty.
+    ast_providers: {slug: the raw tracking_provider this site's AST records
+    use most for it}, only where that differs from the slug.
+    """
+    rows = conn.execute("""
+        SELECT meta_data, line_items FROM orders
+        WHERE source = ? AND status IN ('on-hold','shipped','partial-shipped','completed','delivered')
+        ORDER BY date_modified DESC LIMIT ?
+    """, (site_url, lookback_orders)).fetchall()
+
+    seen = {}  # slug → count
+    raw_providers = {}  # slug → {raw tracking_provider: count}
+    for meta_data, line_items in rows:
+        # AST format: meta_data._wc_shipment_tracking_items[].tracking_provider
+        try:
+            md = json.loads(meta_data or '[]')
+            for m in md:
+                if isinstance(m, dict) and m.get('key') == '_wc_shipment_tracking_items':
+                    items = m.get('value', [])
+                    if isinstance(items, list):
+                        for it in items:
+                            if isinstance(it, dict):
+                                slug = _record_slug(it.get('tracking_provider'), '')
+                                if slug:
+                                    seen[slug] = seen.get(slug, 0) + 1
+                                    raw = str(it.get('tracking_provider') or '').strip().lower()
+                                    if raw != slug:
+                                        counts = raw_providers.setdefault(slug, {})
+                                        counts[raw] = counts.get(raw, 0) + 1
+        except Exception:
+            pass
+
+        # VillaTheme: line_items[*].meta_data._vi_wot_order_item_tracking_data
+        try:
+            li = json.loads(line_items or '[]')
+            for item in li:
+                if not isinstance(item, dict):
+                    continue
+                for m in item.get('meta_data', []):
+                    if not isinstance(m, dict):
+                        continue
+                    if m.get('key') == '_vi_wot_order_item_tracking_data':
+                        v = m.get('value')
+                        try:
+                            recs = json.loads(v) if isinstance(v, str) else v
+                        except Exception:
+                            recs = None
+                        if isinstance(recs, list):
+                            for rec in recs:
+                                if isinstance(rec, dict):
+                                    slug = _record_slug(rec.get('carrier_slug'), rec.get('carrier_name'))
+                                    if slug:
+                                        seen[slug] = seen.get(slug, 0) + 1
+        except Exception:
+            pass
+
+    ast_providers = {slug: max(counts.items(), key=lambda kv: kv[1])[0]
+                     for slug, counts in raw_providers.items()}
+    if not seen:
+        return [], ast_providers
+
+    db_carriers = _carrier_rows(conn)
+    carriers = [_carrier_entry(db_carriers, slug, count)
+                for slug, count in sorted(seen.items(), key=lambda kv: -kv[1])]
+    return carriers, ast_providers
+
+
+def _store(conn, site_url, profile, built_at):
+    conn.execute('UPDATE sites SET tracking_profile = ?, tracking_profile_at = ? WHERE url = ?',
+                 (json.dumps(profile, ensure_ascii=False), built_at, site_url))
+
+
+def _parse(value):
+    try:
+        profile = json.loads(value) if value else None
+    except (TypeError, ValueError):
+        return None
+    return profile if isinstance(profile, dict) else None
+
+
+def load(conn, site_url):
+    """(profile, stale) from the sites row; profile is None when the site
+    has never been scanned (or is not a configured site)."""
+    row = conn.execute('SELECT tracking_profile, tracking_profile_at FROM sites WHERE url = ?',
+                       (site_url,)).fetchone()
+    profile = _parse(row[0]) if row else None
+    if profile is None:
+        return None, True
+    try:
+        built = datetime.strptime(row[1] or '', '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return profile, True
+    return profile, datetime.now() - built > timedelta(hours=TTL_HOURS)
+
+
+def refresh_site(conn, site_url):
+    """Re-scan one site and store its profile; returns it. Carriers learned
+    from ships that the scan does not see yet are carried over. Does not commit."""
+    previous, _ = load(conn, site_url)
+    carriers, ast_providers = detect_carriers(conn, site_url)
+    found = {c['slug'] for c in carriers}
+    added = []
+    for c in (previous or {}).get('carriers', []):
+        if c.get('slug') in (previous.get('added') or []) and c['slug'] not in found:
+            carriers.append(c)
+            added.append(c['slug'])
+    profile = {
+        'format': detect_format(conn, site_url),
+        'carriers': carriers,
+        'ast_providers': ast_providers,
+        'added': added,
+    }
+    _store(conn, site_url, profile, _now())
+    return profile
+
+
+def note_carrier(conn, site_url, slug):
+    """Add a carrier a ship just used to the site's profile. Returns True when
+    the profile did not list it yet. Does not commit."""
+    if not slug:
+        return False
+    row = conn.execute('SELECT tracking_profile, tracking_profile_at FROM sites WHERE url = ?',
+                       (site_url,)).fetchone()
+    profile = _parse(row[0]) if row else None
+    if profile is None:
+        return False  # built from scratch on first read, which lists the ship once synced
+    if any(c.get('slug') == slug for c in profile.get('carriers', [])):
+        return False
+    profile.setdefault('carriers', []).append(_carrier_entry(_carrier_rows(conn), slug, 1))
+    profile['added'] = (profile.get('added') or []) + [slug]
+    _store(conn, site_url, profile, row[1])
+    return True
+
+
+def ensure_profile_columns(conn):
+    """Add sites.tracking_profile / tracking_profile_at; the first time, scan
+    every configured site."""
+    added = False
+    for ddl in (
+        'ALTER TABLE sites ADD COLUMN tracking_profile TEXT',
+        'ALTER TABLE sites ADD COLUMN tracking_profile_at TEXT',
+    ):
+        try:
+            conn.execute(ddl)
+            added = True
+        except sqlite3.OperationalError:
+            pass  # Column already exists
+    if added:
+        has_carriers = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'shipping_carriers'").fetchone()
+        if has_carriers:
+            for (url,) in conn.execute('SELECT DISTINCT url FROM sites').fetchall():
+                refresh_site(conn, url)
+    conn.commit()
+
+
+_schema_ready = False
+
+
+def ensure_schema(conn):
+    """Run ensure_profile_columns once per process (the sync calls this
+    before its first refresh, the web app at startup)."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    ensure_profile_columns(conn)
+    _schema_ready = True
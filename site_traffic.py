@@ -0,0 +1,138 @@
+"""Raw per-day 51.la traffic (site_traffic_daily table).
+
+/api/report/data used to cache the whole computed report JSON under
+(start, end, granularity, country). Any other range, granularity or country
+missed, and a miss called the 51.la trend API once per site, one after the
+other (5 s timeout each).
+
+Fix: the daily numbers the API returns are stored once per (mask_id, day)
+
+    site_traffic_daily(mask_id, day, uv, pv, new_users, sv, ip, bounce, fetched_at)
+
+mask_id     the 51.la site id (sites.mask_id / LA_API_CONFIG['sites']), so two
+            shop URLs sharing one 51.la site share its rows
+uv          NULL when the API answered but had no entry for that day (the
+            site did not exist yet) — such days are not asked for again
+
+and the report aggregates any range / granularity from these rows locally.
+stale_range() tells the caller which days of a site still have to be
+fetched: days never stored, plus the last MUTABLE_DAYS days (51.la keeps
+counting today and revises the previous days for a while) once their row is
+older than REFRESH_SECONDS. Past days are immutable and never refetched.
+
+The HTTP call stays in app.py (fetch_51la_traffic); this module only does
+the bookkeeping. store_days() does not commit.
+"""
+from datetime import datetime, timedelta
+
+MUTABLE_DAYS = 3
+REFRESH_SECONDS = 1800
+
+_FMT = '%Y-%m-%d'
+
+
+def _day_range(start, end):
+    d = datetime.strptime(start, _FMT)
+    last = datetime.strptime(end, _FMT)
+    while d <= last:
+        yield d.strftime(_FMT)
+        d += timedelta(days=1)
+
+
+def stale_range(conn, mask_id, start, end, now=None):
+    """(first, last) days of start..end that need fetching for mask_id, or None.
+
+    end is clamped to today. One range per site keeps it to a single API call;
+    stored days in between are simply overwritten with the same numbers.
+    """
+    now = now or datetime.now()
+    end = min(end, now.strftime(_FMT))
+    if start > end:
+        return None
+    mutable_from = (now - timedelta(days=MUTABLE_DAYS - 1)).strftime(_FMT)
+    expired = (now - timedelta(seconds=REFRESH_SECONDS)).strftime('%Y-%m-%d %H:%M:%S')
+    stored = dict(conn.execute(
+        'SELECT day, fetched_at FROM site_traffic_daily WHERE mask_id = ? AND day BETWEEN ? AND ?',
+        (mask_id, start, end)).fetchall())
+    missing = [d for d in _day_range(start, end)
+               if d not in stored or (d >= mutable_from and (stored[d] or '') < expired)]
+    if not missing:
+        return None
+    return missing[0], missing[-1]
+
+
+def store_days(conn, mask_id, start, end, days, now=None):
+    """Upsert the API's day dicts for start..end (days without an entry are
+    stored with uv NULL). Does not commit."""
+    fetched_at = (now or datetime.now()).strftime('%Y-%m-%d %H:%M:%S')
+    by_day = {}
+    for item in days or []:
+        day = str(item.get('time') or '')[:10]
+        if len(day) == 10:
+            by_day[day] = item
+    values = []
+    for day in _day_range(start, end):
+        item = by_day.get(day)
+        if item is None:
+            values.append((mask_id, day, None, None, None, None, None, None, fetched_at))
+        else:
+            values.append((mask_id, day, item.get('uv', 0), item.get('pv', 0), item.get('newUserCount', 0),
+                           item.get('sv', 0), item.get('ip', 0), item.get('bounceRate', 0), fetched_at))
+    conn.executemany("""
+        INSERT INTO site_traffic_daily (mask_id, day, uv, pv, new_users, sv, ip, bounce, fetched_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(mask_id, day) DO UPDATE SET
+            uv = excluded.uv, pv = excluded.pv, new_users = excluded.new_users,
+            sv = excluded.sv, ip = excluded.ip, bounce = excluded.bounce,
+            fetched_at = excluded.fetched_at
+    """, values)
+
+
+def load_days(conn, mask_ids, start, end):
+    """{mask_id: [day dict, ...]} in the API's own shape (time, uv, pv,
+    newUserCount, sv, ip, bounceRate), oldest first, days with data only."""
+    mask_ids = list(dict.fromkeys(m for m in mask_ids if m))
+    result = {}
+    if not mask_ids:
+        return result
+    placeholders = ','.join('?' * len(mask_ids))
+    for r in conn.execute(f"""
+            SELECT mask_id, day, uv, pv, new_users, sv, ip, bounce FROM site_traffic_daily
+            WHERE mask_id IN ({placeholders}) AND day BETWEEN ? AND ? AND uv IS NOT NULL
+            ORDER BY mask_id, day
+    """, mask_ids + [start, end]):
+        result.setdefault(r[0], []).append({
+            'time': r[1], 'uv': r[2], 'pv': r[3], 'newUserCount': r[4],
+            'sv': r[5], 'ip': r[6], 'bounceRate': r[7],
+        })
+    return result
+
+
+def ensure_traffic_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS site_traffic_daily (
+            mask_id TEXT NOT NULL,
+            day TEXT NOT NULL,
+            uv INTEGER,
+            pv INTEGER,
+            new_users INTEGER,
+            sv INTEGER,
+            ip INTEGER,
+            bounce REAL,
+            fetched_at TEXT NOT NULL,
+            PRIMARY KEY (mask_id, day)
+        ) WITHOUT ROWID
+    """)
+    conn.commit()
+
+
+_schema_ready = False
+
+
+def ensure_schema(conn):
+    """Run ensure_traffic_table once per process."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    ensure_traffic_table(conn)
+    _schema_ready = True
@@ -6,6 +6,16 @@ import concurrent.futures
 from datetime import datetime
 from woocommerce import API
 from oid_utils import make_oid, site_id_for_source, woo_post_id  # cross-site-safe surrogate order id
+import order_index  # derived year_month/day columns, kept in step at upsert
+import order_search  # orders_fts search documents, rebuilt at upsert
+import order_tracking  # extracted tracking numbers, rebuilt at upsert
+import identity_graph  # customer identity keys / clusters, updated at upsert
+import customer_stats  # per-identity customer aggregates: changed customers queued at upsert
+import wc_outbox  # queued WooCommerce write-backs: keep their local status through a sync
+import shipping_view  # shipping-queue display fields (address / products / risk keys), rebuilt at upsert
+import customer_risk  # customer_risk_keys of flagged orders (risk badges), refreshed at upsert
+import latest_note  # orders.latest_note_id pointers, re-derived after the note sync
+import site_profile  # cached per-site tracking format / carriers, rescanned after each site sync
 
 # Database configuration
 DB_FILE = 'woocommerce_orders.db'
@@ -128,7 +138,9 @@ def save_orders_to_db(orders_data, connection=None):
         # woo_id keeps the raw per-site WC post id; id is the cross-site-safe
         # surrogate "<sites.id>-<woo_id>" so same-numbered orders from different
         # stores no longer collide under ON CONFLICT(id). See oid_utils.py.
-        all_columns = wc_fields + ['woo_id', 'updated_at']
+        # year_month / day are the indexed date buckets month pages filter on
+        # (see order_index.py) — derived here so they never lag date_created.
+        all_columns = wc_fields + ['woo_id', 'year_month', 'day', 'updated_at']
         placeholders = ', '.join(['?'] * len(all_columns))
         # On UPDATE, set every column EXCEPT id (the conflict key).
         update_set = ', '.join(f'{c} = excluded.{c}' for c in all_columns if c != 'id')
@@ -144,6 +156,15 @@ def save_orders_to_db(orders_data, connection=None):
         if not orders_data:
             return
 
+        order_index.ensure_schema(connection)
+        order_search.ensure_schema(connection)
+        order_tracking.ensure_schema(connection)
+        shipping_view.ensure_schema(connection)
+        customer_risk.ensure_schema(connection)
+        identity_graph.ensure_schema(connection)
+        customer_stats.ensure_schema(connection)
+        wc_outbox.ensure_schema(connection)
+
         processed_orders = []
         for order in orders_data:
             woo_id = order.get('id')
@@ -172,10 +193,27 @@ def save_orders_to_db(orders_data, connection=None):
                     processed_order.append(value)
 
             processed_order.append(woo_id)                      # woo_id
+            processed_order.extend(order_index.date_keys(order.get('date_created')))  # year_month, day
             processed_order.append(datetime.now().isoformat())  # updated_at
             processed_orders.append(tuple(processed_order))
 
+        # Only months with a new / actually modified order get their data
+        # version bumped — the 7-day re-fetch of unchanged orders must not
+        # invalidate snapshots built on them (see order_index.py).
+        dm_idx, ym_idx = all_columns.index('date_modified'), all_columns.index('year_month')
+        changed_months = order_index.changed_upsert_months(
+            connection, [(row[0], row[dm_idx], row[ym_idx]) for row in processed_orders])
         cursor.executemany(insert_query, processed_orders)
+        # A status change still waiting in the outbox hasn't reached WC yet —
+        # keep showing it instead of the old remote status just fetched.
+        wc_outbox.reapply_pending(connection, [row[0] for row in processed_orders])
+        order_index.bump_versions(connection, [order_index.orders_scope(m) for m in changed_months])
+        order_search.index_orders(connection, [row[0] for row in processed_orders])
+        order_tracking.refresh_orders(connection, [row[0] for row in processed_orders])
+        shipping_view.refresh_orders(connection, [row[0] for row in processed_orders])
+        customer_risk.refresh_orders(connection, [row[0] for row in processed_orders])
+        reclustered = identity_graph.refresh_orders(connection, [row[0] for row in processed_orders])
+        customer_stats.mark_orders(connection, [row[0] for row in processed_orders], reclustered)
         connection.commit()
         
     except Exception as e:
@@ -315,6 +353,7 @@ def sync_order_notes(wcapi, site_url, connection=None):
         return
 
     try:
+        latest_note.ensure_schema(connection)
         cursor = connection.cursor()
 
         # The WC REST API needs the raw post id (woo_id); the local order_id is
@@ -384,8 +423,26 @@ def sync_order_notes(wcapi, site_url, connection=None):
                     added_by_user
                 ))
 
+            # Only write notes that are new or changed: REPLACE re-inserts the
+            # row under a new id, and each write bumps the order_notes version
+            # (latest_note.refresh_orders), so re-storing unchanged notes would
+            # invalidate every cached view on each sync.
+            stored = {}
+            note_order_ids = list({n[1] for n in processed_notes})
+            for i in range(0, len(note_order_ids), 500):
+                chunk = note_order_ids[i:i + 500]
+                cursor.execute(f'''
+                    SELECT wc_note_id, order_id, note, date_created, customer_note, author, added_by_user
+                    FROM order_notes WHERE order_id IN ({','.join('?' * len(chunk))})
+                ''', chunk)
+                for row in cursor.fetchall():
+                    stored[(row[0], row[1])] = tuple(row)
+            processed_notes = [n for n in processed_notes if stored.get((n[0], n[1])) != n]
+
             if processed_notes:
                 cursor.executemany(insert_query, processed_notes)
+                # REPLACE re-inserts a changed note under a new id
+                latest_note.refresh_orders(connection, {n[1] for n in processed_notes})
                 connection.commit()
 
     except Exception as e:
@@ -450,6 +507,15 @@ def sync_site(url, consumer_key, consumer_secret, progress_callback=None, sync_d
         # 3. Sync order notes for active orders
         if progress_callback: progress_callback("Syncing order notes...")
         sync_order_notes(wcapi, url, connection=conn)
+
+        # 4. Rescan the site's tracking format / carriers for the ship modal
+        try:
+            site_profile.ensure_schema(conn)
+            site_profile.refresh_site(conn, url)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            if progress_callback: progress_callback(f"Tracking profile refresh failed: {e}")
         
         msg = f"Sync complete. New: {len(new_orders)}, Updated: {len(updated_orders)}"
         if progress_callback: progress_callback(msg)
@@ -0,0 +1,278 @@
+"""Queue semantics of wc_outbox.py on a throwaway database (no WC calls).
+
+Run: python -m pytest -q test_wc_outbox.py
+"""
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import wc_outbox
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'outbox.db'))
+    conn.row_factory = sqlite3.Row
+    conn.execute('CREATE TABLE orders (id TEXT PRIMARY KEY, status TEXT, year_month TEXT, billing TEXT)')
+    conn.execute('CREATE TABLE data_versions (scope TEXT PRIMARY KEY, version INTEGER, updated_at TEXT)')
+    conn.execute('CREATE TABLE identity_keys (order_id TEXT, email TEXT)')
+    conn.execute('CREATE TABLE customer_stats_dirty (email TEXT PRIMARY KEY)')
+    conn.executemany('INSERT INTO orders VALUES (?, ?, ?, ?)',
+                     [('a.pl_1', 'processing', '2026-10', '{"email": "Ann@Example.com"}'),
+                      ('a.pl_2', 'processing', '2026-10', '{}')])
+    wc_outbox.ensure_outbox_table(conn)
+    yield conn
+    conn.close()
+
+
+def _enqueue(conn, order_id='a.pl_1', **kw):
+    return wc_outbox.enqueue(conn, 'https://a.pl', 'order_update', {'data': {'status': 'x'}},
+                             order_id=order_id, **kw)
+
+
+def _op(conn, op_id):
+    return conn.execute('SELECT * FROM wc_outbox WHERE id = ?', (op_id,)).fetchone()
+
+
+def _claimed_ids(conn):
+    return [op['id'] for op in wc_outbox._claim(conn, 100)]
+
+
+def _delay_seconds(conn, op_id):
+    return conn.execute("SELECT (julianday(next_attempt_at) - julianday('now')) * 86400 FROM wc_outbox WHERE id = ?",
+                        (op_id,)).fetchone()[0]
+
+
+def _kill(conn, op_id, message='API 400'):
+    op = dict(_op(conn, op_id))
+    wc_outbox._finish(conn, op, error=wc_outbox.PushError(message, retryable=False))
+
+
+# --- enqueue -------------------------------------------------------------------
+def test_enqueue_same_key_while_live_returns_existing_op(conn):
+    first = _enqueue(conn, idem_key='click-1')
+    assert _enqueue(conn, idem_key='click-1') == first
+    assert conn.execute('SELECT COUNT(*) FROM wc_outbox').fetchone()[0] == 1
+
+
+def test_enqueue_same_key_after_done_queues_again(conn):
+    first = _enqueue(conn, idem_key='click-1')
+    wc_outbox._finish(conn, dict(_op(conn, first)), result={})
+    second = _enqueue(conn, idem_key='click-1')
+    assert second != first
+    assert wc_outbox.live_op(conn, 'click-1') == second
+
+
+def test_enqueue_without_key_never_dedups(conn):
+    assert _enqueue(conn) != _enqueue(conn)
+
+
+# --- _claim --------------------------------------------------------------------
+def test_claim_takes_only_the_oldest_live_op_of_each_order(conn):
+    a1 = _enqueue(conn, 'a.pl_1')
+    a2 = _enqueue(conn, 'a.pl_1')
+    b1 = _enqueue(conn, 'a.pl_2')
+    claimed = wc_outbox._claim(conn, 100)
+    assert [op['id'] for op in claimed] == [a1, b1]
+    assert all(op['attempts'] == 1 for op in claimed)
+    assert _op(conn, a1)['status'] == 'running'
+    assert _op(conn, a2)['status'] == 'pending'
+
+    # a2 stays behind a1 while a1 is running, and runs once a1 is done
+    assert _claimed_ids(conn) == []
+    wc_outbox._finish(conn, claimed[0], result={})
+    assert _claimed_ids(conn) == [a2]
+
+
+def test_claim_waits_for_depends_on(conn):
+    parent = _enqueue(conn, 'a.pl_1')
+    child = _enqueue(conn, 'a.pl_2', depends_on=parent)
+    assert _claimed_ids(conn) == [parent]
+    assert _claimed_ids(conn) == []  # parent running, not done
+    wc_outbox._finish(conn, dict(_op(conn, parent)), result={})
+    assert _claimed_ids(conn) == [child]
+
+
+def test_claim_skips_ops_not_due_yet(conn):
+    op = _enqueue(conn)
+    conn.execute("UPDATE wc_outbox SET next_attempt_at = datetime('now', '+60 seconds') WHERE id = ?", (op,))
+    assert _claimed_ids(conn) == []
+
+
+def test_claim_caps_running_ops_per_site(conn):
+    ops = [_enqueue(conn, f'a.pl_{i}') for i in range(5)]
+    other = wc_outbox.enqueue(conn, 'https://b.pl', 'order_update', {'data': {}}, order_id='b.pl_1')
+    assert _claimed_ids(conn) == ops[:wc_outbox.PER_SITE] + [other]
+    assert _claimed_ids(conn) == []  # a.pl is at PER_SITE until one of its ops finishes
+    wc_outbox._finish(conn, dict(_op(conn, ops[0])), result={})
+    assert _claimed_ids(conn) == [ops[wc_outbox.PER_SITE]]
+
+
+def test_claim_respects_limit(conn):
+    ops = [_enqueue(conn, f'a.pl_{i}') for i in range(3)]
+    assert _claimed_ids(conn) == ops[:wc_outbox.PER_SITE]
+    assert wc_outbox._claim(conn, 0) == []
+
+
+def test_pending_orders_reports_live_and_dead_ops_per_order(conn):
+    _enqueue(conn, 'a.pl_1')
+    _kill(conn, _enqueue(conn, 'a.pl_1'))
+    done = _enqueue(conn, 'a.pl_2')
+    wc_outbox._finish(conn, dict(_op(conn, done)), result={})
+    assert wc_outbox.pending_orders(conn, ['a.pl_1', 'a.pl_2', 'a.pl_3']) == {
+        'a.pl_1': {'pending': 1, 'dead': 1}}
+    assert wc_outbox.pending_orders(conn, ['a.pl_1'], sources=['https://b.pl']) == {}
+    assert wc_outbox.pending_orders(conn, ['a.pl_1'], sources=[]) == {}
+
+
+# --- drain ---------------------------------------------------------------------
+def test_second_drainer_never_reruns_ops_queued_behind_a_busy_site(tmp_path, monkeypatch):
+    """A site's backlog takes longer than the lease to get through; a second
+    drainer (another worker process) starting meanwhile must not re-queue and
+    re-send the ops the first one still owns."""
+    path = str(tmp_path / 'outbox.db')
+
+    def connect():
+        c = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        c.row_factory = sqlite3.Row
+        return c
+
+    setup = connect()
+    setup.execute('CREATE TABLE sites (url TEXT, consumer_key TEXT, consumer_secret TEXT)')
+    setup.execute("INSERT INTO sites VALUES ('https://a.pl', 'ck', 'cs')")
+    wc_outbox.ensure_outbox_table(setup)
+    ops = [wc_outbox.enqueue(setup, 'https://a.pl', 'order_update', {'data': {}}, order_id=f'a.pl_{i}')
+           for i in range(20)]
+    setup.commit()
+    setup.close()
+
+    sent = []
+    sent_lock = threading.Lock()
+
+    def slow_push(conn, site, op, payload):
+        with sent_lock:
+            sent.append(op['id'])
+        time.sleep(0.4)
+        return {}
+
+    monkeypatch.setitem(wc_outbox.HANDLERS, 'order_update', slow_push)
+    monkeypatch.setattr(wc_outbox, 'LEASE_SECONDS', 1)
+
+    first = {}
+    worker = threading.Thread(target=lambda: first.update(wc_outbox.drain(connect)))
+    worker.start()
+    time.sleep(2.5)  # 20 ops x 0.4 s / PER_SITE = 4 s: the tail of the backlog is past the lease
+    second = wc_outbox.drain(connect)
+    worker.join()
+
+    assert sorted(sent) == ops
+    assert first['done'] + second['done'] == len(ops)
+
+
+# --- _finish -------------------------------------------------------------------
+def test_finish_success_marks_done(conn):
+    op = _enqueue(conn)
+    claimed = wc_outbox._claim(conn, 100)[0]
+    assert wc_outbox._finish(conn, claimed, result={'status': 'x'}) == 'done'
+    row = _op(conn, op)
+    assert row['status'] == 'done' and row['done_at'] and row['result'] == '{"status": "x"}'
+
+
+@pytest.mark.parametrize('attempts, delay', [
+    (1, wc_outbox.BACKOFF_BASE_SECONDS),
+    (2, wc_outbox.BACKOFF_BASE_SECONDS * 2),
+    (4, wc_outbox.BACKOFF_BASE_SECONDS * 8),
+    (20, wc_outbox.BACKOFF_MAX_SECONDS),
+])
+def test_finish_retryable_error_backs_off_exponentially(conn, attempts, delay):
+    op = _enqueue(conn, max_attempts=50)
+    conn.execute("UPDATE wc_outbox SET status = 'running', attempts = ? WHERE id = ?", (attempts, op))
+    outcome = wc_outbox._finish(conn, dict(_op(conn, op)), error=wc_outbox.PushError('API 503'))
+    assert outcome == 'retry'
+    row = _op(conn, op)
+    assert row['status'] == 'pending' and row['last_error'] == 'API 503' and row['claimed_at'] is None
+    assert abs(_delay_seconds(conn, op) - delay) < 5
+
+
+def test_finish_non_retryable_error_is_dead_at_once(conn):
+    op = _enqueue(conn)
+    claimed = wc_outbox._claim(conn, 100)[0]
+    assert wc_outbox._finish(conn, claimed, error=wc_outbox.PushError('API 400', retryable=False)) == 'dead'
+    assert _op(conn, op)['status'] == 'dead'
+
+
+def test_finish_dead_letters_after_max_attempts(conn):
+    op = _enqueue(conn, max_attempts=2)
+    for expected in ('retry', 'dead'):
+        conn.execute("UPDATE wc_outbox SET next_attempt_at = datetime('now') WHERE id = ?", (op,))
+        claimed = wc_outbox._claim(conn, 100)[0]
+        assert wc_outbox._finish(conn, claimed, error=wc_outbox.PushError('timeout')) == expected
+    row = _op(conn, op)
+    assert row['status'] == 'dead' and row['attempts'] == 2
+
+
+def test_housekeep_kills_ops_whose_dependency_died(conn):
+    parent = _enqueue(conn, 'a.pl_1')
+    child = _enqueue(conn, 'a.pl_1', depends_on=parent)
+    _kill(conn, parent)
+    wc_outbox._housekeep(conn)
+    assert _op(conn, child)['status'] == 'dead'
+
+
+# --- retry / discard -----------------------------------------------------------
+def test_retry_revives_dead_op_and_its_dependents(conn):
+    parent = _enqueue(conn, 'a.pl_1', local_status='completed')
+    child = _enqueue(conn, 'a.pl_1', depends_on=parent)
+    _kill(conn, parent)
+    wc_outbox._housekeep(conn)
+    conn.execute("UPDATE orders SET status = 'processing' WHERE id = 'a.pl_1'")  # a sync overwrote it
+
+    assert wc_outbox.retry(conn, [parent]) == 2
+    for op in (parent, child):
+        row = _op(conn, op)
+        assert row['status'] == 'pending' and row['attempts'] == 0 and row['last_error'] is None
+    assert conn.execute("SELECT status FROM orders WHERE id = 'a.pl_1'").fetchone()[0] == 'completed'
+    assert [r[0] for r in conn.execute('SELECT email FROM customer_stats_dirty')] == ['ann@example.com']
+
+
+def test_retry_ignores_ops_that_are_not_dead(conn):
+    op = _enqueue(conn)
+    assert wc_outbox.retry(conn, [op]) == 0
+    assert _op(conn, op)['status'] == 'pending'
+
+
+def test_retry_discards_dead_op_whose_key_is_live_again(conn):
+    dead = _enqueue(conn, 'a.pl_1', idem_key='click-1')
+    dependent = _enqueue(conn, 'a.pl_1', depends_on=dead)
+    _kill(conn, dead)
+    wc_outbox._housekeep(conn)
+    live = _enqueue(conn, 'a.pl_1', idem_key='click-1')  # the click was repeated
+    assert live != dead
+
+    assert wc_outbox.retry(conn, [dead]) == 1  # no IntegrityError on idx_wc_outbox_live_key
+    assert _op(conn, dead)['status'] == 'discarded'
+    assert _op(conn, live)['status'] == 'pending'
+    row = _op(conn, dependent)
+    assert row['status'] == 'pending' and row['depends_on'] == live
+
+
+def test_retry_of_two_dead_ops_with_one_key_revives_one(conn):
+    first = _enqueue(conn, idem_key='click-1')
+    _kill(conn, first)
+    second = _enqueue(conn, idem_key='click-1')
+    _kill(conn, second)
+    assert wc_outbox.retry(conn, [first, second]) == 1
+    assert _op(conn, first)['status'] == 'pending'
+    assert _op(conn, second)['status'] == 'discarded'
+
+
+def test_discard_only_touches_dead_ops(conn):
+    dead = _enqueue(conn)
+    pending = _enqueue(conn)
+    _kill(conn, dead)
+    assert wc_outbox.discard(conn, [dead, pending]) == 1
+    assert _op(conn, dead)['status'] == 'discarded'
+    assert _op(conn, pending)['status'] == 'pending'
+    assert wc_outbox.discard(conn, []) == 0
@@ -0,0 +1,212 @@
+"""Regression check for the single-pass sales board.
+
+_compute_sales_board_data used to run five queries per manager; it now makes
+one grouped pass per period and attributes rows through the site->manager
+map. This script computes the board with the current app.py and with a
+reference revision of app.py (the per-manager implementation) against the
+same DB snapshot and compares every number.
+
+Usage:
+    python verify_sales_board_single_pass.py
+    python verify_sales_board_single_pass.py --ref ffd4ed4 --db snapshot.db --months 2025-05,2025-06
+
+Without --db it builds its own fixture DB (five sites / three managers,
+seeded orders over two years) in a temp directory, so it runs unattended.
+--ref defaults to the revision before the single-pass change. A --db
+snapshot is copied to the temp directory first, so the live database is never
+touched (the actual-cost pass rewrites profit settings on the copy only).
+"""
+import argparse
+import importlib.util
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+TOLERANCE = 1e-6
+
+
+def load_reference_app(ref, workdir):
+    src = subprocess.run(['git', '-C', REPO_DIR, 'show', f'{ref}:app.py'],
+                         check=True, capture_output=True, text=True).stdout
+    path = os.path.join(workdir, 'app_ref.py')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(src)
+    spec = importlib.util.spec_from_file_location('app_ref', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def default_ref():
+    """The revision right before the single-pass sales board commit."""
+    sha = subprocess.run(['git', '-C', REPO_DIR, 'log', '--format=%H', '-1',
+                          '--grep', r'^\[user-027\]'],
+                         check=True, capture_output=True, text=True).stdout.strip()
+    if not sha:
+        sys.exit('single-pass commit not found in git log; pass --ref')
+    return f'{sha}^'
+
+
+def build_fixture():
+    """Create woocommerce_orders.db in the current directory: the sync's
+    orders schema, the app's own tables, five sites over three managers and
+    a fixed-seed spread of orders / statuses / currencies / losses."""
+    spec = importlib.util.spec_from_file_location(
+        'woosync', os.path.join(REPO_DIR, '1.wooorders_sqlite.py'))
+    woosync = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(woosync)
+    woosync.create_orders_table()
+
+    conn = sqlite3.connect('woocommerce_orders.db')
+    conn.execute('ALTER TABLE orders ADD COLUMN woo_id INTEGER')  # migrate_composite_id.py
+    conn.execute('CREATE TABLE IF NOT EXISTS exchange_rates (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                 'year_month TEXT, currency TEXT, rate_to_cny REAL, updated_at TEXT, UNIQUE(year_month, currency))')
+    for ym in ('2025-01', '2025-06', '2026-01'):
+        for currency, rate in (('PLN', 1.8), ('AUD', 4.7), ('AED', 1.95)):
+            conn.execute('INSERT INTO exchange_rates (year_month, currency, rate_to_cny, updated_at) VALUES (?, ?, ?, ?)',
+                         (ym, currency, rate + (0.1 if ym == '2025-06' else 0), 'fixture'))
+    conn.commit()
+    conn.close()
+
+    import app  # creates sites / brands / costs / sales board tables
+    import sync_utils
+    conn = app.get_db_connection()
+    sites = [('https://a.pl', 'PL', 'Alice'), ('https://b.pl', 'PL', 'Bob'),
+             ('https://c.com.au', 'AU', 'Alice'), ('https://d.pl', 'PL', 'Carol'),
+             ('https://e.ae', 'AE', None)]
+    for url, country, manager in sites:
+        conn.execute('INSERT INTO sites (url, consumer_key, consumer_secret, manager, country) VALUES (?, ?, ?, ?, ?)',
+                     (url, 'ck', 'cs', manager, country))
+    conn.execute("INSERT OR IGNORE INTO warehouses (name, code, country, default_currency) "
+                 "VALUES ('PLW', 'PL', 'PL', 'PLN'), ('AUW', 'AU', 'AU', 'AUD'), ('AEW', 'AE', 'AE', 'AED')")
+    conn.commit()
+
+    rng = random.Random(7)
+    names = ['IGET Bar 3500 - Mango', 'FUMO King 6000 - Peach Ice', 'ELF BAR BC5000 - Watermelon',
+             'Lost Mary OS5000 - Grape', 'Geek Bar Pulse 15000 - Blue Razz', 'Waka SoPro 10000 - Cola']
+    statuses = ['completed', 'processing', 'on-hold', 'cancelled', 'failed', 'completed', 'refunded']
+    currencies = {'PL': 'PLN', 'AU': 'AUD', 'AE': 'AED'}
+    orders = []
+    for url, country, _ in sites:
+        for i in range(200):
+            year = rng.choice([2025, 2026])
+            month = rng.randint(1, 12 if year == 2025 else 10)
+            items = []
+            for k in range(rng.randint(1, 3)):
+                qty = rng.randint(1, 4)
+                items.append({'id': k, 'name': rng.choice(names), 'product_id': 100 + k,
+                              'quantity': qty, 'total': str(qty * 40), 'price': 40, 'meta_data': []})
+            email = f'cust{rng.randint(1, 80)}@example.com'
+            billing = {'first_name': 'F', 'last_name': 'L', 'email': email, 'phone': f'+48600{rng.randint(100000, 100400)}',
+                       'address_1': f'Street {rng.randint(1, 60)}', 'city': 'City', 'postcode': '00-001', 'country': country}
+            orders.append({
+                'id': 1000 + i, 'number': str(1000 + i), 'status': rng.choice(statuses),
+                'currency': currencies[country],
+                'date_created': f'{year:04d}-{month:02d}-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:10:00',
+                'date_modified': '2026-10-01T00:00:00',
+                'total': sum(float(it['total']) for it in items) + 15, 'shipping_total': 15,
+                'billing': billing, 'shipping': billing, 'payment_method': rng.choice(['cod', 'bacs']),
+                'line_items': items, 'meta_data': [], 'shipping_lines': [], 'source': url})
+    sync_utils.save_orders_to_db(orders)
+
+    conn.execute('UPDATE orders SET is_undelivered = 1, shipping_loss_amount = 20 WHERE rowid % 37 = 0')
+    conn.execute('UPDATE orders SET is_problem_return = 1, product_loss_amount = 50, shipping_loss_amount = 10 '
+                 'WHERE rowid % 53 = 0')
+    conn.execute("INSERT INTO product_costs (brand_id, cost_price, cost_currency, effective_date, warehouse_id, country) "
+                 "SELECT id, 10 + id, 'PLN', '2024-01-01', 1, 'PL' FROM brands")
+    conn.execute("INSERT INTO sales_targets (year_month, manager, monthly_target) "
+                 "VALUES ('2025-06', 'Alice', 5000), ('2025-06', 'Bob', 3000)")
+    conn.commit()
+    conn.close()
+
+
+def diff(a, b, path='', out=None):
+    """Collect paths where a and b differ (floats compared with TOLERANCE)."""
+    if out is None:
+        out = []
+    if isinstance(a, dict) and isinstance(b, dict):
+        for k in sorted(set(a) | set(b), key=str):
+            if k not in a or k not in b:
+                out.append(f'{path}/{k}: only in {"reference" if k in a else "current"}')
+            else:
+                diff(a[k], b[k], f'{path}/{k}', out)
+    elif isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        if len(a) != len(b):
+            out.append(f'{path}: length {len(a)} != {len(b)}')
+        for i, (x, y) in enumerate(zip(a, b)):
+            diff(x, y, f'{path}[{i}]', out)
+    elif isinstance(a, float) or isinstance(b, float):
+        if a is None or b is None or abs(float(a) - float(b)) > TOLERANCE:
+            out.append(f'{path}: {a!r} != {b!r}')
+    elif a != b:
+        out.append(f'{path}: {a!r} != {b!r}')
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare sales board output with a reference revision')
+    parser.add_argument('--ref', default='', help='git revision holding the reference (per-manager) implementation '
+                                                   '(default: the one before the single-pass change)')
+    parser.add_argument('--db', default='', help='DB snapshot to run against (default: a generated fixture)')
+    parser.add_argument('--months', default='', help='comma-separated YYYY-MM list (default: latest 3 months with orders)')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='sales_board_verify_')
+    os.chdir(workdir)  # both apps open the relative DB_FILE
+    sys.path.insert(0, REPO_DIR)
+    if args.db:
+        shutil.copy(args.db, os.path.join(workdir, 'woocommerce_orders.db'))
+    else:
+        build_fixture()
+
+    import app as current
+    reference = load_reference_app(args.ref or default_ref(), workdir)
+
+    conn = sqlite3.connect('woocommerce_orders.db')
+    if args.months:
+        months = [m.strip() for m in args.months.split(',') if m.strip()]
+    else:
+        months = [r[0] for r in conn.execute(
+            "SELECT DISTINCT substr(date_created, 1, 7) AS m FROM orders "
+            "WHERE date_created IS NOT NULL ORDER BY m DESC LIMIT 3")]
+    managers = [r[0] for r in conn.execute(
+        "SELECT DISTINCT manager FROM sites WHERE manager IS NOT NULL AND manager != '' ORDER BY manager")]
+
+    failures = 0
+    checks = 0
+    for mode in ('as-configured', 'actual'):
+        if mode == 'actual':
+            for month in months:
+                conn.execute(
+                    "INSERT INTO sales_board_profit_settings (year_month, profit_mode, profit_percentage) "
+                    "VALUES (?, 'actual', 50.0) ON CONFLICT(year_month) DO UPDATE SET profit_mode = 'actual'",
+                    (month,))
+            conn.commit()
+        for month in months:
+            for restrict in [None] + managers:
+                expected = reference._compute_sales_board_data(month, restrict_manager=restrict)
+                actual = current._compute_sales_board_data(month, restrict_manager=restrict)
+                problems = diff(expected, actual)
+                checks += 1
+                label = f'[{mode}] {month} manager={restrict or "ALL"}'
+                if problems:
+                    failures += 1
+                    print(f'❌ {label}')
+                    for p in problems[:20]:
+                        print(f'     {p}')
+                else:
+                    print(f'✅ {label}')
+    conn.close()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f'\n{checks - failures}/{checks} board computations identical')
+    sys.exit(1 if failures or not checks else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""Version-keyed cache for the expensive page / summary computations.
+
+The dashboard, order list, monthly, cancelled-analysis and customers pages
+and the reconciliation summary endpoints are pure functions of (request
+args, the user's allowed sources / partners, today's date, the data). They
+used to be recomputed from raw orders on every load, so five managers
+opening the same month ran the same aggregation five times.
+
+Callers build a key from those inputs plus the global data version
+(order_index.GLOBAL_SCOPE, bumped by every writer) and ask get_or_build()
+for the value. Because the version is part of the key, a write makes every
+older entry unreachable — nothing has to be invalidated explicitly; stale
+entries just age out.
+
+Two tiers:
+
+    memory   per-process LRU (OrderedDict), at most MAX_ENTRIES values
+    shared   optional SQLite file shared by the gunicorn workers
+             (configure(shared_path=...)), at most MAX_SHARED_ROWS rows;
+             values are pickled, rows of older versions are dropped
+             whenever a newer version is stored
+
+A worker that misses in memory looks in the shared file before building, so
+a page one worker computed is reused by the others. Values must be treated
+as read-only by callers (the memory tier hands out the same object).
+
+sqlite3.Row values are pickled as CachedRow, which supports the same index,
+key, keys() and dict() access, so contexts holding fetched rows can be
+shared as they are.
+"""
+import copyreg
+import hashlib
+import io
+import json
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+MAX_ENTRIES = 256
+MAX_SHARED_ROWS = 2000
+
+_lock = threading.Lock()
+_memory = OrderedDict()  # key -> value, most recently used last
+_shared_path = None
+_stats = {'hits': 0, 'shared_hits': 0, 'misses': 0, 'evictions': 0, 'shared_errors': 0}
+
+
+class CachedRow:
+    """Picklable stand-in for sqlite3.Row: index, key (case-insensitive),
+    keys(), iteration and dict(row) work the same way."""
+    __slots__ = ('_keys', '_values')
+
+    def __init__(self, keys, values):
+        self._keys = tuple(keys)
+        self._values = tuple(values)
+
+    def __reduce__(self):
+        return CachedRow, (self._keys, self._values)
+
+    def __getitem__(self, item):
+        if isinstance(item, str):
+            lowered = item.lower()
+            for i, k in enumerate(self._keys):
+                if k.lower() == lowered:
+                    return self._values[i]
+            raise IndexError('No item with that key')
+        return self._values[item]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __eq__(self, other):
+        return isinstance(other, CachedRow) and (self._keys, self._values) == (other._keys, other._values)
+
+    def __hash__(self):
+        return hash((self._keys, self._values))
+
+    def keys(self):
+        return list(self._keys)
+
+
+def _reduce_row(row):
+    return CachedRow, (tuple(row.keys()), tuple(row))
+
+
+def _dumps(value):
+    buf = io.BytesIO()
+    pickler = pickle.Pickler(buf, pickle.HIGHEST_PROTOCOL)
+    pickler.dispatch_table = copyreg.dispatch_table.copy()
+    pickler.dispatch_table[sqlite3.Row] = _reduce_row
+    pickler.dump(value)
+    return buf.getvalue()
+
+
+def make_key(name, version, *parts):
+    """Stable key for a view name, data version and any JSON-able inputs."""
+    raw = json.dumps([name, version, parts], sort_keys=True, default=str, ensure_ascii=False)
+    return f'{name}:{version}:' + hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def configure(shared_path=None):
+    """Enable the shared SQLite tier at shared_path (None disables it).
+
+    Rows left from before this start are dropped: the orders DB may have been
+    swapped for a backup whose counters repeat versions already cached.
+    """
+    global _shared_path
+    _shared_path = shared_path
+    if not shared_path:
+        return
+    conn = _shared_connect()
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS view_cache (
+                cache_key TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                payload BLOB NOT NULL,
+                used_at REAL NOT NULL
+            )
+        """)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_view_cache_name_version ON view_cache(name, version)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_view_cache_used ON view_cache(used_at)')
+        conn.execute('DELETE FROM view_cache')
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _shared_connect():
+    conn = sqlite3.connect(_shared_path, timeout=2)
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+
+def _shared_get(key):
+    conn = _shared_connect()
+    try:
+        row = conn.execute('SELECT payload FROM view_cache WHERE cache_key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        conn.execute('UPDATE view_cache SET used_at = ? WHERE cache_key = ?', (time.time(), key))
+        conn.commit()
+        return pickle.loads(row[0])
+    finally:
+        conn.close()
+
+
+def _shared_put(key, name, version, payload):
+    conn = _shared_connect()
+    try:
+        conn.execute('DELETE FROM view_cache WHERE name = ? AND version < ?', (name, version))
+        conn.execute('INSERT OR REPLACE INTO view_cache (cache_key, name, version, payload, used_at) '
+                     'VALUES (?, ?, ?, ?, ?)', (key, name, version, payload, time.time()))
+        conn.execute("""
+            DELETE FROM view_cache WHERE cache_key IN (
+                SELECT cache_key FROM view_cache ORDER BY used_at DESC LIMIT -1 OFFSET ?)
+        """, (MAX_SHARED_ROWS,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _remember(key, value):
+    with _lock:
+        _memory[key] = value
+        _memory.move_to_end(key)
+        while len(_memory) > MAX_ENTRIES:
+            _memory.popitem(last=False)
+            _stats['evictions'] += 1
+
+
+def get_or_build(name, version, key, build):
+    """Cached value for key, else build() (stored in both tiers).
+
+    version is the data version the key was made with; the shared tier uses
+    it to drop rows a newer version has superseded. A failing shared tier
+    (locked, disk full, unpicklable value) only costs the cache, never the
+    request.
+    """
+    with _lock:
+        if key in _memory:
+            _memory.move_to_end(key)
+            _stats['hits'] += 1
+            return _memory[key]
+    if _shared_path:
+        try:
+            value = _shared_get(key)
+        except Exception:
+            value = None
+            _stats['shared_errors'] += 1
+        if value is not None:
+            _stats['shared_hits'] += 1
+            _remember(key, value)
+            return value
+    _stats['misses'] += 1
+    value = build()
+    _remember(key, value)
+    if _shared_path:
+        try:
+            _shared_put(key, name, version, _dumps(value))
+        except Exception:
+            _stats['shared_errors'] += 1
+    return value
+
+
+def stats():
+    """Hit / miss / eviction counters of this process plus current sizes."""
+    with _lock:
+        result = dict(_stats, entries=len(_memory), max_entries=MAX_ENTRIES,
+                      shared=bool(_shared_path))
+    return result
+
+
+def clear():
+    """Drop this process's memory tier (the shared file is left alone)."""
+    with _lock:
+        _memory.clear()
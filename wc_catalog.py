@@ -0,0 +1,422 @@
+"""Local mirror of the WooCommerce product catalogs behind /product-manager.
+
+The product manager used to call the store's REST API live for every list
+page, search and "expand variations" click (up to 60 s per call on big
+catalogs), so browsing the catalog was bounded by the slowest store.
+
+Fix: products and variations are mirrored per catalog
+
+    wc_products(catalog, product_id, ...slim list fields..., date_created_gmt,
+                date_modified_gmt, variations_synced_at, synced_at)
+    wc_variations(catalog, variation_id, parent_id, ...slim fields..., synced_at)
+    wc_catalog_sync(catalog, last_modified_gmt, full_synced_at, synced_at,
+                    product_count, last_error, sync_claimed_at)
+
+catalog     the effective API base URL (get_product_api_endpoint), so every
+            site routed to the same product master shares one mirror
+
+and the list / search / variations endpoints read these tables only. The
+slim fields are exactly what the endpoints returned before (product_row /
+variation_row), so the JSON the page gets is unchanged.
+
+Freshness (the HTTP calls stay in app.py, _sync_wc_catalog):
+  - incremental: products with date_modified_gmt after the stored watermark
+    (WC's `modified_after` + `dates_are_gmt`), every REFRESH_SECONDS
+  - full: every product id, every FULL_SYNC_SECONDS or on demand; products
+    missing from it (deleted / trashed) are removed with their variations
+  - variations are fetched the first time a product is expanded, then
+    refetched whenever a sync sees their parent change
+  - writes made through the product manager are applied from the WC
+    response right away (write-through), so the page never shows the old
+    values while waiting for the next sync
+  - one run per catalog at a time across all worker processes: a run is
+    claimed by setting sync_claimed_at (claim_sync), refreshed after every
+    page it stores (touch_sync) and released by mark_synced; a claim not
+    refreshed for SYNC_LEASE_SECONDS died with its process
+
+Search is a LIKE over name / SKU; WC's own `search` also looked at the
+description, which the mirror does not keep. None of the write functions
+commit.
+"""
+import sqlite3
+from datetime import datetime, timedelta
+
+REFRESH_SECONDS = 300
+FULL_SYNC_SECONDS = 24 * 3600
+SYNC_LEASE_SECONDS = 900  # > the longest gap between touch_sync calls (10 x 60 s variation pages)
+
+_TS = '%Y-%m-%d %H:%M:%S'
+
+_PRODUCT_FIELDS = ('name', 'sku', 'type', 'status', 'manage_stock', 'stock_quantity', 'stock_status',
+                   'regular_price', 'sale_price', 'price', 'permalink', 'image', 'variations_count')
+_VARIATION_FIELDS = ('sku', 'attributes_summary', 'manage_stock', 'stock_quantity', 'stock_status',
+                     'regular_price', 'sale_price', 'price', 'image')
+
+
+def catalog_key(api_url):
+    return (api_url or '').strip().rstrip('/')
+
+
+def _now(now=None):
+    return (now or datetime.now()).strftime(_TS)
+
+
+def _gmt(value):
+    """WC's "2025-03-14T10:22:05" -> "2025-03-14 10:22:05" (sortable, '' if missing)."""
+    return str(value or '').replace('T', ' ')[:19]
+
+
+def product_row(p):
+    """Slim product dict (the list endpoint's shape) from a WC product object."""
+    return {
+        'id': p.get('id'),
+        'name': p.get('name'),
+        'sku': p.get('sku', ''),
+        'type': p.get('type', 'simple'),
+        'status': p.get('status'),
+        'manage_stock': bool(p.get('manage_stock', False)),
+        'stock_quantity': p.get('stock_quantity'),
+        'stock_status': p.get('stock_status', 'instock'),
+        'regular_price': p.get('regular_price', ''),
+        'sale_price': p.get('sale_price', ''),
+        'price': p.get('price', ''),  # display-only effective price
+        'permalink': p.get('permalink', ''),
+        'image': (p.get('images') or [{}])[0].get('src', '') if p.get('images') else '',
+        'variations_count': len(p.get('variations') or []),
+    }
+
+
+def variation_row(v, parent_id):
+    """Slim variation dict (the variations endpoint's shape) from a WC variation object."""
+    # WC returns attributes as list of {id, name, option}
+    attr_summary = ' / '.join(
+        f"{a.get('name', '')}: {a.get('option', '')}"
+        for a in (v.get('attributes') or [])
+        if a.get('option')
+    )
+    return {
+        'id': v.get('id'),
+        'parent_id': parent_id,
+        'sku': v.get('sku', ''),
+        'attributes_summary': attr_summary,
+        'manage_stock': bool(v.get('manage_stock', False)),
+        'stock_quantity': v.get('stock_quantity'),
+        'stock_status': v.get('stock_status', 'instock'),
+        'regular_price': v.get('regular_price', ''),
+        'sale_price': v.get('sale_price', ''),
+        'price': v.get('price', ''),
+        'image': (v.get('image') or {}).get('src', ''),
+    }
+
+
+def upsert_products(conn, catalog, products, now=None):
+    """Store WC product objects. Returns the ids whose date_modified_gmt moved
+    (or that are new) — their variations may have changed too."""
+    products = [p for p in products or [] if p.get('id')]
+    if not products:
+        return set()
+    synced_at = _now(now)
+    ids = [p['id'] for p in products]
+    stored = {}
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        for r in conn.execute(
+                f'SELECT product_id, date_modified_gmt FROM wc_products '
+                f'WHERE catalog = ? AND product_id IN ({placeholders})', [catalog] + chunk):
+            stored[r[0]] = r[1]
+    changed = set()
+    values = []
+    for p in products:
+        row = product_row(p)
+        modified = _gmt(p.get('date_modified_gmt'))
+        if p['id'] not in stored or stored[p['id']] != modified:
+            changed.add(p['id'])
+        values.append((catalog, p['id'], *[row[f] for f in _PRODUCT_FIELDS],
+                       _gmt(p.get('date_created_gmt')), modified, synced_at))
+    conn.executemany(f"""
+        INSERT INTO wc_products (catalog, product_id, {', '.join(_PRODUCT_FIELDS)},
+                                 date_created_gmt, date_modified_gmt, synced_at)
+        VALUES ({', '.join('?' * (len(_PRODUCT_FIELDS) + 5))})
+        ON CONFLICT(catalog, product_id) DO UPDATE SET
+            {', '.join(f'{f} = excluded.{f}' for f in _PRODUCT_FIELDS)},
+            date_created_gmt = excluded.date_created_gmt,
+            date_modified_gmt = excluded.date_modified_gmt,
+            synced_at = excluded.synced_at
+    """, values)
+    return changed
+
+
+def upsert_variations(conn, catalog, parent_id, variations, complete=False, now=None):
+    """Store WC variation objects of parent_id.
+
+    complete=True means `variations` is the parent's full list: variations no
+    longer in it are dropped and the parent is marked as fetched, so
+    load_variations() answers from the mirror from then on.
+    """
+    synced_at = _now(now)
+    variations = [v for v in variations or [] if v.get('id')]
+    values = []
+    for v in variations:
+        row = variation_row(v, parent_id)
+        values.append((catalog, v['id'], parent_id, *[row[f] for f in _VARIATION_FIELDS], synced_at))
+    if values:
+        conn.executemany(f"""
+            INSERT INTO wc_variations (catalog, variation_id, parent_id, {', '.join(_VARIATION_FIELDS)}, synced_at)
+            VALUES ({', '.join('?' * (len(_VARIATION_FIELDS) + 4))})
+            ON CONFLICT(catalog, variation_id) DO UPDATE SET
+                parent_id = excluded.parent_id,
+                {', '.join(f'{f} = excluded.{f}' for f in _VARIATION_FIELDS)},
+                synced_at = excluded.synced_at
+        """, values)
+    if complete:
+        keep = {v['id'] for v in variations}
+        gone = [r[0] for r in conn.execute(
+            'SELECT variation_id FROM wc_variations WHERE catalog = ? AND parent_id = ?', (catalog, parent_id))
+            if r[0] not in keep]
+        conn.executemany('DELETE FROM wc_variations WHERE catalog = ? AND variation_id = ?',
+                         [(catalog, vid) for vid in gone])
+        conn.execute('UPDATE wc_products SET variations_synced_at = ? WHERE catalog = ? AND product_id = ?',
+                     (synced_at, catalog, parent_id))
+
+
+def remove_missing(conn, catalog, seen_ids):
+    """After a full sync: drop products (and their variations) WC no longer lists."""
+    seen = set(seen_ids)
+    stale = [r[0] for r in conn.execute('SELECT product_id FROM wc_products WHERE catalog = ?', (catalog,))
+             if r[0] not in seen]
+    for i in range(0, len(stale), 500):
+        chunk = stale[i:i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        conn.execute(f'DELETE FROM wc_variations WHERE catalog = ? AND parent_id IN ({placeholders})',
+                     [catalog] + chunk)
+        conn.execute(f'DELETE FROM wc_products WHERE catalog = ? AND product_id IN ({placeholders})',
+                     [catalog] + chunk)
+    return len(stale)
+
+
+def variation_parents(conn, catalog, product_ids):
+    """Those of product_ids whose variations are mirrored (to be refetched)."""
+    product_ids = list(product_ids)
+    result = []
+    for i in range(0, len(product_ids), 500):
+        chunk = product_ids[i:i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        result.extend(r[0] for r in conn.execute(
+            f"SELECT product_id FROM wc_products WHERE catalog = ? AND product_id IN ({placeholders}) "
+            f"AND type = 'variable' AND variations_synced_at IS NOT NULL", [catalog] + chunk))
+    return result
+
+
+def _product_dict(r):
+    d = {'id': r['product_id']}
+    for f in _PRODUCT_FIELDS:
+        d[f] = r[f]
+    d['manage_stock'] = bool(d['manage_stock'])
+    return d
+
+
+def search_products(conn, catalog, search='', status='any', page=1, per_page=50):
+    """(products, total) — newest first like WC's default listing.
+
+    status 'any' means every status except trash, as in WC.
+    """
+    where = ['catalog = ?']
+    params = [catalog]
+    if status and status != 'any':
+        where.append('status = ?')
+        params.append(status)
+    else:
+        where.append("status != 'trash'")
+    if search:
+        like = '%' + search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        where.append("(name LIKE ? ESCAPE '\\' OR sku LIKE ? ESCAPE '\\')")
+        params += [like, like]
+    where_sql = ' AND '.join(where)
+    total = conn.execute(f'SELECT COUNT(*) FROM wc_products WHERE {where_sql}', params).fetchone()[0]
+    rows = conn.execute(f"""
+        SELECT * FROM wc_products WHERE {where_sql}
+        ORDER BY date_created_gmt DESC, product_id DESC
+        LIMIT ? OFFSET ?
+    """, params + [per_page, (page - 1) * per_page]).fetchall()
+    return [_product_dict(r) for r in rows], total
+
+
+def load_variations(conn, catalog, parent_id):
+    """The mirrored variations of parent_id (menu order is not kept; by id),
+    or None when they were never fetched."""
+    parent = conn.execute(
+        'SELECT variations_synced_at FROM wc_products WHERE catalog = ? AND product_id = ?',
+        (catalog, parent_id)).fetchone()
+    if parent is None or parent[0] is None:
+        return None
+    result = []
+    for r in conn.execute(
+            'SELECT * FROM wc_variations WHERE catalog = ? AND parent_id = ? ORDER BY variation_id',
+            (catalog, parent_id)):
+        d = {'id': r['variation_id'], 'parent_id': r['parent_id']}
+        for f in _VARIATION_FIELDS:
+            d[f] = r[f]
+        d['manage_stock'] = bool(d['manage_stock'])
+        result.append(d)
+    return result
+
+
+def sync_state(conn, catalog):
+    return conn.execute('SELECT * FROM wc_catalog_sync WHERE catalog = ?', (catalog,)).fetchone()
+
+
+def sync_due(state, now=None):
+    """'full', 'incremental' or None for a wc_catalog_sync row (None row → 'full').
+
+    A catalog whose first full run failed has synced_at (the attempt) but no
+    full_synced_at; it is retried after REFRESH_SECONDS like any other run.
+    """
+    if state is None:
+        return 'full'
+    now = now or datetime.now()
+    if not state['full_synced_at']:
+        if (state['synced_at'] or '') < (now - timedelta(seconds=REFRESH_SECONDS)).strftime(_TS):
+            return 'full'
+        return None
+    if state['full_synced_at'] < (now - timedelta(seconds=FULL_SYNC_SECONDS)).strftime(_TS):
+        return 'full'
+    if (state['synced_at'] or '') < (now - timedelta(seconds=REFRESH_SECONDS)).strftime(_TS):
+        return 'incremental'
+    return None
+
+
+def claim_sync(conn, catalog, now=None):
+    """Claim the catalog's next sync run; False when another process (or
+    thread) holds a live claim. Does not commit — commit right away so the
+    claim is visible to the other workers."""
+    now = now or datetime.now()
+    conn.execute('INSERT OR IGNORE INTO wc_catalog_sync (catalog) VALUES (?)', (catalog,))
+    return conn.execute("""
+        UPDATE wc_catalog_sync SET sync_claimed_at = ?
+        WHERE catalog = ? AND (sync_claimed_at IS NULL OR sync_claimed_at < ?)
+    """, (_now(now), catalog, (now - timedelta(seconds=SYNC_LEASE_SECONDS)).strftime(_TS))).rowcount == 1
+
+
+def touch_sync(conn, catalog, now=None):
+    """Refresh the running sync's claim. Does not commit."""
+    conn.execute('UPDATE wc_catalog_sync SET sync_claimed_at = ? WHERE catalog = ?', (_now(now), catalog))
+
+
+def sync_running(state, now=None):
+    """True while a wc_catalog_sync row holds a live claim."""
+    if state is None or not state['sync_claimed_at']:
+        return False
+    now = now or datetime.now()
+    return state['sync_claimed_at'] >= (now - timedelta(seconds=SYNC_LEASE_SECONDS)).strftime(_TS)
+
+
+def mark_synced(conn, catalog, full, last_modified=None, error=None, now=None):
+    """Record a finished (or failed, error set) sync run and release its claim.
+
+    last_modified is the newest date_modified_gmt the run fetched (WC's ISO
+    form); it becomes the next run's `modified_after`. It is not taken from
+    the table: a write-through may have stored a product edited after
+    changes the sync has not fetched yet.
+    """
+    stamp = _now(now)
+    count = conn.execute('SELECT COUNT(*) FROM wc_products WHERE catalog = ?', (catalog,)).fetchone()[0]
+    if error:
+        # a failed run is retried after REFRESH_SECONDS, not on every page load
+        conn.execute("""
+            INSERT INTO wc_catalog_sync (catalog, synced_at, product_count, last_error)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(catalog) DO UPDATE SET synced_at = excluded.synced_at, last_error = excluded.last_error,
+                sync_claimed_at = NULL
+        """, (catalog, stamp, count, error))
+        return
+    conn.execute("""
+        INSERT INTO wc_catalog_sync (catalog, last_modified_gmt, full_synced_at, synced_at, product_count, last_error)
+        VALUES (?, ?, ?, ?, ?, NULL)
+        ON CONFLICT(catalog) DO UPDATE SET
+            last_modified_gmt = COALESCE(excluded.last_modified_gmt, wc_catalog_sync.last_modified_gmt),
+            full_synced_at = COALESCE(excluded.full_synced_at, wc_catalog_sync.full_synced_at),
+            synced_at = excluded.synced_at,
+            product_count = excluded.product_count,
+            last_error = NULL,
+            sync_claimed_at = NULL
+    """, (catalog, last_modified, stamp if full else None, stamp, count))
+
+
+def ensure_catalog_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS wc_products (
+            catalog TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            name TEXT,
+            sku TEXT,
+            type TEXT,
+            status TEXT,
+            manage_stock INTEGER,
+            stock_quantity INTEGER,
+            stock_status TEXT,
+            regular_price TEXT,
+            sale_price TEXT,
+            price TEXT,
+            permalink TEXT,
+            image TEXT,
+            variations_count INTEGER,
+            date_created_gmt TEXT,
+            date_modified_gmt TEXT,
+            variations_synced_at TEXT,
+            synced_at TEXT NOT NULL,
+            PRIMARY KEY (catalog, product_id)
+        )
+    """)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_wc_products_created '
+                 'ON wc_products(catalog, date_created_gmt, product_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_wc_products_status '
+                 'ON wc_products(catalog, status, date_created_gmt, product_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_wc_products_sku ON wc_products(catalog, sku)')
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS wc_variations (
+            catalog TEXT NOT NULL,
+            variation_id INTEGER NOT NULL,
+            parent_id INTEGER NOT NULL,
+            sku TEXT,
+            attributes_summary TEXT,
+            manage_stock INTEGER,
+            stock_quantity INTEGER,
+            stock_status TEXT,
+            regular_price TEXT,
+            sale_price TEXT,
+            price TEXT,
+            image TEXT,
+            synced_at TEXT NOT NULL,
+            PRIMARY KEY (catalog, variation_id)
+        )
+    """)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_wc_variations_parent ON wc_variations(catalog, parent_id)')
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS wc_catalog_sync (
+            catalog TEXT PRIMARY KEY,
+            last_modified_gmt TEXT,
+            full_synced_at TEXT,
+            synced_at TEXT,
+            product_count INTEGER,
+            last_error TEXT,
+            sync_claimed_at TEXT
+        )
+    """)
+    try:
+        conn.execute('ALTER TABLE wc_catalog_sync ADD COLUMN sync_claimed_at TEXT')
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+    conn.commit()
+
+
+_schema_ready = False
+
+
+def ensure_schema(conn):
+    """Run ensure_catalog_tables once per process."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    ensure_catalog_tables(conn)
+    _schema_ready = True
@@ -0,0 +1,563 @@
+"""Durable outbox for WooCommerce write-backs (wc_outbox table).
+
+Status changes, notes, shipments, delivery confirms and the cron's
+blocklist cancels / auto-confirms used to PUT / POST to the store inside the
+request (or the cron loop) with 30-90 s timeouts, each caller handling a
+failure its own way. A slow WP made every click wait on it.
+
+Now the caller writes its local change and enqueues the remote write in the
+same transaction, then returns. A worker (app._kick_wc_outbox, and the
+hourly cron after its enforcement passes) drains the queue:
+
+    wc_outbox(id, idem_key, source, order_id, kind, payload, local_status,
+              depends_on, status, attempts, max_attempts, next_attempt_at,
+              claimed_at, last_error, result, actor, created_at, updated_at,
+              done_at)
+
+kind          order_update    PUT /orders/{id} with payload['data']
+              order_note      POST /orders/{id}/notes (payload note / customer_note)
+              shipment_email  the ship email trigger + its fallbacks (see below)
+local_status  the order status the local row shows because of this write;
+              reapply_pending() puts it back when a sync fetched the old
+              remote status before the write went out
+depends_on    an earlier op that must be done first (a status note after its
+              status change, a shipment email after the tracking PUT); when
+              that op is dead the dependent one dies with it
+status        pending -> running -> done, or dead once a non-retryable error
+              came back or max_attempts ran out (the dead-letter list in
+              settings, where an admin retries or discards them)
+
+Ordering: one op per order is in flight at a time and ops of an order run in
+id order, so two status clicks reach WP in the order they were made. Sites
+run concurrently (MAX_WORKERS threads per drainer, at most PER_SITE running
+ops per site across all processes). An op is only claimed when a thread can
+start it, so claimed_at is its start time and LEASE_SECONDS (longer than any
+op's timeouts add up to) never expires under a live owner.
+
+Retries: connection errors, timeouts, 5xx / 408 / 429 and WAF HTML pages are
+retried with exponential backoff (BACKOFF_BASE_SECONDS doubling up to
+BACKOFF_MAX_SECONDS); other 4xx answers are dead at once. A PUT is
+idempotent and is simply sent again. A note POST is not: before re-sending
+one, the order's notes are fetched and the note counts as written when it is
+already there. The shipment email is only re-sent when the previous try
+never reached the server.
+
+Idempotency: idem_key is unique among live (pending / running) ops, so a
+double-submitted click enqueues its write once.
+
+Import-safe for the cron (auto_sync.py): does not import the Flask app, only
+needs a DB connection (sqlite3.Row factory). Functions other than drain()
+do not commit.
+"""
+import json
+import sqlite3
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+
+from oid_utils import woo_post_id  # raw WC post id for REST write-back
+import order_index  # data_versions bumps: re-applied statuses, linked notes
+import latest_note  # orders.latest_note_id pointer when a duplicate local note is dropped
+import customer_stats  # re-applied statuses change the customer's success counts / spend
+
+MAX_ATTEMPTS = 8
+BACKOFF_BASE_SECONDS = 30
+BACKOFF_MAX_SECONDS = 3600
+LEASE_SECONDS = 600          # a 'running' op older than this was orphaned by a crash
+MAX_WORKERS = 8
+PER_SITE = 2
+DRAIN_MAX_OPS = 2000         # ops one drain() call starts before it returns
+DONE_RETENTION_DAYS = 14
+
+_API_HEADERS = {
+    "User-Agent": "WooCommerce API Client-Python/3.0.0",
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+}
+
+
+class PushError(Exception):
+    """A failed remote write; retryable=False sends the op straight to dead."""
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+# --- enqueue / bookkeeping ---------------------------------------------------
+def enqueue(conn, source, kind, payload, order_id=None, local_status=None,
+            depends_on=None, idem_key=None, max_attempts=MAX_ATTEMPTS, actor=None):
+    """Queue one remote write and return its id (the existing op's id when a
+    live op with the same idem_key is already queued). Does not commit."""
+    idem_key = idem_key or uuid.uuid4().hex
+    cur = conn.execute(
+        """INSERT OR IGNORE INTO wc_outbox
+               (idem_key, source, order_id, kind, payload, local_status, depends_on,
+                max_attempts, actor, next_attempt_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))""",
+        (idem_key, source, str(order_id) if order_id is not None else None, kind,
+         json.dumps(payload, ensure_ascii=False), local_status, depends_on, max_attempts, actor))
+    if cur.rowcount:
+        return cur.lastrowid
+    return live_op(conn, idem_key)
+
+
+def live_op(conn, idem_key):
+    """Id of the pending / running op queued under idem_key, or None."""
+    row = conn.execute(
+        "SELECT id FROM wc_outbox WHERE idem_key = ? AND status IN ('pending', 'running')",
+        (idem_key,)).fetchone()
+    return row[0] if row else None
+
+
+def reapply_pending(conn, order_ids):
+    """Put local_status of the latest live op back onto each order whose
+    status differs (a sync just overwrote it with the not-yet-pushed remote
+    value). Returns the ids of the orders changed."""
+    order_ids = [str(i) for i in order_ids if i is not None]
+    wanted = {}
+    for i in range(0, len(order_ids), 500):
+        chunk = order_ids[i:i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        for oid, st in conn.execute(f"""
+                SELECT order_id, local_status FROM wc_outbox
+                WHERE status IN ('pending', 'running') AND local_status IS NOT NULL
+                  AND order_id IN ({placeholders})
+                ORDER BY id""", chunk):
+            wanted[oid] = st
+    changed = []
+    for oid, st in wanted.items():
+        if conn.execute('UPDATE orders SET status = ? WHERE id = ? AND status IS NOT ?',
+                        (st, oid, st)).rowcount:
+            changed.append(oid)
+    order_index.bump_order_months(conn, changed)
+    customer_stats.mark_orders(conn, changed)
+    return changed
+
+
+def pending_orders(conn, order_ids, sources=None):
+    """{order_id: {'pending': live ops, 'dead': dead-lettered ops}} for the
+    given orders that have either — the "pushing to the site" / "push failed"
+    badges of the order and shipping lists. ``sources`` (None = all) limits it
+    to the sites the caller may see."""
+    order_ids = [str(i) for i in order_ids if i is not None]
+    source_sql, source_params = '', []
+    if sources is not None:
+        if not sources:
+            return {}
+        source_sql = f" AND source IN ({','.join('?' * len(sources))})"
+        source_params = list(sources)
+    result = {}
+    for i in range(0, len(order_ids), 500):
+        chunk = order_ids[i:i + 500]
+        placeholders = ','.join('?' * len(chunk))
+        for oid, pending, dead in conn.execute(f"""
+                SELECT order_id,
+                       SUM(status IN ('pending', 'running')), SUM(status = 'dead')
+                FROM wc_outbox
+                WHERE status IN ('pending', 'running', 'dead') AND order_id IN ({placeholders}){source_sql}
+                GROUP BY order_id""", chunk + source_params):
+            result[oid] = {'pending': pending, 'dead': dead}
+    return result
+
+
+def counts(conn):
+    """{status: count} over the whole outbox."""
+    return {r[0]: r[1] for r in conn.execute('SELECT status, COUNT(*) FROM wc_outbox GROUP BY status')}
+
+
+def list_ops(conn, status='dead', limit=200):
+    """Newest ops in a status, payload decoded."""
+    rows = conn.execute(
+        'SELECT * FROM wc_outbox WHERE status = ? ORDER BY id DESC LIMIT ?', (status, limit)).fetchall()
+    out = []
+    for r in rows:
+        d = dict(r)
+        for k in ('payload', 'result'):
+            try:
+                d[k] = json.loads(d[k]) if d[k] else None
+            except (TypeError, ValueError):
+                pass
+        out.append(d)
+    return out
+
+
+def retry(conn, op_ids):
+    """Send dead ops (and the ops that died because of them) back to the
+    queue and re-apply their local status. Returns the number revived.
+
+    A dead op whose idem_key was queued again since (the click was repeated)
+    is discarded instead: the live op carries the same write, and the ops
+    that died because of the dead one now wait for the live one."""
+    ids = {int(i) for i in op_ids}
+    revived = 0
+    orders = set()
+    while ids:
+        placeholders = ','.join('?' * len(ids))
+        parents = set()
+        for op_id, idem_key, order_id in conn.execute(
+                f"SELECT id, idem_key, order_id FROM wc_outbox WHERE id IN ({placeholders}) AND status = 'dead' ORDER BY id",
+                list(ids)).fetchall():
+            live = live_op(conn, idem_key)
+            if live is None:
+                conn.execute("""
+                    UPDATE wc_outbox SET status = 'pending', attempts = 0, last_error = NULL,
+                           next_attempt_at = datetime('now'), updated_at = datetime('now')
+                    WHERE id = ?""", (op_id,))
+                revived += 1
+                orders.add(order_id)
+                parents.add(op_id)
+            else:
+                conn.execute("UPDATE wc_outbox SET status = 'discarded', updated_at = datetime('now') WHERE id = ?",
+                             (op_id,))
+                conn.execute("UPDATE wc_outbox SET depends_on = ? WHERE depends_on = ? AND status = 'dead'",
+                             (live, op_id))
+                parents.add(live)
+        if not parents:
+            break
+        placeholders = ','.join('?' * len(parents))
+        ids = {r[0] for r in conn.execute(
+            f"SELECT id FROM wc_outbox WHERE status = 'dead' AND depends_on IN ({placeholders})", list(parents))}
+    changed = reapply_pending(conn, orders)
+    order_index.bump_order_months(conn, changed)
+    return revived
+
+
+def discard(conn, op_ids):
+    """Give up on dead ops. The next sync brings the local order back in line
+    with the store."""
+    ids = [int(i) for i in op_ids]
+    if not ids:
+        return 0
+    placeholders = ','.join('?' * len(ids))
+    return conn.execute(f"""
+        UPDATE wc_outbox SET status = 'discarded', updated_at = datetime('now')
+        WHERE id IN ({placeholders}) AND status = 'dead'""", ids).rowcount
+
+
+def _housekeep(conn):
+    """Re-queue ops orphaned in 'running', kill ops whose dependency died,
+    drop old finished rows."""
+    conn.execute("""
+        UPDATE wc_outbox SET status = 'pending', claimed_at = NULL, updated_at = datetime('now')
+        WHERE status = 'running' AND claimed_at < datetime('now', ?)""", (f'-{LEASE_SECONDS} seconds',))
+    while conn.execute("""
+            UPDATE wc_outbox SET status = 'dead', last_error = '前置操作未成功，未执行',
+                   updated_at = datetime('now')
+            WHERE status = 'pending' AND depends_on IN (
+                SELECT id FROM wc_outbox WHERE status IN ('dead', 'discarded'))""").rowcount:
+        pass
+    conn.execute("""
+        DELETE FROM wc_outbox WHERE status IN ('done', 'discarded')
+          AND updated_at < datetime('now', ?)""", (f'-{DONE_RETENTION_DAYS} days',))
+
+
+def _claim(conn, limit):
+    """Due ops, the oldest live one of each order only, at most limit and no
+    more per site than PER_SITE minus the ops already running there (in any
+    process); marked running."""
+    running = {r[0]: r[1] for r in conn.execute(
+        "SELECT source, COUNT(*) FROM wc_outbox WHERE status = 'running' GROUP BY source")}
+    rows = conn.execute("""
+        SELECT o.* FROM wc_outbox o
+        WHERE o.status = 'pending' AND o.next_attempt_at <= datetime('now')
+          AND NOT EXISTS (
+              SELECT 1 FROM wc_outbox e
+              WHERE e.order_id = o.order_id AND e.id < o.id AND e.status IN ('pending', 'running'))
+          AND (o.depends_on IS NULL OR EXISTS (
+              SELECT 1 FROM wc_outbox d WHERE d.id = o.depends_on AND d.status = 'done'))
+        ORDER BY o.id""").fetchall()
+    claimed = []
+    for r in rows:
+        if len(claimed) >= limit:
+            break
+        if running.get(r['source'], 0) >= PER_SITE:
+            continue
+        # another worker process may have claimed it between SELECT and UPDATE
+        if conn.execute("""
+                UPDATE wc_outbox SET status = 'running', attempts = attempts + 1,
+                       claimed_at = datetime('now'), updated_at = datetime('now')
+                WHERE id = ? AND status = 'pending'""", (r['id'],)).rowcount:
+            d = dict(r)
+            d['attempts'] += 1
+            claimed.append(d)
+            running[r['source']] = running.get(r['source'], 0) + 1
+    return claimed
+
+
+def _finish(conn, op, result=None, error=None):
+    if error is None:
+        conn.execute("""
+            UPDATE wc_outbox SET status = 'done', result = ?, last_error = NULL,
+                   done_at = datetime('now'), updated_at = datetime('now')
+            WHERE id = ?""", (json.dumps(result, ensure_ascii=False) if result is not None else None, op['id']))
+        return 'done'
+    if not error.retryable or op['attempts'] >= op['max_attempts']:
+        conn.execute("""
+            UPDATE wc_outbox SET status = 'dead', last_error = ?, updated_at = datetime('now')
+            WHERE id = ?""", (str(error)[:500], op['id']))
+        return 'dead'
+    delay = min(BACKOFF_BASE_SECONDS * 2 ** (op['attempts'] - 1), BACKOFF_MAX_SECONDS)
+    conn.execute("""
+        UPDATE wc_outbox SET status = 'pending', last_error = ?, claimed_at = NULL,
+               next_attempt_at = datetime('now', ?), updated_at = datetime('now')
+        WHERE id = ?""", (str(error)[:500], f'+{delay} seconds', op['id']))
+    return 'retry'
+
+
+# --- remote calls ------------------------------------------------------------
+def _auth(site):
+    return site['consumer_key'], site['consumer_secret']
+
+
+def _check(resp):
+    """Raise PushError unless WP answered 200/201 with JSON."""
+    text = resp.text or ''
+    if text.strip().startswith('<!') or text.strip().startswith('<html'):
+        raise PushError(f"WP返回HTML(可能WAF/认证问题), HTTP {resp.status_code}")
+    if resp.status_code in (200, 201):
+        return
+    retryable = resp.status_code >= 500 or resp.status_code in (408, 429)
+    raise PushError(f"API {resp.status_code}: {text[:160]}", retryable)
+
+
+def _order_url(site, op):
+    return f"{site['url']}/wp-json/wc/v3/orders/{woo_post_id(op['order_id'])}"
+
+
+def _push_order_update(conn, site, op, payload):
+    try:
+        resp = requests.put(_order_url(site, op), json=payload['data'], auth=_auth(site),
+                            timeout=60, headers=_API_HEADERS)
+    except requests.RequestException as e:
+        raise PushError(f"请求异常: {e}")
+    _check(resp)
+    try:
+        return {'status': (resp.json() or {}).get('status')}
+    except ValueError:
+        return {}
+
+
+def _find_note(site, op, note):
+    """The WC note dict whose text equals note, or None."""
+    try:
+        resp = requests.get(f"{_order_url(site, op)}/notes", auth=_auth(site),
+                            timeout=(10, 30), headers=_API_HEADERS)
+        if resp.status_code == 200:
+            for n in resp.json() or []:
+                if str(n.get('note', '')).strip() == note.strip():
+                    return n
+    except (requests.RequestException, ValueError):
+        pass
+    return None
+
+
+def _push_order_note(conn, site, op, payload):
+    note = payload['note']
+    customer_note = bool(payload.get('customer_note'))
+    created = _find_note(site, op, note) if op['attempts'] > 1 else None
+    if created is None:
+        try:
+            # read timeout absorbs the SMTP send WP does inline for customer notes
+            resp = requests.post(f"{_order_url(site, op)}/notes",
+                                 json={'note': note, 'customer_note': customer_note},
+                                 auth=_auth(site), timeout=(10, 90 if customer_note else 30),
+                                 headers=_API_HEADERS)
+        except requests.RequestException as e:
+            raise PushError(f"请求异常: {e}")
+        _check(resp)
+        try:
+            created = resp.json() or {}
+        except ValueError:
+            created = {}
+    if payload.get('local_note_id') and created.get('id'):
+        # link the local row to the WC note so the note sync updates it in place
+        try:
+            conn.execute('UPDATE order_notes SET wc_note_id = ? WHERE id = ?',
+                         (created['id'], payload['local_note_id']))
+            order_index.bump_versions(conn, [latest_note.NOTES_SCOPE])
+        except sqlite3.IntegrityError:
+            # the note sync already stored the WC copy — drop the local one
+            conn.execute('DELETE FROM order_notes WHERE id = ?', (payload['local_note_id'],))
+            latest_note.refresh_orders(conn, [op['order_id']])
+    return {'wc_note_id': created.get('id')}
+
+
+def _post_note_best_effort(site, op, note, customer_note, timeout, warnings, label):
+    try:
+        resp = requests.post(f"{_order_url(site, op)}/notes",
+                             json={'note': note, 'customer_note': customer_note},
+                             auth=_auth(site), timeout=timeout, headers=_API_HEADERS)
+        if resp.status_code not in (200, 201):
+            warnings.append(f"{label}失败 HTTP {resp.status_code}")
+    except requests.RequestException as e:
+        warnings.append(f"{label}异常: {e}")
+
+
+def _push_shipment_email(conn, site, op, payload):
+    """The customer notification after the tracking PUT (same steps as
+    app._notify_shipment): the site's trigger-shipment-email endpoint, the
+    customer-note fallback when the endpoint is missing or a reship notified
+    nobody, and the reship audit note."""
+    warnings = []
+    trigger = None
+    notified = False
+    if payload.get('send_email'):
+        try:
+            resp = requests.post(
+                f"{site['url']}/wp-json/woo-tracking/v1/orders/{woo_post_id(op['order_id'])}/trigger-shipment-email",
+                json={'tracking_number': payload['tracking_number'], 'carrier_slug': payload['carrier_slug']},
+                params={'consumer_key': site['consumer_key'], 'consumer_secret': site['consumer_secret']},
+                timeout=30, headers=_API_HEADERS)
+        except requests.exceptions.ConnectTimeout as e:
+            raise PushError(f"邮件触发连接失败: {e}")
+        except requests.exceptions.Timeout as e:
+            # the request reached WP — the email may be out; do not send twice
+            resp = None
+            warnings.append(f"邮件触发超时: {e}")
+        except requests.exceptions.ConnectionError as e:
+            raise PushError(f"邮件触发连接失败: {e}")
+        if resp is not None and resp.status_code == 200:
+            try:
+                trigger = resp.json() if resp.text else {}
+            except ValueError:
+                trigger = {}
+            if trigger.get('email_sent') is True:
+                notified = True
+            elif trigger.get('email_sent') is False and trigger.get('plugin') not in ('AST',):
+                warnings.append(f"邮件触发失败（{trigger.get('plugin', '?')}）: {trigger.get('note', '')}")
+        elif resp is not None and resp.status_code == 404:
+            warnings.append("邮件触发端点未找到（请确认 woo-orders-tracking-rest-api mu-plugin 已安装）")
+            _post_note_best_effort(site, op, payload['fallback_note'], True, 45, warnings, '回退客户备注')
+            notified = True
+        elif resp is not None:
+            warnings.append(f"邮件触发返回 {resp.status_code}")
+    if payload.get('is_reship') and payload.get('send_email') and not notified:
+        _post_note_best_effort(site, op, payload['fallback_note'], True, 45, warnings, '回退客户备注')
+    if payload.get('reship_note'):
+        _post_note_best_effort(site, op, payload['reship_note'], False, 10, warnings, '补发备注')
+    return {'trigger': trigger, 'customer_notified': notified, 'warnings': warnings}
+
+
+HANDLERS = {
+    'order_update': _push_order_update,
+    'order_note': _push_order_note,
+    'shipment_email': _push_shipment_email,
+}
+
+
+def _load_site(conn, source):
+    site = conn.execute('SELECT * FROM sites WHERE url = ?', (source,)).fetchone()
+    if not site:
+        raise PushError('站点配置不存在', retryable=False)
+    if not site['consumer_key'] or not site['consumer_secret'] or (
+            'api_write_status' in site.keys() and site['api_write_status'] == 'error'):
+        raise PushError('站点无API写权限', retryable=False)
+    return site
+
+
+def _run_op(connect, op):
+    conn = connect()
+    try:
+        try:
+            handler = HANDLERS.get(op['kind'])
+            if handler is None:
+                raise PushError(f"未知操作类型 {op['kind']}", retryable=False)
+            site = _load_site(conn, op['source'])
+            result = handler(conn, site, op, json.loads(op['payload']))
+        except PushError as e:
+            outcome = _finish(conn, op, error=e)
+        except Exception as e:
+            outcome = _finish(conn, op, error=PushError(f"异常: {e}"))
+        else:
+            outcome = _finish(conn, op, result)
+        conn.commit()
+        return outcome
+    finally:
+        conn.close()
+
+
+def drain(connect, max_ops=DRAIN_MAX_OPS, progress=None):
+    """Run due ops until none are left (or max_ops were started). connect()
+    must return a new sqlite3 connection with the Row factory; one is opened
+    per op so sites can run in parallel. Ops are claimed as threads free up,
+    never ahead of them. Returns {'done', 'retry', 'dead'} counts."""
+    summary = {'done': 0, 'retry': 0, 'dead': 0}
+    conn = connect()
+    try:
+        _housekeep(conn)
+        conn.commit()
+    finally:
+        conn.close()
+
+    started = 0
+    futures = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        while True:
+            free = min(MAX_WORKERS - len(futures), max_ops - started)
+            if free > 0:
+                conn = connect()
+                try:
+                    ops = _claim(conn, free)
+                    conn.commit()
+                finally:
+                    conn.close()
+                for op in ops:
+                    futures[ex.submit(_run_op, connect, op)] = op
+                started += len(ops)
+            if not futures:
+                break
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                op = futures.pop(future)
+                outcome = future.result()
+                summary[outcome] += 1
+                if progress and outcome != 'done':
+                    progress(f"[wc-outbox] #{op['id']} {op['kind']} {op['order_id']} @ {op['source']}: {outcome}")
+    return summary
+
+
+def ensure_outbox_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS wc_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idem_key TEXT NOT NULL,
+            source TEXT NOT NULL,
+            order_id TEXT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            local_status TEXT,
+            depends_on INTEGER,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 8,
+            next_attempt_at TEXT NOT NULL,
+            claimed_at TEXT,
+            last_error TEXT,
+            result TEXT,
+            actor TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            done_at TEXT
+        )
+    """)
+    conn.execute("""CREATE UNIQUE INDEX IF NOT EXISTS idx_wc_outbox_live_key ON wc_outbox(idem_key)
+                    WHERE status IN ('pending', 'running')""")
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_wc_outbox_status ON wc_outbox(status, next_attempt_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_wc_outbox_order ON wc_outbox(order_id, status)')
+    conn.commit()
+
+
+_schema_ready = False
+
+
+def ensure_schema(conn):
+    """Run ensure_outbox_table once per process (and latest_note's, whose
+    pointers the note handler keeps)."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    ensure_outbox_table(conn)
+    latest_note.ensure_schema(conn)
+    _schema_ready = True